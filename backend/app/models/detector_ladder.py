@@ -0,0 +1,370 @@
+"""DetectorLadder: which Roboflow model serves the next sketch detection.
+
+There used to be exactly one detector (ROBOFLOW_MODEL_ID). A cold start of
+the Small model takes 30-60s, and credit exhaustion or a revoked key only
+showed up as a None result, so every later request paid for another failing
+call before falling back to the local contour detector.
+
+ROBOFLOW_MODELS="object-detection-4affw/4@8,object-detection-4affw/2@5" lists
+the rungs best first, each with an optional latency budget in seconds
+(ROBOFLOW_LATENCY_BUDGET_S when omitted), and optional per-class confidence
+thresholds after colons ("object-detection-4affw/2@5:card=0.03"): models
+are calibrated differently, so a fallback rung may need its own floors (see
+inference._resolve_class_threshold). Unset, the ladder is the single
+ROBOFLOW_MODEL_ID. The contour detector in main.py is the implicit last rung:
+when no Roboflow rung answers, detection returns None as before.
+
+Per model the ladder keeps:
+
+    breaker   closed → open on a credit/auth error (at once) or after
+              _TRANSIENT_TRIP timeouts / server errors in a row; an open
+              model is not called at all. Once its cooldown expires one
+              probe is let through (half-open): success closes the breaker,
+              failure re-opens it for twice as long (capped).
+    latency   LatencyStats over successful and timed-out calls (EWMA +
+              p50/p95).
+    warmth    Roboflow unloads idle models, and the next call pays the
+              model load. How long a model may sit idle is learned per
+              model (``unload_after_s``, first guess _COLD_AFTER_S): every
+              success after an idle gap is classed warm or cold by its
+              latency (cold: _COLD_FACTOR × the warm p50, at least
+              _COLD_MIN_S). A cold answer after a shorter gap than the
+              estimate lowers it to that gap; a warm one after a longer gap
+              raises it; and every _EXPLORE_AFTER warm answers close to the
+              estimate stretch it by _EXPLORE_STEP, so keep-warm pings
+              (app.models.keep_warm) drift later until one comes back cold.
+              A model idle for longer than its estimate is cold.
+
+``plan(rungs)`` returns the rungs to try, in order, each flagged with
+whether a healthy rung follows it; the caller gives a rung with a fallback
+one attempt bounded by its budget before moving on, and the last hope its
+full deadline and retries. A rung that is cold, or
+whose EWMA is over its budget, is passed over when a later rung is healthy
+(warm, closed, within budget), so the request does not sit through a cold
+start the next rung would not. A cold rung that is passed over is handed out
+by ``take_warmups()`` so the caller can warm it in the background; a slow
+one is let through again after _PROBE_S so its estimate cannot go stale
+forever. When no later rung is healthy the rung is tried anyway — a slow
+answer beats the contour fallback.
+
+State is per worker and process-local.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from app.utils.latency import LatencyStats
+
+_DEFAULT_LATENCY_BUDGET_S = 10.0
+_COLD_AFTER_S = 900.0
+_UNLOAD_MIN_S = 60.0
+_UNLOAD_MAX_S = 3600.0
+_COLD_FACTOR = 3.0
+_COLD_MIN_S = 8.0
+_EXPLORE_AFTER = 8
+_EXPLORE_NEAR = 0.75  # a warm gap this close to the estimate counts as exploring
+_EXPLORE_STEP = 1.1
+_PROBE_S = 300.0
+_MIN_SAMPLES = 3
+# A half-open probe whose outcome never came back (its caller was cancelled)
+# stops blocking other probes after this long.
+_PROBE_STALE_S = 120.0
+
+# Breaker: consecutive transient failures that open it, and how long it stays
+# open per kind; every re-trip doubles the cooldown up to _MAX_OPEN_S.
+_TRANSIENT_TRIP = 3
+_TRANSIENT_OPEN_S = 60.0
+_AUTH_OPEN_S = 600.0
+_MAX_OPEN_S = 3600.0
+
+FAILURE_KINDS = ("credit", "auth", "timeout", "error")
+
+
+@dataclass(frozen=True)
+class DetectorRung:
+    model_id: str
+    budget_s: float
+    # (class, threshold) pairs from the ROBOFLOW_MODELS entry, sorted by class.
+    class_thresholds: Tuple[Tuple[str, float], ...] = ()
+
+
+def parse_detector_ladder(raw: str, default_budget_s: float) -> List[DetectorRung]:
+    """"proj/4@8,proj/2:card=0.03" → [DetectorRung("proj/4", 8.0),
+    DetectorRung("proj/2", default, (("card", 0.03),))].
+
+    Malformed budgets and thresholds are ignored with a log line (the budget
+    falls back to the default); duplicate models keep their first position.
+    """
+    rungs: List[DetectorRung] = []
+    seen: Set[str] = set()
+    for entry in raw.split(","):
+        head, *threshold_parts = entry.strip().split(":")
+        model_id, _, budget_raw = head.partition("@")
+        model_id = model_id.strip()
+        if not model_id or model_id in seen:
+            continue
+        budget = default_budget_s
+        if budget_raw.strip():
+            try:
+                budget = float(budget_raw)
+            except ValueError:
+                print(f"[roboflow] ignoring malformed budget in ROBOFLOW_MODELS entry {entry.strip()!r}")
+        thresholds: Dict[str, float] = {}
+        for part in threshold_parts:
+            cls, _, value = part.partition("=")
+            try:
+                if not cls.strip():
+                    raise ValueError(part)
+                thresholds[cls.strip().lower()] = float(value)
+            except ValueError:
+                print(f"[roboflow] ignoring malformed threshold {part.strip()!r} for {model_id}")
+        seen.add(model_id)
+        rungs.append(DetectorRung(model_id, budget, tuple(sorted(thresholds.items()))))
+    return rungs
+
+
+def detector_ladder_from_env(default_model_id: str) -> List[DetectorRung]:
+    """ROBOFLOW_MODELS, else the single ROBOFLOW_MODEL_ID (or ``default_model_id``)."""
+    try:
+        budget = float(os.getenv("ROBOFLOW_LATENCY_BUDGET_S", _DEFAULT_LATENCY_BUDGET_S))
+    except ValueError:
+        budget = _DEFAULT_LATENCY_BUDGET_S
+    raw = os.getenv("ROBOFLOW_MODELS", "").strip()
+    rungs = parse_detector_ladder(raw, budget) if raw else []
+    return rungs or [DetectorRung(os.getenv("ROBOFLOW_MODEL_ID", default_model_id), budget)]
+
+
+class DetectorAttempt(NamedTuple):
+    rung: DetectorRung
+    fallback: bool  # a healthy rung comes after this one
+
+
+@dataclass
+class _ModelHealth:
+    latency: LatencyStats = field(default_factory=LatencyStats)
+    last_success: float = 0.0
+    last_attempt: float = 0.0
+    consecutive_failures: int = 0
+    open_until: float = 0.0
+    open_reason: Optional[str] = None
+    trips: int = 0
+    probing_since: float = 0.0  # half-open probe handed out, outcome pending
+    warming: bool = False  # background warm-up handed out, outcome pending
+    unload_after_s: float = _COLD_AFTER_S
+    warm_streak: int = 0  # warm answers after a gap near unload_after_s
+    failures: Dict[str, int] = field(default_factory=dict)
+
+
+class DetectorLadder:
+    """Thread-safe per-model health and rung selection."""
+
+    def __init__(self, *, clock: Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._health: Dict[str, _ModelHealth] = {}
+        self._warmups: List[str] = []
+
+    def _get(self, model_id: str) -> _ModelHealth:
+        health = self._health.get(model_id)
+        if health is None:
+            health = self._health[model_id] = _ModelHealth()
+        return health
+
+    def _breaker(self, health: _ModelHealth, now: float) -> str:
+        if health.open_reason is None:
+            return "closed"
+        probing = health.probing_since and now - health.probing_since < _PROBE_STALE_S
+        return "open" if now < health.open_until or probing else "half-open"
+
+    def _cold(self, health: _ModelHealth, now: float) -> bool:
+        return now - health.last_success >= health.unload_after_s or not health.last_success
+
+    def _slow(self, health: _ModelHealth, rung: DetectorRung) -> bool:
+        return (
+            health.latency.count >= _MIN_SAMPLES
+            and health.latency.ewma is not None
+            and health.latency.ewma > rung.budget_s
+        )
+
+    def _healthy(self, rung: DetectorRung, now: float) -> bool:
+        health = self._get(rung.model_id)
+        return (
+            self._breaker(health, now) == "closed"
+            and not self._cold(health, now)
+            and not self._slow(health, rung)
+        )
+
+    def plan(self, rungs: Sequence[DetectorRung]) -> List[DetectorAttempt]:
+        """Rungs to try for one detection, best first (may be empty)."""
+        now = self._clock()
+        chosen: List[DetectorAttempt] = []
+        with self._lock:
+            for i, rung in enumerate(rungs):
+                health = self._get(rung.model_id)
+                state = self._breaker(health, now)
+                if state == "open":
+                    continue
+                fallback = any(self._healthy(later, now) for later in rungs[i + 1:])
+                if state == "half-open":
+                    health.probing_since = now
+                    print(f"[roboflow] {rung.model_id}: breaker half-open, probing")
+                    chosen.append(DetectorAttempt(rung, fallback))
+                    continue
+                if fallback and self._cold(health, now):
+                    if not health.warming:
+                        health.warming = True
+                        self._warmups.append(rung.model_id)
+                    print(f"[roboflow] {rung.model_id}: cold, skipping to a warm rung")
+                    continue
+                if (
+                    fallback
+                    and self._slow(health, rung)
+                    and now - health.last_attempt < _PROBE_S
+                ):
+                    print(
+                        f"[roboflow] {rung.model_id}: ~{health.latency.ewma:.1f}s is over "
+                        f"its {rung.budget_s:g}s budget, skipping"
+                    )
+                    continue
+                chosen.append(DetectorAttempt(rung, fallback))
+        return chosen
+
+    def take_warmups(self) -> List[str]:
+        """Cold models ``plan`` passed over since the last call, to warm now.
+
+        Each is handed out once until its warm-up reports back through
+        ``record_success``/``record_failure``/``warmup_done``.
+        """
+        with self._lock:
+            taken, self._warmups = self._warmups, []
+        return taken
+
+    def warmup_done(self, model_id: str) -> None:
+        with self._lock:
+            self._get(model_id).warming = False
+
+    def _learn_unload_gap(
+        self, model_id: str, health: _ModelHealth, gap: float, seconds: float
+    ) -> bool:
+        """Fold one (idle gap, latency) observation into the unload estimate;
+        True when the answer was a cold start."""
+        warm_p50 = health.latency.quantile(0.5) if health.latency.count >= _MIN_SAMPLES else None
+        cold = seconds >= max(_COLD_MIN_S, _COLD_FACTOR * warm_p50 if warm_p50 else 0.0)
+        estimate = health.unload_after_s
+        if cold:
+            health.warm_streak = 0
+            if gap < estimate:
+                estimate = max(_UNLOAD_MIN_S, gap)
+        elif gap > estimate:
+            estimate = min(_UNLOAD_MAX_S, gap)
+        elif gap >= _EXPLORE_NEAR * estimate:
+            health.warm_streak += 1
+            if health.warm_streak >= _EXPLORE_AFTER:
+                health.warm_streak = 0
+                estimate = min(_UNLOAD_MAX_S, estimate * _EXPLORE_STEP)
+        if estimate != health.unload_after_s:
+            print(
+                f"[roboflow] {model_id}: {'cold' if cold else 'warm'} after {gap:.0f}s idle, "
+                f"unload estimate {health.unload_after_s:.0f}s → {estimate:.0f}s"
+            )
+            health.unload_after_s = estimate
+        return cold
+
+    def record_success(
+        self, model_id: str, seconds: Optional[float] = None, *, track_latency: bool = True
+    ) -> Optional[bool]:
+        """One successful call taking ``seconds``. Returns whether it was a
+        cold start (None when there is no idle gap or duration to judge by).
+        ``track_latency=False`` keeps the duration out of the latency stats
+        (warm-up pings: a cold start is not what a detection will see)."""
+        now = self._clock()
+        cold = None
+        with self._lock:
+            health = self._get(model_id)
+            if seconds is not None:
+                # Below _UNLOAD_MIN_S a slow answer is just slow, not a reload.
+                if health.last_success and now - health.last_success >= _UNLOAD_MIN_S:
+                    cold = self._learn_unload_gap(
+                        model_id, health, now - health.last_success, seconds
+                    )
+                if track_latency:
+                    health.latency.add(seconds)
+            if health.open_reason is not None:
+                print(f"[roboflow] {model_id}: breaker closed")
+            health.last_success = health.last_attempt = now
+            health.consecutive_failures = 0
+            health.open_reason = None
+            health.open_until = 0.0
+            health.trips = 0
+            health.probing_since = 0.0
+            health.warming = False
+        return cold
+
+    def idle(self, model_id: str) -> Tuple[Optional[float], float]:
+        """(seconds since the last success or None if never, unload estimate)."""
+        now = self._clock()
+        with self._lock:
+            health = self._get(model_id)
+            idle_s = now - health.last_success if health.last_success else None
+            return idle_s, health.unload_after_s
+
+    def record_failure(
+        self, model_id: str, kind: str, seconds: Optional[float] = None
+    ) -> None:
+        """One failed call; ``kind`` is one of FAILURE_KINDS. Pass ``seconds``
+        for a timeout — how long it was waited for is a latency lower bound."""
+        now = self._clock()
+        with self._lock:
+            health = self._get(model_id)
+            if seconds is not None:
+                health.latency.add(seconds)
+            health.last_attempt = now
+            health.failures[kind] = health.failures.get(kind, 0) + 1
+            health.consecutive_failures += 1
+            health.warming = False
+            if kind in ("credit", "auth"):
+                base = _AUTH_OPEN_S
+            elif health.probing_since or health.consecutive_failures >= _TRANSIENT_TRIP:
+                base = _TRANSIENT_OPEN_S
+            else:
+                return
+            health.trips += 1
+            open_s = min(base * 2 ** (health.trips - 1), _MAX_OPEN_S)
+            health.open_until = now + open_s
+            health.open_reason = kind
+            health.probing_since = 0.0
+            print(f"[roboflow] {model_id}: breaker open for {open_s:.0f}s ({kind})")
+
+    def is_open(self, model_id: str) -> bool:
+        with self._lock:
+            return self._breaker(self._get(model_id), self._clock()) == "open"
+
+    def snapshot(self, rungs: Sequence[DetectorRung]) -> List[dict]:
+        """Per rung: breaker state, warmth and latency, for /api/metrics."""
+        now = self._clock()
+        with self._lock:
+            out = []
+            for rung in rungs:
+                health = self._get(rung.model_id)
+                state = self._breaker(health, now)
+                out.append(
+                    {
+                        "model_id": rung.model_id,
+                        "budget_s": rung.budget_s,
+                        "breaker": state,
+                        "open_reason": health.open_reason,
+                        "reopens_in_s": (
+                            max(0, int(health.open_until - now)) if state == "open" else 0
+                        ),
+                        "cold": self._cold(health, now),
+                        "unload_after_s": round(health.unload_after_s),
+                        "failures": dict(health.failures),
+                        "latency": health.latency.summary(),
+                    }
+                )
+            return out
@@ -0,0 +1,82 @@
+"""Long-lived Gemini clients, one per API key.
+
+``genai.configure(api_key=...)`` swaps process-global client state: with two
+requests on different keys in flight, one could go out under the other's key.
+And rebuilding the client on every attempt threw away its connection each
+time. GeminiClients instead keeps one GenerativeServiceAsyncClient per key
+and hands out GenerativeModel objects bound to it, so nothing global is ever
+configured and each key reuses its own gRPC channel.
+
+Async gRPC channels belong to the event loop they were created on, so a
+client is rebuilt when it is requested from a different loop (only happens
+for sync callers that spin up a loop per call; the server has one loop).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+
+class GeminiClients:
+    """Per-key async Gemini clients, created on first use."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Tuple[asyncio.AbstractEventLoop, Any]] = {}
+
+    def _make_client(self, api_key: str) -> Any:
+        from google.ai import generativelanguage as glm
+
+        return glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+
+    def client(self, api_key: str) -> Any:
+        """The client for ``api_key`` on the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._clients.get(api_key)
+            if entry is not None and entry[0] is loop:
+                return entry[1]
+        created = self._make_client(api_key)
+        with self._lock:
+            entry = self._clients.get(api_key)
+            if entry is not None and entry[0] is loop:
+                return entry[1]  # another task won the race; use its client
+            self._clients[api_key] = (loop, created)
+        return created
+
+    def model(
+        self,
+        api_key: str,
+        model_name: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        """A GenerativeModel that calls out through ``api_key``'s client.
+
+        Only ``generate_content_async`` is usable on it — the sync client is
+        never configured.
+        """
+        import google.generativeai as genai
+
+        model = genai.GenerativeModel(model_name, generation_config=generation_config)
+        # GenerativeModel only falls back to the global default client when
+        # this is unset; pinning it is what keeps keys from crossing.
+        model._async_client = self.client(api_key)
+        return model
+
+    async def close_loop_clients(self) -> None:
+        """Close clients bound to the running loop (before that loop ends)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            doomed = [k for k, (owner, _) in self._clients.items() if owner is loop]
+            closing = [self._clients.pop(k)[1] for k in doomed]
+        for client in closing:
+            try:
+                await client.transport.close()
+            except Exception as exc:
+                print(f"[gemini] client close failed: {exc!r}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
@@ -0,0 +1,754 @@
+"""GeminiKeyPool: which (key, model) slot serves the next Gemini attempt.
+
+The old loop re-scanned os.environ on every call and walked keys in fixed
+order from key 1, so key 1 took all the traffic until it 429'd and every
+request then paid a ~2s probe on it before moving on. The pool is built once
+(lazily — main.py loads .env after importing this) and re-read with
+``reload()``.
+
+Per model (a "tier" of the ladder) every key has one slot, kept in one of two
+heaps:
+
+    ready    usable now, ordered by last use — the least recently used key
+             comes out first, so consecutive requests round-robin the keys
+    cooling  in a 429 cooldown, ordered by expiry — migrated back to ready
+             as soon as the expiry passes
+
+``acquire(models)`` walks the tiers in ladder order and leases the least
+recently used ready slot of the first tier that has one: O(log n) per pick.
+Slots are updated by pushing a fresh heap entry and bumping the slot's
+version; outdated entries are dropped when they surface (lazy deletion).
+Models are not fixed up front — a tier's heaps are created on first use, so
+a forced model or a reloaded ladder needs no rebuild.
+
+Budgets (optional, GEMINI_MODEL_BUDGETS="model=RPM/RPD,..."): each lease is
+counted against its slot's per-minute window and per-day total. The lease
+that uses up a budget parks the slot in the cooling heap until the window
+slides / the quota day rolls over, so the next request goes elsewhere
+instead of paying for a 429 to find out. Google resets RPD at midnight
+Pacific, so that is where the quota day ends.
+
+Shared state (optional, ``use_store(SQLitePoolStore(path))``): with several
+uvicorn workers each process used to learn about a 429 on its own, so every
+worker paid for the same exhausted slot, and /api/llm-status only showed the
+worker that happened to answer. With a store, each slot's cooldown expiry,
+last use, budget counters and daily success count live in one SQLite row;
+every change is a ``BEGIN IMMEDIATE`` read-modify-write of that row, so two
+workers cannot both lease the last request of a budget. The heaps stay
+per-process as an index over a local mirror of the rows: ``acquire`` first
+pulls the rows other workers changed since its last look (one indexed
+SELECT), then re-checks the chosen slot inside its lease transaction. Keys
+are stored by fingerprint (sha256 prefix), never by value. If the store
+errors the pool carries on with its local view — scheduling degrades to
+per-worker, it never blocks a request. The pool's lock is never held across
+store I/O, and with a store ``acquire``/``cool``/``record_success`` are
+blocking calls (inference runs them off the event loop).
+
+Without a store all state is process-local.
+
+Latency: every successful (or timed-out) call's duration is fed to a
+per-slot LatencyStats (EWMA + streaming p50/p95), reported in the snapshot.
+With GEMINI_ROUTING=latency, ``acquire`` leases a different ready key of the
+same tier when the least recently used one is known to be much slower
+(EWMA at least _LATENCY_ADVANTAGE times the fastest), so a key that has gone
+slow stops being picked first. Tier order is never changed for speed — a
+faster fallback model is still a worse model. A slot passed over this way is
+let through again after _LATENCY_PROBE_S, so its estimate cannot go stale
+forever. Latency is measured per worker and is not put in the shared store.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+try:
+    from zoneinfo import ZoneInfo
+
+    _QUOTA_TZ = ZoneInfo("America/Los_Angeles")
+except Exception:  # no tz database: fall back to UTC days
+    from datetime import timezone
+
+    _QUOTA_TZ = timezone.utc
+
+from app.utils.latency import LatencyStats
+
+_KEY_RE = re.compile(r"^GEMINI_API_KEY(_(\d+))?$")
+
+# Rows are pulled by updated_at with this much look-back, so a write whose
+# transaction started before our last sync but committed after it (up to the
+# store's busy timeout) is still seen.
+_SYNC_SLACK_S = 5.0
+
+# Latency routing: switch to another key only when the LRU one's EWMA is at
+# least this many times the faster key's, both with enough samples to trust;
+# a passed-over key is tried again once it has sat idle for the probe interval.
+_LATENCY_ADVANTAGE = 2.0
+_LATENCY_MIN_SAMPLES = 3
+_LATENCY_PROBE_S = 300.0
+
+Slot = Tuple[int, str]  # (key_index, model_name)
+Budget = Tuple[Optional[int], Optional[int]]  # (requests/minute, requests/day); None = unlimited
+
+
+def gemini_keys_from_env() -> List[Tuple[str, str]]:
+    """[(env_var_name, key)] for every GEMINI_API_KEY[_N], base key first."""
+    found = sorted(
+        ((int(m.group(2)) if m.group(2) else 0), name, value.strip())
+        for name, value in os.environ.items()
+        if (m := _KEY_RE.match(name)) and value.strip()
+    )
+    return [(name, value) for _, name, value in found]
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Stable, non-reversible id for a key in shared state."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_model_budgets(raw: str) -> Dict[str, Budget]:
+    """"gemini-2.5-flash=10/250,gemini-3.5-flash=5/" → {model: (rpm, rpd)}.
+
+    Either side may be empty or 0 for "no limit". Malformed entries are
+    skipped with a log line rather than failing startup.
+    """
+    budgets: Dict[str, Budget] = {}
+    for entry in raw.split(","):
+        if not entry.strip():
+            continue
+        model, _, limits = entry.partition("=")
+        rpm_raw, _, rpd_raw = limits.partition("/")
+        try:
+            rpm = int(rpm_raw) if rpm_raw.strip() else 0
+            rpd = int(rpd_raw) if rpd_raw.strip() else 0
+        except ValueError:
+            print(f"[gemini] ignoring malformed GEMINI_MODEL_BUDGETS entry {entry.strip()!r}")
+            continue
+        if model.strip() and (rpm > 0 or rpd > 0):
+            budgets[model.strip()] = (rpm if rpm > 0 else None, rpd if rpd > 0 else None)
+    return budgets
+
+
+def budgets_from_env() -> Dict[str, Budget]:
+    return parse_model_budgets(os.getenv("GEMINI_MODEL_BUDGETS", ""))
+
+
+def routing_from_env() -> str:
+    """GEMINI_ROUTING: "lru" (default, round-robin) or "latency"."""
+    routing = os.getenv("GEMINI_ROUTING", "lru").strip().lower()
+    if routing not in ("lru", "latency"):
+        print(f"[gemini] unknown GEMINI_ROUTING={routing!r}; using lru")
+        return "lru"
+    return routing
+
+
+def quota_day(ts: float) -> Tuple[str, float]:
+    """(quota day label, unix ts it ends) for ``ts``, on Google's reset clock."""
+    local = datetime.fromtimestamp(ts, _QUOTA_TZ)
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Aware-datetime arithmetic is wall-clock, so this is the next local
+    # midnight even across a DST change; .timestamp() applies its offset.
+    return local.strftime("%Y-%m-%d"), (midnight + timedelta(days=1)).timestamp()
+
+
+_ROW_FIELDS = (
+    "ready_at",
+    "last_used",
+    "day",
+    "day_count",
+    "success_count",
+    "last_success",
+    "minute",
+    "rev",
+    "updated_at",
+)
+
+
+@dataclass
+class _SlotState:
+    ready_at: float = 0.0   # unix ts the cooldown ends (0 = never cooled)
+    last_used: float = 0.0  # unix ts of the last lease
+    day: str = ""           # quota day the two counts below belong to
+    day_count: int = 0      # leases in that quota day
+    success_count: int = 0  # successful calls in that quota day
+    last_success: float = 0.0
+    minute: Deque[float] = field(default_factory=deque)  # lease ts within the last 60s
+    rev: int = 0            # store revision this state reflects
+    updated_at: float = 0.0
+    version: int = 0        # heap entry version (local only)
+
+    def roll(self, now: float) -> float:
+        """Drop leases older than a minute and reset the counts at a new
+        quota day. Returns the unix ts the current quota day ends."""
+        while self.minute and self.minute[0] <= now - 60:
+            self.minute.popleft()
+        day, day_ends = quota_day(now)
+        if self.day != day:
+            self.day, self.day_count, self.success_count = day, 0, 0
+        return day_ends
+
+    def to_row(self) -> Dict[str, Any]:
+        row = {name: getattr(self, name) for name in _ROW_FIELDS}
+        row["minute"] = json.dumps(list(self.minute))
+        return row
+
+    def load_row(self, row: Any) -> None:
+        for name in _ROW_FIELDS:
+            value = row[name]
+            setattr(self, name, deque(json.loads(value)) if name == "minute" else value)
+
+    def copy(self) -> "_SlotState":
+        clone = _SlotState(version=self.version)
+        clone.load_row(self.to_row())
+        return clone
+
+
+class SQLitePoolStore:
+    """One row per (key fingerprint, model) in a WAL-mode SQLite file.
+
+    Same connection handling as the shared GCRA limiter: a connection per
+    thread, autocommit mode, explicit ``BEGIN IMMEDIATE`` for writes, and a
+    busy timeout so contending workers wait briefly instead of failing.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS gemini_slots ("
+            " key_fp TEXT NOT NULL, model TEXT NOT NULL,"
+            " ready_at REAL NOT NULL, last_used REAL NOT NULL,"
+            " day TEXT NOT NULL, day_count INTEGER NOT NULL,"
+            " success_count INTEGER NOT NULL, last_success REAL NOT NULL,"
+            " minute TEXT NOT NULL, rev INTEGER NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (key_fp, model))"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS gemini_slots_updated ON gemini_slots (updated_at)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def transact(
+        self,
+        key_fp: str,
+        model: str,
+        change: Callable[[Optional[sqlite3.Row]], Dict[str, Any]],
+    ) -> None:
+        """Atomically replace the (key_fp, model) row with ``change(row)``;
+        ``row`` is None when the slot has never been written."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM gemini_slots WHERE key_fp = ? AND model = ?", (key_fp, model)
+            ).fetchone()
+            values = change(row)
+            conn.execute(
+                f"INSERT OR REPLACE INTO gemini_slots (key_fp, model, {', '.join(_ROW_FIELDS)})"
+                f" VALUES (?, ?, {', '.join('?' for _ in _ROW_FIELDS)})",
+                (key_fp, model, *(values[name] for name in _ROW_FIELDS)),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def changed_since(self, ts: float) -> List[sqlite3.Row]:
+        return self._connect().execute(
+            "SELECT * FROM gemini_slots WHERE updated_at >= ?", (ts,)
+        ).fetchall()
+
+
+class GeminiKeyPool:
+    """Thread-safe scheduler over (key, model) slots."""
+
+    def __init__(
+        self,
+        loader: Callable[[], List[Tuple[str, str]]] = gemini_keys_from_env,
+        *,
+        budgets: Callable[[], Dict[str, Budget]] = budgets_from_env,
+        routing: Callable[[], str] = routing_from_env,
+        clock: Callable[[], float] = time.time,
+        store: Optional[SQLitePoolStore] = None,
+    ) -> None:
+        self._loader = loader
+        self._budget_loader = budgets
+        self._budgets: Dict[str, Budget] = {}
+        self._routing_loader = routing
+        self.routing = "lru"
+        self._clock = clock
+        self._store = store
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._keys: List[Tuple[str, str]] = []
+        self._fps: Dict[str, int] = {}  # key fingerprint → key_index
+        self._slots: Dict[Slot, _SlotState] = {}
+        self._ready: Dict[str, List[Tuple[float, int, int]]] = {}    # (last_used, key, ver)
+        self._cooling: Dict[str, List[Tuple[float, int, int]]] = {}  # (ready_at, key, ver)
+        self._latency: Dict[Slot, LatencyStats] = {}
+        self._model_latency: Dict[str, LatencyStats] = {}  # all keys, for hedging
+
+    def use_store(self, store: Optional[SQLitePoolStore]) -> None:
+        """Share slot state through ``store`` from now on (None: go local)."""
+        with self._lock:
+            self._store = store
+            self._synced_at = 0.0
+
+    @property
+    def shared(self) -> bool:
+        return self._store is not None
+
+    # ── Key set ──────────────────────────────────────────────────────────────
+
+    def reload(self) -> None:
+        """Re-read the key list, budgets and routing mode. Cooldowns, usage and
+        latency follow a key across a reload when its value is unchanged, even
+        if its slot number moved."""
+        keys, budgets, routing = self._loader(), self._budget_loader(), self._routing_loader()
+        with self._lock:
+            self._reset(keys, budgets, routing)
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            keys, budgets, routing = self._loader(), self._budget_loader(), self._routing_loader()
+            with self._lock:
+                if not self._loaded:
+                    self._reset(keys, budgets, routing)
+
+    def _reset(
+        self, keys: List[Tuple[str, str]], budgets: Dict[str, Budget], routing: str
+    ) -> None:
+        self._budgets = dict(budgets)
+        self.routing = routing
+        old_index = {value: i for i, (_, value) in enumerate(self._keys)}
+        remap = {old_index[value]: i for i, (_, value) in enumerate(keys) if value in old_index}
+        self._slots = {
+            (remap[k], model): state
+            for (k, model), state in self._slots.items()
+            if k in remap
+        }
+        self._latency = {
+            (remap[k], model): stats
+            for (k, model), stats in self._latency.items()
+            if k in remap
+        }
+        self._keys = list(keys)
+        self._fps = {key_fingerprint(value): i for i, (_, value) in enumerate(self._keys)}
+        self._synced_at = 0.0  # new keys may already have shared rows
+        self._ready = {}
+        self._cooling = {}
+        for model in {model for _, model in self._slots}:
+            self._build_tier(model)
+        self._loaded = True
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._keys)
+
+    def key(self, key_index: int) -> str:
+        self._ensure_loaded()
+        return self._keys[key_index][1]
+
+    def index_of(self, api_key: str) -> Optional[int]:
+        self._ensure_loaded()
+        return next((i for i, (_, value) in enumerate(self._keys) if value == api_key), None)
+
+    # ── Heaps ────────────────────────────────────────────────────────────────
+
+    def _build_tier(self, model: str) -> None:
+        self._ready[model] = []
+        self._cooling[model] = []
+        now = self._clock()
+        for key_index in range(len(self._keys)):
+            self._slots.setdefault((key_index, model), _SlotState())
+            self._requeue(key_index, model, now)
+
+    def _tier(self, model: str) -> None:
+        if model not in self._ready:
+            self._build_tier(model)
+
+    def _requeue(self, key_index: int, model: str, now: float) -> None:
+        """Push a fresh heap entry for the slot's current state."""
+        state = self._slots[(key_index, model)]
+        state.version += 1
+        if state.ready_at > now:
+            heapq.heappush(self._cooling[model], (state.ready_at, key_index, state.version))
+        else:
+            heapq.heappush(self._ready[model], (state.last_used, key_index, state.version))
+
+    def _budget_block(self, state: _SlotState, model: str, now: float) -> Optional[float]:
+        """Unix ts until which the slot's budget is spent, or None if it has room."""
+        rpm, rpd = self._budgets.get(model, (None, None))
+        day_ends = state.roll(now)
+        if rpd is not None and state.day_count >= rpd:
+            return day_ends
+        if rpm is not None and len(state.minute) >= rpm:
+            return state.minute[0] + 60
+        return None
+
+    def _promote_expired(self, model: str, now: float) -> None:
+        cooling = self._cooling[model]
+        while cooling and cooling[0][0] <= now:
+            _, key_index, version = heapq.heappop(cooling)
+            if self._slots[(key_index, model)].version == version:
+                self._requeue(key_index, model, now)
+
+    # ── Shared state ─────────────────────────────────────────────────────────
+
+    def _mutate(self, key_index: int, model: str, change: Callable[[_SlotState], Any]) -> Any:
+        """Apply ``change`` to the slot's state — through the store when there
+        is one, so it sees (and wins against) every other worker's writes —
+        then requeue the slot. Called without the lock: the store transaction
+        (which may wait on another worker's write lock) runs outside it, and
+        only its result is applied under it."""
+        with self._lock:
+            now = self._clock()
+            state = self._slots.setdefault((key_index, model), _SlotState())
+            store = self._store
+            if store is None:
+                result = change(state)
+                state.updated_at = now
+                self._tier(model)
+                self._requeue(key_index, model, now)
+                return result
+            base = state.copy()
+            key_fp = key_fingerprint(self._keys[key_index][1])
+
+        outcome: Dict[str, Any] = {}
+
+        def _apply(row: Optional[sqlite3.Row]) -> Dict[str, Any]:
+            fresh = base.copy()
+            if row is not None:
+                fresh.load_row(row)
+            outcome["result"] = change(fresh)
+            fresh.rev += 1
+            fresh.updated_at = now
+            outcome["state"] = fresh
+            return fresh.to_row()
+
+        try:
+            store.transact(key_fp, model, _apply)
+        except sqlite3.Error as error:
+            print(f"[gemini] shared pool store error, using local state: {error}")
+            outcome.clear()
+        with self._lock:
+            if self._fps.get(key_fp) != key_index:
+                return outcome.get("result")  # a reload moved the key meanwhile
+            state = self._slots.setdefault((key_index, model), _SlotState())
+            if "state" not in outcome:
+                result = change(state)
+                state.updated_at = now
+            else:
+                result = outcome["result"]
+                if outcome["state"].rev > state.rev:  # a sync may have got here first
+                    state.load_row(outcome["state"].to_row())
+            self._tier(model)
+            self._requeue(key_index, model, now)
+        return result
+
+    def _sync(self, now: float) -> None:
+        """Pull the rows other workers changed since the last sync. Called
+        without the lock; the SELECT runs outside it."""
+        with self._lock:
+            store = self._store
+            since = self._synced_at - _SYNC_SLACK_S
+        if store is None:
+            return
+        try:
+            rows = store.changed_since(since)
+        except sqlite3.Error as error:
+            print(f"[gemini] shared pool store error, using local state: {error}")
+            return
+        with self._lock:
+            self._synced_at = now
+            for row in rows:
+                key_index = self._fps.get(row["key_fp"])
+                if key_index is None:
+                    continue  # a key this worker does not have configured
+                model = row["model"]
+                state = self._slots.setdefault((key_index, model), _SlotState())
+                if row["rev"] <= state.rev:
+                    continue
+                state.load_row(row)
+                if model in self._ready:
+                    self._requeue(key_index, model, now)
+
+    # ── Scheduling ───────────────────────────────────────────────────────────
+
+    def acquire(
+        self, models: Sequence[str], exclude: Iterable[Slot] = ()
+    ) -> Optional[Tuple[int, str, str]]:
+        """Lease the best usable slot: first tier in ``models`` order that has
+        one, least recently used key within it. Returns (key_index, model,
+        api_key), or None when every slot is cooling or excluded.
+
+        With a store this does SQLite I/O (the sync and the lease
+        transaction); async callers run it off the event loop."""
+        self._ensure_loaded()
+        skip: Set[Slot] = set(exclude)
+        self._sync(self._clock())
+        for model in models:
+            while True:
+                now = self._clock()
+                with self._lock:
+                    key_index = self._pick(model, skip, now)
+                if key_index is None:
+                    break
+                # False: another worker cooled it or spent its budget (or a
+                # reload lowered the budget); it has been requeued.
+                if self._lease(key_index, model, now):
+                    return key_index, model, self._keys[key_index][1]
+        return None
+
+    def _pick(self, model: str, skip: Set[Slot], now: float) -> Optional[int]:
+        """Take the tier's next candidate off its ready heap (the lease
+        requeues it). Caller holds the lock."""
+        self._tier(model)
+        self._promote_expired(model, now)
+        ready = self._ready[model]
+        passed_over = []
+        chosen: Optional[int] = None
+        while ready:
+            entry = heapq.heappop(ready)
+            _, key_index, version = entry
+            if self._slots[(key_index, model)].version != version:
+                continue
+            if (key_index, model) in skip:
+                passed_over.append(entry)
+                continue
+            chosen = key_index
+            if self.routing == "latency":
+                faster = self._faster_slot(key_index, model, skip, now)
+                if faster is not None:
+                    heapq.heappush(ready, entry)  # still ready, just slow
+                    chosen = faster
+            break
+        for entry in passed_over:
+            heapq.heappush(ready, entry)
+        return chosen
+
+    def _estimate(self, key_index: int, model: str) -> Optional[float]:
+        stats = self._latency.get((key_index, model))
+        if stats is None or stats.count < _LATENCY_MIN_SAMPLES:
+            return None
+        return stats.ewma
+
+    def _faster_slot(
+        self, key_index: int, model: str, skip: Set[Slot], now: float
+    ) -> Optional[int]:
+        """The least recently used ready key of the same tier that is much
+        faster than ``key_index``, or None to keep the LRU pick. Caller holds
+        the lock."""
+        current = self._estimate(key_index, model)
+        if current is None or now - self._slots[(key_index, model)].last_used >= _LATENCY_PROBE_S:
+            return None  # unknown or due a probe: let it serve and be measured
+        best: Optional[Tuple[float, int]] = None
+        for last_used, other, version in self._ready[model]:
+            if (
+                other == key_index
+                or (other, model) in skip
+                or self._slots[(other, model)].version != version
+            ):
+                continue
+            estimate = self._estimate(other, model)
+            if estimate is not None and estimate * _LATENCY_ADVANTAGE <= current:
+                best = min(best or (last_used, other), (last_used, other))
+        return best[1] if best else None
+
+    def _lease(self, key_index: int, model: str, now: float) -> bool:
+        def change(state: _SlotState) -> Optional[float]:
+            if state.ready_at > now:
+                return None
+            blocked_until = self._budget_block(state, model, now)
+            if blocked_until is not None:
+                state.ready_at = max(state.ready_at, blocked_until)
+                return None
+            state.last_used = now
+            state.day_count += 1
+            state.minute.append(now)
+            blocked_until = self._budget_block(state, model, now)
+            if blocked_until is not None:
+                # This was the budget's last request: rotate the slot out now
+                # so nobody spends a round trip on the 429 that would come next.
+                state.ready_at = max(state.ready_at, blocked_until)
+            return now
+
+        if self._mutate(key_index, model, change) is None:
+            return False
+        state = self._slots[(key_index, model)]
+        if state.ready_at > now:
+            print(
+                f"[gemini] key={key_index + 1} model={model} status=budget_spent"
+                f" resume_in={max(0, int(state.ready_at - now))}s"
+            )
+        return True
+
+    def cool(self, key_index: int, model: str, duration: float) -> None:
+        """Take a slot out of rotation for ``duration`` seconds (never shortens
+        a longer cooldown already in place)."""
+        self._ensure_loaded()
+        until = self._clock() + duration
+
+        def change(state: _SlotState) -> None:
+            state.ready_at = max(state.ready_at, until)
+
+        self._mutate(key_index, model, change)
+
+    def record_success(self, key_index: int, model: str) -> None:
+        self._ensure_loaded()
+        now = self._clock()
+
+        def change(state: _SlotState) -> None:
+            state.roll(now)
+            state.success_count += 1
+            state.last_success = now
+
+        self._mutate(key_index, model, change)
+
+    def record_latency(self, key_index: int, model: str, seconds: float) -> None:
+        """Feed one call duration into the slot's latency estimate."""
+        self._ensure_loaded()
+        with self._lock:
+            stats = self._latency.setdefault((key_index, model), LatencyStats())
+            model_stats = self._model_latency.setdefault(
+                model, LatencyStats(quantiles=(0.5, 0.9, 0.99))
+            )
+        stats.add(seconds)
+        model_stats.add(seconds)
+
+    def model_latency(self, model: str, p: float, *, min_samples: int = 1) -> Optional[float]:
+        """Quantile ``p`` (0.5, 0.9 or 0.99) of ``model``'s call latency over
+        every key, or None with fewer than ``min_samples`` observations."""
+        with self._lock:
+            stats = self._model_latency.get(model)
+        if stats is None or stats.count < min_samples:
+            return None
+        return stats.quantile(p)
+
+    # ── Queries ──────────────────────────────────────────────────────────────
+
+    def cooldown_remaining(self, key_index: int, model: str) -> int:
+        with self._lock:
+            state = self._slots.get((key_index, model))
+            ready_at = state.ready_at if state else 0.0
+            return max(0, int(ready_at - self._clock()))
+
+    def is_cooled(self, key_index: int, model: str) -> bool:
+        with self._lock:
+            state = self._slots.get((key_index, model))
+            return state is not None and self._clock() < state.ready_at
+
+    def success_count_today(self, key_index: int, model: str) -> int:
+        with self._lock:
+            state = self._slots.get((key_index, model))
+            day, _ = quota_day(self._clock())
+            return state.success_count if state and state.day == day else 0
+
+    def all_cooling(self, models: Sequence[str]) -> bool:
+        """True when no key can serve any of ``models`` right now."""
+        self._ensure_loaded()
+        return all(self.is_cooled(i, m) for i in range(len(self._keys)) for m in models)
+
+    def usable(self, models: Sequence[str], exclude: Iterable[Slot] = ()) -> int:
+        """How many slots ``acquire`` could still hand out (for logging)."""
+        self._ensure_loaded()
+        skip = set(exclude)
+        return sum(
+            1
+            for i in range(len(self._keys))
+            for m in models
+            if (i, m) not in skip and not self.is_cooled(i, m)
+        )
+
+    def resume_ts(self, models: Sequence[str]) -> float:
+        """Earliest unix ts at which some slot for ``models`` is usable again.
+        Meaningful only while ``all_cooling(models)``."""
+        self._ensure_loaded()
+        with self._lock:
+            return min(
+                (
+                    self._slots[(i, m)].ready_at if (i, m) in self._slots else 0.0
+                    for i in range(len(self._keys))
+                    for m in models
+                ),
+                default=0.0,
+            )
+
+    def snapshot(self, models: Sequence[str]) -> List[dict]:
+        """Per-key state for /api/llm-status. Env var names only — no key
+        material. Pool-wide when a store is in use."""
+        self._ensure_loaded()
+        self._sync(self._clock())
+        keys = []
+        for key_index, (env_name, _) in enumerate(self._keys):
+            last_success = max(
+                (
+                    state.last_success
+                    for (k, _), state in list(self._slots.items())
+                    if k == key_index
+                ),
+                default=0.0,
+            )
+            keys.append(
+                {
+                    "slot": key_index + 1,
+                    "env": env_name,
+                    "last_success_ts": last_success or None,
+                    "models": {m: self._slot_status(key_index, m) for m in models},
+                }
+            )
+        return keys
+
+    def _slot_status(self, key_index: int, model: str) -> dict:
+        status = {
+            "cooldown_remaining_s": self.cooldown_remaining(key_index, model),
+            "success_count_today": self.success_count_today(key_index, model),
+            "latency": (self._latency.get((key_index, model)) or LatencyStats()).summary(),
+        }
+        rpm, rpd = self._budgets.get(model, (None, None))
+        if rpm is None and rpd is None:
+            return status
+        with self._lock:
+            state = self._slots.get((key_index, model)) or _SlotState()
+            now = self._clock()
+            day, _ = quota_day(now)
+            status["budget"] = {
+                "rpm": rpm,
+                "rpd": rpd,
+                "requests_last_minute": sum(1 for ts in state.minute if ts > now - 60),
+                "requests_today": state.day_count if state.day == day else 0,
+            }
+        return status
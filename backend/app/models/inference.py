@@ -33,16 +33,38 @@ Expected external model output:
 }
 """
 
+import asyncio
 import base64
 import io
 import json
+import math
 import os
 import re
+import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
 
 import numpy as np
-from pydantic import AliasChoices, BaseModel, ConfigDict, Field, ValidationError
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, PrivateAttr, ValidationError
+
+from app.models.gemini_clients import GeminiClients
+from app.models.detector_ladder import (
+    DetectorLadder,
+    DetectorRung,
+    detector_ladder_from_env,
+)
+from app.models.gemini_pool import GeminiKeyPool
+from app.models.roboflow_clients import RoboflowClient, RoboflowClients, encode_image
+from app.utils.cancellation import CallCancelled, CancellationToken
+from app.utils.image_handle import ImageHandle
+from app.utils.region_diff import sketch_thumbnail
+from app.utils.tiling import (
+    MODEL_INPUT_SIDE,
+    Rect,
+    merge_tile_predictions,
+    small_region_count,
+    tile_grid,
+)
 
 ROBOFLOW_DEFAULT_MODEL_ID = "object-detection-4affw/2"
 # Use Roboflow's hosted inference endpoint by default.
@@ -50,6 +72,14 @@ ROBOFLOW_DEFAULT_MODEL_ID = "object-detection-4affw/2"
 # to register/load models via `/model/add`, which requires additional auth.
 ROBOFLOW_DEFAULT_API_URL = "https://detect.roboflow.com"
 ROBOFLOW_DEFAULT_THRESHOLD = 0.4
+_roboflow_clients = RoboflowClients()  # one long-lived client per endpoint
+roboflow_ladder = DetectorLadder()  # per-model breaker / latency / warmth
+
+
+def roboflow_models() -> List[DetectorRung]:
+    """The detector ladder (ROBOFLOW_MODELS, else ROBOFLOW_MODEL_ID), read at
+    call time because main.py loads .env after importing this module."""
+    return detector_ladder_from_env(ROBOFLOW_DEFAULT_MODEL_ID)
 
 # Per-class confidence thresholds for object-detection-4affw.
 #
@@ -66,15 +96,21 @@ ROBOFLOW_DEFAULT_THRESHOLD = 0.4
 #   navbar  P 97.0%  R 96.2%
 #   section P 99.5%  R 99.5%
 # So 0.20 is now the right floor across the board — the old 0.03 card floor
-# would admit noise on v4. If you ever swap back to v2, restore card=0.03.
+# would admit noise on v4. v2 keeps card=0.03 (_MODEL_CLASS_THRESHOLDS), so it
+# still works as a fallback rung of the detector ladder.
 #
-# Override any of these via env: ROBOFLOW_CONFIDENCE_THRESHOLD_<CLASS>=0.05
+# Override any of these via env: ROBOFLOW_CONFIDENCE_THRESHOLD_<CLASS>=0.05,
+# or for one model only with a suffix on its ROBOFLOW_MODELS entry
+# ("object-detection-4affw/2@5:card=0.03").
 _DEFAULT_PER_CLASS_THRESHOLDS = {
     "card": 0.20,
     "navbar": 0.20,
     "footer": 0.20,
     "section": 0.20,
 }
+_MODEL_CLASS_THRESHOLDS = {
+    "object-detection-4affw/2": {"card": 0.03},
+}
 
 # Class-aware NMS: when two same-class predictions overlap (IoU > this), keep
 # only the higher-confidence one. Collapses duplicate-section detections that
@@ -132,6 +168,31 @@ class ExternalModelOutput(BaseModel):
         validation_alias=AliasChoices("elements", "detectedElements"),
     )
     metadata: Dict[str, Any] = Field(default_factory=dict)
+    # Uploads: the preprocessed sketch Gemini reads text from and /api/detect
+    # shows as the review preview. In memory only — never serialized, so it
+    # can neither reach the browser nor bloat a persisted row.
+    _processed_image: Optional[ImageHandle] = PrivateAttr(default=None)
+
+    @property
+    def processed_image(self) -> Optional[ImageHandle]:
+        return self._processed_image
+
+    @processed_image.setter
+    def processed_image(self, image: Optional[ImageHandle]) -> None:
+        self._processed_image = image
+
+    # Canvas exports: the grayscale thumbnail the next SketchSnapshot diffs
+    # against (app.utils.region_diff), made from the pixels detection already
+    # decoded. In memory only, like processed_image.
+    _sketch_thumbnail: Optional[ImageHandle] = PrivateAttr(default=None)
+
+    @property
+    def sketch_thumbnail(self) -> Optional[ImageHandle]:
+        return self._sketch_thumbnail
+
+    @sketch_thumbnail.setter
+    def sketch_thumbnail(self, thumbnail: Optional[ImageHandle]) -> None:
+        self._sketch_thumbnail = thumbnail
 
 
 def _sort_key(element: Dict[str, Any]) -> float:
@@ -274,8 +335,25 @@ def _decode_sketch_image(sketch_image: str) -> bytes:
     return base64.b64decode(payload)
 
 
-def _resolve_class_threshold(class_name: str, fallback: float) -> float:
-    """Per-class confidence threshold: env override > built-in default > fallback."""
+def _rung_class_thresholds(model_id: Optional[str]) -> Dict[str, float]:
+    """The thresholds ``model_id``'s ROBOFLOW_MODELS entry sets ({} if none)."""
+    if model_id is None:
+        return {}
+    for rung in roboflow_models():
+        if rung.model_id == model_id:
+            return dict(rung.class_thresholds)
+    return {}
+
+
+def _resolve_class_threshold(
+    class_name: str, fallback: float, model_id: Optional[str] = None
+) -> float:
+    """Per-class confidence threshold for ``model_id``'s predictions: its
+    ROBOFLOW_MODELS suffix > env override > built-in per-model default >
+    built-in default > fallback."""
+    rung_thresholds = _rung_class_thresholds(model_id)
+    if class_name in rung_thresholds:
+        return rung_thresholds[class_name]
     env_key = f"ROBOFLOW_CONFIDENCE_THRESHOLD_{class_name.upper()}"
     raw = os.getenv(env_key)
     if raw is not None:
@@ -283,6 +361,9 @@ def _resolve_class_threshold(class_name: str, fallback: float) -> float:
             return float(raw)
         except ValueError:
             pass
+    model_defaults = _MODEL_CLASS_THRESHOLDS.get(model_id or "", {})
+    if class_name in model_defaults:
+        return model_defaults[class_name]
     return _DEFAULT_PER_CLASS_THRESHOLDS.get(class_name, fallback)
 
 
@@ -424,41 +505,190 @@ def _roboflow_to_element(prediction: Dict[str, Any]) -> Optional[ExternalModelEl
     )
 
 
-def detect_with_roboflow(
-    sketch_image: str,
-    canvas_size: Optional[Tuple[int, int]] = None,
+def roboflow_detection_settings(
     *,
-    api_key: Optional[str] = None,
     model_id: Optional[str] = None,
-    api_url: Optional[str] = None,
     confidence_threshold: Optional[float] = None,
-    sketch_source: Optional[str] = None,
-) -> Optional[ExternalModelOutput]:
-    """Call Roboflow with a base64 sketch and return an ExternalModelOutput, or None on failure.
+) -> Dict[str, Any]:
+    """Every setting that changes what ``detect_with_roboflow`` returns for a
+    given image, resolved the same way it resolves them (argument > env >
+    default). Used to key the detection cache, so an env tweak to a threshold
+    or the model id never serves boxes produced under the old settings."""
+    threshold = (
+        confidence_threshold
+        if confidence_threshold is not None
+        else float(os.getenv("ROBOFLOW_CONFIDENCE_THRESHOLD", ROBOFLOW_DEFAULT_THRESHOLD))
+    )
+    model_ids = [model_id] if model_id else [rung.model_id for rung in roboflow_models()]
+    return {
+        "model_id": ",".join(model_ids),
+        "threshold": threshold,
+        "class_thresholds": {
+            model: {
+                cls: _resolve_class_threshold(cls, threshold, model)
+                for cls in sorted({*_DEFAULT_PER_CLASS_THRESHOLDS, *_rung_class_thresholds(model)})
+            }
+            for model in model_ids
+        },
+        "nms_iou": float(os.getenv("ROBOFLOW_NMS_IOU", _DEFAULT_NMS_IOU)),
+        "upload_max_side": upload_max_side(),
+        "roboflow_max_side": roboflow_max_side(),
+        "tiling": roboflow_tiling(),
+    }
 
-    ``sketch_source`` marks where the image came from. ``None``/``"canvas"`` is the
-    Konva export path and is left byte-for-byte untouched. ``"upload-photo"`` and
-    ``"upload-clean"`` route through ``preprocess_uploaded_photo`` to normalize a
-    real-world photo / digital wireframe into the clean line-art the model expects.
-    """
-    api_key = api_key or os.getenv("ROBOFLOW_API_KEY")
-    if not api_key or not sketch_image:
+
+def upload_max_side() -> Optional[int]:
+    """Long-side cap of the fast upload preprocessing, or None for the
+    full-resolution path (UPLOAD_PREPROCESS=full)."""
+    if os.getenv("UPLOAD_PREPROCESS", "fast").lower() == "full":
         return None
+    from app.utils.preprocessing import DEFAULT_UPLOAD_MAX_SIDE
 
     try:
-        from inference_sdk import InferenceHTTPClient
-    except ImportError as error:
-        print(f"Roboflow inference-sdk not installed: {error}")
+        return max(64, int(os.getenv("UPLOAD_PREPROCESS_MAX_SIDE", DEFAULT_UPLOAD_MAX_SIDE)))
+    except ValueError:
+        return DEFAULT_UPLOAD_MAX_SIDE
+
+
+def roboflow_max_side() -> Optional[int]:
+    """Long-side cap of the image sent to Roboflow (ROBOFLOW_MAX_SIDE), or
+    None to send it at its own size (the default)."""
+    try:
+        value = int(os.getenv("ROBOFLOW_MAX_SIDE", "0") or 0)
+    except ValueError:
         return None
+    return max(64, value) if value > 0 else None
 
-    threshold = (
-        confidence_threshold
-        if confidence_threshold is not None
-        else float(os.getenv("ROBOFLOW_CONFIDENCE_THRESHOLD", ROBOFLOW_DEFAULT_THRESHOLD))
+
+def roboflow_tiling() -> Optional[Dict[str, Any]]:
+    """Tiled detection settings, or None when ROBOFLOW_TILING=off.
+
+    ``auto`` (the default) tiles an image whose long side reaches
+    ROBOFLOW_TILE_MIN_SIDE (default 2560), or a smaller one that is still
+    larger than a tile and has at least ROBOFLOW_TILE_DENSITY (default 12)
+    drawn boxes the model's 640 px input would shrink below 20 px. ``on``
+    tiles anything larger than a tile. Tiles are ROBOFLOW_TILE_SIZE px
+    (default 1024) — see app.utils.tiling.
+    """
+    mode = os.getenv("ROBOFLOW_TILING", "auto").lower()
+    if mode not in ("auto", "on"):
+        return None
+
+    def setting(name: str, default: int) -> int:
+        try:
+            return int(os.getenv(name, default))
+        except ValueError:
+            return default
+
+    return {
+        "mode": mode,
+        "tile_size": max(MODEL_INPUT_SIDE, setting("ROBOFLOW_TILE_SIZE", 1024)),
+        "min_side": setting("ROBOFLOW_TILE_MIN_SIDE", 2560),
+        "density": setting("ROBOFLOW_TILE_DENSITY", 12),
+    }
+
+
+def _plan_tiles(image: Any, tiling: Optional[Dict[str, Any]]) -> List[Rect]:
+    """The tiles to detect ``image`` in, or [] to send it whole."""
+    if tiling is None or max(image.size) <= tiling["tile_size"]:
+        return []
+    if tiling["mode"] == "auto" and max(image.size) < tiling["min_side"]:
+        small = small_region_count(np.asarray(image.convert("L")))
+        if small < tiling["density"]:
+            return []
+    tiles = tile_grid(*image.size, tile_size=tiling["tile_size"])
+    return tiles if len(tiles) > 1 else []
+
+
+def _fit_for_roboflow(
+    image: Any, max_side: Optional[int], *, area: bool = False
+) -> Tuple[Any, Optional[Tuple[Tuple[int, int], Tuple[int, int]]]]:
+    """``image`` shrunk to ``max_side``, and ((sent w, h), (original w, h))
+    when it was. Hosted inference resizes to the model's input anyway, so a
+    smaller upload only costs detail the model never sees. ``area`` averages
+    pixels (like cv2.INTER_AREA) instead of LANCZOS: about 3x faster on a
+    very large image, and as good for line art shrunk by 2x or more."""
+    if max_side is None or max(image.size) <= max_side:
+        return image, None
+    original_size = image.size
+    fit = max_side / max(original_size)
+    sent_size = (
+        max(1, round(original_size[0] * fit)),
+        max(1, round(original_size[1] * fit)),
     )
-    resolved_model_id = model_id or os.getenv("ROBOFLOW_MODEL_ID", ROBOFLOW_DEFAULT_MODEL_ID)
-    resolved_api_url = api_url or os.getenv("ROBOFLOW_API_URL", ROBOFLOW_DEFAULT_API_URL)
+    try:
+        from PIL import Image
+
+        if area:
+            resized = image.resize(sent_size, Image.Resampling.BOX)
+        else:
+            resized = image.resize(sent_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    except Exception as resize_error:
+        print(f"Roboflow: could not downscale sketch image, sending it as is: {resize_error}")
+        return image, None
+    return resized, (sent_size, original_size)
+
+
+class _PreparedTile(NamedTuple):
+    payload: str
+    rect: Rect  # x, y, width, height in the detector image's pixels
+    sent_size: Tuple[int, int]  # payload size (smaller when the tile was shrunk)
+
 
+class _PreparedImage(NamedTuple):
+    payload: str  # base64 JPEG every Roboflow attempt sends
+    gemini_image: Optional[ImageHandle]  # uploads only: what Gemini reads text from
+    transform: Optional[Dict[str, float]]  # fast uploads: photo px → payload px
+    # ROBOFLOW_MAX_SIDE / tiled full pass: ((sent w, h), (detector image w, h)).
+    resized: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None
+    tiles: Tuple[_PreparedTile, ...] = ()  # tiled detection: the tile payloads
+    thumbnail: Optional[ImageHandle] = None  # canvas only: see sketch_thumbnail
+
+
+def _on_white(raw_image: Any) -> Tuple[Any, bool]:
+    """An opened PIL image as RGB with any transparency composited onto white
+    (see _prepare_roboflow_image for why), and whether it had any."""
+    from PIL import Image
+
+    has_alpha = raw_image.mode in ("RGBA", "LA") or (
+        raw_image.mode == "P" and "transparency" in raw_image.info
+    )
+    if has_alpha:
+        rgba = raw_image.convert("RGBA")
+        pil_image = Image.new("RGB", rgba.size, (255, 255, 255))
+        pil_image.paste(rgba, mask=rgba.split()[3])  # alpha channel as mask
+        return pil_image, True
+    if raw_image.mode == "RGB":
+        return raw_image, False  # decoded on first read; no converted copy
+    return raw_image.convert("RGB"), False
+
+
+def decode_sketch_rgb(sketch_image: str) -> Any:
+    """A base64 sketch as an RGB PIL image on white, as the detector sees a
+    canvas export. Raises on undecodable input."""
+    from PIL import Image
+
+    return _on_white(Image.open(io.BytesIO(_decode_sketch_image(sketch_image))))[0]
+
+
+def _prepare_roboflow_image(
+    sketch_image: str, sketch_source: Optional[str], debug: bool
+) -> Optional[_PreparedImage]:
+    """Decode, normalize and encode the sketch exactly once per detection.
+
+    The Gemini image is a handle on the decoded pixels (see
+    app.utils.image_handle — nothing is re-encoded for it here). Uploads go
+    through the fast, resolution-capped preprocessing unless
+    UPLOAD_PREPROCESS=full: JPEGs are decoded in draft mode straight at
+    about the cap, and ``transform`` maps the original photo's pixels onto
+    the payload's (``out = (in - offset) * scale``), so boxes map back
+    exactly. With ROBOFLOW_MAX_SIDE set, any image (canvas exports included)
+    is shrunk to that long side just before the encode, and ``resized``
+    records both sizes so ``_roboflow_output`` can scale the boxes back up.
+    A large or dense image is also cut into ``tiles`` (see roboflow_tiling);
+    ``payload`` is then the low-resolution full pass. None when the image
+    cannot be used. CPU-bound — run it off the event loop.
+    """
     try:
         image_bytes = _decode_sketch_image(sketch_image)
     except (ValueError, base64.binascii.Error) as error:
@@ -478,18 +708,22 @@ def detect_with_roboflow(
     # rendered onto black → effectively invisible → model returns 0 predictions
     # even on a sketch that looks fine when previewed in Windows / Mac (those
     # OSes composite alpha over white before display, hiding the bug).
+    is_upload = sketch_source in ("upload-photo", "upload-clean")
+    max_side = upload_max_side() if is_upload else None
+    draft_scale = 1.0
     try:
         raw_image = Image.open(io.BytesIO(image_bytes))
-        has_alpha = raw_image.mode in ("RGBA", "LA") or (
-            raw_image.mode == "P" and "transparency" in raw_image.info
-        )
-        if has_alpha:
-            rgba = raw_image.convert("RGBA")
-            background = Image.new("RGB", rgba.size, (255, 255, 255))
-            background.paste(rgba, mask=rgba.split()[3])  # alpha channel as mask
-            pil_image = background
-        else:
-            pil_image = raw_image.convert("RGB")
+        if max_side is not None and raw_image.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, the smallest that
+            # still covers the cap: a fraction of the full decode's time.
+            full_width = raw_image.width
+            fit = max_side / max(raw_image.size)
+            if fit < 1.0:
+                raw_image.draft(
+                    "RGB", (math.ceil(raw_image.width * fit), math.ceil(raw_image.height * fit))
+                )
+                draft_scale = raw_image.width / full_width
+        pil_image, has_alpha = _on_white(raw_image)
     except Exception as error:
         print(f"Roboflow: could not open sketch image: {error}")
         return None
@@ -499,25 +733,75 @@ def detect_with_roboflow(
     # canvas export path (sketch_source None/"canvas") is intentionally skipped so
     # it stays byte-identical. Applied BEFORE the debug dump below so the saved PNG
     # reflects exactly what Roboflow receives.
-    gemini_pil_image = pil_image  # what Gemini gets for text reading (uploads only)
-    if sketch_source in ("upload-photo", "upload-clean"):
+    detector_image = ImageHandle.from_pil(pil_image)
+    gemini_image: Optional[ImageHandle] = None  # what Gemini reads text from (uploads only)
+    thumbnail = None if is_upload else ImageHandle.from_array(sketch_thumbnail(pil_image))
+    transform: Optional[Dict[str, float]] = None
+    if is_upload:
         try:
-            from app.utils.preprocessing import preprocess_uploaded_photo
+            from app.utils.preprocessing import (
+                preprocess_uploaded_photo,
+                preprocess_uploaded_photo_fast,
+            )
 
             # Binarization helps the detector but destroys faint/blurred text,
             # so Gemini gets the clean (non-binarized) copy with the exact same
             # crop geometry — its pixel space still matches the boxes below.
-            processed, clean = preprocess_uploaded_photo(
-                np.array(pil_image),
-                binarize=(sketch_source == "upload-photo"),
-                return_clean=True,
-            )
-            pil_image = Image.fromarray(processed)
-            gemini_pil_image = Image.fromarray(clean)
+            binarize = sketch_source == "upload-photo"
+            if max_side is not None:
+                processed, clean, fast = preprocess_uploaded_photo_fast(
+                    np.asarray(pil_image), binarize=binarize, max_side=max_side
+                )
+                # Fold the draft decode's scale in: relative to the photo itself.
+                transform = {
+                    "offsetX": fast["offsetX"] / draft_scale,
+                    "offsetY": fast["offsetY"] / draft_scale,
+                    "scaleX": fast["scaleX"] * draft_scale,
+                    "scaleY": fast["scaleY"] * draft_scale,
+                }
+            else:
+                processed, clean = preprocess_uploaded_photo(
+                    np.asarray(pil_image),
+                    binarize=binarize,
+                    return_clean=True,
+                )
+            detector_image = ImageHandle.from_array(processed)
+            # Without binarization both are the same crop of the same pixels.
+            gemini_image = ImageHandle.from_array(clean) if binarize else detector_image
+            # Only the handles' compact crops are read from here on; let the
+            # full-frame decode go before the JPEG encode below.
+            del pil_image, raw_image, processed, clean
         except Exception as prep_error:
             print(f"Roboflow: upload preprocessing failed, using raw image: {prep_error}")
-
-    debug = os.getenv("DEBUG_AI_PROMPT", "").lower() in ("1", "true", "yes", "on")
+            gemini_image = detector_image
+
+    # Shrink what is sent (not what Gemini reads or what the boxes are
+    # reported in): opt-in via ROBOFLOW_MAX_SIDE, and always to the tile size
+    # in a tiled detection — the full pass only has to find what spans tiles,
+    # and a tile grown past the tile size (MAX_TILES_PER_AXIS) gains nothing
+    # from the extra pixels at the model's 640 px input.
+    source_image = detector_image.pil()
+    tiling = roboflow_tiling()
+    try:
+        tile_rects = _plan_tiles(source_image, tiling)
+    except Exception as plan_error:
+        print(f"Roboflow: could not plan tiles, sending the image whole: {plan_error}")
+        tile_rects = []
+    send_max_side = roboflow_max_side()
+    tile_source = source_image
+    if tile_rects:
+        send_max_side = min(send_max_side or tiling["tile_size"], tiling["tile_size"])
+        # Shrink once and cut the tiles from that, not one resize per tile.
+        longest_tile = max(max(w, h) for _, _, w, h in tile_rects)
+        if longest_tile > send_max_side:
+            tile_source, _ = _fit_for_roboflow(
+                source_image,
+                math.ceil(max(source_image.size) * send_max_side / longest_tile),
+                area=True,
+            )
+    roboflow_image, resized = _fit_for_roboflow(tile_source, send_max_side)
+    if resized is not None:
+        resized = (resized[0], source_image.size)
 
     # In debug mode, dump the white-composited PNG that's about to be sent to
     # Roboflow. Critically: we save the COMPOSITED version, not the raw bytes,
@@ -530,63 +814,417 @@ def detect_with_roboflow(
             )
             os.makedirs(debug_dir, exist_ok=True)
             debug_path = os.path.join(debug_dir, "last_sketch.png")
-            pil_image.save(debug_path, format="PNG")
+            dump = roboflow_image
+            dump.save(debug_path, format="PNG")
             print(
                 f"[debug] sketch PNG saved to {os.path.abspath(debug_path)} "
-                f"({pil_image.width}x{pil_image.height}, mode={pil_image.mode}, "
+                f"({dump.width}x{dump.height}, mode={dump.mode}, "
                 f"alpha={'composited' if has_alpha else 'n/a'})"
             )
         except Exception as dump_error:
             print(f"[debug] could not save sketch PNG: {dump_error}")
 
-    # Roboflow's hosted inference applies its OWN confidence floor (default 0.4)
-    # before sending predictions back. Override it down to a small value so we
-    # can see everything the model considered, then apply our own threshold
-    # (ROBOFLOW_CONFIDENCE_THRESHOLD) on the client side for actual filtering.
-    server_confidence_floor = float(
-        os.getenv("ROBOFLOW_SERVER_CONFIDENCE", "0.05")
-    )
-
     try:
-        client = InferenceHTTPClient(api_url=resolved_api_url, api_key=api_key)
-        try:
-            from inference_sdk import InferenceConfiguration
-            client.configure(
-                InferenceConfiguration(confidence_threshold=server_confidence_floor)
+        payload = encode_image(roboflow_image)
+        tiles = []
+        scale = tile_source.width / source_image.width
+        for x, y, w, h in tile_rects:
+            tile_image = tile_source.crop(
+                tuple(round(v * scale) for v in (x, y, x + w, y + h))
             )
-        except Exception as cfg_error:
-            print(f"Roboflow: could not set custom confidence (using SDK defaults): {cfg_error}")
+            tiles.append(_PreparedTile(encode_image(tile_image), (x, y, w, h), tile_image.size))
     except Exception as error:
-        print(f"Roboflow: could not create client: {error}")
+        print(f"Roboflow: could not encode sketch image: {error}")
         return None
-
-    max_attempts = max(1, int(os.getenv("ROBOFLOW_MAX_RETRIES", "3")))
-    result = None
+    return _PreparedImage(payload, gemini_image, transform, resized, tuple(tiles), thumbnail)
+
+
+def _roboflow_failure_kind(error: BaseException) -> str:
+    """Which DetectorLadder failure kind a failed Roboflow call counts as."""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    status = getattr(error, "status", None)
+    text = str(error).lower()
+    if status == 402 or "credit" in text:
+        return "credit"
+    if status in (401, 403) or any(
+        k in text for k in ("401", "403", "unauthorized", "forbidden")
+    ):
+        return "auth"
+    return "error"
+
+
+async def _infer_roboflow(
+    client: RoboflowClient,
+    payload: str,
+    *,
+    confidence: float,
+    cancel_token: Optional[CancellationToken] = None,
+    max_attempts: Optional[int] = None,
+    attempt_timeout: Optional[float] = None,
+    report: bool = True,
+) -> Optional[Dict[str, Any]]:
+    """Roboflow call with retries on the one pre-encoded ``payload``.
+
+    Backoff is an ``asyncio.sleep`` on the loop, not a parked worker thread.
+    The token's remaining deadline (and ``attempt_timeout``, if given) bounds
+    each attempt's HTTP timeout, and a retry whose backoff would outlast it is
+    not attempted. ``max_attempts`` defaults to ROBOFLOW_MAX_RETRIES. Every
+    outcome is reported to ``roboflow_ladder`` under the client's model,
+    unless ``report`` is False (tiles: see ``_infer_tiled``).
+    """
+    if max_attempts is None:
+        max_attempts = max(1, int(os.getenv("ROBOFLOW_MAX_RETRIES", "3")))
     for attempt in range(1, max_attempts + 1):
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled(f"before attempt {attempt}")
+        timeout = cancel_token.remaining() if cancel_token is not None else None
+        if attempt_timeout is not None:
+            timeout = attempt_timeout if timeout is None else min(timeout, attempt_timeout)
+        started = time.perf_counter()
         try:
-            result = client.infer(pil_image, model_id=resolved_model_id)
-            break
+            result = await client.infer(payload, confidence=confidence, timeout=timeout)
         except Exception as infer_error:
-            err_str = str(infer_error).lower()
+            kind = _roboflow_failure_kind(infer_error)
+            if report:
+                roboflow_ladder.record_failure(
+                    client.model_id,
+                    kind,
+                    time.perf_counter() - started if kind == "timeout" else None,
+                )
             # Credit exhaustion and auth failures cannot recover by retrying.
-            non_retryable = any(
-                k in err_str
-                for k in ("credit", "401", "403", "unauthorized", "forbidden")
-            )
-            if non_retryable or attempt == max_attempts:
-                print(f"Roboflow inference failed: {infer_error}")
+            if kind in ("credit", "auth") or attempt == max_attempts:
+                print(f"Roboflow inference failed: {infer_error!r}")
                 return None
             delay = 2.0 ** (attempt - 1)  # 1 s, then 2 s
-            print(f"Roboflow: attempt {attempt}/{max_attempts} failed, retrying in {delay:.0f}s: {infer_error}")
-            time.sleep(delay)
+            if cancel_token is not None:
+                time_left = cancel_token.remaining()
+                if time_left is not None and time_left <= delay:
+                    print(f"Roboflow inference failed, no time left to retry: {infer_error!r}")
+                    return None
+            print(f"Roboflow: attempt {attempt}/{max_attempts} failed, retrying in {delay:.0f}s: {infer_error!r}")
+            await asyncio.sleep(delay)
+        else:
+            if report:
+                roboflow_ladder.record_success(client.model_id, time.perf_counter() - started)
+            return result
+    return None
+
+
+_WARMUP_TIMEOUT_S = 120.0
+_warmup_payload: Optional[str] = None
+_warmup_tasks: Set["asyncio.Task[bool]"] = set()
+
+
+async def warm_roboflow_model(
+    model_id: str,
+    *,
+    api_key: Optional[str] = None,
+    api_url: Optional[str] = None,
+) -> Optional[Tuple[float, Optional[bool]]]:
+    """One throwaway inference on a 64x64 white image so Roboflow loads
+    ``model_id`` — minimum payload that triggers the model-load path without
+    spending a real inference credit's worth. Goes through the pooled client,
+    so it also opens the connection the first real detection will reuse.
+
+    The outcome feeds ``roboflow_ladder``: a success marks the model warm and
+    teaches it the model's unload gap, but its duration is kept out of the
+    latency stats. Returns (seconds, was_cold) — was_cold None when the ladder
+    had no idle gap to judge by — or None if the call failed."""
+    global _warmup_payload
+    api_key = api_key or os.getenv("ROBOFLOW_API_KEY")
+    if not api_key:
+        return None
+    if _warmup_payload is None:
+        from PIL import Image
+
+        _warmup_payload = encode_image(Image.new("RGB", (64, 64), (255, 255, 255)))
+    client = _roboflow_clients.client(
+        api_url or os.getenv("ROBOFLOW_API_URL", ROBOFLOW_DEFAULT_API_URL), api_key, model_id
+    )
+    confidence = float(os.getenv("ROBOFLOW_SERVER_CONFIDENCE", "0.05"))
+    started = time.perf_counter()
+    try:
+        await client.infer(_warmup_payload, confidence=confidence, timeout=_WARMUP_TIMEOUT_S)
+    except Exception as error:
+        roboflow_ladder.record_failure(model_id, _roboflow_failure_kind(error))
+        print(f"[warmup] Roboflow {model_id} warm-up failed (non-fatal): {error!r}")
+        return None
+    finally:
+        roboflow_ladder.warmup_done(model_id)
+    seconds = time.perf_counter() - started
+    cold = roboflow_ladder.record_success(model_id, seconds, track_latency=False)
+    print(
+        f"[warmup] Roboflow {model_id} warm in {seconds:.1f}s"
+        f"{'' if cold is None else ' (was cold)' if cold else ' (was warm)'}"
+    )
+    return seconds, cold
+
+
+def _start_warmups(api_key: str, api_url: str) -> None:
+    """Warm, in the background, the cold rungs the last plan passed over."""
+    for model_id in roboflow_ladder.take_warmups():
+        task = asyncio.ensure_future(
+            warm_roboflow_model(model_id, api_key=api_key, api_url=api_url)
+        )
+        _warmup_tasks.add(task)
+        task.add_done_callback(_warmup_tasks.discard)
+
+
+async def detect_with_roboflow_async(
+    sketch_image: str,
+    canvas_size: Optional[Tuple[int, int]] = None,
+    *,
+    api_key: Optional[str] = None,
+    model_id: Optional[str] = None,
+    api_url: Optional[str] = None,
+    confidence_threshold: Optional[float] = None,
+    sketch_source: Optional[str] = None,
+    cancel_token: Optional[CancellationToken] = None,
+    run_blocking: Optional[Callable[..., Awaitable[Any]]] = None,
+) -> Optional[ExternalModelOutput]:
+    """Call Roboflow with a base64 sketch and return an ExternalModelOutput, or None on failure.
 
-    if result is None:
+    ``sketch_source`` marks where the image came from. ``None``/``"canvas"`` is the
+    Konva export path and is left byte-for-byte untouched. ``"upload-photo"`` and
+    ``"upload-clean"`` route through ``preprocess_uploaded_photo_fast`` (or the
+    full-resolution ``preprocess_uploaded_photo`` with UPLOAD_PREPROCESS=full) to
+    normalize a real-world photo / digital wireframe into the clean line-art the
+    model expects; the fast path records ``metadata["upload_transform"]``.
+    ROBOFLOW_MAX_SIDE (opt-in, any source) shrinks the image just for the
+    upload; the boxes and ``image_width``/``image_height`` come back in the
+    pixels of the image before that shrink, so callers see no difference.
+    Large or dense images are detected in overlapping tiles plus a
+    low-resolution full pass, sent concurrently and merged back into one set
+    of boxes (``roboflow_tiling``, ``_infer_tiled``).
+
+    Without ``model_id`` the detector ladder (``roboflow_models()``) is walked
+    in the order ``roboflow_ladder.plan`` gives: a rung with a healthy rung
+    after it gets one attempt bounded by its latency budget, the last hope
+    gets the full deadline and retries. Models whose breaker is open are not
+    called; when every one is, this returns None at once (contour fallback).
+
+    The image work (decode, composite, preprocess, encode) runs once through
+    ``run_blocking`` (default ``asyncio.to_thread``; main.py passes its CPU
+    pool); the HTTP calls and their retries run on the loop through the pooled
+    client for each endpoint (``_roboflow_clients``). ``cancel_token`` is
+    checked before each attempt and caps each attempt's HTTP timeout; raises
+    CallCancelled when the caller has given up.
+    """
+    api_key = api_key or os.getenv("ROBOFLOW_API_KEY")
+    if not api_key or not sketch_image:
         return None
 
+    threshold = (
+        confidence_threshold
+        if confidence_threshold is not None
+        else float(os.getenv("ROBOFLOW_CONFIDENCE_THRESHOLD", ROBOFLOW_DEFAULT_THRESHOLD))
+    )
+    rungs = [DetectorRung(model_id, float("inf"))] if model_id else roboflow_models()
+    resolved_api_url = api_url or os.getenv("ROBOFLOW_API_URL", ROBOFLOW_DEFAULT_API_URL)
+    debug = os.getenv("DEBUG_AI_PROMPT", "").lower() in ("1", "true", "yes", "on")
+
+    attempts = roboflow_ladder.plan(rungs)
+    _start_warmups(api_key, resolved_api_url)
+    if not attempts:
+        print("[roboflow] every detector's breaker is open → contour fallback")
+        return None
+
+    prepared = await (run_blocking or asyncio.to_thread)(
+        _prepare_roboflow_image, sketch_image, sketch_source, debug
+    )
+    if prepared is None:
+        return None
+    payload = prepared.payload
+
+    # Roboflow's hosted inference applies its OWN confidence floor (default 0.4)
+    # before sending predictions back. Override it down to a small value so we
+    # can see everything the model considered, then apply our own threshold
+    # (ROBOFLOW_CONFIDENCE_THRESHOLD) on the client side for actual filtering.
+    server_confidence_floor = float(
+        os.getenv("ROBOFLOW_SERVER_CONFIDENCE", "0.05")
+    )
+
+    if prepared.tiles:
+        print(f"[roboflow] tiled detection: {len(prepared.tiles)} tiles + full pass")
+    for rung, fallback in attempts:
+        client = _roboflow_clients.client(resolved_api_url, api_key, rung.model_id)
+        infer_kwargs: Dict[str, Any] = dict(
+            confidence=server_confidence_floor,
+            cancel_token=cancel_token,
+            max_attempts=1 if fallback else None,
+            attempt_timeout=rung.budget_s if fallback else None,
+        )
+        if prepared.tiles:
+            result = await _infer_tiled(
+                client,
+                prepared,
+                threshold,
+                budget_s=rung.budget_s if fallback else None,
+                **infer_kwargs,
+            )
+        else:
+            result = await _infer_roboflow(client, payload, **infer_kwargs)
+        if result is not None:
+            return _roboflow_output(
+                result,
+                model_id=rung.model_id,
+                api_url=resolved_api_url,
+                threshold=threshold,
+                canvas_size=canvas_size,
+                gemini_image=prepared.gemini_image,
+                thumbnail=prepared.thumbnail,
+                upload_transform=prepared.transform,
+                resized=None if prepared.tiles else prepared.resized,
+                debug=debug,
+            )
+        if fallback:
+            print(f"[roboflow] {rung.model_id} failed → next rung")
+    return None
+
+
+async def _infer_tiled(
+    client: RoboflowClient,
+    prepared: _PreparedImage,
+    threshold: float,
+    *,
+    budget_s: Optional[float] = None,
+    **infer_kwargs: Any,
+) -> Optional[Dict[str, Any]]:
+    """The full pass and every tile through ``_infer_roboflow`` at once (at
+    most ROBOFLOW_TILE_CONCURRENCY in flight), merged into one raw result in
+    the detector image's pixels (app.utils.tiling.merge_tile_predictions).
+
+    None when the full pass fails — the tiles still in flight are cancelled
+    then — or when the whole attempt outlasts ``budget_s`` (a fallback rung's
+    latency budget: ``attempt_timeout`` only bounds each call, and a tiled
+    attempt makes up to 17 of them). A failed tile only loses that tile's
+    extra resolution, and is counted in ``result["tiles"]``.
+
+    Only the full pass reports to ``roboflow_ladder``, so a rung attempt is
+    one outcome whether or not it was tiled: small tile payloads would drag
+    the latency stats down, and a burst of concurrent tile timeouts would
+    trip the breaker for what is a single detection.
+    """
+    limit = asyncio.Semaphore(max(1, int(os.getenv("ROBOFLOW_TILE_CONCURRENCY", "4"))))
+
+    async def infer(payload: str, report: bool) -> Optional[Dict[str, Any]]:
+        async with limit:
+            return await _infer_roboflow(client, payload, report=report, **infer_kwargs)
+
+    started = time.perf_counter()
+    full_task = asyncio.ensure_future(infer(prepared.payload, True))
+    tile_tasks = [asyncio.ensure_future(infer(tile.payload, False)) for tile in prepared.tiles]
+    for task in (full_task, *tile_tasks):
+        # Tasks left behind below are cancelled, never awaited: retrieve their
+        # outcome so an error they ended with is not logged as unretrieved.
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    async def collect() -> Tuple[Any, List[Any]]:
+        full = await full_task
+        if not isinstance(full, dict):
+            return None, []
+        return full, await asyncio.gather(*tile_tasks)
+
+    try:
+        full, tile_results = await asyncio.wait_for(collect(), budget_s)
+    except asyncio.TimeoutError:
+        seconds = time.perf_counter() - started
+        if full_task.cancelled():  # cut off before it could report
+            roboflow_ladder.record_failure(client.model_id, "timeout", seconds)
+        print(f"[roboflow] {client.model_id}: tiled attempt over its {budget_s:g}s budget")
+        return None
+    finally:
+        for task in (full_task, *tile_tasks):
+            task.cancel()
+    if not isinstance(full, dict):
+        return None
+    if prepared.resized is not None:
+        full = _rescale_roboflow_result(full, *prepared.resized)
+
+    tiles: List[Tuple[Rect, List[Dict[str, Any]]]] = []
+    for tile, result in zip(prepared.tiles, tile_results):
+        if not isinstance(result, dict):
+            continue
+        tile_size = tuple(tile.rect[2:])
+        if tile.sent_size != tile_size:
+            result = _rescale_roboflow_result(result, tile.sent_size, tile_size)
+        tiles.append((tile.rect, result.get("predictions") or []))
+
+    thresholds: Dict[str, float] = {}
+
+    def min_confidence(cls: str) -> float:
+        if cls not in thresholds:
+            thresholds[cls] = _resolve_class_threshold(cls, threshold, client.model_id)
+        return thresholds[cls]
+
+    # The tiles end on the image edges.
+    image_size = (
+        max(x + w for x, _, w, _ in (tile.rect for tile in prepared.tiles)),
+        max(y + h for _, y, _, h in (tile.rect for tile in prepared.tiles)),
+    )
+    predictions = merge_tile_predictions(
+        full.get("predictions") or [],
+        tiles,
+        image_size,
+        min_confidence=min_confidence,
+    )
+    return {
+        **full,
+        "predictions": predictions,
+        "tiles": {"count": len(prepared.tiles), "failed": len(prepared.tiles) - len(tiles)},
+    }
+
+
+def _rescale_roboflow_result(
+    result: Any, sent_size: Tuple[int, int], original_size: Tuple[int, int]
+) -> Any:
+    """Roboflow's answer for a downscaled upload (ROBOFLOW_MAX_SIDE) → the
+    same answer in the pixels of the image before the downscale: box centres
+    and sizes scaled per axis, and ``image`` set to the original size."""
+    if not isinstance(result, dict):
+        return result
+    sx = original_size[0] / sent_size[0]
+    sy = original_size[1] / sent_size[1]
+    predictions = []
+    for prediction in result.get("predictions") or []:
+        if isinstance(prediction, dict):
+            prediction = dict(prediction)
+            for key, factor in (("x", sx), ("width", sx), ("y", sy), ("height", sy)):
+                if isinstance(prediction.get(key), (int, float)):
+                    prediction[key] = prediction[key] * factor
+        predictions.append(prediction)
+    rescaled = dict(result, predictions=predictions)
+    image_meta = result.get("image")
+    rescaled["image"] = {
+        **(image_meta if isinstance(image_meta, dict) else {}),
+        "width": original_size[0],
+        "height": original_size[1],
+    }
+    return rescaled
+
+
+def _roboflow_output(
+    result: Any,
+    *,
+    model_id: str,
+    api_url: str,
+    threshold: float,
+    canvas_size: Optional[Tuple[int, int]],
+    gemini_image: Optional[ImageHandle],
+    thumbnail: Optional[ImageHandle] = None,
+    upload_transform: Optional[Dict[str, float]] = None,
+    resized: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None,
+    debug: bool = False,
+) -> Optional[ExternalModelOutput]:
+    """Roboflow's raw answer → filtered, ordered ExternalModelOutput (None if
+    nothing survives the filters)."""
+    if resized is not None:
+        result = _rescale_roboflow_result(result, *resized)
     predictions = result.get("predictions") if isinstance(result, dict) else None
     if debug:
         print(
-            f"[debug] Roboflow API URL={resolved_api_url} model={resolved_model_id} "
+            f"[debug] Roboflow API URL={api_url} model={model_id} "
             f"threshold={threshold}"
         )
         print(f"[debug] Roboflow raw result keys: {list(result.keys()) if isinstance(result, dict) else type(result).__name__}")
@@ -612,8 +1250,10 @@ def detect_with_roboflow(
     nms_iou = float(os.getenv("ROBOFLOW_NMS_IOU", _DEFAULT_NMS_IOU))
 
     # Pass 1: convert + per-class threshold + oversize-card guard.
-    # Thresholds are per-class because card / navbar / footer / section have
-    # very different confidence calibrations (see _DEFAULT_PER_CLASS_THRESHOLDS).
+    # Thresholds are per-class (and per model) because card / navbar / footer /
+    # section have very different confidence calibrations (see
+    # _DEFAULT_PER_CLASS_THRESHOLDS).
+    thresholds: Dict[str, float] = {}
     pre_nms: List[ExternalModelElement] = []
     rejected_low_conf = 0
     rejected_oversize_card = 0
@@ -621,14 +1261,16 @@ def detect_with_roboflow(
     if debug:
         print("[debug] per-class thresholds:")
         for cls in ("navbar", "footer", "section", "card"):
-            print(f"    {cls}: {_resolve_class_threshold(cls, threshold):.2f}")
+            print(f"    {cls}: {_resolve_class_threshold(cls, threshold, model_id):.2f}")
     for prediction in predictions:
         element = _roboflow_to_element(prediction)
         if element is None:
             parse_errors += 1
             continue
         cls = (element.type or "").lower()
-        cls_threshold = _resolve_class_threshold(cls, threshold)
+        cls_threshold = thresholds.get(cls)
+        if cls_threshold is None:
+            cls_threshold = thresholds[cls] = _resolve_class_threshold(cls, threshold, model_id)
         if element.confidence < cls_threshold:
             rejected_low_conf += 1
             if debug:
@@ -686,7 +1328,7 @@ def detect_with_roboflow(
     sort_reading_order(elements)
 
     metadata: Dict[str, Any] = {
-        "model_id": resolved_model_id,
+        "model_id": model_id,
         "raw_prediction_count": len(predictions),
         "filtered_prediction_count": len(elements),
         "confidence_threshold": threshold,
@@ -696,24 +1338,42 @@ def detect_with_roboflow(
     if isinstance(image_meta, dict):
         metadata["image_width"] = image_meta.get("width")
         metadata["image_height"] = image_meta.get("height")
-
-    # For uploads, stash the exact (processed) image Roboflow saw so the caller can
-    # hand it to Gemini for text-reading. Its pixel space matches the box coords
-    # above. Caller pops this before returning so the blob never reaches the browser.
-    if sketch_source in ("upload-photo", "upload-clean"):
-        try:
-            buf = io.BytesIO()
-            gemini_pil_image.save(buf, format="PNG")
-            metadata["processed_image_b64"] = base64.b64encode(buf.getvalue()).decode("ascii")
-        except Exception as enc_error:
-            print(f"Roboflow: could not stash processed image for Gemini: {enc_error}")
-
-    return ExternalModelOutput(
+    if upload_transform is not None:
+        # Boxes are in the preprocessed upload's pixels; this maps the
+        # original photo onto them (see _prepare_roboflow_image).
+        metadata["upload_transform"] = {k: round(v, 6) for k, v in upload_transform.items()}
+    if resized is not None:
+        metadata["roboflow_upload_size"] = list(resized[0])
+    if isinstance(result, dict) and isinstance(result.get("tiles"), dict):
+        metadata["tiles"] = result["tiles"]  # see _infer_tiled
+
+    output = ExternalModelOutput(
         source="roboflow",
-        model_version=resolved_model_id,
+        model_version=model_id,
         elements=elements,
         metadata=metadata,
     )
+    # Uploads: the processed image for Gemini's text-reading (see
+    # _prepare_roboflow_image).
+    output.processed_image = gemini_image
+    output.sketch_thumbnail = thumbnail
+    return output
+
+
+def detect_with_roboflow(*args: Any, **kwargs: Any) -> Optional[ExternalModelOutput]:
+    """Blocking ``detect_with_roboflow_async`` for scripts and other sync callers.
+
+    Runs on a fresh event loop and closes that loop's Roboflow clients before
+    returning. Must not be called from a running loop.
+    """
+
+    async def _call() -> Optional[ExternalModelOutput]:
+        try:
+            return await detect_with_roboflow_async(*args, **kwargs)
+        finally:
+            await _roboflow_clients.close_loop_clients()
+
+    return asyncio.run(_call())
 
 
 def _position_phrase(bounds: Dict[str, Any], width: float, height: float) -> str:
@@ -1457,93 +2117,118 @@ def _build_gemini_prompt(
     )
 
 
-# ── Per-(key, model) state (module-level, process-scoped) ────────────────────
-# Wiped on process restart — intentional. 60s RPM cooldowns recover within a
-# restart window; 24h daily cooldowns re-arm on the first failed request.
-#
+# ── Per-(key, model) state ───────────────────────────────────────────────────
 # Cooldowns are tracked per-(key, model) — NOT per-key — because Pro and Flash
 # on the same key have independent quota pools. Pro hitting per_day does not
 # prevent Flash from serving on the same key, and the next request should skip
 # the known-exhausted Pro instead of paying ~2s to confirm it's still 429.
+# gemini_key_pool owns the cooldowns, usage and success counts and picks which
+# slot serves next. Set GEMINI_MODEL_BUDGETS (e.g. "gemini-2.5-flash=10/250",
+# RPM/RPD) to have it rotate a slot out when its free-tier quota is used up,
+# before the 429. State is process-scoped unless main.py hands the pool a
+# shared store (GEMINI_POOL_BACKEND=sqlite), in which case every worker sees
+# every other worker's cooldowns and counts, and they survive a restart.
+# GEMINI_ROUTING=latency lets it skip a key that has gone much slower than
+# its peers (per-slot latency is tracked either way).
 _GEMINI_MODELS = _parse_gemini_models()
-_model_cooldowns: dict[tuple[int, str], float] = {}  # (key_index, model_name) → unix ts
-_key_last_used: dict[int, float] = {}                # key_index → last_success_at
-# Successful generations per (key_index, model_name) since the process started,
-# keyed by UTC date so /api/llm-status can show today's usage. Google exposes
-# no remaining-quota API, so this local count is the best available signal.
-_key_model_success_counts: dict[tuple[str, int, str], int] = {}  # (utc_date, key, model) → n
-
-
-def _record_model_success(key_index: int, model_name: str) -> None:
-    day = time.strftime("%Y-%m-%d", time.gmtime())
-    bucket = (day, key_index, model_name)
-    _key_model_success_counts[bucket] = _key_model_success_counts.get(bucket, 0) + 1
-    # Drop stale days so the dict never grows unbounded.
-    for k in [k for k in _key_model_success_counts if k[0] != day]:
-        del _key_model_success_counts[k]
-
-
-def _success_count_today(key_index: int, model_name: str) -> int:
-    day = time.strftime("%Y-%m-%d", time.gmtime())
-    return _key_model_success_counts.get((day, key_index, model_name), 0)
+gemini_key_pool = GeminiKeyPool()
+_gemini_clients = GeminiClients()  # one long-lived async client per key
 
 
 def get_llm_pool_status() -> dict:
     """Snapshot of the Gemini key pool for the /api/llm-status endpoint.
 
-    Keys are identified by slot index only — NEVER key material. Counts are
-    process-local (Google exposes no remaining-quota API); a model showing a
-    long cooldown_remaining_s (~hours) hit its per-day quota.
+    Keys are identified by slot index only — NEVER key material. Counts come
+    from the pool's own bookkeeping (Google exposes no remaining-quota API):
+    per worker by default, pool-wide with a shared store. A model showing a
+    long cooldown_remaining_s (~hours) hit its per-day quota. ``latency``
+    (EWMA, p50, p95 of successful and timed-out calls) and ``hedging`` are
+    always per worker.
     """
-    _key_re = re.compile(r"^GEMINI_API_KEY(_(\d+))?$")
-    _env_keys = sorted(
-        ((int(m.group(2)) if m.group(2) else 0), k)
-        for k, v in os.environ.items()
-        if (m := _key_re.match(k)) and v.strip()
-    )
-    keys = []
-    for key_index, (_, env_name) in enumerate(_env_keys):
-        models = {}
-        for model_name in _GEMINI_MODELS:
-            models[model_name] = {
-                "cooldown_remaining_s": _model_cooldown_remaining(key_index, model_name),
-                "success_count_today": _success_count_today(key_index, model_name),
-            }
-        keys.append(
-            {
-                "slot": key_index + 1,
-                "env": env_name,
-                "last_success_ts": _key_last_used.get(key_index),
-                "models": models,
-            }
-        )
-    return {"ladder": list(_GEMINI_MODELS), "keys": keys}
-
-
-def _is_model_cooled(key_index: int, model_name: str) -> bool:
-    return time.time() < _model_cooldowns.get((key_index, model_name), 0.0)
-
+    keys = gemini_key_pool.snapshot(_GEMINI_MODELS)
+    hedging = _hedge_stats.snapshot()
+    hedging["delay_s"] = {m: _hedge_delay(gemini_key_pool, m) for m in _GEMINI_MODELS}
+    return {
+        "ladder": list(_GEMINI_MODELS),
+        "routing": gemini_key_pool.routing,
+        "hedging": hedging,
+        "keys": keys,
+    }
 
-def _model_cooldown_remaining(key_index: int, model_name: str) -> int:
-    return max(0, int(_model_cooldowns.get((key_index, model_name), 0.0) - time.time()))
 
+# ── Hedging (GEMINI_HEDGE=true) ──────────────────────────────────────────────
+# Tail latency, not the median, sets our p99: a call that has run past its
+# model's p90 is likely stuck behind a slow backend, and a duplicate on
+# another slot usually finishes first. Each hedge costs one extra request of
+# quota, so it only fires past the p90 (≈10% of calls at most) and only once
+# the model has enough latency samples to know where its p90 is. With hedging
+# on, each attempt's own deadline also follows the measured distribution
+# (a multiple of p99) instead of only the caller's fixed timeout, so a stuck
+# call gives way to the next slot well before GEMINI_TIMEOUT_SECONDS.
+_HEDGE_MIN_SAMPLES = 20
+_HEDGE_MIN_DELAY_S = 1.0
+_ATTEMPT_TIMEOUT_P99_FACTOR = 3.0
+_ATTEMPT_TIMEOUT_FLOOR_S = 20.0
 
-def _apply_model_cooldown(key_index: int, model_name: str, duration: float) -> None:
-    _model_cooldowns[(key_index, model_name)] = time.time() + duration
 
+def _hedging_enabled() -> bool:
+    return os.getenv("GEMINI_HEDGE", "").lower() in ("1", "true", "yes", "on")
 
-def _is_key_fully_cooled(key_index: int) -> bool:
-    """A key is unusable only when EVERY model on it is currently cooling."""
-    return all(_is_model_cooled(key_index, m) for m in _GEMINI_MODELS)
 
+def _hedge_delay(pool: GeminiKeyPool, model_name: str) -> Optional[float]:
+    """Seconds after which a call on ``model_name`` gets a hedge: its p90."""
+    p90 = pool.model_latency(model_name, 0.9, min_samples=_HEDGE_MIN_SAMPLES)
+    return None if p90 is None else max(_HEDGE_MIN_DELAY_S, p90)
 
-def _earliest_resume_ts(n: int) -> float:
-    """Earliest unix ts at which any (key, model) becomes usable again.
 
-    Caller should only invoke this when every (key, model) is currently cooling
-    — otherwise the min may include a stale zero from a never-cooled pair.
-    """
-    return min(_model_cooldowns.get((i, m), 0.0) for i in range(n) for m in _GEMINI_MODELS)
+def _adaptive_attempt_timeout(pool: GeminiKeyPool, model_name: str) -> Optional[float]:
+    p99 = pool.model_latency(model_name, 0.99, min_samples=_HEDGE_MIN_SAMPLES)
+    if p99 is None:
+        return None
+    return max(_ATTEMPT_TIMEOUT_FLOOR_S, _ATTEMPT_TIMEOUT_P99_FACTOR * p99)
+
+
+class _HedgeStats:
+    """Counters behind the "hedging" block of /api/llm-status."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, *, hedged: bool, hedge_won: bool = False) -> None:
+        with self._lock:
+            self.calls += 1
+            self.hedged += int(hedged)
+            self.hedge_wins += int(hedge_won)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            calls, hedged, wins = self.calls, self.hedged, self.hedge_wins
+        return {
+            "enabled": _hedging_enabled(),
+            "calls": calls,
+            "hedged": hedged,
+            "hedge_rate": round(hedged / calls, 3) if calls else 0.0,
+            "hedge_wins": wins,
+            "win_rate": round(wins / hedged, 3) if hedged else 0.0,
+            # Every hedge is one request more than the call needed, won or lost.
+            "extra_requests": hedged,
+            "extra_request_ratio": round(hedged / calls, 3) if calls else 0.0,
+        }
+
+
+_hedge_stats = _HedgeStats()
+
+
+def _is_gemini_timeout(exc: BaseException) -> bool:
+    """Request-deadline errors: asyncio/OS timeouts or google-api-core's
+    DeadlineExceeded (matched by name so api-core stays an optional import)."""
+    return isinstance(exc, (TimeoutError, asyncio.TimeoutError)) or type(exc).__name__ in (
+        "DeadlineExceeded",
+        "GatewayTimeout",
+    )
 
 
 class GeminiQuotaExhausted(Exception):
@@ -1608,7 +2293,48 @@ def _classify_gemini_429(error: Exception) -> str:
     return "ambiguous"
 
 
-def generate_with_gemini(
+async def _stream_gemini_text(
+    model: Any,
+    content: Any,
+    on_chunk: Callable[[Optional[str]], None],
+    *,
+    cancel_token: Optional[CancellationToken] = None,
+    request_options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Stream one generate_content_async call, forwarding each text chunk.
+
+    Chunks blocked by safety filters raise ValueError on ``.text``; they carry
+    no code, so they are skipped rather than failing the whole attempt. The
+    cancel token is checked between chunks, so an abandoned stream stops
+    pulling tokens from Gemini.
+    """
+    pieces: List[str] = []
+    kwargs: Dict[str, Any] = {"stream": True}
+    if request_options:
+        kwargs["request_options"] = request_options
+    response = await model.generate_content_async(content, **kwargs)
+    async for chunk in response:
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled("mid-stream")
+        try:
+            piece = chunk.text
+        except ValueError:
+            continue
+        if piece:
+            pieces.append(piece)
+            on_chunk(piece)
+    return "".join(pieces)
+
+
+async def _pool_io(pool: GeminiKeyPool, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Call a pool method that writes the slot state. With a shared store
+    that is SQLite I/O (up to its busy timeout), so it runs off the loop."""
+    if pool.shared:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+async def generate_with_gemini_async(
     elements: List[ExternalModelElement],
     framework: str,
     styling: str,
@@ -1616,60 +2342,86 @@ def generate_with_gemini(
     *,
     api_key: Optional[str] = None,
     extra_text: Optional[List[str]] = None,
-    image_bytes: Optional[bytes] = None,
+    image: Optional[ImageHandle] = None,
     prompt_override: Optional[str] = None,
     brand_kit: Optional[Dict[str, str]] = None,
     screens: Optional[List[str]] = None,
     current_screen: Optional[str] = None,
     force_model: Optional[str] = None,
+    stream_callback: Optional[Callable[[Optional[str]], None]] = None,
+    cancel_token: Optional[CancellationToken] = None,
 ) -> str:
     """Call Gemini to synthesize code from detected elements.
 
+    Runs on the event loop: every attempt goes through the per-key client from
+    ``_gemini_clients`` via ``generate_content_async``, so no thread is held
+    while Gemini thinks and no process-global ``genai.configure`` is needed.
+    Scripts and other sync callers use ``generate_with_gemini``.
+
     ``prompt_override`` bypasses ``_build_gemini_prompt`` entirely (the repair
     pass sends its own corrective prompt) while keeping the key rotation,
     cooldown, and model-fallback machinery below. ``elements`` is ignored when
     it is set.
 
-    ``image_bytes`` (upload path only) is the processed sketch PNG. When present
-    it is sent to Gemini alongside the text prompt so the model can READ the text
-    baked into the pixels (the detector returns boxes but no text). The canvas
-    path leaves it None, so the request stays text-only and byte-identical.
+    ``image`` (upload path only) is the processed sketch, as the handle
+    detection decoded it into (``ExternalModelOutput.processed_image``). When
+    present it is sent to Gemini alongside the text prompt so the model can
+    READ the text baked into the pixels (the detector returns boxes but no
+    text). The canvas path leaves it None, so the request stays text-only and
+    byte-identical.
 
     ``force_model`` (UI model-control panel) restricts the ladder to that single
     model — key rotation still applies, but no model fallback. Unknown values
     are ignored (full ladder) so a stale client can never brick generation.
 
-    Routing:
-      - Keys tried in deterministic order (sorted by env var suffix).
+    ``stream_callback`` (/api/predict/stream) switches the call to
+    ``generate_content_async(..., stream=True)`` and receives each raw text chunk as
+    it arrives; the joined text is still returned (fence-stripped) as usual.
+    When an attempt that already streamed text fails or comes back empty, the
+    callback gets ``None`` so the consumer can discard the partial output
+    before the next key/model is tried. Called on the event loop.
+
+    ``cancel_token`` makes the call abandonable: it is checked before every
+    key/model attempt (and between stream chunks), and its remaining deadline
+    becomes the per-request HTTP timeout. Once the caller has timed out or
+    gone away the call raises CallCancelled instead of rotating on through
+    the pool, and a response that arrives after cancellation is dropped
+    without recording a success.
+
+    Routing (slots come from ``gemini_key_pool``, see app/models/gemini_pool.py):
+      - Ladder order first: every key's primary model is tried before any
+        key's fallback model. Within a model tier the least recently used
+        key goes first, so load spreads round-robin across keys instead of
+        piling onto key 1 (GEMINI_ROUTING=latency: unless another key of the
+        tier is much faster). Each (key, model) slot is tried at most once.
       - Cooldowns are per-(key, model): Pro hitting per_day on key=1 cools only
-        (key=1, pro); Flash on the same key keeps serving and is preferred on
-        the next request without the wasted ~2s probe to confirm Pro is still 429.
-      - per_minute → 60s cooldown on that (key, model), try next model.
-      - per_day    → 24h cooldown on that (key, model), try next model.
-      - ambiguous  → 60s cooldown on that (key, model), try next model
+        (key=1, pro); Flash on the same key keeps serving, and a cooling slot
+        is never handed out — no wasted ~2s probe to confirm Pro is still 429.
+      - per_minute → 60s cooldown on that (key, model), try next slot.
+      - per_day    → 24h cooldown on that (key, model), try next slot.
+      - ambiguous  → 60s cooldown on that (key, model), try next slot
                      (raw_error logged for classifier tuning).
-      - Non-quota errors → no cooldown, try fallback model on same key.
-      - Pre-flight + per-key skip: bail / rotate when every model is cooling.
+      - Non-quota errors → no cooldown, try the next slot.
+      - Pre-flight: bail when every (key, model) in scope is cooling.
+      - ``api_key`` outside the configured pool runs on a private one-key pool.
+      - GEMINI_HEDGE=true (non-streamed calls): past the model's p90 a
+        duplicate goes to the next slot; first success wins, the other is
+        cancelled. Both slots count as tried.
     """
-    _key_re = re.compile(r"^GEMINI_API_KEY(_(\d+))?$")
-    _env_keys = sorted(
-        ((int(m.group(2)) if m.group(2) else 0), v.strip())
-        for k, v in os.environ.items()
-        if (m := _key_re.match(k)) and v.strip()
-    )
-    api_keys = [v for _, v in _env_keys]
-    if api_key and api_key not in api_keys:
-        api_keys.insert(0, api_key)
+    pool = gemini_key_pool
+    if api_key and pool.index_of(api_key) is None:
+        # An explicit key outside the configured pool gets a private pool.
+        pool = GeminiKeyPool(lambda: [("api_key", api_key)])
 
-    if not api_keys:
+    if not len(pool):
         raise GeminiQuotaExhausted("No GEMINI_API_KEY configured.")
 
     try:
-        import google.generativeai as genai
+        import google.generativeai  # noqa: F401
     except ImportError as exc:
         raise RuntimeError(f"google-generativeai not installed: {exc}") from exc
 
-    n = len(api_keys)
+    n = len(pool)
 
     # ── Model scope: full ladder, or a single forced model (UI panel) ────────
     # An unknown force_model falls back to the full ladder rather than failing —
@@ -1682,29 +2434,27 @@ def generate_with_gemini(
             print(f"[gemini] force_model={force_model!r} not in ladder — using full ladder")
         models_to_try = _GEMINI_MODELS
 
-    def _key_cooled_for_scope(i: int) -> bool:
-        return all(_is_model_cooled(i, m) for m in models_to_try)
-
-    def _scope_resume_ts() -> float:
-        return min(_model_cooldowns.get((i, m), 0.0) for i in range(n) for m in models_to_try)
-
     # ── Pre-flight: bail immediately if every (key, model) is cooling ────────
-    if all(_key_cooled_for_scope(i) for i in range(n)):
-        retry_after = max(1, int(_scope_resume_ts() - time.time()))
+    if pool.all_cooling(models_to_try):
+        retry_after = max(1, int(pool.resume_ts(models_to_try) - time.time()))
         print(f"[gemini] all_keys_cooling retry_after={retry_after}s")
         raise GeminiRateLimited(
             f"All Gemini keys are temporarily rate limited. Retry in {retry_after}s."
         )
 
-    # Decode the attached sketch once (upload path). If it fails to decode we fall
-    # back to a text-only call rather than aborting code generation.
+    # The attached sketch goes out as one PNG blob, encoded once off the loop
+    # and shared by every attempt and hedge. Handed a PIL image, the SDK would
+    # re-encode it (lossless WebP, ~0.4 s at 1280x960) on the loop per call.
+    # A handle built from PNG bytes (HITL) is sent as-is; any other decodes
+    # here. If that fails we fall back to a text-only call rather than
+    # aborting code generation.
     sketch_image_part = None
-    if image_bytes is not None:
+    if image is not None:
         try:
-            from PIL import Image
-
-            sketch_image_part = Image.open(io.BytesIO(image_bytes))
-            sketch_image_part.load()  # force decode now so a bad image fails early
+            sketch_image_part = {
+                "mime_type": "image/png",
+                "data": await asyncio.to_thread(image.encode, "PNG"),
+            }
         except Exception as img_error:
             print(f"[gemini] could not decode attached image, proceeding text-only: {img_error}")
             sketch_image_part = None
@@ -1722,110 +2472,166 @@ def generate_with_gemini(
     )
 
     any_daily_exhausted = False
-
-    for key_index, current_key in enumerate(api_keys):
-
-        if _key_cooled_for_scope(key_index):
-            remaining = min(
-                _model_cooldown_remaining(key_index, m) for m in models_to_try
-            )
-            print(
-                f"[gemini] key={key_index + 1} status=skipped"
-                f" reason=all_models_cooling remaining={remaining}s"
-            )
-            continue
-
+    tried: set = set()
+    content = [prompt, sketch_image_part] if sketch_image_part is not None else prompt
+    # Hedging needs one response to pick; a streamed attempt has already
+    # forwarded its chunks, so streamed calls are never hedged.
+    hedging = stream_callback is None and _hedging_enabled()
+
+    async def attempt(key_index: int, model_name: str, current_key: str) -> Optional[str]:
+        """One call on one slot. Returns the code, or None after a failure
+        (the slot is cooled / logged here); CallCancelled propagates."""
+        nonlocal any_daily_exhausted
+        request_options: Optional[Dict[str, Any]] = None
+        timeout = cancel_token.remaining() if cancel_token is not None else None
+        if hedging:
+            adaptive = _adaptive_attempt_timeout(pool, model_name)
+            if adaptive is not None:
+                timeout = adaptive if timeout is None else min(timeout, adaptive)
+        if timeout is not None:
+            request_options = {"timeout": max(1.0, timeout)}
+
+        streamed = False
+        started = time.perf_counter()
         try:
-            genai.configure(api_key=current_key)
-        except Exception as exc:
-            print(f"[gemini] key={key_index + 1} status=configure_error error={exc!r}")
-            continue
-
-        for model_name in models_to_try:
-            if _is_model_cooled(key_index, model_name):
-                print(
-                    f"[gemini] key={key_index + 1} model={model_name} status=skipped"
-                    f" reason=cooling remaining={_model_cooldown_remaining(key_index, model_name)}s"
-                )
-                continue
-
-            try:
-                # Low temperature: this is a rendering task, not a creative one.
-                # Default (~1.0) made Gemini invent/move elements between runs on
-                # the same sketch. 0.1 instead of 0.0 — pure greedy decoding can
-                # degenerate into repetition loops on long outputs.
-                model = genai.GenerativeModel(
-                    model_name,
-                    generation_config={"temperature": 0.1, "top_p": 0.8},
+            # Low temperature: this is a rendering task, not a creative one.
+            # Default (~1.0) made Gemini invent/move elements between runs on
+            # the same sketch. 0.1 instead of 0.0 — pure greedy decoding can
+            # degenerate into repetition loops on long outputs.
+            model = _gemini_clients.model(
+                current_key,
+                model_name,
+                generation_config={"temperature": 0.1, "top_p": 0.8},
+            )
+            if stream_callback is not None:
+                streamed = True
+                text = await _stream_gemini_text(
+                    model,
+                    content,
+                    stream_callback,
+                    cancel_token=cancel_token,
+                    request_options=request_options,
                 )
-                content = (
-                    [prompt, sketch_image_part]
-                    if sketch_image_part is not None
-                    else prompt
+            else:
+                response = await model.generate_content_async(
+                    content, request_options=request_options
                 )
-                response = model.generate_content(content)
                 text = getattr(response, "text", None)
-                if text:
-                    _key_last_used[key_index] = time.time()
-                    _record_model_success(key_index, model_name)
-                    print(
-                        f"[gemini] key={key_index + 1} model={model_name}"
-                        f" status=success chars={len(text)}"
-                    )
-                    return _strip_code_fences(text)
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled("after response")
+            if text:
+                await _pool_io(pool, pool.record_success, key_index, model_name)
+                pool.record_latency(key_index, model_name, time.perf_counter() - started)
                 print(
                     f"[gemini] key={key_index + 1} model={model_name}"
-                    " status=empty_response"
+                    f" status=success chars={len(text)}"
                 )
+                return text
+            print(
+                f"[gemini] key={key_index + 1} model={model_name}"
+                " status=empty_response"
+            )
+            if streamed:
+                stream_callback(None)
+            return None
 
-            except Exception as exc:
-                kind = _classify_gemini_429(exc)
-                trying_next = "yes" if model_name != models_to_try[-1] else "no"
-
-                if kind == "per_day":
-                    _apply_model_cooldown(key_index, model_name, 86_400)
-                    any_daily_exhausted = True
-                    print(
-                        f"[gemini] key={key_index + 1} model={model_name}"
-                        f" status=per_day_429 trying_fallback={trying_next}"
-                        f" cooldown=86400s"
-                    )
-                    continue
-
-                if kind in ("per_minute", "ambiguous"):
-                    _apply_model_cooldown(key_index, model_name, 60)
-                    extra = f" raw_error={str(exc)!r}" if kind == "ambiguous" else ""
-                    print(
-                        f"[gemini] key={key_index + 1} model={model_name}"
-                        f" status={kind}_429 trying_fallback={trying_next}"
-                        f" cooldown=60s{extra}"
-                    )
-                    continue
-
-                # Non-quota failure — try fallback model on the same key (no cooldown).
+        except CallCancelled:
+            raise
+        except Exception as exc:
+            if streamed:
+                stream_callback(None)
+            kind = _classify_gemini_429(exc)
+            trying_next = "yes" if pool.usable(models_to_try, exclude=tried) else "no"
+
+            if kind == "per_day":
+                await _pool_io(pool, pool.cool, key_index, model_name, 86_400)
+                any_daily_exhausted = True
                 print(
                     f"[gemini] key={key_index + 1} model={model_name}"
-                    f" status=error error={exc!r}"
+                    f" status=per_day_429 trying_fallback={trying_next}"
+                    f" cooldown=86400s"
                 )
+                return None
 
-        # Key became fully cooled during this iteration — log the routing decision.
-        if _key_cooled_for_scope(key_index):
-            next_key = next(
-                (j + 1 for j in range(key_index + 1, n) if not _key_cooled_for_scope(j)),
-                None,
-            )
-            available = sum(1 for j in range(n) if not _key_cooled_for_scope(j))
-            if next_key:
+            if kind in ("per_minute", "ambiguous"):
+                await _pool_io(pool, pool.cool, key_index, model_name, 60)
+                extra = f" raw_error={str(exc)!r}" if kind == "ambiguous" else ""
                 print(
-                    f"[gemini] routing key={key_index + 1}->key={next_key}"
-                    f" available={available}"
+                    f"[gemini] key={key_index + 1} model={model_name}"
+                    f" status={kind}_429 trying_fallback={trying_next}"
+                    f" cooldown=60s{extra}"
                 )
-            else:
-                print(f"[gemini] routing key={key_index + 1}->none available={available}")
+                return None
+
+            # Non-quota failure — no cooldown, move on to the next slot. A
+            # timeout still says how slow this slot is; a fast 500 does not.
+            if _is_gemini_timeout(exc):
+                pool.record_latency(key_index, model_name, time.perf_counter() - started)
+            print(
+                f"[gemini] key={key_index + 1} model={model_name}"
+                f" status=error error={exc!r}"
+            )
+            return None
 
-    # ── Post-loop: all keys tried ─────────────────────────────────────────────
-    if all(_key_cooled_for_scope(i) for i in range(n)):
-        retry_after = max(1, int(_scope_resume_ts() - time.time()))
+    async def hedged(key_index: int, model_name: str, current_key: str) -> Optional[str]:
+        """``attempt`` on the slot, plus a duplicate on the next slot the pool
+        hands out once the primary outlives its model's p90. First success
+        wins; the other call is cancelled."""
+        primary = asyncio.ensure_future(attempt(key_index, model_name, current_key))
+        delay = _hedge_delay(pool, model_name)
+        if delay is None:  # too few samples to know where the tail starts
+            _hedge_stats.record(hedged=False)
+            return await primary
+        try:
+            await asyncio.wait_for(asyncio.shield(primary), delay)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            primary.cancel()
+            raise
+        hedge_slot = (
+            None
+            if primary.done()
+            else await _pool_io(pool, pool.acquire, models_to_try, exclude=tried)
+        )
+        if hedge_slot is None:
+            _hedge_stats.record(hedged=False)
+            return await primary
+        tried.add(hedge_slot[:2])
+        print(
+            f"[gemini] key={key_index + 1} model={model_name} status=hedging"
+            f" after={delay:.1f}s hedge_key={hedge_slot[0] + 1} hedge_model={hedge_slot[1]}"
+        )
+        hedge = asyncio.ensure_future(attempt(*hedge_slot))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    text = task.result()  # CallCancelled propagates
+                    if text:
+                        _hedge_stats.record(hedged=True, hedge_won=task is hedge)
+                        return text
+            _hedge_stats.record(hedged=True)
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    while True:
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled(f"after {len(tried)} attempt(s)")
+        slot = await _pool_io(pool, pool.acquire, models_to_try, exclude=tried)
+        if slot is None:
+            break
+        tried.add(slot[:2])
+        text = await (hedged(*slot) if hedging else attempt(*slot))
+        if text:
+            return _strip_code_fences(text)
+
+    # ── Post-loop: every usable slot tried ────────────────────────────────────
+    if pool.all_cooling(models_to_try):
+        retry_after = max(1, int(pool.resume_ts(models_to_try) - time.time()))
         print(f"[gemini] all_keys_cooling retry_after={retry_after}s")
         raise GeminiRateLimited(
             f"All Gemini keys are temporarily rate limited. Retry in {retry_after}s."
@@ -1844,6 +2650,23 @@ def generate_with_gemini(
     )
 
 
+def generate_with_gemini(*args: Any, **kwargs: Any) -> str:
+    """Blocking ``generate_with_gemini_async`` for scripts and other sync callers.
+
+    Runs the call on a fresh event loop and closes that loop's Gemini clients
+    before returning. Must not be called from a running loop — await the async
+    version there.
+    """
+
+    async def _call() -> str:
+        try:
+            return await generate_with_gemini_async(*args, **kwargs)
+        finally:
+            await _gemini_clients.close_loop_clients()
+
+    return asyncio.run(_call())
+
+
 class SketchDetector:
     """
     Sketch detection wrapper. Primary path is Roboflow (see detect_with_roboflow);
@@ -1857,13 +2680,18 @@ class SketchDetector:
 
     def detect(
         self,
-        preprocessed_image: np.ndarray,
+        preprocessed_image: Union[np.ndarray, Callable[[], np.ndarray]],
         external_output: Optional[Any] = None,
     ) -> List[Dict[str, Any]]:
+        """``preprocessed_image`` may be a zero-argument callable returning the
+        array: it is only called when the contour fallback actually runs, so
+        requests the external model answered never pay for rasterizing."""
         resolved_external_elements = external_elements_from_output(external_output)
         if resolved_external_elements:
             return resolved_external_elements
 
+        if callable(preprocessed_image):
+            preprocessed_image = preprocessed_image()
         return self._fallback_detection(preprocessed_image)
 
     def detect_from_external_output(
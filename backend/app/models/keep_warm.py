@@ -0,0 +1,205 @@
+"""KeepWarm: background pings that keep the hosted detector's weights loaded.
+
+``warmup_roboflow`` pings each model once, at startup. After a quiet spell
+Roboflow unloads the weights, and the next real user pays the 30-60s cold
+start the warm-up was meant to save them.
+
+KeepWarm watches each rung of the detector ladder. The ladder learns, per
+model, how long it can sit idle before answers come back cold
+(``DetectorLadder.idle``, see app.models.detector_ladder). A model is pinged
+with the 64x64 dummy inference once it has been idle for _MARGIN of that
+estimate, so the ping lands just before the weights would be dropped. Real
+detections reset the idle clock, so a busy model is never pinged. Every ping
+feeds the estimate back: a ping that finds the model cold pulls the next one
+earlier, and a long run of warm pings stretches the interval.
+
+Pings only go out:
+
+    inside the active hours   ROBOFLOW_KEEPWARM_HOURS="8-20" or "7-12,13-23"
+                              (start inclusive, end exclusive, may wrap
+                              midnight; empty = always), on the clock of
+                              ROBOFLOW_KEEPWARM_TZ (default UTC)
+    within the credit budget  ROBOFLOW_KEEPWARM_MAX_PINGS per day, all
+                              models together (default 96)
+    while the breaker is shut an open model is not called, not even to warm it
+
+Each ping's latency is recorded as warm or cold (per model LatencyStats) for
+/api/metrics. Budget and state are per worker: with several uvicorn workers,
+set the budget per worker accordingly.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.models.detector_ladder import DetectorLadder, DetectorRung
+from app.utils.latency import LatencyStats
+
+_MARGIN = 0.8
+_TICK_S = 60.0
+_DEFAULT_MAX_PINGS = 96
+
+ActiveHours = List[Tuple[int, int]]  # [(start_hour, end_hour)], end exclusive
+PingResult = Optional[Tuple[float, Optional[bool]]]  # (seconds, was_cold) or None
+
+
+def parse_active_hours(raw: str) -> ActiveHours:
+    """"8-20,22-2" → [(8, 20), (22, 2)]. Malformed ranges are skipped with a
+    log line; an empty result means "always active"."""
+    hours: ActiveHours = []
+    for entry in raw.split(","):
+        if not entry.strip():
+            continue
+        start_raw, _, end_raw = entry.partition("-")
+        try:
+            start, end = int(start_raw), int(end_raw)
+        except ValueError:
+            start = end = -1
+        if not (0 <= start <= 23 and 0 <= end <= 24 and start != end):
+            print(f"[keepwarm] ignoring malformed ROBOFLOW_KEEPWARM_HOURS entry {entry.strip()!r}")
+            continue
+        hours.append((start, end))
+    return hours
+
+
+def _tz(name: str) -> Any:
+    try:
+        from zoneinfo import ZoneInfo
+
+        return ZoneInfo(name)
+    except Exception:
+        print(f"[keepwarm] unknown timezone {name!r}; using UTC")
+        return timezone.utc
+
+
+class _ModelPings:
+    def __init__(self) -> None:
+        self.pings = 0
+        self.failures = 0
+        self.warm = LatencyStats()
+        self.cold = LatencyStats()
+        self.last: Optional[Dict[str, Any]] = None
+
+
+class KeepWarm:
+    """Schedules keep-warm pings for the detector ladder's models."""
+
+    def __init__(
+        self,
+        ladder: DetectorLadder,
+        rungs: Callable[[], Sequence[DetectorRung]],
+        ping: Callable[[str], Awaitable[PingResult]],
+        *,
+        active_hours: Optional[ActiveHours] = None,
+        max_pings_per_day: int = _DEFAULT_MAX_PINGS,
+        tz: str = "UTC",
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self._ladder = ladder
+        self._rungs = rungs
+        self._ping = ping
+        self.active_hours = active_hours or []
+        self.max_pings_per_day = max_pings_per_day
+        self._tz = _tz(tz)
+        self._clock = clock
+        self._day = ""
+        self._pings_today = 0
+        self._models: Dict[str, _ModelPings] = {}
+
+    def _local(self, now: float) -> datetime:
+        return datetime.fromtimestamp(now, self._tz)
+
+    def active(self, now: Optional[float] = None) -> bool:
+        if not self.active_hours:
+            return True
+        hour = self._local(self._clock() if now is None else now).hour
+        return any(
+            start <= hour < end if start < end else hour >= start or hour < end
+            for start, end in self.active_hours
+        )
+
+    def _budget_left(self, now: float) -> int:
+        day = self._local(now).date().isoformat()
+        if day != self._day:
+            self._day, self._pings_today = day, 0
+        return self.max_pings_per_day - self._pings_today
+
+    def due(self) -> Tuple[List[str], float]:
+        """(models to ping now, seconds until the next one comes due)."""
+        now_due: List[str] = []
+        wait = _TICK_S
+        for rung in self._rungs():
+            if self._ladder.is_open(rung.model_id):
+                continue
+            idle_s, unload_after_s = self._ladder.idle(rung.model_id)
+            left = _MARGIN * unload_after_s - idle_s if idle_s is not None else 0.0
+            if left <= 0:
+                now_due.append(rung.model_id)
+            else:
+                wait = min(wait, left)
+        return now_due, wait
+
+    async def tick(self) -> float:
+        """Ping whatever is due; returns how long to sleep before the next tick."""
+        now = self._clock()
+        if not self.active(now):
+            return _TICK_S
+        models, wait = self.due()
+        for model_id in models:
+            if self._budget_left(now) <= 0:
+                print(f"[keepwarm] daily budget of {self.max_pings_per_day} pings spent")
+                return _TICK_S
+            self._pings_today += 1
+            stats = self._models.setdefault(model_id, _ModelPings())
+            stats.pings += 1
+            try:
+                result = await self._ping(model_id)
+            except Exception as error:
+                result = None
+                print(f"[keepwarm] {model_id} ping raised: {error!r}")
+            if result is None:
+                stats.failures += 1
+                continue
+            seconds, cold = result
+            (stats.cold if cold else stats.warm).add(seconds)
+            stats.last = {"at": round(now), "ms": round(seconds * 1000, 1), "cold": cold}
+        return max(1.0, wait)
+
+    async def run(self) -> None:
+        """Tick forever (cancel the task to stop). Starts after one tick, so
+        the startup warm-up is not duplicated."""
+        await asyncio.sleep(_TICK_S)
+        while True:
+            try:
+                wait = await self.tick()
+            except Exception as error:
+                print(f"[keepwarm] tick failed: {error!r}")
+                wait = _TICK_S
+            await asyncio.sleep(wait)
+
+    def metrics(self) -> Dict[str, Any]:
+        now = self._clock()
+        self._budget_left(now)  # roll the day over before reporting
+        per_model = {}
+        for rung in self._rungs():
+            idle_s, unload_after_s = self._ladder.idle(rung.model_id)
+            stats = self._models.get(rung.model_id) or _ModelPings()
+            per_model[rung.model_id] = {
+                "idle_s": round(idle_s) if idle_s is not None else None,
+                "unload_after_s": round(unload_after_s),
+                "pings": stats.pings,
+                "failures": stats.failures,
+                "warm": stats.warm.summary(),
+                "cold": stats.cold.summary(),
+                "last": stats.last,
+            }
+        return {
+            "active": self.active(now),
+            "active_hours": [f"{start}-{end}" for start, end in self.active_hours],
+            "pings_today": self._pings_today,
+            "max_pings_per_day": self.max_pings_per_day,
+            "models": per_model,
+        }
@@ -0,0 +1,161 @@
+"""Long-lived Roboflow inference clients, one per (api_url, api_key, model_id).
+
+detect_with_roboflow used to build an InferenceHTTPClient and call
+``configure()`` on every request, then hand it a PIL image — which the SDK
+re-encoded to JPEG on every retry — and the SDK itself opens a fresh HTTP
+connection per call (module-level ``requests.post`` / a new aiohttp session),
+so every detection paid TCP + TLS setup to Roboflow again.
+
+RoboflowClients keeps one RoboflowClient per (api_url, api_key, model_id).
+For Roboflow's hosted API (the default) the client speaks the hosted "v0"
+protocol itself — POST the base64 image to ``{api_url}/{project}/{version}``
+— over one aiohttp session whose connector keeps connections alive between
+calls, with a per-call timeout. Any other api_url (a self-hosted inference
+server) goes through the SDK's ``infer_async`` on one configured SDK client.
+Either way the caller encodes the image once (``encode_image``) and passes
+the same payload to every retry.
+
+aiohttp sessions belong to the event loop they were created on, so, like
+GeminiClients, a client is rebuilt when requested from a different loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import io
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+# Base URLs of Roboflow's hosted inference (inference_sdk.config.ALL_ROBOFLOW_API_URLS).
+_HOSTED_API_URLS = frozenset(
+    {
+        "https://detect.roboflow.com",
+        "https://outline.roboflow.com",
+        "https://classify.roboflow.com",
+        "https://infer.roboflow.com",
+        "https://serverless.roboflow.com",
+        "https://serverless.roboflow.one",
+    }
+)
+_KEEPALIVE_SECONDS = 60.0
+_MAX_CONNECTIONS = 16
+
+ClientKey = Tuple[str, str, str]  # (api_url, api_key, model_id)
+
+
+class RoboflowHTTPError(Exception):
+    """Non-2xx answer from Roboflow. The message carries the status and the
+    start of the body (never the URL, which holds the api key)."""
+
+    def __init__(self, status: int, body: str) -> None:
+        super().__init__(f"Roboflow HTTP {status}: {body[:200]}")
+        self.status = status
+
+
+def encode_image(image: Any) -> str:
+    """PIL image → the base64 JPEG payload Roboflow receives (what the SDK
+    would send for the same image)."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class RoboflowClient:
+    """Inference calls for one (api_url, api_key, model_id) on one event loop."""
+
+    def __init__(self, api_url: str, api_key: str, model_id: str) -> None:
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key
+        self.model_id = model_id
+        self.hosted = self.api_url in _HOSTED_API_URLS
+        self._session: Any = None
+        self._sdk_clients: Dict[float, Any] = {}  # server confidence → SDK client
+
+    def _http(self) -> Any:
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=_MAX_CONNECTIONS, keepalive_timeout=_KEEPALIVE_SECONDS
+                )
+            )
+        return self._session
+
+    def _sdk(self, confidence: float) -> Any:
+        client = self._sdk_clients.get(confidence)
+        if client is None:
+            from inference_sdk import InferenceConfiguration, InferenceHTTPClient
+
+            client = InferenceHTTPClient(api_url=self.api_url, api_key=self.api_key)
+            client.configure(InferenceConfiguration(confidence_threshold=confidence))
+            self._sdk_clients[confidence] = client
+        return client
+
+    async def infer(
+        self, image_b64: str, *, confidence: float, timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """One inference call on an already-encoded image. ``confidence`` is
+        Roboflow's server-side floor; ``timeout`` (seconds) bounds the call."""
+        if not self.hosted:
+            call = self._sdk(confidence).infer_async(image_b64, model_id=self.model_id)
+            return await (asyncio.wait_for(call, timeout) if timeout is not None else call)
+
+        import aiohttp
+
+        project, _, version = self.model_id.partition("/")
+        async with self._http().post(
+            f"{self.api_url}/{project}/{version}",
+            params={"api_key": self.api_key, "confidence": str(confidence)},
+            data=image_b64,
+            headers={"Content-Type": "application/json"},  # what the SDK sends
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            if response.status >= 400:
+                raise RoboflowHTTPError(response.status, await response.text())
+            return await response.json(content_type=None)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class RoboflowClients:
+    """Per-(api_url, api_key, model_id) clients, created on first use."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._clients: Dict[ClientKey, Tuple[asyncio.AbstractEventLoop, RoboflowClient]] = {}
+
+    def _make_client(self, api_url: str, api_key: str, model_id: str) -> RoboflowClient:
+        return RoboflowClient(api_url, api_key, model_id)
+
+    def client(self, api_url: str, api_key: str, model_id: str) -> RoboflowClient:
+        """The client for this endpoint on the running event loop."""
+        loop = asyncio.get_running_loop()
+        key = (api_url, api_key, model_id)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry[0] is loop:
+                return entry[1]
+            created = self._make_client(api_url, api_key, model_id)
+            self._clients[key] = (loop, created)
+        return created
+
+    async def close_loop_clients(self) -> None:
+        """Close clients bound to the running loop (before that loop ends)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            doomed = [k for k, (owner, _) in self._clients.items() if owner is loop]
+            closing = [self._clients.pop(k)[1] for k in doomed]
+        for client in closing:
+            try:
+                await client.close()
+            except Exception as exc:
+                print(f"[roboflow] client close failed: {exc!r}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
@@ -0,0 +1,443 @@
+"""Vector-native sketch detection from the canvas JSON.
+
+For ``sketchSource="canvas"`` the request already carries what the user drew:
+``canvasData.shapes`` (rectangles, buttons, ...), ``componentGroups``
+(inserted templates, shapes relative to the group origin) and ``lines`` (pen
+strokes as flattened ``[x0, y0, x1, y1, ...]``). Rasterizing that to a PNG,
+uploading it to Roboflow and waiting for boxes the vector data already
+describes costs seconds; classifying the boxes here costs milliseconds.
+
+Boxes are the drawn rectangles and buttons, plus pen strokes that close on
+themselves and fill their bounding box (a hand-drawn rectangle). They are
+classified with the rules the rest of the pipeline already applies to the
+detector's output:
+
+    navbar / footer   a wide, thin box (≥ _BAR_MIN_WIDTH of the layout,
+                      aspect ≥ _BAR_MIN_ASPECT) that is the topmost / bottommost
+                      box, with its centre in the top / bottom third
+                      (snap_positional_bars, _synthesize_missing_containers)
+    section           any other top-level box that holds boxes or covers a
+                      large share of the layout; a wide thin bar mid-page
+    card              everything nested in another box, and small leaves
+
+A box drawn around the whole layout (a page frame) counts as a section; its
+direct children are then classified as top level.
+
+Confidence gate: the vector answer is only used when the drawing is
+unambiguous. ``detect_from_canvas`` returns None — the caller then asks
+Roboflow — when:
+- the eraser was used, since the pixels no longer match the vectors;
+- a shape of unknown type or a rotated shape is present;
+- a significant share of freehand ink lies outside every box, or a long
+  straight stroke sits inside one — both usually mean a box drawn in
+  several strokes;
+- any box scores below VECTOR_MIN_CONFIDENCE;
+- the export transform cannot be matched to the PNG.
+
+Boxes are returned in the exported PNG's pixel space, like Roboflow's. The
+frontend exports a tight crop of the content (24px padding, pixelRatio 2)
+and does not send the transform, so it is rebuilt from the content's
+bounding box and checked against the PNG's actual size.
+"""
+
+from __future__ import annotations
+
+import base64
+import math
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.models.inference import (
+    ExternalModelElement,
+    ExternalModelOutput,
+    _class_aware_nms,
+    snap_positional_bars,
+    sort_reading_order,
+)
+
+VECTOR_MODEL_VERSION = "vector-v1"
+_DEFAULT_MIN_CONFIDENCE = 0.6
+
+# Export crop (SketchCanvas.exportAsPNG): content bbox + PAD on every side.
+_EXPORT_PAD = 24.0
+# The rebuilt transform must explain the PNG's size this closely.
+_SCALE_TOLERANCE = 0.08
+
+_MIN_BOX_SIDE = 8.0
+_CONTAIN_RATIO = 0.9  # share of a box's area inside another to count as nested
+_FRAME_COVER = 0.85  # a top-level box covering this much of the layout is a page frame
+_BAR_MIN_WIDTH = 0.6
+_BAR_MIN_ASPECT = 4.0
+_SECTION_MIN_AREA = 0.15
+_NESTED_SECTION_MIN_AREA = 0.1
+
+# Closed freehand strokes: the gap between first and last point, relative to
+# the stroke's bbox diagonal, and how much of the bbox the outline must fill
+# (a rectangle ≈ 1.0, an ellipse ≈ 0.79, a scribble far less).
+_CLOSE_GAP = 0.15
+_RECT_FILL_SURE = 0.85
+_RECT_FILL_MIN = 0.7
+_MIN_CLOSED_POINTS = 8
+
+# Unexplained ink: freehand strokes whose centre is in no box.
+_STRAY_INK_SHARE = 0.15
+_STRAY_STROKE_SPAN = 0.25  # one stray stroke this long (of the layout) is a box edge
+# An open stroke this straight, spanning _STRAY_STROKE_SPAN of the box it sits
+# in, is an edge of a box drawn line by line, not content inside the box.
+_EDGE_STRAIGHTNESS = 0.9
+
+_KNOWN_SHAPES = {
+    "rectangle", "button", "text", "image", "circle", "ellipse", "triangle", "arrow", "line",
+}
+
+Box = Tuple[float, float, float, float]  # x, y, w, h
+
+
+@dataclass
+class _Candidate:
+    box: Box
+    origin: str  # "rectangle" | "button" | "image" | "stroke"
+    fit: float = 1.0  # how surely this is a box at all (strokes < 1)
+    parent: Optional["_Candidate"] = None
+    children: List["_Candidate"] = field(default_factory=list)
+    cls: str = "card"
+    confidence: float = 0.0
+
+    @property
+    def area(self) -> float:
+        return self.box[2] * self.box[3]
+
+
+def vector_min_confidence() -> float:
+    try:
+        return float(os.getenv("VECTOR_MIN_CONFIDENCE", _DEFAULT_MIN_CONFIDENCE))
+    except ValueError:
+        return _DEFAULT_MIN_CONFIDENCE
+
+
+def png_size(image: str) -> Optional[Tuple[int, int]]:
+    """(width, height) from a base64 PNG's IHDR chunk — no full decode."""
+    payload = image.split(",", 1)[1] if image.startswith("data:") else image
+    try:
+        head = base64.b64decode(payload[:44])
+    except Exception:
+        return None
+    if len(head) < 24 or head[:8] != b"\x89PNG\r\n\x1a\n" or head[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", head[16:24])
+
+
+def _points(flat: Any) -> List[Tuple[float, float]]:
+    if not isinstance(flat, list):
+        return []
+    try:
+        return [(float(flat[i]), float(flat[i + 1])) for i in range(0, len(flat) - 1, 2)]
+    except (TypeError, ValueError):
+        return []
+
+
+def _bbox(points: Iterable[Tuple[float, float]]) -> Optional[Box]:
+    xs, ys = [], []
+    for x, y in points:
+        xs.append(x)
+        ys.append(y)
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)
+
+
+def _union(a: Optional[Box], b: Optional[Box]) -> Optional[Box]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x1, y1 = min(a[0], b[0]), min(a[1], b[1])
+    x2 = max(a[0] + a[2], b[0] + b[2])
+    y2 = max(a[1] + a[3], b[1] + b[3])
+    return x1, y1, x2 - x1, y2 - y1
+
+
+def _grow(box: Box, pad: float) -> Box:
+    return box[0] - pad, box[1] - pad, box[2] + 2 * pad, box[3] + 2 * pad
+
+
+def _inside_share(inner: Box, outer: Box) -> float:
+    """Share of ``inner``'s area that lies inside ``outer``."""
+    iw = min(inner[0] + inner[2], outer[0] + outer[2]) - max(inner[0], outer[0])
+    ih = min(inner[1] + inner[3], outer[1] + outer[3]) - max(inner[1], outer[1])
+    area = inner[2] * inner[3]
+    if iw <= 0 or ih <= 0 or area <= 0:
+        return 0.0
+    return iw * ih / area
+
+
+def _centre_in(box: Box, outer: Box) -> bool:
+    cx, cy = box[0] + box[2] / 2, box[1] + box[3] / 2
+    return outer[0] <= cx <= outer[0] + outer[2] and outer[1] <= cy <= outer[1] + outer[3]
+
+
+def _stroke_length(points: List[Tuple[float, float]]) -> float:
+    return sum(math.dist(points[i], points[i + 1]) for i in range(len(points) - 1))
+
+
+def _closed_box_fit(points: List[Tuple[float, float]], box: Box) -> float:
+    """0 for an open stroke; else how rectangle-like the closed outline is."""
+    if len(points) < _MIN_CLOSED_POINTS or box[2] < _MIN_BOX_SIDE or box[3] < _MIN_BOX_SIDE:
+        return 0.0
+    diagonal = math.hypot(box[2], box[3])
+    if math.dist(points[0], points[-1]) > _CLOSE_GAP * diagonal:
+        return 0.0
+    area = 0.0  # shoelace
+    for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2 / (box[2] * box[3])
+
+
+def _shape_box(shape: Dict[str, Any], dx: float, dy: float) -> Optional[Box]:
+    """Canvas-space bbox of one shape as Konva draws it (stroke included)."""
+    try:
+        kind = shape.get("type")
+        x = float(shape.get("x") or 0) + dx
+        y = float(shape.get("y") or 0) + dy
+        sx = float(shape.get("scaleX") or 1)
+        sy = float(shape.get("scaleY") or 1)
+        stroke = float(shape.get("strokeWidth") or 0) / 2
+        if kind in ("rectangle", "button", "image"):
+            box = (x, y, float(shape.get("width") or 0) * sx, float(shape.get("height") or 0) * sy)
+        elif kind == "circle":
+            r = float(shape.get("radius") or 0)
+            box = (x - r * sx, y - r * sy, 2 * r * sx, 2 * r * sy)
+        elif kind in ("ellipse", "triangle"):
+            rx = float(shape.get("radiusX") or shape.get("radius") or 0)
+            ry = float(shape.get("radiusY") or shape.get("radius") or 0)
+            box = (x - rx * sx, y - ry * sy, 2 * rx * sx, 2 * ry * sy)
+        elif kind in ("arrow", "line"):  # width/height are the (dx, dy) displacement
+            w, h = float(shape.get("width") or 0), float(shape.get("height") or 0)
+            box = (min(x, x + w), min(y, y + h), abs(w), abs(h))
+        elif kind == "text":
+            size = float(shape.get("fontSize") or 16)
+            text = str(shape.get("text") or "")
+            longest = max((len(line) for line in text.split("\n")), default=0)
+            box = (x, y, longest * size * 0.55, size * max(1, text.count("\n") + 1))
+            stroke = 0.0
+        else:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return _grow(box, stroke) if stroke else box
+
+
+def _flatten_shapes(canvas: Dict[str, Any]) -> List[Tuple[Dict[str, Any], float, float]]:
+    flat = [(s, 0.0, 0.0) for s in canvas.get("shapes") or [] if isinstance(s, dict)]
+    for group in canvas.get("componentGroups") or []:
+        if not isinstance(group, dict):
+            continue
+        gx, gy = float(group.get("x") or 0), float(group.get("y") or 0)
+        flat.extend((s, gx, gy) for s in group.get("shapes") or [] if isinstance(s, dict))
+    return flat
+
+
+def _classify(candidates: List[_Candidate], layout: Box) -> None:
+    """Assign parent/children, class and confidence to every candidate."""
+    by_area = sorted(candidates, key=lambda c: c.area, reverse=True)
+    for i, cand in enumerate(by_area):
+        for outer in reversed(by_area[:i]):  # smallest enclosing box wins
+            if outer.area > cand.area and _inside_share(cand.box, outer.box) >= _CONTAIN_RATIO:
+                cand.parent = outer
+                outer.children.append(cand)
+                break
+
+    top = [c for c in candidates if c.parent is None]
+    frame = None
+    if len(candidates) > 1 and len(top) == 1 and top[0].children:
+        frame = top[0]
+    elif len(top) > 1:
+        biggest = max(top, key=lambda c: c.area)
+        if biggest.area >= _FRAME_COVER * layout[2] * layout[3] and biggest.children:
+            frame = biggest
+    if frame is not None:
+        frame.cls, frame.confidence = "section", 0.8
+        region = frame.box
+        level = [c for c in top if c is not frame] + frame.children
+    else:
+        region = layout
+        level = top
+    region_area = max(region[2] * region[3], 1.0)
+
+    tops = sorted(level, key=lambda c: c.box[1] + c.box[3] / 2)
+    for cand in level:
+        x, y, w, h = cand.box
+        rel_cy = (y + h / 2 - region[1]) / max(region[3], 1.0)
+        aspect = w / max(h, 1.0)
+        bar = w >= _BAR_MIN_WIDTH * region[2] and aspect >= _BAR_MIN_ASPECT
+        if bar and cand is tops[0] and rel_cy < 1 / 3:
+            cand.cls, cand.confidence = "navbar", 0.95 if aspect >= 2 * _BAR_MIN_ASPECT else 0.9
+        elif bar and cand is tops[-1] and rel_cy > 2 / 3:
+            cand.cls, cand.confidence = "footer", 0.95 if aspect >= 2 * _BAR_MIN_ASPECT else 0.9
+        elif bar:
+            cand.cls, cand.confidence = "section", 0.75
+        elif cand.children or cand.area >= _SECTION_MIN_AREA * region_area:
+            cand.cls, cand.confidence = "section", 0.9 if cand.children else 0.7
+        else:
+            cand.cls, cand.confidence = "card", 0.85
+
+    placed = set(map(id, level)) | ({id(frame)} if frame is not None else set())
+    for cand in candidates:
+        if id(cand) in placed:
+            continue
+        if cand.children and cand.parent is not None and cand.parent.cls == "section" and (
+            cand.area >= _NESTED_SECTION_MIN_AREA * region_area
+        ):
+            cand.cls, cand.confidence = "section", 0.7
+        else:
+            cand.cls, cand.confidence = "card", 0.9 if not cand.children else 0.75
+
+    for cand in candidates:
+        cand.confidence = round(cand.confidence * cand.fit, 3)
+
+
+def detect_from_canvas(
+    canvas_data: Dict[str, Any],
+    image_size: Optional[Tuple[int, int]],
+    *,
+    min_confidence: Optional[float] = None,
+) -> Optional[ExternalModelOutput]:
+    """Classify the drawn boxes in ``canvas_data``; None when the drawing is
+    ambiguous (see the module docstring) and Roboflow should decide.
+
+    ``image_size`` is the exported PNG's (width, height); boxes come back in
+    its pixel space.
+    """
+    gate = vector_min_confidence() if min_confidence is None else min_confidence
+
+    def ambiguous(reason: str) -> None:
+        print(f"[vector] {reason} → Roboflow")
+        return None
+
+    if not image_size:
+        return ambiguous("no PNG size to map boxes into")
+
+    content: Optional[Box] = None
+    candidates: List[_Candidate] = []
+    ink: List[Tuple[Box, float, float]] = []  # open freehand strokes: (bbox, length, straightness)
+    # Shapes come in as free-form JSON (CanvasData is Dict[str, Any]): a
+    # number that does not parse makes the drawing ambiguous, not an error.
+    try:
+        for shape, dx, dy in _flatten_shapes(canvas_data):
+            kind = shape.get("type")
+            if kind not in _KNOWN_SHAPES:
+                return ambiguous(f"unknown shape type {kind!r}")
+            if float(shape.get("rotation") or 0) % 360:
+                return ambiguous("rotated shape")
+            box = _shape_box(shape, dx, dy)
+            if box is None:
+                return ambiguous(f"unreadable {kind} shape")
+            content = _union(content, box)
+            if kind in ("rectangle", "button", "image"):
+                stroke = float(shape.get("strokeWidth") or 0) / 2
+                inner = _grow(box, -stroke) if stroke else box
+                if inner[2] >= _MIN_BOX_SIDE and inner[3] >= _MIN_BOX_SIDE:
+                    candidates.append(
+                        _Candidate(inner, kind, fit=0.8 if kind == "image" else 1.0)
+                    )
+
+        for line in canvas_data.get("lines") or []:
+            if not isinstance(line, dict):
+                continue
+            if str(line.get("tool") or "pen") == "eraser":
+                return ambiguous("eraser strokes")
+            points = _points(line.get("points"))
+            box = _bbox(points)
+            if box is None or len(points) < 2:
+                continue
+            half = float(line.get("width") or 2) / 2
+            content = _union(content, _grow(box, half))
+            fit = _closed_box_fit(points, box)
+            if fit >= _RECT_FILL_MIN:
+                sure = min(1.0, (fit - _RECT_FILL_MIN) / (_RECT_FILL_SURE - _RECT_FILL_MIN))
+                candidates.append(_Candidate(box, "stroke", fit=round(0.6 + 0.4 * sure, 3)))
+            else:
+                length = _stroke_length(points)
+                straightness = math.dist(points[0], points[-1]) / length if length else 0.0
+                ink.append((box, length, straightness))
+    except (TypeError, ValueError):
+        return ambiguous("unreadable canvas data")
+
+    if not candidates or content is None:
+        return ambiguous("no drawn boxes")
+
+    layout = candidates[0].box
+    for cand in candidates[1:]:
+        layout = _union(layout, cand.box)
+    assert layout is not None
+
+    total_ink = sum(length for _, length, _ in ink)
+    stray_ink = 0.0
+    for box, length, straightness in ink:
+        holders = [c.box for c in candidates if _centre_in(box, c.box)]
+        span = max(box[2], box[3])
+        if not holders:
+            if span > _STRAY_STROKE_SPAN * max(layout[2], layout[3]):
+                return ambiguous("long stroke outside every box")
+            stray_ink += length
+            continue
+        holder = min(holders, key=lambda b: b[2] * b[3])
+        if straightness >= _EDGE_STRAIGHTNESS and span > _STRAY_STROKE_SPAN * max(holder[2], holder[3]):
+            return ambiguous("straight stroke that looks like a box edge")
+    if total_ink and stray_ink > _STRAY_INK_SHARE * total_ink:
+        return ambiguous("freehand ink outside every box")
+
+    _classify(candidates, layout)
+    weakest = min(candidates, key=lambda c: c.confidence)
+    if weakest.confidence < gate:
+        return ambiguous(f"{weakest.cls} from a {weakest.origin} at {weakest.confidence:.2f} < {gate:.2f}")
+
+    # Rebuild the export transform: image = (canvas - offset) * scale.
+    img_w, img_h = image_size
+    scale_x = img_w / (content[2] + 2 * _EXPORT_PAD)
+    scale_y = img_h / (content[3] + 2 * _EXPORT_PAD)
+    scale = (scale_x + scale_y) / 2
+    if abs(scale_x - scale_y) > _SCALE_TOLERANCE * scale:
+        return ambiguous(f"PNG {img_w}x{img_h} does not match the drawing's extent")
+    offset_x = max(0.0, content[0] - _EXPORT_PAD)
+    offset_y = max(0.0, content[1] - _EXPORT_PAD)
+
+    elements = [
+        ExternalModelElement(
+            id=f"vector-{i}",
+            type=cand.cls,
+            confidence=cand.confidence,
+            label=cand.cls.capitalize(),
+            bounds={
+                "x": (cand.box[0] - offset_x) * scale,
+                "y": (cand.box[1] - offset_y) * scale,
+                "width": cand.box[2] * scale,
+                "height": cand.box[3] * scale,
+            },
+            attributes={"vector_origin": cand.origin},
+        )
+        for i, cand in enumerate(candidates, 1)
+    ]
+    # The same rectangle drawn twice (or a template dropped on itself).
+    elements = _class_aware_nms(elements, 0.9)
+    snap_positional_bars(elements)
+    sort_reading_order(elements)
+    return ExternalModelOutput(
+        source="vector",
+        model_version=VECTOR_MODEL_VERSION,
+        elements=elements,
+        metadata={
+            "model_id": VECTOR_MODEL_VERSION,
+            "filtered_prediction_count": len(elements),
+            "confidence_threshold": gate,
+            "image_width": img_w,
+            "image_height": img_h,
+            "export_transform": {
+                "offsetX": round(offset_x, 2),
+                "offsetY": round(offset_y, 2),
+                "scale": round(scale, 4),
+            },
+        },
+    )
@@ -0,0 +1,86 @@
+"""Cooperative cancellation for blocking upstream calls (Gemini, Roboflow).
+
+``asyncio.wait_for`` around a worker-thread call only abandons the *await*:
+the thread keeps rotating Gemini keys / retrying Roboflow after the user has
+already received a 504, burning pool slots and quota for a result nobody
+reads. Python threads cannot be killed, so the blocking code has to stop
+itself. A CancellationToken is handed to the call; it is checked at the
+natural checkpoints (between key/model attempts, between stream chunks,
+before and during Roboflow retry backoff) and its remaining deadline bounds
+per-request HTTP timeouts where the client library supports one.
+
+A token is cancelled explicitly (``cancel()``: the caller gave up or the
+client disconnected) or implicitly once its deadline passes. The call raises
+CallCancelled at its next checkpoint; every such early exit is counted per
+upstream and exposed via ``abandoned_counts()`` for /api/metrics.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Optional
+
+_abandoned: Dict[str, int] = {}
+_abandoned_lock = threading.Lock()
+
+
+class CallCancelled(Exception):
+    """The caller no longer wants this result; stop doing upstream work."""
+
+
+class CancellationToken:
+    """Thread-safe cancel flag with an optional deadline.
+
+    ``name`` labels the upstream ("gemini", "roboflow") for the abandoned-call
+    counters.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, *, name: str = "upstream") -> None:
+        self.name = name
+        self._event = threading.Event()
+        self._deadline = time.monotonic() + timeout if timeout is not None else None
+        self.reason = ""
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self.cancel("deadline exceeded")
+            return True
+        return False
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline (None when there is none)."""
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to ``seconds``, waking early on cancel. True if cancelled."""
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self._event.wait(remaining)
+            return self.cancelled
+        return self._event.wait(seconds) or self.cancelled
+
+    def raise_if_cancelled(self, where: str = "") -> None:
+        if not self.cancelled:
+            return
+        with _abandoned_lock:
+            _abandoned[self.name] = _abandoned.get(self.name, 0) + 1
+        suffix = f" {where}" if where else ""
+        print(f"[cancel] {self.name}: abandoning call{suffix} ({self.reason})")
+        raise CallCancelled(f"{self.name} call cancelled: {self.reason}")
+
+
+def abandoned_counts() -> Dict[str, int]:
+    """Calls that stopped early because their caller had already given up."""
+    with _abandoned_lock:
+        return dict(_abandoned)
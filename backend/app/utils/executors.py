@@ -0,0 +1,245 @@
+"""Bounded per-upstream thread pools with admission control.
+
+Why: every blocking call used to go through ``asyncio.to_thread``, i.e. the
+loop's single default executor (min(32, cpu + 4) threads). Gemini calls can
+hold a thread for up to GEMINI_TIMEOUT_SECONDS, so a burst of them starves
+Roboflow detection and fidelity renders of threads, and everything behind
+them waits in an unbounded queue with no signal to the client.
+
+Each upstream (Roboflow, Gemini, Chromium render, OpenCV/CPU) gets its own
+BoundedExecutor: a fixed number of worker threads plus a bounded wait queue.
+When workers AND queue are full, ``run()`` raises ExecutorSaturated at once
+instead of queueing — the caller sheds the request with a 503 + Retry-After
+while the client can still retry somewhere useful.
+
+Accounting: a slot is taken at submit and released when the work actually
+finishes (or is cancelled before it started). A caller that times out via
+``asyncio.wait_for`` does NOT free the slot early — the thread is still busy,
+so admission keeps reflecting real thread occupancy.
+
+Gemini runs on the event loop (generate_with_gemini_async) rather than on
+threads, so it gets a BoundedConcurrency instead: the same admission and
+metrics, but the "workers" are concurrent coroutines, and a caller that
+times out cancels the call itself and frees its slot immediately.
+
+Env vars (read by main.py, all optional): <NAME>_EXECUTOR_WORKERS and
+<NAME>_EXECUTOR_QUEUE for NAME in ROBOFLOW, GEMINI, RENDER, CPU.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class ExecutorSaturated(Exception):
+    """Raised by BoundedExecutor.run when every worker and queue slot is taken."""
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"{name} executor is saturated; retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class _Admission:
+    """Shared admission control and queue-time metrics.
+
+    ``_inflight`` counts queued + running work; ``_admit`` rejects once it
+    reaches workers + queue, ``_started``/``_finished`` keep the timing stats.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        if max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+        if max_queue < 0:
+            raise ValueError("max_queue must be >= 0")
+        self.name = name
+        self.max_workers = int(max_workers)
+        self.max_queue = int(max_queue)
+        self._lock = threading.Lock()
+        self._inflight = 0  # queued + running
+        self._running = 0
+        self._stats: Dict[str, float] = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected": 0,
+            "last_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "total_wait_ms": 0.0,
+            "total_run_ms": 0.0,
+        }
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def retry_after(self) -> float:
+        """Rough seconds until a slot frees up: the queue ahead drained at the
+        observed mean service time. Clamped to [1, 60]."""
+        with self._lock:
+            completed = self._stats["completed"]
+            avg_run_s = (self._stats["total_run_ms"] / completed / 1000) if completed else 1.0
+            waves = (self._inflight - self.max_workers + 1) / self.max_workers
+        return float(min(60, max(1, math.ceil(avg_run_s * max(waves, 1.0)))))
+
+    def _admit(self) -> None:
+        with self._lock:
+            if self._inflight >= self.capacity:
+                self._stats["rejected"] += 1
+                rejected = True
+            else:
+                self._inflight += 1
+                self._stats["submitted"] += 1
+                rejected = False
+        if rejected:
+            retry_after = self.retry_after()
+            print(
+                f"[executor] {self.name}: saturated ({self.max_workers} running, "
+                f"{self.max_queue} queued) — shedding, retry in {retry_after:.0f}s"
+            )
+            raise ExecutorSaturated(self.name, retry_after)
+
+    def _release(self, _future: Any = None) -> None:
+        with self._lock:
+            self._inflight -= 1
+
+    def _started(self, submitted_at: float) -> float:
+        started_at = time.perf_counter()
+        wait_ms = (started_at - submitted_at) * 1000
+        with self._lock:
+            self._running += 1
+            self._stats["last_wait_ms"] = wait_ms
+            self._stats["total_wait_ms"] += wait_ms
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+        return started_at
+
+    def _finished(self, started_at: float) -> None:
+        run_ms = (time.perf_counter() - started_at) * 1000
+        with self._lock:
+            self._running -= 1
+            self._stats["completed"] += 1
+            self._stats["total_run_ms"] += run_ms
+
+    def shutdown(self) -> None:
+        pass
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            inflight = self._inflight
+            running = self._running
+        started = stats["completed"] + running
+        return {
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": running,
+            "queued": max(0, inflight - running),
+            "submitted": int(stats["submitted"]),
+            "completed": int(stats["completed"]),
+            "rejected": int(stats["rejected"]),
+            "queue_wait_ms": {
+                "last": round(stats["last_wait_ms"], 1),
+                "avg": round(stats["total_wait_ms"] / started, 1) if started else 0.0,
+                "max": round(stats["max_wait_ms"], 1),
+            },
+            "run_ms_avg": (
+                round(stats["total_run_ms"] / stats["completed"], 1) if stats["completed"] else 0.0
+            ),
+        }
+
+
+class BoundedExecutor(_Admission):
+    """ThreadPoolExecutor with a hard cap on queued work and queue-time metrics."""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        super().__init__(name, max_workers, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+
+    async def run(self, fn: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+        """``asyncio.to_thread`` on this pool, or ExecutorSaturated when full."""
+        self._admit()
+        submitted_at = time.perf_counter()
+        ctx = contextvars.copy_context()
+        call = functools.partial(ctx.run, fn, *args, **kwargs)
+
+        def _timed() -> T:
+            started_at = self._started(submitted_at)
+            try:
+                return call()
+            finally:
+                self._finished(started_at)
+
+        try:
+            future: Future = self._pool.submit(_timed)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class BoundedConcurrency(_Admission):
+    """BoundedExecutor's admission control for coroutine functions.
+
+    At most ``max_workers`` calls run concurrently on the event loop and at
+    most ``max_queue`` wait (FIFO) for a turn; beyond that ``run()`` raises
+    ExecutorSaturated. Cancelling the awaiting caller cancels the call and
+    frees its slot at once — there is no thread left running.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        super().__init__(name, max_workers, max_queue)
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._active = 0
+
+    async def run(self, fn: Callable[..., Awaitable[T]], /, *args: Any, **kwargs: Any) -> T:
+        """Await ``fn(*args, **kwargs)`` within the limit, or ExecutorSaturated when full."""
+        self._admit()
+        submitted_at = time.perf_counter()
+        try:
+            await self._acquire()
+        except BaseException:
+            self._release()
+            raise
+        started_at = self._started(submitted_at)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self._finished(started_at)
+            self._hand_off()
+            self._release()
+
+    async def _acquire(self) -> None:
+        if self._active < self.max_workers and not self._waiters:
+            self._active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter  # resolved by _hand_off, which passes its slot on
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._hand_off()  # got a slot while being cancelled: pass it on
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _hand_off(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
@@ -527,6 +527,8 @@ async def render_code_to_png(
     framework: str,
     width: int,
     height: int,
+    *,
+    executor: Optional[Any] = None,
 ) -> bytes:
     """Render generated code headless and return a PNG in the sketch's pixel
     space (width x height).
@@ -542,6 +544,9 @@ async def render_code_to_png(
     loop cannot spawn subprocesses (asyncio raises NotImplementedError when
     Playwright launches Chromium). The worker thread builds a Proactor loop
     directly, bypassing the policy.
+
+    ``executor`` (a BoundedExecutor) runs that worker on a dedicated pool
+    instead of the default one; it may raise ExecutorSaturated.
     """
     try:
         from playwright.async_api import async_playwright  # noqa: F401
@@ -568,9 +573,12 @@ async def render_code_to_png(
 
     import asyncio
 
-    png = await asyncio.to_thread(
-        _render_html_in_own_loop, html, view_w, view_h, settle_ms
-    )
+    if executor is not None:
+        png = await executor.run(_render_html_in_own_loop, html, view_w, view_h, settle_ms)
+    else:
+        png = await asyncio.to_thread(
+            _render_html_in_own_loop, html, view_w, view_h, settle_ms
+        )
     return _resize_png(png, int(width), int(height))
 
 
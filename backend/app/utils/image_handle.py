@@ -0,0 +1,166 @@
+"""ImageHandle: one decoded sketch image, shared by every stage that reads it.
+
+An upload used to be decoded from base64, opened, composited and
+preprocessed, then PNG-encoded and base64-encoded into
+``metadata["processed_image_b64"]``. /api/predict then base64-decoded it and
+PIL re-opened it for Gemini. On a 12 MP phone photo that round trip costs
+more CPU than the preprocessing itself, and it briefly holds several
+full-size copies of the image.
+
+A handle carries the decoded pixels (a numpy array or a PIL image) from the
+decode to the last consumer. Each consumer asks for the form it needs:
+
+    pil()          the Roboflow JPEG encode, the debug dump
+    array()        numpy / OpenCV stages
+    encode("PNG")  the image part sent to Gemini
+    b64("PNG")     the /api/detect review preview
+
+Conversions and encodings are made on first request and cached, so each one
+happens at most once per handle, however many callers share it (single-flight
+joiners, detection-cache hits). Base64 is not cached: it would be a second,
+larger copy of an encoding the handle already holds, and it is cheap to
+redo. ``nbytes`` is what the handle holds right now, for bounded caches.
+
+Handles are immutable: callers must not draw on the arrays or images they
+are given. Copying a handle returns the same handle, so pydantic's
+``model_copy(deep=True)`` shares it instead of copying the pixels. It
+cannot be pickled or JSON-serialized.
+"""
+
+from __future__ import annotations
+
+import base64
+import io
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+
+class ImageHandle:
+    """Decoded image pixels with lazily converted, cached forms."""
+
+    def __init__(
+        self,
+        *,
+        array: Optional[np.ndarray] = None,
+        image: Any = None,
+        data: Optional[bytes] = None,
+    ) -> None:
+        if array is None and image is None and data is None:
+            raise ValueError("ImageHandle needs an array, a PIL image or encoded bytes")
+        # Own a compact buffer: a crop view would keep the whole frame alive.
+        # A view of it, so array() making the handle's copy read-only never
+        # touches the flags of an array the caller still holds.
+        self._array = np.ascontiguousarray(array).view() if array is not None else None
+        self._image = image
+        self._data = data  # encoded file bytes, decoded on first use
+        self._encoded: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._encode_lock = threading.RLock()  # one encode per format, ever
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "ImageHandle":
+        """HxWx3 uint8 RGB (or HxW grayscale) pixels."""
+        return cls(array=array)
+
+    @classmethod
+    def from_pil(cls, image: Any) -> "ImageHandle":
+        return cls(image=image)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ImageHandle":
+        """An encoded image file; decoded the first time pixels are needed."""
+        return cls(data=data)
+
+    def pil(self) -> Any:
+        """The image as PIL. Built from the array once; the array is then
+        released (array() rebuilds it if ever asked), so the handle holds one
+        full-size copy of the pixels, not two."""
+        with self._lock:
+            if self._image is None:
+                from PIL import Image
+
+                if self._array is not None:
+                    self._image = Image.fromarray(self._array)
+                    self._array = None
+                else:
+                    image = Image.open(io.BytesIO(self._data))
+                    image.load()  # decode now, so a bad image fails here
+                    self._image = image
+            return self._image
+
+    def array(self) -> np.ndarray:
+        """The pixels as a read-only numpy array."""
+        with self._lock:
+            array = self._array
+        if array is None:
+            array = np.asarray(self.pil())
+            with self._lock:
+                self._array = array
+        array.flags.writeable = False
+        return array
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(width, height)."""
+        with self._lock:
+            if self._array is not None:
+                return self._array.shape[1], self._array.shape[0]
+        return self.pil().size
+
+    def encode(self, format: str = "PNG") -> bytes:
+        """The image encoded as ``format`` (a PIL format name), cached."""
+        format = format.upper()
+        with self._encode_lock:
+            if format not in self._encoded:
+                if self._sniff() == format:
+                    self._encoded[format] = self._data  # already that format
+                else:
+                    buffer = io.BytesIO()
+                    self.pil().save(buffer, format=format)
+                    self._encoded[format] = buffer.getvalue()
+            return self._encoded[format]
+
+    def b64(self, format: str = "PNG") -> str:
+        """Base64 of ``encode(format)`` (the encoding is cached, this is not)."""
+        return base64.b64encode(self.encode(format)).decode("ascii")
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes currently held: decoded pixels in every form built so far
+        plus the source bytes and each cached encoding."""
+        with self._lock:
+            array, image, data = self._array, self._image, self._data
+        total = array.nbytes if array is not None else 0
+        if image is not None:
+            total += image.width * image.height * len(image.getbands())
+        with self._encode_lock:
+            encoded = [blob for blob in self._encoded.values() if blob is not data]
+        return total + len(data or b"") + sum(len(blob) for blob in encoded)
+
+    def _sniff(self) -> Optional[str]:
+        head = (self._data or b"")[:8]
+        if head.startswith(b"\x89PNG"):
+            return "PNG"
+        if head.startswith(b"\xff\xd8"):
+            return "JPEG"
+        return None
+
+    # Immutable and in-memory only: share on copy, refuse to serialize.
+    def __copy__(self) -> "ImageHandle":
+        return self
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "ImageHandle":
+        return self
+
+    def __reduce__(self) -> Any:
+        raise TypeError("ImageHandle is in-memory only and cannot be serialized")
+
+    def __repr__(self) -> str:
+        forms = [
+            name
+            for name, value in (("array", self._array), ("pil", self._image), ("bytes", self._data))
+            if value is not None
+        ]
+        return f"ImageHandle({'+'.join(forms)}, encoded={sorted(self._encoded)})"
@@ -0,0 +1,110 @@
+"""Streaming latency statistics: an EWMA plus P² quantile estimates.
+
+Per (Gemini key, model) slot we want "how fast is it lately" (the EWMA, which
+follows a slot that turns slow within a few calls) and "what does its
+distribution look like" (p50/p95, for /api/llm-status). Keeping every sample
+to sort on read would grow without bound, so the quantiles use the P²
+algorithm (Jain & Chlamtac, 1985): five markers per quantile, O(1) memory and
+O(1) work per observation, exact for the first five samples.
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from typing import Dict, List, Optional, Sequence
+
+
+class P2Quantile:
+    """Running estimate of one quantile ``p`` (0 < p < 1) of a stream."""
+
+    def __init__(self, p: float) -> None:
+        if not 0.0 < p < 1.0:
+            raise ValueError("p must be in (0, 1)")
+        self.p = p
+        self.count = 0
+        self._heights: List[float] = []  # marker heights q[0..4]
+        self._positions = [0, 1, 2, 3, 4]  # actual marker positions n[0..4]
+        self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self._increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        q = self._heights
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                height = self._parabolic(i, step)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                q[i] = height
+                n[i] += step
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q, n = self._heights, self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> Optional[float]:
+        if not self.count:
+            return None
+        if self.count <= 5:
+            # Few samples: nearest-rank on the exact values.
+            return self._heights[max(0, math.ceil(self.p * self.count) - 1)]
+        return self._heights[2]
+
+
+class LatencyStats:
+    """Thread-safe EWMA + p50/p95 (by default) over observed durations in seconds."""
+
+    def __init__(self, alpha: float = 0.3, quantiles: Sequence[float] = (0.5, 0.95)) -> None:
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.count = 0
+        self.ewma: Optional[float] = None
+        self._quantiles = {p: P2Quantile(p) for p in quantiles}
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.ewma = (
+                seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+            )
+            for estimator in self._quantiles.values():
+                estimator.add(seconds)
+
+    def quantile(self, p: float) -> Optional[float]:
+        with self._lock:
+            return self._quantiles[p].value()
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """{"samples", "ewma_ms", "p50_ms", "p95_ms"} for status endpoints."""
+        with self._lock:
+            out: Dict[str, Optional[float]] = {"samples": self.count}
+            out["ewma_ms"] = round(self.ewma * 1000, 1) if self.ewma is not None else None
+            for p, estimator in self._quantiles.items():
+                value = estimator.value()
+                out[f"p{round(p * 100)}_ms"] = round(value * 1000, 1) if value is not None else None
+            return out
@@ -0,0 +1,359 @@
+"""Write-behind persistence queue for Supabase writes in the request path.
+
+Why: supabase-py is a synchronous HTTPS client. Calling it straight from an
+``async def`` handler blocks the uvicorn event loop for a full round trip, so
+one slow ``iterations`` insert stalls every concurrent request — cache hits
+included. Version-history writes are not on the user's critical path (the
+response only needs the iteration id), so they are handed to a bounded
+in-process queue and flushed by a background writer thread.
+
+Contract:
+- ``submit_iteration`` pre-generates the iteration UUID, enqueues the
+  ``iterations`` insert + ``projects`` mirror update, and returns the id
+  immediately. ``submit_insert`` does the same for arbitrary audit rows
+  (``detection_corrections``).
+- Both report refusal (None / False) when the queue is not running or is
+  full. Callers then fall back to a direct write (off the event loop), so a saturated queue
+  degrades to the old behaviour instead of dropping history.
+- The writer drains whatever is queued (up to ``batch_size`` jobs), collapses
+  inserts per table into one multi-row insert and updates per row id into one
+  update (last write wins, fields merged), and retries failures with
+  exponential backoff. A batch that still fails is retried row by row so one
+  poison row cannot take its neighbours down with it.
+- Rows carrying their own ``id`` (iterations) are written as an upsert that
+  ignores existing ids, so a retry after a lost response (the insert landed,
+  the reply did not) is a no-op instead of a duplicate-key failure.
+
+Process-local like the rate limiter and cache: each uvicorn worker owns its own
+queue. ``stop()`` drains the queue on shutdown so a deploy does not lose
+accepted writes.
+
+Env vars (read by main.py, all optional):
+  PERSIST_QUEUE_ENABLED=true     set false to write synchronously (old path)
+  PERSIST_QUEUE_MAX_DEPTH=500    queued jobs before submit() starts refusing
+  PERSIST_BATCH_SIZE=25          max jobs flushed per writer cycle
+  PERSIST_MAX_RETRIES=3          attempts per batch before the row-by-row pass
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass
+class WriteJob:
+    """One queued write. ``kind`` is "insert" (``payload`` is a row or a list
+    of rows) or "update" (``payload`` is the column dict, ``match_id`` the
+    row's primary key)."""
+
+    kind: str
+    table: str
+    payload: Any
+    match_id: Optional[str] = None
+    enqueued_at: float = field(default_factory=lambda: time.monotonic())
+
+
+_STOP = object()
+
+
+class PersistenceQueue:
+    """Bounded write-behind queue with a single background writer thread.
+
+    ``client_factory`` returns a supabase client (the writer calls it lazily
+    on each flush, so a client created after startup is picked up).
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        *,
+        max_depth: int = 500,
+        batch_size: int = 25,
+        max_retries: int = 3,
+        retry_base_seconds: float = 0.5,
+    ) -> None:
+        if max_depth < 1:
+            raise ValueError("max_depth must be >= 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        if max_retries < 1:
+            raise ValueError("max_retries must be >= 1")
+        self._client_factory = client_factory
+        self.max_depth = int(max_depth)
+        self.batch_size = int(batch_size)
+        self.max_retries = int(max_retries)
+        self.retry_base_seconds = float(retry_base_seconds)
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=self.max_depth)
+        self._thread: Optional[threading.Thread] = None
+        self._stop_requested = threading.Event()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "enqueued": 0,
+            "written": 0,
+            "failed": 0,
+            "rejected": 0,
+            "retries": 0,
+            "batches": 0,
+            "last_write_ms": 0.0,
+            "max_write_ms": 0.0,
+            "total_write_ms": 0.0,
+            "last_queue_wait_ms": 0.0,
+        }
+
+    # ── lifecycle ────────────────────────────────────────────────────────────
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_requested.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="persistence-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush everything already queued, then stop the writer."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            # Full queue and a writer stuck on a slow flush: no room for the
+            # sentinel, so flag the stop instead. The writer exits once it
+            # has drained the queue; the join below bounds the wait either way.
+            self._stop_requested.set()
+        thread.join(max(0.0, deadline - time.monotonic()))
+        self._thread = None
+
+    # ── producers (called from request handlers, never block) ────────────────
+
+    def submit_iteration(
+        self,
+        project_id: str,
+        canvas_data: Any,
+        generated_code: str,
+        prompt_used: Optional[str],
+    ) -> Optional[str]:
+        """Queue an ``iterations`` insert + ``projects`` mirror update.
+
+        Returns the pre-generated iteration id, or None when the queue is not
+        running or full (caller must write synchronously instead)."""
+        if not self.running:
+            return None
+        iteration_id = str(uuid.uuid4())
+        insert = WriteJob(
+            kind="insert",
+            table="iterations",
+            payload={
+                "id": iteration_id,
+                "project_id": project_id,
+                "canvas_data": canvas_data,
+                "generated_code": generated_code,
+                "prompt_used": prompt_used,
+            },
+        )
+        update = WriteJob(
+            kind="update",
+            table="projects",
+            payload={"generated_code": generated_code, "canvas_data": canvas_data},
+            match_id=project_id,
+        )
+        # Both halves or neither: reserve room for the pair under the lock so
+        # a concurrent producer cannot squeeze in between the two puts.
+        with self._lock:
+            if self._queue.qsize() + 2 > self.max_depth:
+                self._stats["rejected"] += 1
+                return None
+            self._queue.put_nowait(insert)
+            self._queue.put_nowait(update)
+            self._stats["enqueued"] += 2
+        return iteration_id
+
+    def submit_insert(self, table: str, rows: List[Dict[str, Any]]) -> bool:
+        """Queue a fire-and-forget insert. False when it was not accepted."""
+        if not self.running or not rows:
+            return False
+        with self._lock:
+            try:
+                self._queue.put_nowait(WriteJob(kind="insert", table=table, payload=list(rows)))
+            except queue.Full:
+                self._stats["rejected"] += 1
+                return False
+            self._stats["enqueued"] += len(rows)
+        return True
+
+    # ── metrics ──────────────────────────────────────────────────────────────
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats.pop("batches")
+        total_ms = stats.pop("total_write_ms")
+        return {
+            "running": self.running,
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "enqueued": int(stats["enqueued"]),
+            "written": int(stats["written"]),
+            "failed": int(stats["failed"]),
+            "rejected": int(stats["rejected"]),
+            "retries": int(stats["retries"]),
+            "write_latency_ms": {
+                "last": round(stats["last_write_ms"], 1),
+                "avg": round(total_ms / batches, 1) if batches else 0.0,
+                "max": round(stats["max_write_ms"], 1),
+            },
+            "last_queue_wait_ms": round(stats["last_queue_wait_ms"], 1),
+        }
+
+    # ── writer ───────────────────────────────────────────────────────────────
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            batch: List[WriteJob] = []
+            stop = first is _STOP
+            if not stop:
+                batch.append(first)
+            # Drain without blocking: under load the queue fills while the
+            # previous batch is in flight, so batching happens for free.
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    continue
+                batch.append(item)
+            if batch:
+                try:
+                    self._flush(batch)
+                except Exception as error:  # never let the writer thread die
+                    print(f"[persist] writer error: {error}")
+            if (stop or self._stop_requested.is_set()) and self._queue.empty():
+                return
+
+    def _flush(self, batch: List[WriteJob]) -> None:
+        now = time.monotonic()
+        oldest_wait = max((now - job.enqueued_at) * 1000 for job in batch)
+        with self._lock:
+            self._stats["last_queue_wait_ms"] = oldest_wait
+
+        client = self._client_factory()
+        for op, count in self._coalesce(batch):
+            self._execute_with_retry(client, op, count)
+
+    @staticmethod
+    def _coalesce(batch: List[WriteJob]) -> List[Tuple[Tuple[str, str, Any, Optional[str]], int]]:
+        """Group jobs into the fewest round trips, preserving first-seen order.
+
+        Returns [((kind, table, payload, match_id), write_count), ...] where
+        write_count is the number of submitted rows/updates the op carries."""
+        inserts: Dict[str, List[Dict[str, Any]]] = {}
+        insert_jobs: Dict[str, int] = {}
+        updates: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        update_jobs: Dict[Tuple[str, str], int] = {}
+        order: List[Tuple[str, Any]] = []
+        for job in batch:
+            if job.kind == "insert":
+                if job.table not in inserts:
+                    inserts[job.table] = []
+                    insert_jobs[job.table] = 0
+                    order.append(("insert", job.table))
+                rows = job.payload if isinstance(job.payload, list) else [job.payload]
+                inserts[job.table].extend(rows)
+                insert_jobs[job.table] += len(rows)
+            elif job.kind == "update":
+                key = (job.table, job.match_id or "")
+                if key not in updates:
+                    updates[key] = {}
+                    update_jobs[key] = 0
+                    order.append(("update", key))
+                updates[key].update(job.payload)
+                update_jobs[key] += 1
+
+        ops: List[Tuple[Tuple[str, str, Any, Optional[str]], int]] = []
+        for kind, ref in order:
+            if kind == "insert":
+                ops.append((("insert", ref, inserts[ref], None), insert_jobs[ref]))
+            else:
+                table, match_id = ref
+                ops.append((("update", table, updates[ref], match_id), update_jobs[ref]))
+        return ops
+
+    @staticmethod
+    def _insert(client: Any, table: str, rows: Any) -> None:
+        batch = rows if isinstance(rows, list) else [rows]
+        if batch and all(isinstance(row, dict) and row.get("id") for row in batch):
+            # ON CONFLICT (id) DO NOTHING: safe to re-send after a lost reply.
+            client.table(table).upsert(rows, on_conflict="id", ignore_duplicates=True).execute()
+        else:
+            client.table(table).insert(rows).execute()
+
+    def _execute(self, client: Any, op: Tuple[str, str, Any, Optional[str]]) -> None:
+        kind, table, payload, match_id = op
+        if kind == "insert":
+            self._insert(client, table, payload)
+        else:
+            client.table(table).update(payload).eq("id", match_id).execute()
+
+    def _execute_with_retry(
+        self, client: Any, op: Tuple[str, str, Any, Optional[str]], write_count: int
+    ) -> None:
+        kind, table, payload, _ = op
+        last_error: Optional[Exception] = None
+        for attempt in range(1, self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                self._execute(client, op)
+            except Exception as error:
+                last_error = error
+                if attempt < self.max_retries:
+                    with self._lock:
+                        self._stats["retries"] += 1
+                    time.sleep(self.retry_base_seconds * (2 ** (attempt - 1)))
+                continue
+            self._record_write((time.perf_counter() - start) * 1000, write_count)
+            return
+
+        # Multi-row insert still failing: isolate the bad row(s) so the rest of
+        # the batch is not lost with them.
+        if kind == "insert" and isinstance(payload, list) and len(payload) > 1:
+            for row in payload:
+                start = time.perf_counter()
+                try:
+                    self._insert(client, table, row)
+                except Exception as error:
+                    print(f"[persist] could not write {table} row: {error}")
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    continue
+                self._record_write((time.perf_counter() - start) * 1000, 1)
+            return
+
+        print(
+            f"[persist] giving up on {kind} {table} after "
+            f"{self.max_retries} attempt(s): {last_error}"
+        )
+        with self._lock:
+            self._stats["failed"] += write_count
+
+    def _record_write(self, elapsed_ms: float, write_count: int) -> None:
+        with self._lock:
+            self._stats["written"] += write_count
+            self._stats["batches"] += 1
+            self._stats["last_write_ms"] = elapsed_ms
+            self._stats["total_write_ms"] += elapsed_ms
+            self._stats["max_write_ms"] = max(self._stats["max_write_ms"], elapsed_ms)
@@ -3,6 +3,25 @@ import cv2
 from typing import Dict, List, Any, Tuple
 
 
+def _binarize(gray: np.ndarray, block_size: int = 35) -> np.ndarray:
+    """Photo grayscale → crisp black-on-white line art."""
+    # Median blur kills JPEG/paper speckle without smearing strokes the way a
+    # Gaussian would. Adaptive threshold handles uneven lighting across the
+    # page far better than a single global cutoff.
+    denoised = cv2.medianBlur(gray, 3)
+    binary = cv2.adaptiveThreshold(
+        denoised,
+        255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY,
+        blockSize=block_size,
+        C=10,
+    )
+    # Drop specks of inverse noise (isolated dark pixels) via a light open.
+    kernel = np.ones((2, 2), np.uint8)
+    return cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+
+
 def preprocess_uploaded_photo(
     img_rgb: np.ndarray, *, binarize: bool, return_clean: bool = False
 ):
@@ -43,21 +62,7 @@ def preprocess_uploaded_photo(
     gray = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2GRAY)
 
     if binarize:
-        # Median blur kills JPEG/paper speckle without smearing strokes the way a
-        # Gaussian would. Adaptive threshold handles uneven lighting across the
-        # page far better than a single global cutoff.
-        denoised = cv2.medianBlur(gray, 3)
-        binary = cv2.adaptiveThreshold(
-            denoised,
-            255,
-            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY,
-            blockSize=35,
-            C=10,
-        )
-        # Drop specks of inverse noise (isolated dark pixels) via a light open.
-        kernel = np.ones((2, 2), np.uint8)
-        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+        binary = _binarize(gray)
         work_gray = binary
         rgb_out = cv2.cvtColor(binary, cv2.COLOR_GRAY2RGB)
     else:
@@ -92,54 +97,165 @@ def preprocess_uploaded_photo(
     return rgb_out[y0:y1, x0:x1]
 
 
-def preprocess_canvas_data(canvas_data: Dict[str, Any], target_size: Tuple[int, int] = (256, 256)) -> np.ndarray:
+# Fast mode: the crop is searched on a copy this size (long side), and the
+# cropped region is binarized at no more than the cap below.
+_FAST_MASK_SIDE = 512
+# Roboflow resizes to 640 before inference; twice that keeps small handwriting
+# legible for Gemini, which reads text off the clean copy.
+DEFAULT_UPLOAD_MAX_SIDE = 1280
+
+
+def preprocess_uploaded_photo_fast(
+    img_rgb: np.ndarray, *, binarize: bool, max_side: int = DEFAULT_UPLOAD_MAX_SIDE
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, float]]:
     """
-    Convert canvas JSON data to image format for CNN input
-    
-    Args:
-        canvas_data: Dict with 'strokes' or 'lines' + width/height
-        target_size: Target image dimensions for CNN
-    
+    Resolution-capped ``preprocess_uploaded_photo(..., return_clean=True)``.
+
+    The full-resolution path blurs, thresholds and searches the whole 12-48 MP
+    frame, only for Roboflow to shrink the result to 640 px. Here the crop is
+    found on a ``_FAST_MASK_SIDE`` copy, the cropped region is scaled down to
+    fit ``max_side`` first, and only that is binarized. Pair it with a JPEG
+    draft-mode decode (see inference._prepare_roboflow_image) to keep any
+    photo well under 100 ms.
+
     Returns:
-        Preprocessed numpy array ready for model input
+        (detector_img, clean_img, transform). Both images share one pixel
+        space; ``transform`` maps ``img_rgb`` pixels into it:
+        ``out = (in - offset) * scale`` per axis, with keys offsetX, offsetY,
+        scaleX, scaleY (the vector detector's export-transform convention).
     """
-    width = canvas_data.get('width', 1000)
-    height = canvas_data.get('height', 600)
-    
-    # Create blank white canvas
-    image = np.ones((height, width, 3), dtype=np.uint8) * 255
-    
-    # Draw strokes/lines on canvas
+    identity = {"offsetX": 0.0, "offsetY": 0.0, "scaleX": 1.0, "scaleY": 1.0}
+    if img_rgb is None or img_rgb.size == 0:
+        return img_rgb, img_rgb, identity
+    if img_rgb.ndim == 2:
+        img_rgb = cv2.cvtColor(img_rgb, cv2.COLOR_GRAY2RGB)
+    elif img_rgb.shape[2] == 4:
+        img_rgb = cv2.cvtColor(img_rgb, cv2.COLOR_RGBA2RGB)
+
+    # 1. Crop search on a small copy, with the same ink test as the full path.
+    h, w = img_rgb.shape[:2]
+    mask_scale = min(1.0, _FAST_MASK_SIDE / max(h, w))
+    small = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2GRAY)
+    if mask_scale < 1.0:
+        small = cv2.resize(
+            small,
+            (max(1, round(w * mask_scale)), max(1, round(h * mask_scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    if binarize:
+        # The 35 px threshold block, sized for the capped output, in mask pixels.
+        block = _odd(35 * max(small.shape) / min(max(h, w), max_side))
+        work = _binarize(small, block_size=block)
+    else:
+        _, work = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    ys, xs = np.where(work < 250)
+
+    x0, y0, x1, y1 = 0, 0, w, h
+    if ys.size and xs.size:
+        sy, sx = h / small.shape[0], w / small.shape[1]
+        # One mask pixel of slack on each side covers the downsampling.
+        margin = max(8, int(0.02 * max(h, w))) + int(np.ceil(max(sx, sy)))
+        cx0 = max(0, int(xs.min() * sx) - margin)
+        cy0 = max(0, int(ys.min() * sy) - margin)
+        cx1 = min(w, int((xs.max() + 1) * sx) + margin)
+        cy1 = min(h, int((ys.max() + 1) * sy) + margin)
+        # Same degenerate-crop guard as the full path.
+        if (cy1 - cy0) >= 16 and (cx1 - cx0) >= 16:
+            x0, y0, x1, y1 = cx0, cy0, cx1, cy1
+
+    # 2. Scale the crop to the cap, then 3. binarize only that.
+    crop = img_rgb[y0:y1, x0:x1]
+    ch, cw = crop.shape[:2]
+    scale = min(1.0, max_side / max(ch, cw))
+    if scale < 1.0:
+        out_w, out_h = max(1, round(cw * scale)), max(1, round(ch * scale))
+        clean = cv2.resize(crop, (out_w, out_h), interpolation=cv2.INTER_AREA)
+    else:
+        out_w, out_h = cw, ch
+        clean = crop
+    transform = {
+        "offsetX": float(x0),
+        "offsetY": float(y0),
+        "scaleX": out_w / cw,
+        "scaleY": out_h / ch,
+    }
+    if not binarize:
+        return clean, clean, transform
+    binary = _binarize(cv2.cvtColor(clean, cv2.COLOR_RGB2GRAY))
+    return cv2.cvtColor(binary, cv2.COLOR_GRAY2RGB), clean, transform
+
+
+def _odd(value: float, minimum: int = 3) -> int:
+    size = max(minimum, int(round(value)))
+    return size if size % 2 else size + 1
+
+
+def _canvas_polylines(canvas_data: Dict[str, Any]) -> List[np.ndarray]:
+    """Every stroke as an (N, 2) float32 array of canvas-space points."""
+    polylines: List[np.ndarray] = []
     if 'strokes' in canvas_data and canvas_data['strokes']:
         # Mini canvas format: array of stroke arrays
         for stroke in canvas_data['strokes']:
             if len(stroke) < 2:
                 continue
-            points = [(int(p['x']), int(p['y'])) for p in stroke]
-            for i in range(len(points) - 1):
-                cv2.line(image, points[i], points[i + 1], (0, 0, 0), 2)
-    
+            polylines.append(
+                np.array([(p['x'], p['y']) for p in stroke], dtype=np.float32)
+            )
+
     elif 'lines' in canvas_data and canvas_data['lines']:
         # Main canvas format: array of line objects with flattened points
         for line in canvas_data['lines']:
             points_flat = line.get('points', [])
             if len(points_flat) < 4:  # Need at least 2 points (x1,y1,x2,y2)
                 continue
-            
-            # Convert flattened points to coordinate pairs
-            points = [(int(points_flat[i]), int(points_flat[i + 1])) 
-                     for i in range(0, len(points_flat) - 1, 2)]
-            
-            for i in range(len(points) - 1):
-                cv2.line(image, points[i], points[i + 1], (0, 0, 0), 2)
-    
-    # Resize to target size for CNN
-    resized = cv2.resize(image, target_size, interpolation=cv2.INTER_AREA)
-    
+            pairs = len(points_flat) // 2
+            polylines.append(
+                np.asarray(points_flat[: 2 * pairs], dtype=np.float32).reshape(pairs, 2)
+            )
+    return polylines
+
+
+# Fixed-point bits for cv2.polylines, so scaled-down points keep sub-pixel
+# precision instead of snapping to the target grid.
+_POLYLINE_SHIFT = 4
+
+
+def preprocess_canvas_data(canvas_data: Dict[str, Any], target_size: Tuple[int, int] = (256, 256)) -> np.ndarray:
+    """
+    Convert canvas JSON data to image format for CNN input
+
+    Strokes are rasterized straight at ``target_size`` with one batched
+    ``cv2.polylines`` call (points scaled from the canvas size), instead of a
+    ``cv2.line`` per segment on a full-size canvas followed by a resize. Only
+    the contour fallback reads the result, so callers should build it lazily
+    (see SketchDetector.detect).
+
+    Args:
+        canvas_data: Dict with 'strokes' or 'lines' + width/height
+        target_size: Target image dimensions for CNN
+
+    Returns:
+        Preprocessed numpy array ready for model input
+    """
+    width = canvas_data.get('width') or 1000
+    height = canvas_data.get('height') or 600
+    target_w, target_h = target_size
+    scale_x = target_w / width
+    scale_y = target_h / height
+
+    # Blank white canvas at the target size
+    image = np.full((target_h, target_w, 3), 255, dtype=np.uint8)
+
+    polylines = _canvas_polylines(canvas_data)
+    if polylines:
+        factor = np.array([scale_x, scale_y], dtype=np.float32) * (1 << _POLYLINE_SHIFT)
+        scaled = [np.rint(points * factor).astype(np.int32) for points in polylines]
+        # The old 2px full-size stroke, scaled with the canvas (never below 1px).
+        thickness = max(1, int(round(2 * min(scale_x, scale_y))))
+        cv2.polylines(image, scaled, False, (0, 0, 0), thickness, cv2.LINE_8, _POLYLINE_SHIFT)
+
     # Normalize to [0, 1] range
-    normalized = resized.astype(np.float32) / 255.0
-    
-    return normalized
+    return image.astype(np.float32) / 255.0
 
 def normalize_coordinates(bounds: Dict[str, float], canvas_width: int, canvas_height: int) -> Dict[str, float]:
     """
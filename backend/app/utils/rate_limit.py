@@ -5,11 +5,21 @@ Why a custom limiter and not slowapi:
   proxy's IP. IP-based limiting (slowapi's default) would pool all users into a
   single bucket. The proxy authenticates the user and stamps the trusted Supabase
   user id into the request body, so we key on that instead — per-user and fair.
-- The backend is a single uvicorn process, so process-local state is enough; a
-  Redis/limits dependency is not justified at FYP scale.
+- A Redis/limits dependency is not justified at FYP scale.
 
-If this ever scales to multiple workers/instances, swap the in-process dict for a
-shared store (e.g. Redis) keyed the same way and keep the same check() contract.
+Costs: check(key, cost) charges ``cost`` units of the ``max_requests`` budget
+(default 1, i.e. plain request counting), refund(key, cost) hands units back
+once the caller learns the request was cheaper than reserved (a cache hit),
+and remaining(key) peeks at the balance for response headers. A cost larger
+than the whole budget is clamped to it so it can still pass on a fresh key.
+
+Two limiters share the check() contract:
+- SlidingWindowRateLimiter: per-key deque of timestamps, process-local. Exact,
+  but each uvicorn worker enforces its own budget.
+- GCRARateLimiter: generic cell rate algorithm — one "theoretical arrival time"
+  (TAT) float per key. Same max_requests-per-window budget and burst size,
+  O(1) state and work per check. With ``path`` set the TATs live in a WAL-mode
+  SQLite file, so every worker on the host draws from ONE budget per user.
 
 The module has zero third-party dependencies and a runnable self-check at the
 bottom (`python app/utils/rate_limit.py`) so the logic can be verified without a
@@ -18,18 +28,22 @@ test framework.
 
 from __future__ import annotations
 
+import math
+import os
+import sqlite3
 import threading
 import time
 from collections import defaultdict, deque
-from typing import Deque, Dict, Tuple
+from typing import Deque, Dict, List, Optional, Tuple
 
 
 class SlidingWindowRateLimiter:
     """Per-key sliding-window log limiter.
 
-    Each key (a user id, or an IP fallback) gets a deque of monotonic
-    timestamps for the requests it made inside the last `window_seconds`.
-    A request is allowed only while that count is below `max_requests`.
+    Each key (a user id, or an IP fallback) gets a deque of [monotonic
+    timestamp, cost] entries for the requests it made inside the last
+    `window_seconds`. A request is allowed only while the summed cost plus its
+    own stays within `max_requests`.
 
     A sliding window log is used over a fixed-window counter because fixed
     windows allow a double burst across the window boundary (up to 2x the limit
@@ -43,12 +57,13 @@ class SlidingWindowRateLimiter:
             raise ValueError("window_seconds must be > 0")
         self.max_requests = int(max_requests)
         self.window_seconds = float(window_seconds)
-        self._hits: Dict[str, Deque[float]] = defaultdict(deque)
+        self._hits: Dict[str, Deque[List[float]]] = defaultdict(deque)
         self._lock = threading.Lock()
         self._last_sweep = 0.0
 
-    def check(self, key: str) -> Tuple[bool, float, int]:
-        """Record an attempt for `key` and decide if it is allowed.
+    def check(self, key: str, cost: float = 1.0) -> Tuple[bool, float, int]:
+        """Record an attempt costing `cost` units for `key` and decide if it
+        is allowed.
 
         Returns (allowed, retry_after_seconds, remaining):
           - allowed: False once `key` has `max_requests` hits inside the window.
@@ -60,20 +75,56 @@ class SlidingWindowRateLimiter:
         A blocked attempt is NOT recorded, so a caller hammering the endpoint
         cannot keep pushing its own retry window further into the future.
         """
+        cost = min(max(float(cost), 0.0), float(self.max_requests))
         now = time.monotonic()
-        cutoff = now - self.window_seconds
         with self._lock:
             self._maybe_sweep(now)
-            hits = self._hits[key]
-            while hits and hits[0] <= cutoff:
-                hits.popleft()
+            hits = self._live_hits(key, now)
+            used = sum(c for _, c in hits)
 
-            if len(hits) >= self.max_requests:
-                retry_after = self.window_seconds - (now - hits[0])
+            if used + cost > self.max_requests + 1e-9:
+                # Wait until enough of the oldest cost ages out to fit this one.
+                freed = 0.0
+                retry_after = self.window_seconds
+                for ts, c in hits:
+                    freed += c
+                    if used - freed + cost <= self.max_requests + 1e-9:
+                        retry_after = self.window_seconds - (now - ts)
+                        break
                 return False, max(retry_after, 0.0), 0
 
-            hits.append(now)
-            return True, 0.0, self.max_requests - len(hits)
+            if cost > 0:
+                hits.append([now, cost])
+            return True, 0.0, int(math.floor(self.max_requests - used - cost + 1e-9))
+
+    def refund(self, key: str, cost: float) -> None:
+        """Return up to `cost` units charged to `key`, newest charges first."""
+        cost = float(cost)
+        with self._lock:
+            hits = self._hits.get(key)
+            while hits and cost > 0:
+                take = min(hits[-1][1], cost)
+                hits[-1][1] -= take
+                cost -= take
+                if hits[-1][1] <= 1e-9:
+                    hits.pop()
+
+    def remaining(self, key: str) -> int:
+        """Units `key` could still spend right now (does not record anything)."""
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._hits:
+                return self.max_requests
+            used = sum(c for _, c in self._live_hits(key, now))
+        return max(0, int(math.floor(self.max_requests - used + 1e-9)))
+
+    def _live_hits(self, key: str, now: float) -> Deque[List[float]]:
+        """The key's entries with aged-out ones dropped. Caller holds the lock."""
+        cutoff = now - self.window_seconds
+        hits = self._hits[key]
+        while hits and hits[0][0] <= cutoff:
+            hits.popleft()
+        return hits
 
     def _maybe_sweep(self, now: float) -> None:
         """Drop keys whose windows are fully expired so the dict cannot grow
@@ -86,12 +137,179 @@ class SlidingWindowRateLimiter:
         stale = [
             key
             for key, hits in self._hits.items()
-            if not hits or hits[-1] <= cutoff
+            if not hits or hits[-1][0] <= cutoff
         ]
         for key in stale:
             del self._hits[key]
 
 
+class GCRARateLimiter:
+    """Per-key GCRA limiter, optionally shared across processes via SQLite.
+
+    Every request advances the key's theoretical arrival time (TAT) by the
+    emission interval ``T = window_seconds / max_requests``. A request is
+    allowed while ``TAT - now <= window_seconds - T`` (the burst tolerance),
+    so an idle key can spend ``max_requests`` at once and then refills at one
+    request per ``T`` — the smooth equivalent of the sliding window, without
+    storing timestamps.
+
+    ``path=None`` keeps TATs in a process-local dict. With a path, each check
+    is one ``BEGIN IMMEDIATE`` read-modify-write on a WAL-mode SQLite file;
+    the write lock serializes workers, and ``busy_timeout`` (seconds, kept
+    short) makes contenders wait briefly rather than fail. Wall-clock time is
+    used because the stored TATs must mean the same thing in every process
+    and across restarts. check() and refund() can block for up to
+    ``busy_timeout``; async callers run them off the event loop.
+
+    If the shared store errors (disk full, locked past the timeout) the check
+    fails OPEN: rate limiting protects the budget, it must not take the API
+    down with it.
+    """
+
+    def __init__(
+        self,
+        max_requests: int,
+        window_seconds: float,
+        *,
+        path: Optional[str] = None,
+        busy_timeout: float = 0.5,
+    ) -> None:
+        if max_requests < 1:
+            raise ValueError("max_requests must be >= 1")
+        if window_seconds <= 0:
+            raise ValueError("window_seconds must be > 0")
+        if busy_timeout < 0:
+            raise ValueError("busy_timeout must be >= 0")
+        self.max_requests = int(max_requests)
+        self.window_seconds = float(window_seconds)
+        self.busy_timeout = float(busy_timeout)
+        self.emission_interval = self.window_seconds / self.max_requests
+        self.path = path
+        self._tats: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        if path is not None:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._connect().execute(
+                "CREATE TABLE IF NOT EXISTS gcra_tat (key TEXT PRIMARY KEY, tat REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _decide(
+        self, stored_tat: Optional[float], now: float, cost: float
+    ) -> Tuple[bool, float, int, float]:
+        """Pure GCRA step: (allowed, retry_after, remaining, new_tat)."""
+        tat = max(stored_tat or now, now)
+        new_tat = tat + cost * self.emission_interval
+        allow_at = new_tat - self.window_seconds
+        if now < allow_at - 1e-9:
+            return False, allow_at - now, 0, tat
+        return True, 0.0, self._remaining_for(new_tat, now), new_tat
+
+    def _remaining_for(self, tat: float, now: float) -> int:
+        units = (now + self.window_seconds - max(tat, now)) / self.emission_interval
+        return max(0, min(self.max_requests, int(math.floor(units + 1e-9))))
+
+    def check(self, key: str, cost: float = 1.0) -> Tuple[bool, float, int]:
+        """Same contract as SlidingWindowRateLimiter.check: returns
+        (allowed, retry_after_seconds, remaining); blocked attempts are not
+        recorded. A charge of ``cost`` advances the TAT by ``cost`` emission
+        intervals."""
+        cost = min(max(float(cost), 0.0), float(self.max_requests))
+        now = time.time()
+        if self.path is None:
+            with self._lock:
+                self._maybe_sweep_memory(now)
+                allowed, retry_after, remaining, new_tat = self._decide(
+                    self._tats.get(key), now, cost
+                )
+                if allowed:
+                    self._tats[key] = new_tat
+            return allowed, retry_after, remaining
+
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tat FROM gcra_tat WHERE key = ?", (key,)).fetchone()
+                allowed, retry_after, remaining, new_tat = self._decide(
+                    row[0] if row else None, now, cost
+                )
+                if allowed:
+                    conn.execute(
+                        "INSERT INTO gcra_tat (key, tat) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                        (key, new_tat),
+                    )
+                self._maybe_sweep_sqlite(conn, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as error:
+            print(f"[rate-limit] shared store error, allowing request: {error}")
+            return True, 0.0, 0
+        return allowed, retry_after, remaining
+
+    def refund(self, key: str, cost: float) -> None:
+        """Move the key's TAT back by ``cost`` intervals (never below now)."""
+        delta = max(float(cost), 0.0) * self.emission_interval
+        now = time.time()
+        if self.path is None:
+            with self._lock:
+                if key in self._tats:
+                    self._tats[key] = max(now, self._tats[key] - delta)
+            return
+        try:
+            self._connect().execute(
+                "UPDATE gcra_tat SET tat = MAX(?, tat - ?) WHERE key = ?", (now, delta, key)
+            )
+        except sqlite3.Error as error:
+            print(f"[rate-limit] shared store error, refund dropped: {error}")
+
+    def remaining(self, key: str) -> int:
+        """Units ``key`` could still spend right now (does not record anything)."""
+        now = time.time()
+        if self.path is None:
+            with self._lock:
+                tat = self._tats.get(key, now)
+        else:
+            try:
+                row = self._connect().execute(
+                    "SELECT tat FROM gcra_tat WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                return self.max_requests
+            tat = row[0] if row else now
+        return self._remaining_for(tat, now)
+
+    def _maybe_sweep_memory(self, now: float) -> None:
+        """A key whose TAT is in the past has its full burst back — same as
+        never seen — so it can be dropped. At most once per window; caller
+        holds the lock."""
+        if now - self._last_sweep < self.window_seconds:
+            return
+        self._last_sweep = now
+        for key in [k for k, tat in self._tats.items() if tat <= now]:
+            del self._tats[key]
+
+    def _maybe_sweep_sqlite(self, conn: sqlite3.Connection, now: float) -> None:
+        if now - self._last_sweep < self.window_seconds:
+            return
+        self._last_sweep = now
+        conn.execute("DELETE FROM gcra_tat WHERE tat <= ?", (now,))
+
+
 if __name__ == "__main__":
     # Lightweight self-check — runnable with `python app/utils/rate_limit.py`.
     # Not a pytest suite (that is task B11); just enough to prove the contract.
@@ -132,4 +350,22 @@ if __name__ == "__main__":
         else:
             raise AssertionError(f"expected ValueError for config {bad}")
 
+    # GCRA: same burst as the sliding window, then blocked with a retry hint.
+    import tempfile
+
+    for shared in (None, os.path.join(tempfile.gettempdir(), "gcra-selfcheck.sqlite3")):
+        g = GCRARateLimiter(max_requests=3, window_seconds=1.0, path=shared)
+        key = f"gcra-{time.time()}"
+        for i in range(3):
+            allowed, _, remaining = g.check(key)
+            _expect(allowed and remaining == 2 - i, f"gcra request {i + 1}: {allowed} {remaining}")
+        allowed, retry, _ = g.check(key)
+        _expect(not allowed and retry > 0.0, "gcra 4th request should be blocked")
+        if shared:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(shared + suffix)
+                except FileNotFoundError:
+                    pass
+
     print("rate_limit self-check passed")
@@ -0,0 +1,231 @@
+"""
+Incremental region re-detection: find what changed between two exports of
+the same canvas, and detect only that.
+
+An edit to a generated sketch is usually small (one button added, one card
+moved), yet every regeneration used to send the whole sketch to Roboflow and
+only then diff the detection sets. Instead the previous detection is kept as
+a SketchSnapshot (a grayscale thumbnail of the image the detector saw and
+the boxes it returned), and the edited export is compared with it:
+
+    changed_region()            bbox of the pixels that differ (thumbnail px)
+    plan_crop()                 that bbox, grown over any box it cuts through
+                                and padded with context, in image px; None
+                                when the crop would be most of the image
+    merge_region_detections()   previous boxes outside the crop + the crop's
+                                fresh boxes
+
+Only canvas exports qualify: Konva renders unchanged strokes to identical
+pixels, so the diff is exact. Two photos of the same paper never are. An
+export whose content bbox moved (something drawn past the old edges) shifts
+every pixel, fails the area check and gets a full detection.
+
+SketchHistory holds the snapshots, one per project screen, bounded (LRU) and
+time-limited like the detection cache.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+DIFF_SIDE = 1024  # thumbnail long side the exports are compared at
+_DIFF_THRESHOLD = 48  # grey levels; antialiasing jitter stays far below
+_MIN_CHANGED_PIXELS = 4
+
+Rect = Tuple[int, int, int, int]  # x, y, width, height
+
+
+class SketchSnapshot(NamedTuple):
+    thumbnail: np.ndarray  # grayscale, at most DIFF_SIDE px on the long side
+    image_size: Tuple[int, int]  # the detector image's (width, height)
+    elements: List[Any]  # ExternalModelElement boxes in image px
+    settings: str  # roboflow_detection_settings() they were detected under
+
+
+def sketch_thumbnail(image: Any) -> np.ndarray:
+    """Grayscale copy of a PIL image, at most DIFF_SIDE px on the long side."""
+    import cv2
+
+    gray = np.asarray(image.convert("L"))
+    height, width = gray.shape
+    scale = DIFF_SIDE / max(width, height)
+    if scale >= 1.0:
+        return gray.copy()
+    return cv2.resize(
+        gray,
+        (max(1, round(width * scale)), max(1, round(height * scale))),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def changed_region(previous: np.ndarray, current: np.ndarray) -> Optional[Rect]:
+    """Bounding box (thumbnail px) of the pixels that differ between two
+    same-size thumbnails, or None when they match."""
+    changed = np.abs(previous.astype(np.int16) - current.astype(np.int16)) > _DIFF_THRESHOLD
+    if int(changed.sum()) < _MIN_CHANGED_PIXELS:
+        return None
+    ys = np.flatnonzero(changed.any(axis=1))
+    xs = np.flatnonzero(changed.any(axis=0))
+    return int(xs[0]), int(ys[0]), int(xs[-1] - xs[0] + 1), int(ys[-1] - ys[0] + 1)
+
+
+def _box(element: Any) -> Tuple[float, float, float, float]:
+    b = element.bounds or {}
+    x, y = float(b.get("x", 0.0)), float(b.get("y", 0.0))
+    return x, y, x + float(b.get("width", 0.0)), y + float(b.get("height", 0.0))
+
+
+def _corners(rect: Rect) -> Tuple[float, float, float, float]:
+    x, y, w, h = rect
+    return x, y, x + w, y + h
+
+
+def _intersects(a: Tuple[float, ...], b: Tuple[float, ...]) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _contains(outer: Tuple[float, ...], inner: Tuple[float, ...]) -> bool:
+    return (
+        outer[0] <= inner[0] and outer[1] <= inner[1]
+        and outer[2] >= inner[2] and outer[3] >= inner[3]
+    )
+
+
+def plan_crop(
+    changed: Rect,
+    thumbnail_size: Tuple[int, int],
+    image_size: Tuple[int, int],
+    previous_elements: List[Any],
+    *,
+    margin: float = 0.5,
+    min_margin: int = 48,
+    max_area: float = 0.4,
+) -> Optional[Tuple[Rect, Rect]]:
+    """(crop, changed) in image px for a changed thumbnail region, or None
+    when the crop would cover more than ``max_area`` of the image.
+
+    A previous box the change cuts through (an edge moved, a new stroke
+    crosses it) is pulled into the region whole, so it is re-detected rather
+    than kept stale; boxes that contain the whole change (its section) are
+    not. The crop pads the region by ``margin`` of its size on each side (at
+    least ``min_margin`` px) so the detector sees the new element in context.
+    """
+    width, height = image_size
+    sx = width / thumbnail_size[0]
+    sy = height / thumbnail_size[1]
+    x, y, w, h = changed
+    # One thumbnail pixel of slack: the area resize smears edges by that much.
+    region = (
+        max(0.0, (x - 1) * sx),
+        max(0.0, (y - 1) * sy),
+        min(float(width), (x + w + 1) * sx),
+        min(float(height), (y + h + 1) * sy),
+    )
+    change = region
+    boxes = [_box(el) for el in previous_elements]
+    for _ in range(len(boxes) + 1):
+        grown = region
+        for box in boxes:
+            if _intersects(box, change) and not _contains(box, change) and not _contains(region, box):
+                grown = (
+                    min(grown[0], box[0]), min(grown[1], box[1]),
+                    max(grown[2], box[2]), max(grown[3], box[3]),
+                )
+        if grown == region:
+            break
+        region = change = grown
+
+    pad_x = max(min_margin, margin * (region[2] - region[0]))
+    pad_y = max(min_margin, margin * (region[3] - region[1]))
+    x0 = int(max(0, region[0] - pad_x))
+    y0 = int(max(0, region[1] - pad_y))
+    x1 = int(min(width, region[2] + pad_x + 0.999))
+    y1 = int(min(height, region[3] + pad_y + 0.999))
+    if (x1 - x0) * (y1 - y0) > max_area * width * height:
+        return None
+    changed_px = (
+        int(region[0]), int(region[1]),
+        int(region[2] + 0.999) - int(region[0]), int(region[3] + 0.999) - int(region[1]),
+    )
+    return (x0, y0, x1 - x0, y1 - y0), changed_px
+
+
+def merge_region_detections(
+    previous_elements: List[Any],
+    crop_elements: List[Any],
+    crop: Rect,
+    image_size: Tuple[int, int],
+) -> List[Any]:
+    """Previous boxes not wholly inside ``crop`` plus the boxes detected in
+    the crop (in crop px, moved into image px here, in place).
+
+    A crop box touching a crop edge that is not an image edge is a partial
+    view of something outside the change (its section, a neighbour): the
+    previous box for it is kept instead.
+    """
+    crop_box = _corners(crop)
+    kept = [el for el in previous_elements if not _contains(crop_box, _box(el))]
+    cx, cy, cw, ch = crop
+    width, height = image_size
+    edge = max(2.0, 0.01 * max(cw, ch))
+    for el in crop_elements:
+        x0, y0, x1, y1 = _box(el)
+        if (
+            (cx > 0 and x0 <= edge)
+            or (cy > 0 and y0 <= edge)
+            or (cx + cw < width and x1 >= cw - edge)
+            or (cy + ch < height and y1 >= ch - edge)
+        ):
+            continue
+        el.bounds = {**el.bounds, "x": x0 + cx, "y": y0 + cy}
+        kept.append(el)
+    return kept
+
+
+class SketchHistory:
+    """Thread-safe bounded LRU+TTL store of the last SketchSnapshot per key
+    (user, project, screen). Elements are deep-copied on the way in and out,
+    as in DetectionCache, since callers mutate them downstream."""
+
+    def __init__(self, max_size: int = 64, ttl_seconds: float = 1800.0) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        if ttl_seconds <= 0:
+            raise ValueError("ttl_seconds must be > 0")
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._store: Dict[str, Tuple[float, SketchSnapshot]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[SketchSnapshot]:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            stored_at, snapshot = entry
+            if time.monotonic() - stored_at > self._ttl:
+                del self._store[key]
+                return None
+            del self._store[key]
+            self._store[key] = entry
+        return snapshot._replace(elements=[el.model_copy(deep=True) for el in snapshot.elements])
+
+    def put(self, key: str, snapshot: SketchSnapshot) -> None:
+        snapshot = snapshot._replace(
+            elements=[el.model_copy(deep=True) for el in snapshot.elements]
+        )
+        with self._lock:
+            if key in self._store:
+                del self._store[key]
+            elif len(self._store) >= self._max_size:
+                del self._store[next(iter(self._store))]
+            self._store[key] = (time.monotonic(), snapshot)
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return len(self._store)
@@ -5,21 +5,44 @@ so that identical inputs return immediately without calling Roboflow or Gemini.
 The cache is bounded (LRU eviction) and time-limited (TTL) so memory use
 stays predictable and stale results do not outlive a deploy.
 
-This is process-local (single uvicorn instance). For a multi-worker deployment,
-move the store to Redis and keep the same get()/put() contract.
+Two interchangeable backends share the get()/put()/size contract:
+
+- GenerationCache: process-local dict. Lost on restart, private per worker.
+- SQLiteGenerationCache: one SQLite file in WAL mode shared by every uvicorn
+  worker on the host. Survives restarts, bounded by total bytes (LRU on last
+  access) as well as entry count, with generated_code stored zlib-compressed.
 
 Env vars (all optional, have safe defaults):
   CACHE_ENABLED=true          set false to disable globally
   CACHE_TTL_SECONDS=1800      entry lifetime in seconds (default 30 min)
   CACHE_MAX_SIZE=50           max entries before LRU eviction kicks in
+  CACHE_BACKEND=memory        "memory" or "sqlite"
+  CACHE_SQLITE_PATH=...       database file for the sqlite backend
+  CACHE_MAX_BYTES=67108864    sqlite backend: stored-bytes budget (64 MB)
+
+DetectionCache is the second tier: it stores the raw Roboflow output
+(ExternalModelOutput, including the in-memory processed_image handle) keyed on the
+inputs detection actually depends on — image bytes, sketch_source, canvas
+size, model id and thresholds. Framework / brand-kit / model switches miss
+GenerationCache but hit this tier, so they skip Roboflow and only pay Gemini.
+The HITL /api/detect step warms it for the /api/predict call that follows.
+
+  DETECTION_CACHE_ENABLED=true         set false to always call Roboflow
+  DETECTION_CACHE_TTL_SECONDS=1800     entry lifetime in seconds
+  DETECTION_CACHE_MAX_SIZE=64          max entries
+  DETECTION_CACHE_MAX_BYTES=268435456  image bytes held by entries (256 MB)
 """
 
 from __future__ import annotations
 
+import json
+import os
+import sqlite3
 import threading
 import time
+import zlib
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 
 @dataclass
@@ -74,3 +97,285 @@ class GenerationCache:
     def size(self) -> int:
         with self._lock:
             return len(self._store)
+
+
+class SQLiteGenerationCache:
+    """Disk-backed GenerationCache shared across processes.
+
+    Same contract as GenerationCache. Each thread gets its own connection
+    (sqlite3 connections are not thread-safe); WAL mode lets readers in every
+    worker proceed while one writer commits, and ``busy_timeout`` absorbs the
+    short write locks instead of raising.
+
+    TTL uses wall-clock time (created_at must mean the same thing after a
+    restart and in every process). LRU order is ``last_access``. get() is
+    read-only, so a hit never waits on another worker's write lock: the
+    bump (and the delete of an expired row) is remembered in memory and
+    applied by the next put() of this instance, inside its transaction.
+    Eviction runs on put: expired rows first, then least recently used rows
+    until both ``max_size`` and ``max_bytes`` hold. ``size_bytes`` is the
+    stored (compressed) footprint of the row.
+
+    Both calls can wait up to the 5 s busy timeout on a put; async callers
+    run them off the event loop.
+
+    A cache must never break generation: sqlite errors are logged and treated
+    as a miss / dropped put.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS generation_cache (
+            key          TEXT PRIMARY KEY,
+            code_z       BLOB NOT NULL,
+            elements     TEXT NOT NULL,
+            source       TEXT NOT NULL,
+            created_at   REAL NOT NULL,
+            last_access  REAL NOT NULL,
+            size_bytes   INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS generation_cache_lru
+            ON generation_cache (last_access);
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = 50,
+        ttl_seconds: float = 1800.0,
+        max_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        if ttl_seconds <= 0:
+            raise ValueError("ttl_seconds must be > 0")
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be >= 1")
+        self._path = path
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+        # LRU bumps and expired keys seen by get(), applied by the next put().
+        self._pending_lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        self._expired: set = set()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; writes open explicit BEGIN IMMEDIATE transactions.
+            conn = sqlite3.connect(self._path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT code_z, elements, source, created_at FROM generation_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            code_z, elements, source, created_at = row
+            with self._pending_lock:
+                if now - created_at > self._ttl:
+                    self._expired.add(key)
+                    self._touched.pop(key, None)
+                    return None
+                self._touched[key] = now
+            return CachedResult(
+                generated_code=zlib.decompress(code_z).decode("utf-8"),
+                elements_json=json.loads(elements),
+                source=source,
+            )
+        except (sqlite3.Error, zlib.error, ValueError) as error:
+            print(f"[cache] sqlite get failed, treating as miss: {error}")
+            return None
+
+    def put(self, key: str, result: CachedResult) -> None:
+        now = time.time()
+        code_z = zlib.compress(result.generated_code.encode("utf-8"), 6)
+        elements = json.dumps(result.elements_json, separators=(",", ":"))
+        size_bytes = len(code_z) + len(elements.encode("utf-8")) + len(key)
+        if size_bytes > self._max_bytes:
+            return
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO generation_cache "
+                    "(key, code_z, elements, source, created_at, last_access, size_bytes) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, code_z, elements, result.source, now, now, size_bytes),
+                )
+                self._apply_pending(conn, now)
+                self._evict(conn, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as error:
+            print(f"[cache] sqlite put failed, entry dropped: {error}")
+
+    def _apply_pending(self, conn: sqlite3.Connection, now: float) -> None:
+        with self._pending_lock:
+            touched, self._touched = self._touched, {}
+            expired, self._expired = self._expired, set()
+        # Another worker may have rewritten an expired key since; only delete
+        # what is still expired.
+        conn.executemany(
+            "DELETE FROM generation_cache WHERE key = ? AND created_at < ?",
+            [(k, now - self._ttl) for k in expired],
+        )
+        conn.executemany(
+            "UPDATE generation_cache SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(at, k) for k, at in touched.items()],
+        )
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM generation_cache WHERE created_at < ?", (now - self._ttl,))
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM generation_cache"
+        ).fetchone()
+        if count <= self._max_size and total <= self._max_bytes:
+            return
+        victims: List[str] = []
+        for key, size_bytes in conn.execute(
+            "SELECT key, size_bytes FROM generation_cache ORDER BY last_access ASC"
+        ):
+            if count <= self._max_size and total <= self._max_bytes:
+                break
+            victims.append(key)
+            count -= 1
+            total -= size_bytes
+        conn.executemany("DELETE FROM generation_cache WHERE key = ?", [(k,) for k in victims])
+
+    @property
+    def size(self) -> int:
+        try:
+            return int(
+                self._connect()
+                .execute(
+                    "SELECT COUNT(*) FROM generation_cache WHERE created_at >= ?",
+                    (time.time() - self._ttl,),
+                )
+                .fetchone()[0]
+            )
+        except sqlite3.Error:
+            return 0
+
+    @property
+    def size_bytes(self) -> int:
+        try:
+            return int(
+                self._connect()
+                .execute("SELECT COALESCE(SUM(size_bytes), 0) FROM generation_cache")
+                .fetchone()[0]
+            )
+        except sqlite3.Error:
+            return 0
+
+
+class DetectionCache:
+    """Thread-safe bounded LRU+TTL cache of detection outputs.
+
+    Callers mutate detection output downstream (container synthesis, role
+    hints), so values are deep-copied on both put and get — a hit always
+    returns a pristine, caller-owned copy. The processed_image handle is
+    immutable and shared by the copies rather than duplicated.
+    Values must provide pydantic's ``model_copy(deep=True)``.
+
+    An upload's entry holds its decoded crop (a canvas export's, a
+    thumbnail), and a handle grows as callers ask it for encodings, so the
+    byte budget is measured live from the handles' ``nbytes`` on every put:
+    least recently used entries go until the rest fit, and an entry larger
+    than the whole budget is not stored.
+
+    Hit/miss counters are cumulative for the process and surfaced through
+    ``stats()`` for the [timing] log line and /api/metrics.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 64,
+        ttl_seconds: float = 1800.0,
+        max_bytes: int = 256 * 1024 * 1024,
+    ) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        if ttl_seconds <= 0:
+            raise ValueError("ttl_seconds must be > 0")
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be >= 1")
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._ttl = ttl_seconds
+        self._store: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, output = entry
+            if time.monotonic() - stored_at > self._ttl:
+                del self._store[key]
+                self.misses += 1
+                return None
+            del self._store[key]
+            self._store[key] = entry
+            self.hits += 1
+        return output.model_copy(deep=True)
+
+    @staticmethod
+    def _nbytes(output: Any) -> int:
+        return sum(
+            getattr(getattr(output, name, None), "nbytes", 0)
+            for name in ("processed_image", "sketch_thumbnail")
+        )
+
+    def put(self, key: str, output: Any) -> None:
+        entry = (time.monotonic(), output.model_copy(deep=True))
+        with self._lock:
+            self._store.pop(key, None)
+            needed = self._nbytes(entry[1])
+            if needed > self._max_bytes:
+                return
+            held = sum(self._nbytes(value) for _, value in self._store.values())
+            while self._store and (
+                len(self._store) >= self._max_size or held + needed > self._max_bytes
+            ):
+                oldest = next(iter(self._store))
+                held -= self._nbytes(self._store.pop(oldest)[1])
+            self._store[key] = entry
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return len(self._store)
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(self._nbytes(value) for _, value in self._store.values())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._store),
+                "bytes": sum(self._nbytes(value) for _, value in self._store.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,75 @@
+"""Single-flight coalescing for identical in-flight AI calls.
+
+GenerationCache (B12) only helps once the first call has finished. A
+double-clicked Generate button or a proxy retry arrives while the first
+request is still waiting on Roboflow/Gemini, misses the cache, and pays for
+the whole pipeline a second time. SingleFlight closes that window: the first
+caller for a key (the leader) starts the work, and every concurrent caller
+with the same key awaits the leader's result instead of starting its own.
+
+Semantics:
+- The work runs as its own task and followers await it through
+  ``asyncio.shield``, so a follower disconnecting never cancels the shared
+  call, and neither does the leader's own request being cancelled.
+- Exceptions (including HTTPException) propagate to every waiter — a
+  timed-out Gemini call is a timeout for all of the duplicates too.
+- The key is forgotten as soon as the work finishes; later callers go through
+  the cache as before. Nothing is memoized here.
+
+Event-loop local: all bookkeeping happens on the loop thread, so no lock is
+needed. Per-worker, like the rest of the in-process state.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Deduplicates concurrent awaits of the same keyed coroutine."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._inflight: Dict[str, "asyncio.Future[Any]"] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """Run ``fn()`` once per in-flight ``key``.
+
+        Returns (result, shared): ``shared`` is True when this caller joined a
+        call another request had already started.
+        """
+        task = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, k=key: self._forget(k, done))
+            self.leaders += 1
+        else:
+            self.followers += 1
+            print(f"[single-flight] {self.name}: joined in-flight call (key={key[:20]}…)")
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key: str, task: "asyncio.Future[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception retrieved: if every waiter went away, asyncio
+        # would otherwise log "exception was never retrieved".
+        if not task.cancelled():
+            task.exception()
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "inflight": self.inflight,
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
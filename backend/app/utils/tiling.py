@@ -0,0 +1,318 @@
+"""
+Tiled detection geometry: where to cut a large sketch, and how to put the
+detector's per-tile boxes back together.
+
+The hosted detector squeezes whatever it is sent into a 640 px input. An
+8000 px canvas export, or a page with many small cards, loses those cards in
+the squeeze: a 120 px card on a 6000 px page is 13 px at the model's input.
+Cutting the image into overlapping tiles gives every tile the model's full
+input resolution. The whole image is still sent once at low resolution (the
+"full pass") for the containers that span many tiles.
+
+    tile_grid()               overlapping tiles covering the image
+    small_region_count()      density signal: enclosed regions the 640 px
+                              input would shrink below a usable size
+    merge_tile_predictions()  tile boxes → one global prediction list
+
+Predictions are Roboflow's raw dicts (centre ``x``/``y`` plus ``width``/
+``height``); the merged list goes through the usual filtering in
+inference._roboflow_output (per-class thresholds, class-aware NMS, shadow
+cards), which removes the duplicates the overlap produces.
+
+A box cut by a tile edge shows up in each tile as a fragment. Fragments that
+meet across a shared edge, with matching extent across it, are stitched into
+one box (navbar and section bars are the usual case). A leftover fragment
+mostly covered by a same-class box found elsewhere (the neighbouring tile saw
+the whole card, or the full pass saw the whole section) is dropped.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MODEL_INPUT_SIDE = 640
+TILE_OVERLAP = 0.25  # of the tile side
+MAX_TILES_PER_AXIS = 4
+
+# A fragment and its neighbour across a tile edge must agree this well
+# (1-D IoU of their extent along that edge) to be stitched.
+_STITCH_EXTENT_IOU = 0.6
+# A leftover fragment is dropped when a same-class box covers this much of it.
+_FRAGMENT_COVERED = 0.8
+# A hole, and the ink outline around it, must fill this much of its bounding
+# box to count as a drawn box in small_region_count; the hole must also come
+# out as four corners when simplified to this share of its perimeter.
+_RECTANGULAR = 0.85
+_CORNER_TOLERANCE = 0.02
+
+Rect = Tuple[int, int, int, int]  # x, y, width, height
+
+
+def tile_grid(
+    width: int,
+    height: int,
+    *,
+    tile_size: int,
+    overlap: float = TILE_OVERLAP,
+    max_per_axis: int = MAX_TILES_PER_AXIS,
+) -> List[Rect]:
+    """Overlapping tiles covering a ``width`` x ``height`` image, row by row.
+
+    Tiles are ``tile_size`` px where the image allows, adjacent tiles overlap
+    by ``overlap`` of a tile, and the tiles of an axis are spread evenly so the
+    last one ends on the image edge. An axis that would need more than
+    ``max_per_axis`` tiles gets larger ones instead.
+    """
+
+    def axis(length: int) -> List[Tuple[int, int]]:
+        if length <= tile_size:
+            return [(0, length)]
+        count = math.ceil((length / tile_size - overlap) / (1.0 - overlap))
+        count = max(2, min(count, max_per_axis))
+        size = min(length, math.ceil(length / (count - overlap * (count - 1))))
+        step = (length - size) / (count - 1)
+        return [(round(i * step), size) for i in range(count)]
+
+    return [(x, y, w, h) for y, h in axis(height) for x, w in axis(width)]
+
+
+def _rectangularity(contour: np.ndarray) -> float:
+    """Contour area over its bounding box's, both measured between pixel
+    centres as cv2 does (a solid rectangle is 1.0, an ellipse about 0.79)."""
+    import cv2
+
+    _, _, w, h = cv2.boundingRect(contour)
+    return cv2.contourArea(contour) / max(1, (w - 1) * (h - 1))
+
+
+def _is_box(contour: np.ndarray) -> bool:
+    """Nearly fills its bounding box and simplifies to four corners (a
+    rounded or bevelled letter counter keeps six or more)."""
+    import cv2
+
+    if _rectangularity(contour) < _RECTANGULAR:
+        return False
+    corners = cv2.approxPolyDP(contour, _CORNER_TOLERANCE * cv2.arcLength(contour, True), True)
+    return len(corners) == 4
+
+
+def small_region_count(
+    gray: np.ndarray,
+    *,
+    model_side: int = MODEL_INPUT_SIDE,
+    min_side: float = 20.0,
+    min_hole: float = 8.0,
+) -> int:
+    """Enclosed regions (drawn boxes) whose shorter side would come out under
+    ``min_side`` px once the whole image is squeezed into the model's input.
+
+    Counted on a mask of at most 1600 px, as the holes of dark-on-white ink.
+    Only box-like holes count: at least ``min_hole`` image px on their shorter
+    side, four-cornered and nearly rectangular, inside a nearly rectangular
+    outline. Letter counters (o, e, a, D, B) fail at least one of these, so a
+    page of text does not read as a page of small cards.
+    """
+    import cv2
+
+    height, width = gray.shape[:2]
+    mask_scale = min(1.0, 1600.0 / max(width, height))
+    if mask_scale < 1.0:
+        gray = cv2.resize(
+            gray,
+            (max(1, round(width * mask_scale)), max(1, round(height * mask_scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    ink = (gray < 160).astype(np.uint8)
+    contours, hierarchy = cv2.findContours(ink, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return 0
+    to_model = model_side / max(width, height) / mask_scale
+    smallest = max(3.0, min_hole * mask_scale)
+    outline_is_box: Dict[int, bool] = {}
+    count = 0
+    for contour, (_, _, _, parent) in zip(contours, hierarchy[0]):
+        if parent < 0:
+            continue  # outer ink boundary, not a hole
+        _, _, w, h = cv2.boundingRect(contour)
+        if min(w, h) < smallest or min(w, h) * to_model >= min_side:
+            continue
+        if not _is_box(contour):
+            continue
+        if parent not in outline_is_box:
+            outline_is_box[parent] = _rectangularity(contours[parent]) >= _RECTANGULAR
+        if outline_is_box[parent]:
+            count += 1
+    return count
+
+
+def _corners(prediction: Dict[str, Any]) -> Optional[Tuple[float, float, float, float]]:
+    try:
+        cx, cy = float(prediction["x"]), float(prediction["y"])
+        w, h = float(prediction["width"]), float(prediction["height"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return cx - w / 2.0, cy - h / 2.0, cx + w / 2.0, cy + h / 2.0
+
+
+def _class_of(prediction: Dict[str, Any]) -> str:
+    return str(prediction.get("class") or prediction.get("class_name") or "").lower()
+
+
+def _extent_iou(a0: float, a1: float, b0: float, b1: float) -> float:
+    inter = min(a1, b1) - max(a0, b0)
+    union = max(a1, b1) - min(a0, b0)
+    return inter / union if inter > 0 and union > 0 else 0.0
+
+
+def _area(corners: Tuple[float, ...]) -> float:
+    return max(0.0, corners[2] - corners[0]) * max(0.0, corners[3] - corners[1])
+
+
+def _covered(box: Tuple[float, ...], by: Tuple[float, ...]) -> float:
+    """Share of ``box``'s area inside ``by``."""
+    iw = min(box[2], by[2]) - max(box[0], by[0])
+    ih = min(box[3], by[3]) - max(box[1], by[1])
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    return iw * ih / area if iw > 0 and ih > 0 and area > 0 else 0.0
+
+
+class _Box:
+    __slots__ = ("prediction", "cls", "corners", "tile", "cut")
+
+    def __init__(self, prediction, cls, corners, tile, cut):
+        self.prediction = prediction
+        self.cls = cls
+        self.corners = corners
+        self.tile = tile  # index into the tiles, None for the full pass
+        self.cut = cut  # interior tile edges it touches: subset of "lrtb"
+
+
+def _stitchable(a: _Box, b: _Box) -> bool:
+    """``a`` and ``b`` are two parts of one box cut by the edge between their
+    tiles: they meet across it and agree on their extent along it."""
+    for first, second in ((a, b), (b, a)):
+        fx0, fy0, fx1, fy1 = first.corners
+        sx0, sy0, sx1, sy1 = second.corners
+        if (
+            "r" in first.cut and "l" in second.cut and fx0 < sx0 < fx1
+            and _extent_iou(fy0, fy1, sy0, sy1) >= _STITCH_EXTENT_IOU
+        ):
+            return True
+        if (
+            "b" in first.cut and "t" in second.cut and fy0 < sy0 < fy1
+            and _extent_iou(fx0, fx1, sx0, sx1) >= _STITCH_EXTENT_IOU
+        ):
+            return True
+    return False
+
+
+def merge_tile_predictions(
+    full_predictions: Sequence[Dict[str, Any]],
+    tiles: Sequence[Tuple[Rect, Sequence[Dict[str, Any]]]],
+    image_size: Tuple[int, int],
+    *,
+    min_confidence: Callable[[str], float],
+) -> List[Dict[str, Any]]:
+    """One global prediction list from the full pass and the tiles.
+
+    ``full_predictions`` are in image pixels; each tile's predictions are in
+    that tile's own pixels and are offset by its rect. Predictions under
+    ``min_confidence(class)`` are dropped first so low-confidence fragments
+    never widen a stitched box. Stitched boxes take the union of their parts
+    and the highest confidence.
+    """
+    image_w, image_h = image_size
+    boxes: List[_Box] = []
+    for prediction in full_predictions:
+        corners = _corners(prediction)
+        cls = _class_of(prediction)
+        if corners is not None and float(prediction.get("confidence", 0.0)) >= min_confidence(cls):
+            boxes.append(_Box(prediction, cls, corners, None, ""))
+
+    for index, ((tx, ty, tw, th), predictions) in enumerate(tiles):
+        margin = max(2.0, 0.01 * max(tw, th))
+        for prediction in predictions:
+            corners = _corners(prediction)
+            cls = _class_of(prediction)
+            if corners is None or float(prediction.get("confidence", 0.0)) < min_confidence(cls):
+                continue
+            x0, y0, x1, y1 = corners
+            cut = "".join(
+                side
+                for side, touches in (
+                    ("l", tx > 0 and x0 <= margin),
+                    ("r", tx + tw < image_w and x1 >= tw - margin),
+                    ("t", ty > 0 and y0 <= margin),
+                    ("b", ty + th < image_h and y1 >= th - margin),
+                )
+                if touches
+            )
+            boxes.append(
+                _Box(prediction, cls, (x0 + tx, y0 + ty, x1 + tx, y1 + ty), index, cut)
+            )
+
+    # Stitch: union-find over fragment pairs from different tiles.
+    parent = list(range(len(boxes)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    fragments = [i for i, box in enumerate(boxes) if box.cut]
+    for n, i in enumerate(fragments):
+        for j in fragments[n + 1:]:
+            a, b = boxes[i], boxes[j]
+            if a.cls == b.cls and a.tile != b.tile and _stitchable(a, b):
+                parent[find(j)] = find(i)
+
+    groups: Dict[int, List[_Box]] = {}
+    for i, box in enumerate(boxes):
+        groups.setdefault(find(i), []).append(box)
+
+    merged: List[_Box] = []
+    for parts in groups.values():
+        if len(parts) == 1:
+            merged.append(parts[0])
+            continue
+        best = max(parts, key=lambda p: float(p.prediction.get("confidence", 0.0)))
+        corners = (
+            min(p.corners[0] for p in parts),
+            min(p.corners[1] for p in parts),
+            max(p.corners[2] for p in parts),
+            max(p.corners[3] for p in parts),
+        )
+        cut = "".join(sorted(set("".join(p.cut for p in parts))))
+        merged.append(_Box(best.prediction, best.cls, corners, best.tile, cut))
+
+    # Drop leftover fragments a same-class box already covers.
+    kept = [
+        box
+        for box in merged
+        if not box.cut
+        or not any(
+            other is not box
+            and other.cls == box.cls
+            and _area(other.corners) > _area(box.corners)
+            and _covered(box.corners, other.corners) >= _FRAGMENT_COVERED
+            for other in merged
+        )
+    ]
+
+    out: List[Dict[str, Any]] = []
+    for box in kept:
+        x0, y0, x1, y1 = box.corners
+        out.append(
+            {
+                **box.prediction,
+                "x": (x0 + x1) / 2.0,
+                "y": (y0 + y1) / 2.0,
+                "width": x1 - x0,
+                "height": y1 - y0,
+            }
+        )
+    return out
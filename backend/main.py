@@ -2,49 +2,77 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import contextlib
 import hashlib
+import io
 import json
 import math
 import os
 import re
 import time
 from pathlib import Path
-from typing import Any, Dict, List, Literal, Optional
+from typing import Any, Callable, Dict, List, Literal, NamedTuple, Optional, Tuple, Union
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+from app.models.gemini_pool import SQLitePoolStore
+from app.models.keep_warm import KeepWarm, parse_active_hours
+from app.models.vector_detector import detect_from_canvas, png_size
 from app.models.inference import (
     CodeGenerator,
     ExternalModelOutput,
     GeminiQuotaExhausted,
     GeminiRateLimited,
-    ROBOFLOW_DEFAULT_API_URL,
-    ROBOFLOW_DEFAULT_MODEL_ID,
     SketchDetector,
     _build_gemini_prompt,
     build_annotation_prompt,
     build_incremental_prompt,
     build_repair_prompt,
     create_mock_external_model_output,
-    detect_with_roboflow,
+    _roboflow_clients,
+    detect_with_roboflow_async,
     diff_detection_sets,
-    generate_with_gemini,
+    gemini_key_pool,
+    generate_with_gemini_async,
     get_llm_pool_status,
+    roboflow_detection_settings,
+    decode_sketch_rgb,
+    roboflow_ladder,
+    roboflow_models,
+    warm_roboflow_model,
 )
 
 
 def _debug_ai_enabled() -> bool:
     return os.getenv("DEBUG_AI_PROMPT", "").lower() in ("1", "true", "yes", "on")
+from app.utils.cancellation import CallCancelled, CancellationToken, abandoned_counts
+from app.utils.executors import BoundedConcurrency, BoundedExecutor, ExecutorSaturated
+from app.utils.image_handle import ImageHandle
+from app.utils.persistence import PersistenceQueue
 from app.utils.preprocessing import preprocess_canvas_data
-from app.utils.rate_limit import SlidingWindowRateLimiter
+from app.utils.rate_limit import GCRARateLimiter, SlidingWindowRateLimiter
+from app.utils.region_diff import (
+    SketchHistory,
+    SketchSnapshot,
+    changed_region,
+    merge_region_detections,
+    plan_crop,
+    sketch_thumbnail,
+)
 from app.utils.role_inference import annotate_alignment, annotate_role_hints
-from app.utils.response_cache import CachedResult, GenerationCache
+from app.utils.response_cache import (
+    CachedResult,
+    DetectionCache,
+    GenerationCache,
+    SQLiteGenerationCache,
+)
+from app.utils.single_flight import SingleFlight
 
 BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / ".env")
@@ -73,30 +101,309 @@ def _env_flag(name: str, default: bool) -> bool:
 # on the authenticated user id the proxy stamps in (see _rate_limit_key). Defaults
 # allow normal interactive use; override per-deploy via env. Set
 # RATE_LIMIT_ENABLED=false to disable (e.g. for load tests / automated QA).
+# RATE_LIMIT_BACKEND picks the limiter: "memory" (sliding window, per worker),
+# "gcra" (GCRA, per worker) or "sqlite" (GCRA state in a file shared by every
+# worker on the host — required for a per-user budget with --workers > 1).
+#
+# The budget is cost-weighted: each AI call spends units according to what it
+# costs us upstream (RATE_LIMIT_COSTS, "kind=units" pairs, comma-separated,
+# overriding the defaults below). RATE_LIMIT_BUDGET is units per window; it
+# defaults to RATE_LIMIT_MAX_REQUESTS full generations. The remaining balance
+# is returned in X-RateLimit-* headers so the frontend can throttle itself.
 RATE_LIMIT_ENABLED = _env_flag("RATE_LIMIT_ENABLED", True)
 RATE_LIMIT_MAX_REQUESTS = int(os.getenv("RATE_LIMIT_MAX_REQUESTS", "20"))
 RATE_LIMIT_WINDOW_SECONDS = float(os.getenv("RATE_LIMIT_WINDOW_SECONDS", "60"))
 
-ai_rate_limiter: Optional[SlidingWindowRateLimiter] = (
-    SlidingWindowRateLimiter(RATE_LIMIT_MAX_REQUESTS, RATE_LIMIT_WINDOW_SECONDS)
-    if RATE_LIMIT_ENABLED
-    else None
+_DEFAULT_RATE_LIMIT_COSTS: Dict[str, float] = {
+    "generate": 3.0,   # Roboflow + full Gemini generation
+    "chat": 1.0,       # one short Gemini refinement
+    "detect": 1.0,     # Roboflow only (HITL review)
+    "fidelity": 4.0,   # Chromium render + Roboflow
+    "repair": 2.0,     # full-code Gemini call
+    "annotate": 2.0,   # full-code Gemini call
+    "cache_hit": 0.0,  # served from the generation cache
+    "noop": 0.0,       # incremental, nothing changed, no Gemini call
+}
+
+
+def _parse_rate_limit_costs(raw: str) -> Dict[str, float]:
+    """Defaults overlaid with "kind=units,..." from the env. Malformed pairs
+    and unknown kinds are ignored (logged) rather than failing startup."""
+    costs = dict(_DEFAULT_RATE_LIMIT_COSTS)
+    for pair in raw.split(","):
+        if not pair.strip():
+            continue
+        name, _, value = pair.partition("=")
+        name = name.strip().lower()
+        try:
+            units = float(value)
+        except ValueError:
+            units = -1.0
+        if name not in costs or units < 0:
+            print(f"[rate-limit] ignoring RATE_LIMIT_COSTS entry {pair.strip()!r}")
+            continue
+        costs[name] = units
+    return costs
+
+
+RATE_LIMIT_COSTS = _parse_rate_limit_costs(os.getenv("RATE_LIMIT_COSTS", ""))
+RATE_LIMIT_BUDGET = int(
+    os.getenv(
+        "RATE_LIMIT_BUDGET",
+        str(max(1, math.ceil(RATE_LIMIT_MAX_REQUESTS * RATE_LIMIT_COSTS["generate"]))),
+    )
+)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower()
+RATE_LIMIT_SQLITE_PATH = os.getenv(
+    "RATE_LIMIT_SQLITE_PATH", str(BASE_DIR / ".cache" / "rate_limit.sqlite3")
 )
 
+
+def _build_rate_limiter() -> Optional[Union[SlidingWindowRateLimiter, GCRARateLimiter]]:
+    if not RATE_LIMIT_ENABLED:
+        return None
+    if RATE_LIMIT_BACKEND == "sqlite":
+        try:
+            limiter = GCRARateLimiter(
+                RATE_LIMIT_BUDGET, RATE_LIMIT_WINDOW_SECONDS, path=RATE_LIMIT_SQLITE_PATH
+            )
+            print(f"[rate-limit] shared GCRA store at {RATE_LIMIT_SQLITE_PATH}")
+            return limiter
+        except Exception as error:
+            print(f"[rate-limit] shared store unavailable ({error}); using per-worker limiter")
+    elif RATE_LIMIT_BACKEND == "gcra":
+        return GCRARateLimiter(RATE_LIMIT_BUDGET, RATE_LIMIT_WINDOW_SECONDS)
+    elif RATE_LIMIT_BACKEND != "memory":
+        print(f"[rate-limit] unknown RATE_LIMIT_BACKEND={RATE_LIMIT_BACKEND!r}; using sliding window")
+    return SlidingWindowRateLimiter(RATE_LIMIT_BUDGET, RATE_LIMIT_WINDOW_SECONDS)
+
+
+# SlidingWindowRateLimiter or GCRARateLimiter — same check() contract.
+ai_rate_limiter = _build_rate_limiter()
+
 # B12: In-memory cache so identical sketch+framework+labels return without
 # hitting Roboflow or Gemini again. Bounded (LRU) + time-limited (TTL) to
 # keep memory predictable. Cache hits still persist a new iteration so version
 # history remains correct. Set CACHE_ENABLED=false to disable (e.g. QA runs).
+# CACHE_BACKEND=sqlite swaps the per-worker dict for a WAL-mode SQLite file
+# shared by every worker on the host and kept across restarts/deploys.
 CACHE_ENABLED = _env_flag("CACHE_ENABLED", True)
 CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "1800"))
 CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "50"))
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").strip().lower()
+CACHE_SQLITE_PATH = os.getenv(
+    "CACHE_SQLITE_PATH", str(BASE_DIR / ".cache" / "generation_cache.sqlite3")
+)
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def _build_generation_cache() -> Optional[Union[GenerationCache, SQLiteGenerationCache]]:
+    if not CACHE_ENABLED:
+        return None
+    if CACHE_BACKEND == "sqlite":
+        try:
+            cache = SQLiteGenerationCache(
+                CACHE_SQLITE_PATH, CACHE_MAX_SIZE, CACHE_TTL_SECONDS, CACHE_MAX_BYTES
+            )
+            print(f"[cache] sqlite backend at {CACHE_SQLITE_PATH}")
+            return cache
+        except Exception as error:
+            print(f"[cache] sqlite backend unavailable ({error}); using in-memory cache")
+    elif CACHE_BACKEND != "memory":
+        print(f"[cache] unknown CACHE_BACKEND={CACHE_BACKEND!r}; using in-memory cache")
+    return GenerationCache(CACHE_MAX_SIZE, CACHE_TTL_SECONDS)
+
+
+# GenerationCache or SQLiteGenerationCache — same get()/put()/size contract.
+generation_cache = _build_generation_cache()
+
+# Gemini key-pool state (per key×model cooldowns, budget counters, today's
+# success counts). "memory" keeps it per worker, so each worker discovers a
+# 429 on its own; "sqlite" shares it through a WAL-mode file so a cooldown hit
+# by one worker is skipped by all of them, /api/llm-status reports pool-wide
+# numbers, and a restart does not forget an exhausted daily quota.
+GEMINI_POOL_BACKEND = os.getenv("GEMINI_POOL_BACKEND", "memory").strip().lower()
+GEMINI_POOL_SQLITE_PATH = os.getenv(
+    "GEMINI_POOL_SQLITE_PATH", str(BASE_DIR / ".cache" / "gemini_pool.sqlite3")
+)
+
+
+def _build_gemini_pool_store() -> Optional[SQLitePoolStore]:
+    if GEMINI_POOL_BACKEND == "sqlite":
+        try:
+            store = SQLitePoolStore(GEMINI_POOL_SQLITE_PATH)
+            print(f"[gemini] shared key-pool state at {GEMINI_POOL_SQLITE_PATH}")
+            return store
+        except Exception as error:
+            print(f"[gemini] shared key-pool store unavailable ({error}); using per-worker pool")
+    elif GEMINI_POOL_BACKEND != "memory":
+        print(f"[gemini] unknown GEMINI_POOL_BACKEND={GEMINI_POOL_BACKEND!r}; using per-worker pool")
+    return None
+
+
+gemini_key_pool.use_store(_build_gemini_pool_store())
+
+# Detection tier below the generation cache: Roboflow output keyed on image
+# bytes + sketchSource + canvas size + model id/thresholds only. A framework,
+# brand-kit or model switch misses generation_cache but still skips Roboflow,
+# and /api/detect (HITL review) warms it for the /api/predict that follows.
+# Set DETECTION_CACHE_ENABLED=false to always call Roboflow.
+DETECTION_CACHE_ENABLED = _env_flag("DETECTION_CACHE_ENABLED", True)
+
+detection_cache: Optional[DetectionCache] = (
+    DetectionCache(
+        int(os.getenv("DETECTION_CACHE_MAX_SIZE", "64")),
+        float(os.getenv("DETECTION_CACHE_TTL_SECONDS", "1800")),
+        int(os.getenv("DETECTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    )
+    if DETECTION_CACHE_ENABLED
+    else None
+)
+
+# Incremental region re-detection: the last canvas detection per project
+# screen (a thumbnail of the sketch and its raw boxes). A request carrying
+# previousElements is diffed against it and only the changed region goes to
+# Roboflow (app/utils/region_diff.py). Set INCREMENTAL_DETECTION_ENABLED=false
+# to always detect the whole sketch.
+INCREMENTAL_DETECTION_ENABLED = _env_flag("INCREMENTAL_DETECTION_ENABLED", True)
+# Largest share of the image a changed region may cover before a full
+# detection is the better deal.
+INCREMENTAL_DETECTION_MAX_AREA = float(os.getenv("INCREMENTAL_DETECTION_MAX_AREA", "0.4"))
+
+sketch_history: Optional[SketchHistory] = (
+    SketchHistory(
+        int(os.getenv("SKETCH_HISTORY_MAX_SIZE", "64")),
+        float(os.getenv("SKETCH_HISTORY_TTL_SECONDS", "1800")),
+    )
+    if INCREMENTAL_DETECTION_ENABLED
+    else None
+)
 
-generation_cache: Optional[GenerationCache] = (
-    GenerationCache(CACHE_MAX_SIZE, CACHE_TTL_SECONDS)
-    if CACHE_ENABLED
+# Write-behind persistence: iterations/projects/detection_corrections writes go
+# through a bounded queue drained by a background thread, so the synchronous
+# supabase-py client never blocks the event loop on the request path. Handlers
+# get a pre-generated iteration id back immediately. Set
+# PERSIST_QUEUE_ENABLED=false to write inline (on a worker thread) instead.
+PERSIST_QUEUE_ENABLED = _env_flag("PERSIST_QUEUE_ENABLED", True)
+
+persistence_queue: Optional[PersistenceQueue] = (
+    PersistenceQueue(
+        lambda: create_supabase_client(),
+        max_depth=int(os.getenv("PERSIST_QUEUE_MAX_DEPTH", "500")),
+        batch_size=int(os.getenv("PERSIST_BATCH_SIZE", "25")),
+        max_retries=int(os.getenv("PERSIST_MAX_RETRIES", "3")),
+    )
+    if PERSIST_QUEUE_ENABLED
     else None
 )
 
+# Single-flight: concurrent identical requests (double-clicked Generate, proxy
+# retries) share ONE in-flight Roboflow/Gemini/render call instead of each
+# paying for it. Complements the cache, which only helps after the first call
+# finishes. /api/predict keys on the generation cache key, /api/detect on the
+# image hash + sketchSource, /api/fidelity on code + elements + dims. Set
+# SINGLE_FLIGHT_ENABLED=false to disable.
+SINGLE_FLIGHT_ENABLED = _env_flag("SINGLE_FLIGHT_ENABLED", True)
+
+generation_flights: Optional[SingleFlight] = (
+    SingleFlight("predict") if SINGLE_FLIGHT_ENABLED else None
+)
+detect_flights: Optional[SingleFlight] = (
+    SingleFlight("detect") if SINGLE_FLIGHT_ENABLED else None
+)
+fidelity_flights: Optional[SingleFlight] = (
+    SingleFlight("fidelity") if SINGLE_FLIGHT_ENABLED else None
+)
+
+# Per-upstream executors (bounded thread pools). Each upstream gets its own
+# workers and a bounded wait queue instead of sharing the loop's default
+# executor, so a burst of slow Gemini calls cannot starve Roboflow or fidelity
+# renders. A full queue sheds the request with 503 + Retry-After. Sized via
+# <NAME>_EXECUTOR_WORKERS / <NAME>_EXECUTOR_QUEUE; queue-time metrics are in
+# /api/metrics. Supabase calls stay on the default executor. Gemini and
+# Roboflow calls are native async, so their "workers" bound concurrent calls
+# on the loop instead of threads (Roboflow's image prep runs on the CPU pool).
+
+
+def _bounded_executor(
+    name: str, workers: int, queue: int, cls: type = BoundedExecutor
+) -> Any:
+    env = name.upper()
+    return cls(
+        name,
+        int(os.getenv(f"{env}_EXECUTOR_WORKERS", str(workers))),
+        int(os.getenv(f"{env}_EXECUTOR_QUEUE", str(queue))),
+    )
+
+
+roboflow_executor = _bounded_executor("roboflow", 8, 16, BoundedConcurrency)
+gemini_executor = _bounded_executor("gemini", 8, 16, BoundedConcurrency)
+render_executor = _bounded_executor("render", 2, 4)
+cpu_executor = _bounded_executor("cpu", os.cpu_count() or 2, 32)
+
+# Keep-warm: ping each Roboflow model with a dummy inference just before the
+# idle gap after which Roboflow unloads it (learned per model, see
+# app/models/keep_warm.py), so the next real user does not pay the 30-60s
+# cold start. Every ping spends a Roboflow credit, so it is opt-in
+# (ROBOFLOW_KEEPWARM=true), limited to ROBOFLOW_KEEPWARM_HOURS (e.g. "8-20",
+# in ROBOFLOW_KEEPWARM_TZ) and to ROBOFLOW_KEEPWARM_MAX_PINGS per day per
+# worker. Ping latencies (warm vs cold) are in /api/metrics.
+ROBOFLOW_KEEPWARM_ENABLED = _env_flag("ROBOFLOW_KEEPWARM", False)
+
+
+def _build_keep_warm() -> Optional[KeepWarm]:
+    if not ROBOFLOW_KEEPWARM_ENABLED:
+        return None
+
+    async def ping(model_id: str):
+        return await roboflow_executor.run(warm_roboflow_model, model_id)
+
+    return KeepWarm(
+        roboflow_ladder,
+        roboflow_models,
+        ping,
+        active_hours=parse_active_hours(os.getenv("ROBOFLOW_KEEPWARM_HOURS", "")),
+        max_pings_per_day=int(os.getenv("ROBOFLOW_KEEPWARM_MAX_PINGS", "96")),
+        tz=os.getenv("ROBOFLOW_KEEPWARM_TZ", "UTC"),
+    )
+
+
+keep_warm = _build_keep_warm()
+_keep_warm_task: Optional["asyncio.Task[None]"] = None
+
+# Vector-native detection: for canvas sketches (sketchSource "canvas" or
+# unset) the drawn rectangles and closed strokes in canvasData are classified
+# locally in milliseconds (app/models/vector_detector.py) and Roboflow is not
+# called. Ambiguous freehand drawings, and any box scoring below
+# VECTOR_MIN_CONFIDENCE (default 0.6), still go to Roboflow. Set
+# VECTOR_DETECTION_ENABLED=false to always call Roboflow.
+VECTOR_DETECTION_ENABLED = _env_flag("VECTOR_DETECTION_ENABLED", True)
+
+
+def _shed(error: ExecutorSaturated) -> HTTPException:
+    """503 for a saturated upstream pool — fast, with a retry hint."""
+    retry_secs = max(1, math.ceil(error.retry_after))
+    return HTTPException(
+        status_code=503,
+        detail=f"The server is busy right now. Please try again in {retry_secs}s.",
+        headers={"Retry-After": str(retry_secs)},
+    )
+
+
+async def _offload(
+    executor: Union[BoundedExecutor, BoundedConcurrency],
+    fn: Callable[..., Any],
+    /,
+    *args: Any,
+    **kwargs: Any,
+) -> Any:
+    """Run ``fn`` under ``executor`` (blocking fn on a BoundedExecutor, async
+    fn on a BoundedConcurrency); a full pool becomes a 503."""
+    try:
+        return await executor.run(fn, *args, **kwargs)
+    except ExecutorSaturated as error:
+        raise _shed(error)
+
 
 def _client_ip(http_request: Request) -> str:
     """Best-effort client IP for the rate-limit fallback key. Only used when the
@@ -117,6 +424,341 @@ def _rate_limit_key(request: "GenerateCodeRequest", http_request: Request) -> st
     return f"ip:{_client_ip(http_request)}"
 
 
+async def _charge_ai_budget(request: Any, http_request: Request, kind: str) -> Optional[str]:
+    """Spend ``kind``'s cost from the caller's AI budget, or raise 429.
+
+    Call BEFORE any DB load / Roboflow / Gemini work. Returns the limiter key
+    for _settle_ai_budget / _ai_budget_headers (None when limiting is off).
+    The check runs off the event loop: the sqlite backend takes a write lock
+    other workers may be holding.
+    """
+    if ai_rate_limiter is None:
+        return None
+    key = _rate_limit_key(request, http_request)
+    cost = RATE_LIMIT_COSTS.get(kind, 1.0)
+    allowed, retry_after, _ = await asyncio.to_thread(ai_rate_limiter.check, key, cost)
+    if not allowed:
+        retry_secs = max(1, math.ceil(retry_after))
+        print(
+            f"[rate-limit] 429: {kind} costs {cost:g} of {RATE_LIMIT_BUDGET} units / "
+            f"{RATE_LIMIT_WINDOW_SECONDS:.0f}s; retry in {retry_secs}s"
+        )
+        raise HTTPException(
+            status_code=429,
+            detail=(
+                "You're sending requests too quickly. "
+                f"Please wait {retry_secs}s and try again."
+            ),
+            headers={"Retry-After": str(retry_secs), **_ai_budget_headers(key)},
+        )
+    return key
+
+
+async def _settle_ai_budget(key: Optional[str], charged: str, actual: Optional[str]) -> None:
+    """Refund the difference when a request turned out cheaper than the cost
+    reserved up front (e.g. generation that hit the cache). ``actual=None``
+    refunds the whole charge (the request was shed or failed upstream)."""
+    if key is None or ai_rate_limiter is None:
+        return
+    refund = RATE_LIMIT_COSTS.get(charged, 1.0) - (
+        RATE_LIMIT_COSTS.get(actual, 1.0) if actual is not None else 0.0
+    )
+    if refund > 0:
+        await asyncio.to_thread(ai_rate_limiter.refund, key, refund)
+
+
+class _BudgetCharge:
+    """What an endpoint was charged. ``billed_as`` is the cost kind it
+    turned out to be; the request body sets it when that is cheaper than
+    ``kind`` (a cache hit)."""
+
+    def __init__(self, key: Optional[str], kind: str) -> None:
+        self.key = key
+        self.kind = kind
+        self.billed_as = kind
+
+
+@contextlib.asynccontextmanager
+async def _settling(charge: _BudgetCharge, response: Optional[Response] = None):
+    """Settle ``charge`` on the way out, whatever happens in between.
+
+    Success settles to ``billed_as``. A 5xx (a 503 shed included) or an
+    unexpected error refunds the whole charge, so a client that retries after
+    Retry-After is not 429'd for work that never happened. Client errors
+    (4xx) keep it. A cancelled request (client gone mid-call) keeps it too:
+    the upstream call may already be paid for.
+    """
+    try:
+        yield charge
+    except HTTPException as error:
+        if error.status_code >= 500:
+            await _settle_ai_budget(charge.key, charge.kind, None)
+        raise
+    except Exception:
+        await _settle_ai_budget(charge.key, charge.kind, None)
+        raise
+    await _settle_ai_budget(charge.key, charge.kind, charge.billed_as)
+    if response is not None:
+        response.headers.update(_ai_budget_headers(charge.key))
+
+
+@contextlib.asynccontextmanager
+async def _ai_budget(
+    request: Any, http_request: Request, kind: str, response: Optional[Response] = None
+):
+    """Charge ``kind`` up front (429 when over budget) and settle on the way
+    out (see _settling)."""
+    charge = _BudgetCharge(await _charge_ai_budget(request, http_request, kind), kind)
+    if response is not None:
+        response.headers.update(_ai_budget_headers(charge.key))
+    async with _settling(charge, response):
+        yield charge
+
+
+def _ai_budget_headers(key: Optional[str]) -> Dict[str, str]:
+    if key is None or ai_rate_limiter is None:
+        return {}
+    return {
+        "X-RateLimit-Limit": str(RATE_LIMIT_BUDGET),
+        "X-RateLimit-Remaining": str(ai_rate_limiter.remaining(key)),
+        "X-RateLimit-Window": f"{RATE_LIMIT_WINDOW_SECONDS:g}",
+    }
+
+
+def _detection_cache_key(
+    sketch_image: str,
+    sketch_source: Optional[str],
+    canvas_size: Optional[tuple],
+) -> str:
+    """Cache key for one detect_with_roboflow call.
+
+    Only the inputs detection depends on: the image payload (a data-URL
+    prefix is ignored), the source modality (selects photo preprocessing),
+    the canvas size (echoed into metadata) and the resolved Roboflow
+    settings. Framework, labels, brand kit and model choice are deliberately
+    absent — they only affect Gemini.
+    """
+    payload = sketch_image.split(",", 1)[1] if sketch_image.startswith("data:") else sketch_image
+    img_hash = hashlib.sha256(payload.encode()).hexdigest()[:32]
+    src = (sketch_source or "canvas").lower()
+    size = f"{canvas_size[0]}x{canvas_size[1]}" if canvas_size else "nosize"
+    settings_hash = hashlib.sha256(
+        json.dumps(roboflow_detection_settings(), sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()[:12]
+    return f"{img_hash}|{src}|{size}|{settings_hash}"
+
+
+async def _detect_cached(
+    sketch_image: str,
+    canvas_size: Optional[tuple],
+    sketch_source: Optional[str] = None,
+    cancel_token: Optional[CancellationToken] = None,
+) -> tuple:
+    """detect_with_roboflow behind the detection cache.
+
+    Returns (output, cache_hit). Misses prepare the image on the CPU pool,
+    call Roboflow under roboflow_executor's concurrency limit and
+    store successful outputs; a None output (Roboflow down, nothing detected)
+    is never cached so the next request tries again. ``cancel_token`` is
+    handed to Roboflow so a timed-out caller stops its retries.
+    """
+    if detection_cache is None:
+        output = await _offload(
+            roboflow_executor,
+            detect_with_roboflow_async,
+            sketch_image,
+            canvas_size,
+            sketch_source=sketch_source,
+            cancel_token=cancel_token,
+            run_blocking=cpu_executor.run,
+        )
+        return output, False
+
+    key = _detection_cache_key(sketch_image, sketch_source, canvas_size)
+    cached = detection_cache.get(key)
+    if cached is not None:
+        return cached, True
+    output = await _offload(
+        roboflow_executor,
+        detect_with_roboflow_async,
+        sketch_image,
+        canvas_size,
+        sketch_source=sketch_source,
+        cancel_token=cancel_token,
+        run_blocking=cpu_executor.run,
+    )
+    if output is not None:
+        detection_cache.put(key, output)
+    return output, False
+
+
+def _detection_cache_log() -> str:
+    """" detect_cache=hits/misses" suffix for [timing] lines ("" when off)."""
+    if detection_cache is None:
+        return ""
+    stats = detection_cache.stats()
+    return f" detect_cache={stats['hits']}/{stats['hits'] + stats['misses']} hits"
+
+
+class _RegionPlan(NamedTuple):
+    thumbnail: Any  # new SketchSnapshot thumbnail
+    image_size: Tuple[int, int]
+    unchanged: bool  # pixel-identical to the snapshot: reuse its boxes
+    crop: Optional[Tuple[int, int, int, int]]  # region to re-detect (x, y, w, h)
+    crop_image: Optional[str]  # that region as base64 PNG
+
+
+def _sketch_history_key(request: "GenerateCodeRequest") -> str:
+    return f"{request.userId}|{request.projectId}|{request.currentScreen or ''}"
+
+
+def _plan_region_detection(sketch_image: str, previous: SketchSnapshot) -> _RegionPlan:
+    """Decode the canvas export, thumbnail it for the next snapshot and find
+    the region to re-detect against the previous one. No crop (and not
+    unchanged) means a full detection. CPU-bound — run it on cpu_executor."""
+    image = decode_sketch_rgb(sketch_image)
+    thumbnail = sketch_thumbnail(image)
+    if previous.image_size != image.size or previous.thumbnail.shape != thumbnail.shape:
+        return _RegionPlan(thumbnail, image.size, False, None, None)
+    changed = changed_region(previous.thumbnail, thumbnail)
+    if changed is None:
+        return _RegionPlan(thumbnail, image.size, True, None, None)
+    planned = plan_crop(
+        changed,
+        (thumbnail.shape[1], thumbnail.shape[0]),
+        image.size,
+        previous.elements,
+        max_area=INCREMENTAL_DETECTION_MAX_AREA,
+    )
+    if planned is None:
+        return _RegionPlan(thumbnail, image.size, False, None, None)
+    x, y, w, h = planned[0]
+    buffer = io.BytesIO()
+    image.crop((x, y, x + w, y + h)).save(buffer, format="PNG")
+    crop_image = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return _RegionPlan(thumbnail, image.size, False, planned[0], crop_image)
+
+
+async def _detect_region(
+    plan: _RegionPlan,
+    previous: SketchSnapshot,
+    canvas_size: tuple,
+    cancel_token: CancellationToken,
+) -> Optional[ExternalModelOutput]:
+    """The previous snapshot's boxes, with the planned region re-detected.
+
+    An unchanged sketch makes no Roboflow call. A crop that detects nothing
+    returns None, so the caller runs a full detection: an empty crop may as
+    well be Roboflow failing as the user erasing something.
+    """
+    from app.models.inference import snap_positional_bars, sort_reading_order
+
+    model_id: Optional[str] = None
+    detected = 0
+    elements = previous.elements
+    if not plan.unchanged:
+        crop_output = await _offload(
+            roboflow_executor,
+            detect_with_roboflow_async,
+            plan.crop_image,
+            plan.crop[2:],
+            cancel_token=cancel_token,
+            run_blocking=cpu_executor.run,
+        )
+        if crop_output is None or not crop_output.elements:
+            return None
+        model_id = crop_output.model_version
+        detected = len(crop_output.elements)
+        elements = merge_region_detections(
+            previous.elements, crop_output.elements, plan.crop, plan.image_size
+        )
+        snap_positional_bars(elements)
+        sort_reading_order(elements)
+    metadata: Dict[str, Any] = {
+        "image_width": plan.image_size[0],
+        "image_height": plan.image_size[1],
+        "canvas_width": canvas_size[0],
+        "canvas_height": canvas_size[1],
+        "incremental_detection": {
+            "crop": list(plan.crop) if plan.crop else None,
+            "detected": detected,
+        },
+    }
+    if model_id:
+        metadata["model_id"] = model_id
+    return ExternalModelOutput(
+        source="roboflow", model_version=model_id, elements=elements, metadata=metadata
+    )
+
+
+async def _detect_for_generation(
+    request: "GenerateCodeRequest",
+    canvas_size: tuple,
+    cancel_token: CancellationToken,
+) -> Tuple[Optional[ExternalModelOutput], str]:
+    """Detection for /api/predict: incremental when it can be, otherwise the
+    cached full detection. Returns (output, how) — how is "cache hit",
+    "cache miss", "incremental region WxH" or "incremental unchanged" for the
+    [timing] line.
+
+    Canvas exports are planned against the project screen's SketchSnapshot
+    when the request carries previousElements (the user edited a generated
+    sketch); a plan that fails for any reason, a shed CPU pool included,
+    means a full detection. Either way the new snapshot is recorded after a
+    successful detection, from the plan's thumbnail or else the one the
+    detection made from the pixels it decoded (``sketch_thumbnail``, kept by
+    the detection cache too), so nothing is decoded just for the snapshot.
+    """
+    incremental = sketch_history is not None and request.sketchSource in (None, "canvas")
+    history_key = _sketch_history_key(request)
+    settings = json.dumps(roboflow_detection_settings(), sort_keys=True)
+    previous = sketch_history.get(history_key) if incremental and request.previousElements else None
+    if previous is not None and previous.settings != settings:
+        previous = None
+
+    output: Optional[ExternalModelOutput] = None
+    how = ""
+    plan: Optional[_RegionPlan] = None
+    if previous is not None:
+        try:
+            plan = await _offload(
+                cpu_executor, _plan_region_detection, request.sketchImage, previous
+            )
+        except Exception as plan_error:
+            print(f"[incremental] could not diff the sketch, detecting it whole: {plan_error!r}")
+        if plan is not None and (plan.unchanged or plan.crop is not None):
+            output = await _detect_region(plan, previous, canvas_size, cancel_token)
+            if output is not None:
+                how = (
+                    "incremental unchanged"
+                    if plan.unchanged
+                    else f"incremental region {plan.crop[2]}x{plan.crop[3]}"
+                )
+    if output is None:
+        output, hit = await _detect_cached(
+            request.sketchImage,
+            canvas_size,
+            request.sketchSource,
+            cancel_token=cancel_token,
+        )
+        how = "cache hit" if hit else "cache miss"
+
+    if incremental and output is not None and output.elements:
+        snapshot: Optional[Tuple[Any, Tuple[int, int]]] = None
+        if plan is not None:
+            snapshot = plan.thumbnail, plan.image_size
+        elif output.sketch_thumbnail is not None:
+            width = output.metadata.get("image_width")
+            height = output.metadata.get("image_height")
+            if isinstance(width, (int, float)) and isinstance(height, (int, float)):
+                snapshot = output.sketch_thumbnail.array(), (int(width), int(height))
+        if snapshot is not None:
+            sketch_history.put(
+                history_key, SketchSnapshot(*snapshot, output.elements, settings)
+            )
+    return output, how
+
+
 def _generation_cache_key(
     sketch_image: str,
     framework: str,
@@ -180,6 +822,37 @@ def _generation_cache_key(
     return f"{img_hash}|{fw}|{src}|{ann_hash}|{kit_hash}|{screen_hash}|{model_part}"
 
 
+def _detect_flight_key(
+    sketch_image: str,
+    sketch_source: Optional[str],
+    canvas_size: Optional[tuple] = None,
+) -> str:
+    """Single-flight key for /api/detect: the detection depends only on the
+    image bytes and how they are preprocessed (sketchSource); the canvas size
+    is echoed into the shared output's metadata, so it is part of the key."""
+    img_hash = hashlib.sha256(sketch_image.encode()).hexdigest()[:16]
+    width, height = canvas_size or (None, None)
+    return f"{img_hash}|{(sketch_source or 'canvas').lower()}|{width}x{height}"
+
+
+def _fidelity_flight_key(
+    code: str,
+    framework: str,
+    elements: List["DetectedElement"],
+    width: int,
+    height: int,
+) -> str:
+    """Single-flight key for /api/fidelity: same code rendered at the same size
+    and scored against the same boxes yields the same report."""
+    code_hash = hashlib.sha256(code.encode()).hexdigest()[:16]
+    elements_hash = hashlib.sha256(
+        json.dumps(
+            [e.model_dump() for e in elements], sort_keys=True, separators=(",", ":")
+        ).encode()
+    ).hexdigest()[:12]
+    return f"{code_hash}|{(framework or 'react').lower()}|{elements_hash}|{width}x{height}"
+
+
 class BodySizeLimitMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next) -> Response:
         content_length = request.headers.get("content-length")
@@ -464,13 +1137,15 @@ def build_chat_refine_prompt(
     )
 
 
-def persist_generation_result(
+def _write_generation_result(
     supabase,
     project_id: str,
     canvas_data: Any,
     generated_code: str,
     prompt_used: Optional[str],
 ) -> Optional[str]:
+    """Direct (blocking) write of an iteration + project mirror. Used when the
+    write-behind queue is disabled or full; callers run it off the event loop."""
     iteration_id = None
 
     try:
@@ -499,6 +1174,35 @@ def persist_generation_result(
     return iteration_id
 
 
+async def persist_generation_result(
+    supabase,
+    project_id: str,
+    canvas_data: Any,
+    generated_code: str,
+    prompt_used: Optional[str],
+) -> Optional[str]:
+    """Record a generation in version history without blocking the event loop.
+
+    Fast path: hand the writes to the write-behind queue and return the
+    pre-generated iteration id immediately. When the queue is disabled or
+    full, fall back to a direct write on a worker thread.
+    """
+    if persistence_queue is not None:
+        iteration_id = persistence_queue.submit_iteration(
+            project_id, canvas_data, generated_code, prompt_used
+        )
+        if iteration_id is not None:
+            return iteration_id
+    return await asyncio.to_thread(
+        _write_generation_result,
+        supabase,
+        project_id,
+        canvas_data,
+        generated_code,
+        prompt_used,
+    )
+
+
 def load_project_or_403(supabase, project_id: str, user_id: str):
     project_result = (
         supabase.table("projects")
@@ -1055,9 +1759,24 @@ def _corrected_elements_to_output(
     )
 
 
+# Streaming hooks (/api/predict/stream). ProgressCallback receives a stage name
+# plus a JSON-safe payload; CodeStreamCallback receives each Gemini text chunk,
+# or None when a failed attempt's partial output must be discarded. Both are
+# optional everywhere — the blocking endpoint passes neither.
+ProgressCallback = Callable[[str, Dict[str, Any]], None]
+CodeStreamCallback = Callable[[Optional[str]], None]
+
+
+def _elements_payload(elements: List[Any]) -> List[Dict[str, Any]]:
+    return [el.model_dump(exclude_none=True) for el in elements]
+
+
 async def resolve_external_model_output(
     request: GenerateCodeRequest,
     canvas_data: Dict[str, Any],
+    *,
+    progress: Optional[ProgressCallback] = None,
+    code_stream: Optional[CodeStreamCallback] = None,
 ) -> Optional[ExternalModelOutput]:
     if request.externalModelOutput is not None:
         print("[trace] using request.externalModelOutput (skipping Roboflow)")
@@ -1072,11 +1791,22 @@ async def resolve_external_model_output(
             f"[trace] HITL: using {len(request.correctedElements)} user-corrected "
             "elements (skipping Roboflow + container synthesis)"
         )
+        corrected_output = _corrected_elements_to_output(request.correctedElements)
+        if progress is not None:
+            progress(
+                "detection",
+                {
+                    "source": corrected_output.source,
+                    "elements": _elements_payload(corrected_output.elements),
+                },
+            )
         return await _generate_from_output(
-            _corrected_elements_to_output(request.correctedElements),
+            corrected_output,
             request,
             roboflow_ms=0.0,
             skip_synthesis=True,
+            progress=progress,
+            code_stream=code_stream,
         )
 
     if request.useMockModelOutput or os.getenv("MODEL_OUTPUT_SOURCE", "").lower() == "mock":
@@ -1098,6 +1828,46 @@ async def resolve_external_model_output(
         f"DEBUG_AI_PROMPT={'on' if debug_flag else 'off'}"
     )
 
+    if (
+        VECTOR_DETECTION_ENABLED
+        and has_sketch
+        and request.sketchSource in (None, "canvas")
+        and (canvas_data.get("shapes") or canvas_data.get("lines") or canvas_data.get("componentGroups"))
+    ):
+        _t_vector_start = time.perf_counter()
+        try:
+            vector_output = detect_from_canvas(canvas_data, png_size(request.sketchImage))
+        except Exception as vector_error:
+            # A shortcut, never a failure point: Roboflow still gets the sketch.
+            print(f"[vector] failed, falling back to Roboflow: {vector_error!r}")
+            vector_output = None
+        _vector_ms = (time.perf_counter() - _t_vector_start) * 1000
+        if vector_output is not None and vector_output.elements:
+            print(
+                f"[timing] vector={_vector_ms:.1f}ms "
+                f"({len(vector_output.elements)} elements, skipping Roboflow)"
+            )
+            if progress is not None:
+                meta = vector_output.metadata or {}
+                progress(
+                    "detection",
+                    {
+                        "source": vector_output.source,
+                        "elements": _elements_payload(vector_output.elements),
+                        "imageWidth": meta.get("image_width"),
+                        "imageHeight": meta.get("image_height"),
+                        "timing_ms": {"vector": round(_vector_ms, 1)},
+                    },
+                )
+            return await _generate_from_output(
+                vector_output,
+                request,
+                roboflow_ms=_vector_ms,
+                skip_synthesis=False,
+                progress=progress,
+                code_stream=code_stream,
+            )
+
     if not has_sketch or not has_key:
         print(
             "[trace] short-circuiting Roboflow: "
@@ -1116,17 +1886,15 @@ async def resolve_external_model_output(
     # v4 (YOLOv11 Small) is slower — observed >30s on cold start. 60s gives
     # headroom without hitting the 100s Next.js proxy ceiling.
     _t_roboflow_start = time.perf_counter()
+    detect_token = CancellationToken(60.0, name="roboflow")
     try:
-        roboflow_output = await asyncio.wait_for(
-            asyncio.to_thread(
-                detect_with_roboflow,
-                request.sketchImage,
-                canvas_size,
-                sketch_source=request.sketchSource,
-            ),
+        roboflow_output, _detect_how = await asyncio.wait_for(
+            _detect_for_generation(request, canvas_size, detect_token),
             timeout=60.0,
         )
-    except asyncio.TimeoutError:
+    except HTTPException:
+        raise
+    except (asyncio.TimeoutError, CallCancelled):
         print("[error] Roboflow call timed out after 60s")
         raise HTTPException(
             status_code=504,
@@ -1135,8 +1903,15 @@ async def resolve_external_model_output(
     except Exception as error:
         print(f"Roboflow call raised: {error}")
         return None
+    finally:
+        # Whatever happened to this await, the call must not keep
+        # retrying on our behalf.
+        detect_token.cancel("caller finished")
     _roboflow_ms = (time.perf_counter() - _t_roboflow_start) * 1000
-    print(f"[timing] roboflow={_roboflow_ms:.0f}ms")
+    print(
+        f"[timing] roboflow={_roboflow_ms:.0f}ms"
+        f" ({_detect_how}){_detection_cache_log()}"
+    )
 
     if roboflow_output is None:
         print("[trace] detect_with_roboflow returned None → falling back to contour")
@@ -1145,11 +1920,26 @@ async def resolve_external_model_output(
         print("[trace] Roboflow output had no elements → falling back to contour")
         return None
 
+    if progress is not None:
+        meta = roboflow_output.metadata or {}
+        progress(
+            "detection",
+            {
+                "source": roboflow_output.source,
+                "elements": _elements_payload(roboflow_output.elements),
+                "imageWidth": meta.get("image_width"),
+                "imageHeight": meta.get("image_height"),
+                "timing_ms": {"roboflow": round(_roboflow_ms)},
+            },
+        )
+
     return await _generate_from_output(
         roboflow_output,
         request,
         roboflow_ms=_roboflow_ms,
         skip_synthesis=False,
+        progress=progress,
+        code_stream=code_stream,
     )
 
 
@@ -1159,6 +1949,8 @@ async def _generate_from_output(
     *,
     roboflow_ms: float,
     skip_synthesis: bool,
+    progress: Optional[ProgressCallback] = None,
+    code_stream: Optional[CodeStreamCallback] = None,
 ) -> Optional[ExternalModelOutput]:
     """Shared generation tail: text attachment, role hints, Gemini call.
 
@@ -1206,15 +1998,14 @@ async def _generate_from_output(
     inferred_canvas_size = (image_w, image_h)
 
     # For uploads, hand the processed sketch to Gemini so it can READ the text
-    # baked into the pixels (the detector only returns boxes). Pop it out of the
-    # metadata so the base64 blob never travels back to the browser in the response.
-    gemini_image_bytes: Optional[bytes] = None
-    processed_b64 = (roboflow_output.metadata or {}).pop("processed_image_b64", None)
-    if processed_b64 and request.sketchSource in ("upload-photo", "upload-clean"):
-        try:
-            gemini_image_bytes = base64.b64decode(processed_b64)
-        except Exception as decode_error:
-            print(f"[trace] could not decode processed upload image for Gemini: {decode_error}")
+    # baked into the pixels (the detector only returns boxes). The handle is
+    # the decoded image from detection — nothing is re-encoded or re-decoded.
+    gemini_image: Optional[ImageHandle] = None
+    if roboflow_output.processed_image is not None and request.sketchSource in (
+        "upload-photo",
+        "upload-clean",
+    ):
+        gemini_image = roboflow_output.processed_image
     elif (
         skip_synthesis  # HITL path: Roboflow was skipped, so no stashed image
         and request.sketchSource in ("upload-photo", "upload-clean")
@@ -1222,11 +2013,11 @@ async def _generate_from_output(
     ):
         # The frontend sends back the preprocessed preview it got from
         # /api/detect as sketchImage, so it is already in the same pixel space
-        # as the corrected boxes — decode it directly for Gemini text reading.
+        # as the corrected boxes — hand it to Gemini for text reading.
         try:
             from app.models.inference import _decode_sketch_image
 
-            gemini_image_bytes = _decode_sketch_image(request.sketchImage)
+            gemini_image = ImageHandle.from_bytes(_decode_sketch_image(request.sketchImage))
         except Exception as decode_error:
             print(f"[trace] could not decode HITL upload image for Gemini: {decode_error}")
 
@@ -1258,6 +2049,15 @@ async def _generate_from_output(
     annotate_role_hints(roboflow_output.elements)
     annotate_alignment(roboflow_output.elements)
 
+    if progress is not None:
+        progress(
+            "synthesis",
+            {
+                "elements": _elements_payload(roboflow_output.elements),
+                "extraText": extra_text,
+            },
+        )
+
     # Incremental regeneration (feature D): when the frontend sends the prior
     # generation, diff old vs new detection sets and patch instead of
     # regenerating — unchanged code (incl. chat refinements) stays intact.
@@ -1321,7 +2121,7 @@ async def _generate_from_output(
                 request.styling,
                 request.description,
                 extra_text=extra_text or None,
-                has_image=gemini_image_bytes is not None,
+                has_image=gemini_image is not None,
                 brand_kit=request.brandKit.as_prompt_dict() if request.brandKit else None,
                 screens=request.screens,
                 current_screen=request.currentScreen,
@@ -1331,17 +2131,22 @@ async def _generate_from_output(
         print(prompt_preview)
         print("-" * 70)
 
+    if progress is not None:
+        progress("generating", {"incremental": incremental_prompt is not None})
+
     _t_gemini_start = time.perf_counter()
+    gemini_token = CancellationToken(GEMINI_TIMEOUT_SECONDS, name="gemini")
     try:
         generated_code = await asyncio.wait_for(
-            asyncio.to_thread(
-                generate_with_gemini,
+            _offload(
+                gemini_executor,
+                generate_with_gemini_async,
                 roboflow_output.elements,
                 request.framework,
                 request.styling,
                 request.description,
                 extra_text=extra_text or None,
-                image_bytes=gemini_image_bytes,
+                image=gemini_image,
                 brand_kit=request.brandKit.as_prompt_dict()
                 if request.brandKit
                 else None,
@@ -1349,10 +2154,14 @@ async def _generate_from_output(
                 screens=request.screens,
                 current_screen=request.currentScreen,
                 force_model=request.forceModel,
+                stream_callback=code_stream,
+                cancel_token=gemini_token,
             ),
             timeout=GEMINI_TIMEOUT_SECONDS,
         )
-    except asyncio.TimeoutError:
+    except HTTPException:
+        raise
+    except (asyncio.TimeoutError, CallCancelled):
         print(f"[error] Gemini call timed out after {GEMINI_TIMEOUT_SECONDS:.0f}s")
         raise HTTPException(
             status_code=504,
@@ -1376,6 +2185,8 @@ async def _generate_from_output(
             status_code=504,
             detail="Code generation failed unexpectedly. Please try again.",
         )
+    finally:
+        gemini_token.cancel("caller finished")
 
     if debug:
         preview = generated_code[:500] + ("..." if len(generated_code) > 500 else "")
@@ -1428,10 +2239,32 @@ async def load_models():
         print("Running in development mode with mock predictions")
 
 
+@app.on_event("startup")
+async def start_persistence_queue():
+    if persistence_queue is not None:
+        persistence_queue.start()
+
+
+@app.on_event("shutdown")
+async def drain_persistence_queue():
+    """Flush accepted version-history writes before the worker exits."""
+    if persistence_queue is not None:
+        await asyncio.to_thread(persistence_queue.stop, 10.0)
+
+
+@app.on_event("shutdown")
+async def stop_executors():
+    """Drop queued upstream work; running thread-pool calls finish on their own."""
+    for pool in (roboflow_executor, gemini_executor, render_executor, cpu_executor):
+        pool.shutdown()
+    await _roboflow_clients.close_loop_clients()
+
+
 @app.on_event("startup")
 async def warmup_roboflow():
     """Pre-warm Roboflow's hosted inference so the first user detection
     doesn't pay the cold-start tax (30-60s for v4 Small to load weights).
+    A model that goes cold later is re-warmed by the detector ladder.
 
     Fires in the background so backend startup is non-blocking. A failure
     here is non-fatal — the user's first real request will still work,
@@ -1440,27 +2273,29 @@ async def warmup_roboflow():
     if not api_key:
         return  # validate_env already complained
 
-    async def _warm():
-        import time
-        start = time.time()
+    async def _warm(model_id: str):
         try:
-            from inference_sdk import InferenceHTTPClient
-            from PIL import Image
+            await roboflow_executor.run(warm_roboflow_model, model_id, api_key=api_key)
+        except Exception as error:
+            print(f"[startup] Roboflow {model_id} warm-up skipped (non-fatal): {error}")
 
-            model_id = os.getenv("ROBOFLOW_MODEL_ID", ROBOFLOW_DEFAULT_MODEL_ID)
-            api_url = os.getenv("ROBOFLOW_API_URL", ROBOFLOW_DEFAULT_API_URL)
+    # Every rung of the detector ladder, so a fallback is warm before the
+    # first request needs it.
+    for rung in roboflow_models():
+        asyncio.create_task(_warm(rung.model_id))
 
-            # 64x64 white image — minimum payload that triggers Roboflow's
-            # model-load path without spending a real inference credit's worth.
-            dummy = Image.new("RGB", (64, 64), (255, 255, 255))
-            client = InferenceHTTPClient(api_url=api_url, api_key=api_key)
 
-            await asyncio.to_thread(client.infer, dummy, model_id=model_id)
-            print(f"[startup] Roboflow {model_id} warm-up done in {time.time() - start:.1f}s")
-        except Exception as error:
-            print(f"[startup] Roboflow warm-up skipped after {time.time() - start:.1f}s (non-fatal): {error}")
+@app.on_event("startup")
+async def start_keep_warm():
+    global _keep_warm_task
+    if keep_warm is not None and os.getenv("ROBOFLOW_API_KEY"):
+        _keep_warm_task = asyncio.create_task(keep_warm.run())
 
-    asyncio.create_task(_warm())
+
+@app.on_event("shutdown")
+async def stop_keep_warm():
+    if _keep_warm_task is not None:
+        _keep_warm_task.cancel()
 
 
 @app.get("/")
@@ -1489,339 +2324,575 @@ async def llm_status():
 
     Read-only snapshot: configured model ladder + per key×model cooldowns and
     today's success counts. Key slots only — no key material ever leaves the
-    process. Counts are in-memory (reset on backend restart); Google has no
+    process. Counts are per worker and reset on restart, unless
+    GEMINI_POOL_BACKEND=sqlite shares them pool-wide; Google has no
     remaining-quota API, so a per-day cooldown is the "exhausted today" signal.
     """
-    return get_llm_pool_status()
+    # Off the loop: with a shared store the snapshot first syncs from SQLite.
+    return await asyncio.to_thread(get_llm_pool_status)
 
 
-@app.post("/api/predict", response_model=GenerateCodeResponse)
-async def predict(request: GenerateCodeRequest, http_request: Request):
+def _generation_cache_metrics() -> Optional[Dict[str, Any]]:
+    """The /api/metrics generation_cache section. Blocking with the sqlite
+    backend — run it off the event loop."""
+    if generation_cache is None:
+        return None
+    return {"backend": type(generation_cache).__name__, "size": generation_cache.size}
+
+
+@app.get("/api/metrics")
+async def metrics():
+    """Process-local operational counters (this uvicorn worker only).
+
+    ``persistence``: write-behind queue depth, write counts and Supabase write
+    latency — a growing depth or failed count means Supabase is slow/down.
+    ``single_flight``: per-endpoint leaders (calls actually made) vs followers
+    (duplicates that joined an in-flight call instead of paying for their own).
+    ``generation_cache``: which backend is active and its entry count (the
+    sqlite backend's count is shared by every worker on the host).
+    ``detection_cache``: Roboflow outputs reused across framework/brand-kit
+    switches and the HITL detect → predict hand-off.
+    ``executors``: per-upstream pool occupancy, queue wait and shed (rejected)
+    counts — rising queue_wait_ms means that upstream needs more workers.
+    ``detector_ladder``: per Roboflow model breaker state, warmth and latency.
+    ``keep_warm``: keep-warm pings per model, split into warm and cold
+    latencies, against the daily ping budget (null when disabled).
     """
-    Main endpoint for sketch-to-code generation using custom trained models
+    # The sqlite backend's size is a COUNT(*) over the shared file.
+    generation_cache_metrics = await asyncio.to_thread(_generation_cache_metrics)
+    return {
+        "persistence": persistence_queue.metrics() if persistence_queue else None,
+        "single_flight": {
+            flight.name: flight.metrics()
+            for flight in (generation_flights, detect_flights, fidelity_flights)
+            if flight is not None
+        },
+        "generation_cache": generation_cache_metrics,
+        "detection_cache": detection_cache.stats() if detection_cache else None,
+        "detector_ladder": roboflow_ladder.snapshot(roboflow_models()),
+        "keep_warm": keep_warm.metrics() if keep_warm is not None else None,
+        "executors": {
+            pool.name: pool.metrics()
+            for pool in (roboflow_executor, gemini_executor, render_executor, cpu_executor)
+        },
+        # Upstream calls that stopped early because their caller timed out or
+        # disconnected, instead of running to completion for nobody.
+        "abandoned_calls": abandoned_counts(),
+    }
 
-    This is your FYP AI pipeline:
-    1. Preprocess canvas data
-    2. Run custom CNN for element detection
-    3. Run custom code generation model
-    4. Save results to Supabase
-    5. Return generated code
+
+class _PipelineResult(NamedTuple):
+    external_model_output: Optional[ExternalModelOutput]
+    detected_elements: List[Dict[str, Any]]
+    generated_code: str
+    generation_description: Optional[str]
+
+
+async def _run_generation_pipeline(
+    request: GenerateCodeRequest,
+    canvas_data: Dict[str, Any],
+    cache_key: Optional[str],
+    *,
+    progress: Optional[ProgressCallback] = None,
+    code_stream: Optional[CodeStreamCallback] = None,
+) -> _PipelineResult:
+    """Detection + code generation for /api/predict (everything but persistence).
+
+    Split out of predict so identical in-flight requests can share one run via
+    ``generation_flights``; each caller still persists its own iteration.
     """
+    external_model_output = await resolve_external_model_output(
+        request, canvas_data, progress=progress, code_stream=code_stream
+    )
+    generation_framework = (
+        external_model_output.framework
+        if external_model_output and external_model_output.framework
+        else request.framework
+    )
+    generation_description = (
+        external_model_output.description
+        if external_model_output and external_model_output.description
+        else request.description
+    )
+    # Only the contour fallback reads the rasterized canvas; build it on demand.
+    def processed_data() -> Any:
+        return preprocess_canvas_data(canvas_data, target_size=(256, 256))
+
+    detector = sketch_detector or SketchDetector()
     try:
-        # Rate limit the expensive AI pipeline per authenticated user, BEFORE any
-        # DB load / Roboflow / Gemini work, so abuse is cheap to reject. The proxy
-        # stamps the trusted user id into request.userId; we key on that (every
-        # request shares the proxy IP, so IP keying would pool all users together).
-        if ai_rate_limiter is not None:
-            allowed, retry_after, _ = ai_rate_limiter.check(
-                _rate_limit_key(request, http_request)
-            )
-            if not allowed:
-                retry_secs = max(1, math.ceil(retry_after))
-                print(
-                    f"[rate-limit] 429: over {RATE_LIMIT_MAX_REQUESTS} req / "
-                    f"{RATE_LIMIT_WINDOW_SECONDS:.0f}s; retry in {retry_secs}s"
-                )
-                raise HTTPException(
-                    status_code=429,
-                    detail=(
-                        "You're sending requests too quickly. "
-                        f"Please wait {retry_secs}s and try again."
-                    ),
-                    headers={"Retry-After": str(retry_secs)},
-                )
+        detected_elements = detector.detect(
+            processed_data,
+            external_output=external_model_output,
+        )
+    except Exception as error:
+        print(f"Sketch detector error: {error}")
+        detected_elements = detector.detect(processed_data)
 
-        print(f"Received prediction request for project: {request.projectId}")
+    print(f"Detected {len(detected_elements)} UI elements")
 
-        supabase = create_supabase_client()
-        project = load_project_or_403(supabase, request.projectId, request.userId)
-        project_canvas_data = project.get("canvas_data") or {}
-
-        # HITL audit trail: what the user changed in the review overlay. Logged
-        # fire-and-forget — a logging failure must never block generation.
-        if request.detectionCorrections:
-            rows = _build_correction_rows(
-                request.projectId, request.userId, request.detectionCorrections
-            )
-            if rows:
-                try:
-                    supabase.table("detection_corrections").insert(rows).execute()
-                    print(f"[hitl] logged {len(rows)} detection correction(s)")
-                except Exception as log_error:
-                    print(f"Warning: could not log detection corrections: {log_error}")
+    generator = code_generator or CodeGenerator()
+    try:
+        generated_code = generator.generate(
+            elements=detected_elements,
+            framework=generation_framework,
+            description=generation_description,
+            external_output=external_model_output,
+        )
+    except Exception as error:
+        print(f"Code generator error: {error}")
+        generated_code = generator.generate(
+            elements=detected_elements,
+            framework=generation_framework,
+            description=generation_description,
+        )
 
-        if request.mode == "chat":
-            if not request.messages or not request.currentCode:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Missing messages or code context",
-                )
+    print(f"Generated {len(generated_code)} characters of code")
 
-            last_message = request.messages[-1].content
-            chat_prompt = build_chat_refine_prompt(
-                last_message,
-                request.currentCode,
-                request.framework,
-            )
-            used_fallback = False
-            try:
-                refined = await asyncio.wait_for(
-                    asyncio.to_thread(
-                        generate_with_gemini,
-                        [],
-                        request.framework,
-                        request.styling,
-                        None,
-                        prompt_override=chat_prompt,
-                        force_model=request.forceModel,
-                    ),
-                    timeout=GEMINI_TIMEOUT_SECONDS,
-                )
-                refined = re.sub(r"^```[\w]*\n?", "", refined.strip())
-                refined = re.sub(r"\n?```$", "", refined).strip()
-                if not refined:
-                    raise RuntimeError("Gemini returned empty code")
-                result = {
-                    "code": refined,
-                    "message": "Code updated.",
-                }
-            except (GeminiRateLimited, GeminiQuotaExhausted) as error:
-                print(f"Gemini chat unavailable: {error}")
-                used_fallback = True
-                result = {
-                    "code": request.currentCode
-                    + f"\n\n<!-- Refinement: {last_message} -->",
-                    "message": "AI service is busy right now - added your request as a comment. Try again shortly.",
-                }
-            except Exception as error:
-                print(f"Gemini chat error: {error}")
-                used_fallback = True
-                result = {
-                    "code": request.currentCode
-                    + f"\n\n<!-- Refinement: {last_message} -->",
-                    "message": "AI service temporarily unavailable - added your request as a comment.",
-                }
-
-            iteration_id = persist_generation_result(
-                supabase,
-                request.projectId,
-                project_canvas_data,
-                result["code"],
-                last_message,
-            )
+    # Cache successful Gemini results. Skip for fallback/mock/template paths —
+    # those are degraded outputs and shouldn't crowd out real results.
+    if (
+        generation_cache is not None
+        and cache_key is not None
+        and external_model_output is not None
+        and getattr(external_model_output, "source", None) != "mock"
+        and getattr(external_model_output, "generated_code", None)
+    ):
+        # Off the loop: the sqlite backend may wait on another worker's lock.
+        await asyncio.to_thread(
+            generation_cache.put,
+            cache_key,
+            CachedResult(
+                generated_code=generated_code,
+                elements_json=detected_elements,
+                source="gemini",
+            ),
+        )
+        print(f"[cache] stored (key={cache_key[:20]}…)")
 
-            return GenerateCodeResponse(
-                code=result["code"],
-                success=True,
-                detectedElements=[],
-                message=result["message"],
-                iteration_id=iteration_id,
-                usedFallback=used_fallback or None,
-            )
+    return _PipelineResult(
+        external_model_output, detected_elements, generated_code, generation_description
+    )
 
-        if not request.canvasData:
-            raise HTTPException(status_code=400, detail="Invalid canvas data")
 
-        canvas_data = request.canvasData.model_dump()
+async def _log_detection_corrections(supabase, request: GenerateCodeRequest) -> None:
+    if not request.detectionCorrections:
+        return
+    rows = _build_correction_rows(
+        request.projectId, request.userId, request.detectionCorrections
+    )
+    if not rows:
+        return
+    if persistence_queue is not None and persistence_queue.submit_insert(
+        "detection_corrections", rows
+    ):
+        print(f"[hitl] queued {len(rows)} detection correction(s)")
+        return
+    try:
+        await asyncio.to_thread(
+            lambda: supabase.table("detection_corrections").insert(rows).execute()
+        )
+        print(f"[hitl] logged {len(rows)} detection correction(s)")
+    except Exception as log_error:
+        print(f"Warning: could not log detection corrections: {log_error}")
 
-        # Upload path: the frontend keeps the API payload lean (the image
-        # already travels as sketchImage), so canvasData carries no
-        # uploadedSketch stub. Stamp one in before persisting so version
-        # restore can bring the upload workspace back for THIS iteration.
-        if (
-            request.sketchSource in ("upload-photo", "upload-clean")
-            and request.sketchImage
-            and not canvas_data.get("uploadedSketch")
-        ):
-            _data_url = request.sketchImage
-            if not _data_url.startswith("data:"):
-                _data_url = "data:image/png;base64," + _data_url
-            canvas_data["uploadedSketch"] = {
-                "dataUrl": _data_url,
-                "source": request.sketchSource,
-                "width": canvas_data.get("width") or 1000,
-                "height": canvas_data.get("height") or 600,
-            }
 
-        # B12: Cache check. Same sketch + framework + labels → skip Roboflow+Gemini.
-        # Auth and rate-limit already passed above; still persist an iteration on
-        # hit so version history stays accurate for the user.
-        # HITL corrected sets bypass the cache entirely (read AND write): the
-        # cache key hashes the sketch image, not the corrections, so a cached
-        # result would silently ignore the user's edits.
-        cache_key: Optional[str] = None
-        if (
-            generation_cache is not None
-            and request.sketchImage
-            and not request.correctedElements
-            # Incremental requests depend on previousCode, which the key does
-            # not hash — a cache hit would ignore the user's sketch edit.
-            and not request.previousCode
-        ):
-            cache_key = _generation_cache_key(
-                request.sketchImage,
-                request.framework,
-                request.sketchSource,
-                request.textAnnotations,
-                request.brandKit,
-                request.screens,
-                request.currentScreen,
-                request.forceModel,
+async def _generate_response(
+    request: GenerateCodeRequest,
+    supabase,
+    *,
+    progress: Optional[ProgressCallback] = None,
+    code_stream: Optional[CodeStreamCallback] = None,
+) -> Tuple[GenerateCodeResponse, str]:
+    """Generate-mode body of /api/predict: cache, pipeline, persistence.
+
+    Returns (response, billed_as) where ``billed_as`` is the rate-limit cost
+    class the request turned out to be: "cache_hit", "noop" (incremental,
+    nothing changed, no Gemini call) or "generate".
+
+    Shared by the blocking endpoint and its SSE variant. ``progress`` and
+    ``code_stream`` are only set by the streaming endpoint; such requests
+    skip single-flight, because a joined call would never report its stages
+    to the second caller.
+    """
+    if not request.canvasData:
+        raise HTTPException(status_code=400, detail="Invalid canvas data")
+
+    canvas_data = request.canvasData.model_dump()
+
+    # Upload path: the frontend keeps the API payload lean (the image
+    # already travels as sketchImage), so canvasData carries no
+    # uploadedSketch stub. Stamp one in before persisting so version
+    # restore can bring the upload workspace back for THIS iteration.
+    if (
+        request.sketchSource in ("upload-photo", "upload-clean")
+        and request.sketchImage
+        and not canvas_data.get("uploadedSketch")
+    ):
+        _data_url = request.sketchImage
+        if not _data_url.startswith("data:"):
+            _data_url = "data:image/png;base64," + _data_url
+        canvas_data["uploadedSketch"] = {
+            "dataUrl": _data_url,
+            "source": request.sketchSource,
+            "width": canvas_data.get("width") or 1000,
+            "height": canvas_data.get("height") or 600,
+        }
+
+    # B12: Cache check. Same sketch + framework + labels → skip Roboflow+Gemini.
+    # Auth and rate-limit are the caller's job; still persist an iteration on
+    # hit so version history stays accurate for the user.
+    # HITL corrected sets bypass the cache entirely (read AND write): the
+    # cache key hashes the sketch image, not the corrections, so a cached
+    # result would silently ignore the user's edits.
+    cache_key: Optional[str] = None
+    if (
+        generation_cache is not None
+        and request.sketchImage
+        and not request.correctedElements
+        # Incremental requests depend on previousCode, which the key does
+        # not hash — a cache hit would ignore the user's sketch edit.
+        and not request.previousCode
+    ):
+        cache_key = _generation_cache_key(
+            request.sketchImage,
+            request.framework,
+            request.sketchSource,
+            request.textAnnotations,
+            request.brandKit,
+            request.screens,
+            request.currentScreen,
+            request.forceModel,
+        )
+        cached = await asyncio.to_thread(generation_cache.get, cache_key)
+        if cached is not None:
+            print(f"[cache] HIT (key={cache_key[:20]}…) — skipping Roboflow+Gemini")
+            iteration_id = await persist_generation_result(
+                supabase,
+                request.projectId,
+                canvas_data,
+                cached.generated_code,
+                request.description,
+            )
+            return GenerateCodeResponse(
+                code=cached.generated_code,
+                success=True,
+                detectedElements=[DetectedElement(**e) for e in cached.elements_json],
+                message=None,
+                iteration_id=iteration_id,
+                usedFallback=False,
+                timing_ms={"total": 0, "cache_hit": 1},
+            ), "cache_hit"
+        print(f"[cache] MISS (key={cache_key[:20]}…)")
+
+    _t_pipeline_start = time.perf_counter()
+    # Single-flight: a double-click or proxy retry with the same cache key
+    # joins the in-flight run instead of paying Roboflow + Gemini twice.
+    if (
+        cache_key is not None
+        and generation_flights is not None
+        and progress is None
+        and code_stream is None
+    ):
+        pipeline, _shared = await generation_flights.do(
+            cache_key,
+            lambda: _run_generation_pipeline(request, canvas_data, cache_key),
+        )
+    else:
+        pipeline = await _run_generation_pipeline(
+            request,
+            canvas_data,
+            cache_key,
+            progress=progress,
+            code_stream=code_stream,
+        )
+    (
+        external_model_output,
+        detected_elements,
+        generated_code,
+        generation_description,
+    ) = pipeline
+
+    iteration_id = await persist_generation_result(
+        supabase,
+        request.projectId,
+        canvas_data,
+        generated_code,
+        generation_description,
+    )
+
+    _total_ms = (time.perf_counter() - _t_pipeline_start) * 1000
+    _stage_timing: Optional[Dict[str, float]] = (
+        (external_model_output.metadata or {}).get("timing_ms")
+        if external_model_output and external_model_output.metadata
+        else None
+    )
+    _timing_ms: Dict[str, float] = {"total": round(_total_ms)}
+    if _stage_timing:
+        _timing_ms.update(_stage_timing)
+    print(
+        f"[timing] total={_total_ms:.0f}ms"
+        + (
+            f" (roboflow={_stage_timing['roboflow']}ms"
+            f" gemini={_stage_timing['gemini']}ms)"
+            if _stage_timing
+            else ""
+        )
+    )
+
+    if external_model_output is None:
+        used_fallback = True
+        response_message = (
+            "Sketch detection was unavailable — code was generated from basic shape analysis. "
+            "Results may be generic."
+        )
+    elif getattr(external_model_output, "source", None) == "mock":
+        used_fallback = True
+        response_message = "Running in demo mode — using mock detection."
+    elif not getattr(external_model_output, "generated_code", None):
+        used_fallback = True
+        response_message = (
+            "AI code generation hit a quota limit — showing a template-based result instead. "
+            "Try again in a few minutes."
+        )
+    else:
+        used_fallback = False
+        response_message = None
+
+    used_incremental = bool(
+        external_model_output is not None
+        and (external_model_output.metadata or {}).get("incremental")
+    )
+    billed_as = (
+        "noop"
+        if external_model_output is not None
+        and (external_model_output.metadata or {}).get("code_generator") == "incremental-noop"
+        else "generate"
+    )
+
+    return GenerateCodeResponse(
+        code=generated_code,
+        success=True,
+        detectedElements=[DetectedElement(**elem) for elem in detected_elements],
+        message=response_message,
+        iteration_id=iteration_id,
+        usedFallback=used_fallback,
+        timing_ms=_timing_ms,
+        usedIncremental=used_incremental or None,
+    ), billed_as
+
+
+@app.post("/api/predict", response_model=GenerateCodeResponse)
+async def predict(request: GenerateCodeRequest, http_request: Request, response: Response):
+    """
+    Main endpoint for sketch-to-code generation using custom trained models
+
+    This is your FYP AI pipeline:
+    1. Preprocess canvas data
+    2. Run custom CNN for element detection
+    3. Run custom code generation model
+    4. Save results to Supabase
+    5. Return generated code
+    """
+    # Rate limit the expensive AI pipeline per authenticated user, BEFORE any
+    # DB load / Roboflow / Gemini work, so abuse is cheap to reject. The proxy
+    # stamps the trusted user id into request.userId; we key on that (every
+    # request shares the proxy IP, so IP keying would pool all users together).
+    # Generation reserves the full cost up front; a cache hit or incremental
+    # no-op is refunded once _generate_response knows which path it took, and
+    # a shed or failed request gets it all back.
+    budget_kind = "chat" if request.mode == "chat" else "generate"
+    async with _ai_budget(request, http_request, budget_kind, response) as budget:
+        try:
+            print(f"Received prediction request for project: {request.projectId}")
+
+            supabase = create_supabase_client()
+            project = await asyncio.to_thread(
+                load_project_or_403, supabase, request.projectId, request.userId
             )
-            cached = generation_cache.get(cache_key)
-            if cached is not None:
-                print(f"[cache] HIT (key={cache_key[:20]}…) — skipping Roboflow+Gemini")
-                iteration_id = persist_generation_result(
+            project_canvas_data = project.get("canvas_data") or {}
+
+            # HITL audit trail: what the user changed in the review overlay. Logged
+            # fire-and-forget — a logging failure must never block generation.
+            await _log_detection_corrections(supabase, request)
+
+            if request.mode == "chat":
+                if not request.messages or not request.currentCode:
+                    raise HTTPException(
+                        status_code=400,
+                        detail="Missing messages or code context",
+                    )
+
+                last_message = request.messages[-1].content
+                chat_prompt = build_chat_refine_prompt(
+                    last_message,
+                    request.currentCode,
+                    request.framework,
+                )
+                used_fallback = False
+                chat_token = CancellationToken(GEMINI_TIMEOUT_SECONDS, name="gemini")
+                try:
+                    refined = await asyncio.wait_for(
+                        _offload(
+                            gemini_executor,
+                            generate_with_gemini_async,
+                            [],
+                            request.framework,
+                            request.styling,
+                            None,
+                            prompt_override=chat_prompt,
+                            force_model=request.forceModel,
+                            cancel_token=chat_token,
+                        ),
+                        timeout=GEMINI_TIMEOUT_SECONDS,
+                    )
+                    refined = re.sub(r"^```[\w]*\n?", "", refined.strip())
+                    refined = re.sub(r"\n?```$", "", refined).strip()
+                    if not refined:
+                        raise RuntimeError("Gemini returned empty code")
+                    result = {
+                        "code": refined,
+                        "message": "Code updated.",
+                    }
+                except HTTPException:
+                    raise
+                except (GeminiRateLimited, GeminiQuotaExhausted) as error:
+                    print(f"Gemini chat unavailable: {error}")
+                    used_fallback = True
+                    result = {
+                        "code": request.currentCode
+                        + f"\n\n<!-- Refinement: {last_message} -->",
+                        "message": "AI service is busy right now - added your request as a comment. Try again shortly.",
+                    }
+                except Exception as error:
+                    print(f"Gemini chat error: {error}")
+                    used_fallback = True
+                    result = {
+                        "code": request.currentCode
+                        + f"\n\n<!-- Refinement: {last_message} -->",
+                        "message": "AI service temporarily unavailable - added your request as a comment.",
+                    }
+                finally:
+                    chat_token.cancel("caller finished")
+
+                iteration_id = await persist_generation_result(
                     supabase,
                     request.projectId,
-                    canvas_data,
-                    cached.generated_code,
-                    request.description,
+                    project_canvas_data,
+                    result["code"],
+                    last_message,
                 )
+
                 return GenerateCodeResponse(
-                    code=cached.generated_code,
+                    code=result["code"],
                     success=True,
-                    detectedElements=[DetectedElement(**e) for e in cached.elements_json],
-                    message=None,
+                    detectedElements=[],
+                    message=result["message"],
                     iteration_id=iteration_id,
-                    usedFallback=False,
-                    timing_ms={"total": 0, "cache_hit": 1},
+                    usedFallback=used_fallback or None,
                 )
-            print(f"[cache] MISS (key={cache_key[:20]}…)")
-
-        _t_pipeline_start = time.perf_counter()
-        external_model_output = await resolve_external_model_output(request, canvas_data)
-        generation_framework = (
-            external_model_output.framework
-            if external_model_output and external_model_output.framework
-            else request.framework
-        )
-        generation_description = (
-            external_model_output.description
-            if external_model_output and external_model_output.description
-            else request.description
-        )
-        processed_data = preprocess_canvas_data(
-            canvas_data,
-            target_size=(256, 256),
-        )
 
-        detector = sketch_detector or SketchDetector()
-        try:
-            detected_elements = detector.detect(
-                processed_data,
-                external_output=external_model_output,
-            )
+            generated, budget.billed_as = await _generate_response(request, supabase)
+            return generated
+
+        except HTTPException:
+            raise
         except Exception as error:
-            print(f"Sketch detector error: {error}")
-            detected_elements = detector.detect(processed_data)
+            print(f"Error in prediction pipeline: {str(error)}")
+            raise HTTPException(status_code=500, detail=f"Prediction failed: {str(error)}")
 
-        print(f"Detected {len(detected_elements)} UI elements")
 
-        generator = code_generator or CodeGenerator()
-        try:
-            generated_code = generator.generate(
-                elements=detected_elements,
-                framework=generation_framework,
-                description=generation_description,
-                external_output=external_model_output,
-            )
-        except Exception as error:
-            print(f"Code generator error: {error}")
-            generated_code = generator.generate(
-                elements=detected_elements,
-                framework=generation_framework,
-                description=generation_description,
-            )
+def _sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event frame. ``data`` is JSON-encoded on a single
+    line, so no payload can break the frame with an embedded blank line."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
 
-        print(f"Generated {len(generated_code)} characters of code")
 
-        # Cache successful Gemini results. Skip for fallback/mock/template paths —
-        # those are degraded outputs and shouldn't crowd out real results.
-        if (
-            generation_cache is not None
-            and cache_key is not None
-            and external_model_output is not None
-            and getattr(external_model_output, "source", None) != "mock"
-            and getattr(external_model_output, "generated_code", None)
-        ):
-            generation_cache.put(
-                cache_key,
-                CachedResult(
-                    generated_code=generated_code,
-                    elements_json=detected_elements,
-                    source="gemini",
-                ),
-            )
-            print(f"[cache] stored (key={cache_key[:20]}…, size={generation_cache.size})")
+@app.post("/api/predict/stream")
+async def predict_stream(request: GenerateCodeRequest, http_request: Request):
+    """Generate-mode /api/predict as a Server-Sent Events stream.
 
-        iteration_id = persist_generation_result(
-            supabase,
-            request.projectId,
-            canvas_data,
-            generated_code,
-            generation_description,
-        )
+    Same auth, rate limit, cache and persistence as the blocking endpoint, but
+    the client sees each stage as soon as it is ready instead of staring at a
+    spinner for the whole Roboflow + Gemini round trip:
 
-        _total_ms = (time.perf_counter() - _t_pipeline_start) * 1000
-        _stage_timing: Optional[Dict[str, float]] = (
-            (external_model_output.metadata or {}).get("timing_ms")
-            if external_model_output and external_model_output.metadata
-            else None
-        )
-        _timing_ms: Dict[str, float] = {"total": round(_total_ms)}
-        if _stage_timing:
-            _timing_ms.update(_stage_timing)
-        print(
-            f"[timing] total={_total_ms:.0f}ms"
-            + (
-                f" (roboflow={_stage_timing['roboflow']}ms"
-                f" gemini={_stage_timing['gemini']}ms)"
-                if _stage_timing
-                else ""
-            )
-        )
+      detection   boxes from Roboflow (or the HITL corrected set)
+      synthesis   final elements after container synthesis + role hints
+      generating  Gemini call started ({"incremental": bool})
+      code        a chunk of generated code ({"delta": str})
+      code_reset  discard streamed code — a key/model attempt failed and the
+                  next one starts from scratch
+      done        the full GenerateCodeResponse (authoritative code)
+      error       {"status": int, "detail": str}; the stream ends after it
 
-        if external_model_output is None:
-            used_fallback = True
-            response_message = (
-                "Sketch detection was unavailable — code was generated from basic shape analysis. "
-                "Results may be generic."
-            )
-        elif getattr(external_model_output, "source", None) == "mock":
-            used_fallback = True
-            response_message = "Running in demo mode — using mock detection."
-        elif not getattr(external_model_output, "generated_code", None):
-            used_fallback = True
-            response_message = (
-                "AI code generation hit a quota limit — showing a template-based result instead. "
-                "Try again in a few minutes."
-            )
-        else:
-            used_fallback = False
-            response_message = None
+    A cache hit or an unchanged incremental sketch goes straight to ``done``.
+    Auth/rate-limit failures are returned as plain HTTP errors before the
+    stream opens. Chat mode is not streamed (use /api/predict).
+    """
+    if request.mode == "chat":
+        raise HTTPException(status_code=400, detail="Chat mode is not streamed; use /api/predict")
 
-        used_incremental = bool(
-            external_model_output is not None
-            and (external_model_output.metadata or {}).get("incremental")
-        )
+    budget = _BudgetCharge(await _charge_ai_budget(request, http_request, "generate"), "generate")
 
-        return GenerateCodeResponse(
-            code=generated_code,
-            success=True,
-            detectedElements=[DetectedElement(**elem) for elem in detected_elements],
-            message=response_message,
-            iteration_id=iteration_id,
-            usedFallback=used_fallback,
-            timing_ms=_timing_ms,
-            usedIncremental=used_incremental or None,
+    print(f"Received streaming prediction request for project: {request.projectId}")
+
+    async with _settling(budget):
+        supabase = create_supabase_client()
+        await asyncio.to_thread(load_project_or_403, supabase, request.projectId, request.userId)
+        await _log_detection_corrections(supabase, request)
+
+    events: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
+    def progress(stage: str, payload: Dict[str, Any]) -> None:
+        events.put_nowait(_sse_event(stage, payload))
+
+    def code_stream(delta: Optional[str]) -> None:
+        # Gemini streams on the event loop, so chunks go straight onto the queue.
+        events.put_nowait(
+            _sse_event("code_reset", {}) if delta is None else _sse_event("code", {"delta": delta})
         )
 
-    except HTTPException:
-        raise
-    except Exception as error:
-        print(f"Error in prediction pipeline: {str(error)}")
-        raise HTTPException(status_code=500, detail=f"Prediction failed: {str(error)}")
+    async def run() -> None:
+        try:
+            async with _settling(budget):
+                generated, budget.billed_as = await _generate_response(
+                    request, supabase, progress=progress, code_stream=code_stream
+                )
+            events.put_nowait(_sse_event("done", generated.model_dump(exclude_none=True)))
+        except HTTPException as error:
+            events.put_nowait(
+                _sse_event("error", {"status": error.status_code, "detail": error.detail})
+            )
+        except Exception as error:
+            print(f"Error in streaming prediction pipeline: {str(error)}")
+            events.put_nowait(
+                _sse_event("error", {"status": 500, "detail": f"Prediction failed: {str(error)}"})
+            )
+        finally:
+            events.put_nowait(None)
+
+    async def frames():
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                frame = await events.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            # Client went away mid-stream: cancelling the pipeline cancels the
+            # in-flight Gemini stream with it.
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        frames(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            **_ai_budget_headers(budget.key),
+        },
+    )
 
 
 def _build_correction_rows(
@@ -1853,7 +2924,7 @@ def _build_correction_rows(
 
 
 @app.post("/api/detect", response_model=DetectResponse)
-async def detect(request: DetectRequest, http_request: Request):
+async def detect(request: DetectRequest, http_request: Request, response: Response):
     """Detection-only endpoint for the HITL review step (Idea #4).
 
     Runs the same Roboflow call /api/predict would, but stops before Gemini so
@@ -1865,88 +2936,102 @@ async def detect(request: DetectRequest, http_request: Request):
         raise HTTPException(status_code=400, detail="No sketch image to detect on")
 
     # Same per-user AI budget as /api/predict — this spends a Roboflow call.
-    if ai_rate_limiter is not None:
-        allowed, retry_after, _ = ai_rate_limiter.check(
-            _rate_limit_key(request, http_request)
+    async with _ai_budget(request, http_request, "detect", response):
+        supabase = create_supabase_client()
+        await asyncio.to_thread(
+            load_project_or_403, supabase, request.projectId, request.userId
         )
-        if not allowed:
-            retry_secs = max(1, math.ceil(retry_after))
-            raise HTTPException(
-                status_code=429,
-                detail=(
-                    "You're sending requests too quickly. "
-                    f"Please wait {retry_secs}s and try again."
+
+        async def _detect() -> Optional[ExternalModelOutput]:
+            token = CancellationToken(60.0, name="roboflow")
+            try:
+                output, _hit = await asyncio.wait_for(
+                    _detect_cached(
+                        request.sketchImage,
+                        (request.width, request.height),
+                        request.sketchSource,
+                        cancel_token=token,
+                    ),
+                    timeout=60.0,
+                )
+                return output
+            except HTTPException:
+                raise
+            except (asyncio.TimeoutError, CallCancelled):
+                raise HTTPException(
+                    status_code=504,
+                    detail="Sketch detection timed out — the Roboflow API did not respond in time. Please try again.",
+                )
+            except Exception as error:
+                print(f"[detect] Roboflow call raised: {error}")
+                raise HTTPException(status_code=502, detail="Sketch detection failed")
+            finally:
+                token.cancel("caller finished")
+
+        _t_start = time.perf_counter()
+        if detect_flights is not None:
+            output, _shared = await detect_flights.do(
+                _detect_flight_key(
+                    request.sketchImage, request.sketchSource, (request.width, request.height)
                 ),
-                headers={"Retry-After": str(retry_secs)},
+                _detect,
             )
+        else:
+            output = await _detect()
 
-    supabase = create_supabase_client()
-    load_project_or_403(supabase, request.projectId, request.userId)
+        _detect_ms = (time.perf_counter() - _t_start) * 1000
 
-    _t_start = time.perf_counter()
-    try:
-        output = await asyncio.wait_for(
-            asyncio.to_thread(
-                detect_with_roboflow,
-                request.sketchImage,
-                (request.width, request.height),
-                sketch_source=request.sketchSource,
-            ),
-            timeout=60.0,
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(
-            status_code=504,
-            detail="Sketch detection timed out — the Roboflow API did not respond in time. Please try again.",
-        )
-    except Exception as error:
-        print(f"[detect] Roboflow call raised: {error}")
-        raise HTTPException(status_code=502, detail="Sketch detection failed")
+        if output is None or not output.elements:
+            # Not an error: a blank/unrecognizable sketch legitimately detects
+            # nothing. The frontend falls back to the direct generation path.
+            return DetectResponse(
+                success=True,
+                elements=[],
+                timing_ms={"total": round(_detect_ms)},
+            )
 
-    _detect_ms = (time.perf_counter() - _t_start) * 1000
+        meta = output.metadata or {}
+
+        # Uploads: the boxes live in post-preprocessing pixel space, so the overlay
+        # must draw on the preprocessed image. Reuse the stashed Gemini copy (clean,
+        # non-binarized — most readable for the user) as the review preview.
+        # Read, don't pop: a single-flight output is shared with concurrent callers.
+        # The PNG is encoded on first use and cached on the handle, so repeat
+        # reviews of a cached detection do not encode it again.
+        preview_image: Optional[str] = None
+        if output.processed_image is not None and request.sketchSource in (
+            "upload-photo",
+            "upload-clean",
+        ):
+            preview_b64 = await _offload(cpu_executor, output.processed_image.b64, "PNG")
+            preview_image = f"data:image/png;base64,{preview_b64}"
+
+        elements = [
+            DetectedElement(
+                type=el.type,
+                confidence=el.confidence,
+                bounds=el.bounds,
+                label=el.label,
+            )
+            for el in output.elements
+        ]
+        print(
+            f"[detect] {len(elements)} element(s) in {_detect_ms:.0f}ms (HITL review)"
+            f"{_detection_cache_log()}"
+        )
 
-    if output is None or not output.elements:
-        # Not an error: a blank/unrecognizable sketch legitimately detects
-        # nothing. The frontend falls back to the direct generation path.
         return DetectResponse(
             success=True,
-            elements=[],
+            elements=elements,
+            imageWidth=float(meta.get("image_width") or 0) or None,
+            imageHeight=float(meta.get("image_height") or 0) or None,
+            previewImage=preview_image,
             timing_ms={"total": round(_detect_ms)},
         )
 
-    meta = output.metadata or {}
-
-    # Uploads: the boxes live in post-preprocessing pixel space, so the overlay
-    # must draw on the preprocessed image. Reuse the stashed Gemini copy (clean,
-    # non-binarized — most readable for the user) as the review preview.
-    preview_image: Optional[str] = None
-    processed_b64 = meta.pop("processed_image_b64", None)
-    if processed_b64 and request.sketchSource in ("upload-photo", "upload-clean"):
-        preview_image = f"data:image/png;base64,{processed_b64}"
-
-    elements = [
-        DetectedElement(
-            type=el.type,
-            confidence=el.confidence,
-            bounds=el.bounds,
-            label=el.label,
-        )
-        for el in output.elements
-    ]
-    print(f"[detect] {len(elements)} element(s) in {_detect_ms:.0f}ms (HITL review)")
-
-    return DetectResponse(
-        success=True,
-        elements=elements,
-        imageWidth=float(meta.get("image_width") or 0) or None,
-        imageHeight=float(meta.get("image_height") or 0) or None,
-        previewImage=preview_image,
-        timing_ms={"total": round(_detect_ms)},
-    )
-
 
 @app.post("/api/fidelity", response_model=FidelityResponse)
-async def fidelity(request: FidelityRequest, http_request: Request):
+async def fidelity(request: FidelityRequest, http_request: Request, response: Response):
     """Cyclic self-verification of a generation (Decision #25).
 
     Renders the generated code headless, converts the screenshot back into
@@ -1979,111 +3064,123 @@ async def fidelity(request: FidelityRequest, http_request: Request):
 
     # Shares the AI limiter with /api/predict — this endpoint also spends a
     # Roboflow call, so it draws from the same per-user budget.
-    if ai_rate_limiter is not None:
-        allowed, retry_after, _ = ai_rate_limiter.check(
-            _rate_limit_key(request, http_request)
+    async with _ai_budget(request, http_request, "fidelity", response):
+        supabase = create_supabase_client()
+        await asyncio.to_thread(
+            load_project_or_403, supabase, request.projectId, request.userId
         )
-        if not allowed:
-            retry_secs = max(1, math.ceil(retry_after))
-            raise HTTPException(
-                status_code=429,
-                detail=(
-                    "You're sending requests too quickly. "
-                    f"Please wait {retry_secs}s and try again."
-                ),
-                headers={"Retry-After": str(retry_secs)},
-            )
-
-    supabase = create_supabase_client()
-    load_project_or_403(supabase, request.projectId, request.userId)
 
-    _t_start = time.perf_counter()
-    try:
-        render_png = await render_code_to_png(
-            request.code, request.framework, request.width, request.height
-        )
-    except FidelityUnavailableError as error:
-        raise HTTPException(status_code=503, detail=str(error))
-    except Exception as error:
-        print(f"[fidelity] render failed: {error}")
-        raise HTTPException(status_code=500, detail=f"Render failed: {error}")
-    _render_ms = (time.perf_counter() - _t_start) * 1000
+        async def _score() -> tuple:
+            _t_render = time.perf_counter()
+            try:
+                render_png = await render_code_to_png(
+                    request.code,
+                    request.framework,
+                    request.width,
+                    request.height,
+                    executor=render_executor,
+                )
+            except ExecutorSaturated as error:
+                raise _shed(error)
+            except FidelityUnavailableError as error:
+                raise HTTPException(status_code=503, detail=str(error))
+            except Exception as error:
+                print(f"[fidelity] render failed: {error}")
+                raise HTTPException(status_code=500, detail=f"Render failed: {error}")
+            _render_ms = (time.perf_counter() - _t_render) * 1000
 
-    line_art_png = await asyncio.to_thread(normalize_render_to_sketch_domain, render_png)
+            line_art_png = await _offload(cpu_executor, normalize_render_to_sketch_domain, render_png)
 
-    if _debug_ai_enabled():
-        try:
-            debug_dir = BASE_DIR / "debug"
-            debug_dir.mkdir(exist_ok=True)
-            (debug_dir / "last_render.png").write_bytes(render_png)
-            (debug_dir / "last_render_lineart.png").write_bytes(line_art_png)
-            print(f"[fidelity] debug renders saved to {debug_dir}")
-        except Exception as dump_error:
-            print(f"[fidelity] could not save debug renders: {dump_error}")
-
-    _t_detect = time.perf_counter()
-    rendered_output = await asyncio.to_thread(
-        detect_with_roboflow,
-        base64.b64encode(line_art_png).decode("ascii"),
-        (request.width, request.height),
-    )
-    _detect_ms = (time.perf_counter() - _t_detect) * 1000
-    if rendered_output is None:
-        raise HTTPException(
-            status_code=502, detail="Re-detection on the rendered code failed"
-        )
+            if _debug_ai_enabled():
+                try:
+                    debug_dir = BASE_DIR / "debug"
+                    debug_dir.mkdir(exist_ok=True)
+                    (debug_dir / "last_render.png").write_bytes(render_png)
+                    (debug_dir / "last_render_lineart.png").write_bytes(line_art_png)
+                    print(f"[fidelity] debug renders saved to {debug_dir}")
+                except Exception as dump_error:
+                    print(f"[fidelity] could not save debug renders: {dump_error}")
+
+            _t_detect = time.perf_counter()
+            rendered_output, _hit = await _detect_cached(
+                base64.b64encode(line_art_png).decode("ascii"),
+                (request.width, request.height),
+            )
+            _detect_ms = (time.perf_counter() - _t_detect) * 1000
+            if rendered_output is None:
+                raise HTTPException(
+                    status_code=502, detail="Re-detection on the rendered code failed"
+                )
 
-    original_boxes = elements_to_fidelity_boxes(
-        [e.model_dump() for e in request.elements]
-    )
-    rendered_boxes = elements_to_fidelity_boxes(
-        [
-            {"type": el.type, "confidence": el.confidence, "bounds": el.bounds}
-            for el in (rendered_output.elements or [])
-        ]
-    )
-    report = score_fidelity(
-        original_boxes,
-        rendered_boxes,
-        canvas_height=float(request.height),
-        canvas_width=float(request.width),
-    )
+            original_boxes = elements_to_fidelity_boxes(
+                [e.model_dump() for e in request.elements]
+            )
+            rendered_boxes = elements_to_fidelity_boxes(
+                [
+                    {"type": el.type, "confidence": el.confidence, "bounds": el.bounds}
+                    for el in (rendered_output.elements or [])
+                ]
+            )
+            report = score_fidelity(
+                original_boxes,
+                rendered_boxes,
+                canvas_height=float(request.height),
+                canvas_width=float(request.width),
+            )
 
-    _total_ms = (time.perf_counter() - _t_start) * 1000
-    print(
-        f"[fidelity] score={report['score']:.2f} "
-        f"(tp={report['counts']['tp']} fp={report['counts']['fp']} "
-        f"fn={report['counts']['fn']}) total={_total_ms:.0f}ms"
-    )
-    if _debug_ai_enabled():
-        # Box-level dump — without this a 0.00 score is undiagnosable (no way
-        # to tell coordinate mismatch from render failure from detector miss).
-        for b in original_boxes:
+            _total_ms = (time.perf_counter() - _t_render) * 1000
             print(
-                f"[fidelity]   orig {b.cls:8s} ({b.x:.0f},{b.y:.0f},{b.w:.0f},{b.h:.0f}) "
-                f"{'matched' if b.matched else 'MISSING'}"
+                f"[fidelity] score={report['score']:.2f} "
+                f"(tp={report['counts']['tp']} fp={report['counts']['fp']} "
+                f"fn={report['counts']['fn']}) total={_total_ms:.0f}ms"
+                f"{_detection_cache_log()}"
             )
-        for b in rendered_boxes:
-            print(
-                f"[fidelity]   rend {b.cls:8s} conf={b.confidence:.2f} "
-                f"({b.x:.0f},{b.y:.0f},{b.w:.0f},{b.h:.0f}) "
-                f"{'matched' if b.matched else 'EXTRA'}"
+            if _debug_ai_enabled():
+                # Box-level dump — without this a 0.00 score is undiagnosable (no way
+                # to tell coordinate mismatch from render failure from detector miss).
+                for b in original_boxes:
+                    print(
+                        f"[fidelity]   orig {b.cls:8s} ({b.x:.0f},{b.y:.0f},{b.w:.0f},{b.h:.0f}) "
+                        f"{'matched' if b.matched else 'MISSING'}"
+                    )
+                for b in rendered_boxes:
+                    print(
+                        f"[fidelity]   rend {b.cls:8s} conf={b.confidence:.2f} "
+                        f"({b.x:.0f},{b.y:.0f},{b.w:.0f},{b.h:.0f}) "
+                        f"{'matched' if b.matched else 'EXTRA'}"
+                    )
+            return report, _render_ms, _detect_ms
+
+        _t_start = time.perf_counter()
+        if fidelity_flights is not None:
+            (report, _render_ms, _detect_ms), _shared = await fidelity_flights.do(
+                _fidelity_flight_key(
+                    request.code,
+                    request.framework,
+                    request.elements,
+                    request.width,
+                    request.height,
+                ),
+                _score,
             )
+        else:
+            report, _render_ms, _detect_ms = await _score()
+        _total_ms = (time.perf_counter() - _t_start) * 1000
 
-    return FidelityResponse(
-        success=True,
-        score=report["score"],
-        report=report,
-        timing_ms={
-            "total": round(_total_ms),
-            "render": round(_render_ms),
-            "redetect": round(_detect_ms),
-        },
-    )
+        return FidelityResponse(
+            success=True,
+            score=report["score"],
+            report=report,
+            timing_ms={
+                "total": round(_total_ms),
+                "render": round(_render_ms),
+                "redetect": round(_detect_ms),
+            },
+        )
 
 
 @app.post("/api/repair", response_model=RepairResponse)
-async def repair(request: RepairRequest, http_request: Request):
+async def repair(request: RepairRequest, http_request: Request, response: Response):
     """Auto-repair pass: one corrective Gemini call driven by the fidelity
     mismatch report. Adds the missing elements, removes the extras, and is
     instructed to leave everything else byte-identical. The client re-scores
@@ -2095,114 +3192,109 @@ async def repair(request: RepairRequest, http_request: Request):
         raise HTTPException(status_code=400, detail="Nothing to repair")
 
     # Same per-user AI budget as /api/predict — this is a full Gemini call.
-    if ai_rate_limiter is not None:
-        allowed, retry_after, _ = ai_rate_limiter.check(
-            _rate_limit_key(request, http_request)
+    async with _ai_budget(request, http_request, "repair", response):
+        supabase = create_supabase_client()
+        project = await asyncio.to_thread(
+            load_project_or_403, supabase, request.projectId, request.userId
         )
-        if not allowed:
-            retry_secs = max(1, math.ceil(retry_after))
-            raise HTTPException(
-                status_code=429,
-                detail=(
-                    "You're sending requests too quickly. "
-                    f"Please wait {retry_secs}s and try again."
+
+        prompt = build_repair_prompt(
+            request.code,
+            request.framework,
+            request.missing,
+            request.extra,
+            float(request.width),
+            float(request.height),
+        )
+
+        _t_start = time.perf_counter()
+        token = CancellationToken(GEMINI_TIMEOUT_SECONDS, name="gemini")
+        try:
+            repaired_code = await asyncio.wait_for(
+                _offload(
+                    gemini_executor,
+                    generate_with_gemini_async,
+                    [],
+                    request.framework,
+                    "tailwind",
+                    None,
+                    prompt_override=prompt,
+                    force_model=request.forceModel,
+                    cancel_token=token,
                 ),
-                headers={"Retry-After": str(retry_secs)},
+                timeout=GEMINI_TIMEOUT_SECONDS,
+            )
+        except HTTPException:
+            raise
+        except (asyncio.TimeoutError, CallCancelled):
+            raise HTTPException(status_code=504, detail="Repair timed out")
+        except GeminiRateLimited as error:
+            raise HTTPException(
+                status_code=429, detail=str(error), headers={"Retry-After": "60"}
+            )
+        except GeminiQuotaExhausted as error:
+            raise HTTPException(status_code=503, detail=str(error))
+        except Exception as error:
+            print(f"[repair] Gemini error: {error}")
+            raise HTTPException(status_code=500, detail=f"Repair failed: {error}")
+        finally:
+            token.cancel("caller finished")
+
+        if not repaired_code or not repaired_code.strip():
+            raise HTTPException(status_code=502, detail="Repair returned empty code")
+
+        # Sanity guard: repair is a SURGICAL patch (add missing, remove extras,
+        # byte-identical elsewhere). Output dramatically smaller than the input
+        # means Gemini rewrote the page as a stub (live case: a correct 4679-char
+        # login screen came back as 901 chars of literal "Card"/"Navbar"
+        # placeholders). Reject — the user keeps their code, the badge just shows
+        # the unrepaired score. Legitimate extra-removal never halves the file.
+        if len(repaired_code) < 0.5 * len(request.code):
+            print(
+                f"[repair] REJECTED: output {len(repaired_code)} chars vs input "
+                f"{len(request.code)} — shrank below 50%, looks like a rewrite, "
+                "not a patch"
+            )
+            raise HTTPException(
+                status_code=422,
+                detail="Repair output failed sanity check (code shrank drastically)",
             )
 
-    supabase = create_supabase_client()
-    project = load_project_or_403(supabase, request.projectId, request.userId)
-
-    prompt = build_repair_prompt(
-        request.code,
-        request.framework,
-        request.missing,
-        request.extra,
-        float(request.width),
-        float(request.height),
-    )
+        # Second sanity guard: the repair prompt names missing elements by their
+        # detector class ("card", "navbar"...) and despite an explicit rule Gemini
+        # sometimes renders that word as the element's visible text (live case:
+        # a '<p>Card</p>' heading + stub injected into a correct signup form). A
+        # class stub the INPUT didn't have means the patch fabricated garbage.
+        if _repair_introduced_class_stubs(repaired_code, request.code):
+            print(
+                "[repair] REJECTED: output renders a literal detector-class name "
+                "('Card'/'Navbar'/...) as visible text that the input did not — "
+                "fabricated stub, not a patch"
+            )
+            raise HTTPException(
+                status_code=422,
+                detail="Repair output failed sanity check (introduced detector-class stubs)",
+            )
 
-    _t_start = time.perf_counter()
-    try:
-        repaired_code = await asyncio.wait_for(
-            asyncio.to_thread(
-                generate_with_gemini,
-                [],
-                request.framework,
-                "tailwind",
-                None,
-                prompt_override=prompt,
-                force_model=request.forceModel,
-            ),
-            timeout=GEMINI_TIMEOUT_SECONDS,
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="Repair timed out")
-    except GeminiRateLimited as error:
-        raise HTTPException(
-            status_code=429, detail=str(error), headers={"Retry-After": "60"}
-        )
-    except GeminiQuotaExhausted as error:
-        raise HTTPException(status_code=503, detail=str(error))
-    except Exception as error:
-        print(f"[repair] Gemini error: {error}")
-        raise HTTPException(status_code=500, detail=f"Repair failed: {error}")
-
-    if not repaired_code or not repaired_code.strip():
-        raise HTTPException(status_code=502, detail="Repair returned empty code")
-
-    # Sanity guard: repair is a SURGICAL patch (add missing, remove extras,
-    # byte-identical elsewhere). Output dramatically smaller than the input
-    # means Gemini rewrote the page as a stub (live case: a correct 4679-char
-    # login screen came back as 901 chars of literal "Card"/"Navbar"
-    # placeholders). Reject — the user keeps their code, the badge just shows
-    # the unrepaired score. Legitimate extra-removal never halves the file.
-    if len(repaired_code) < 0.5 * len(request.code):
-        print(
-            f"[repair] REJECTED: output {len(repaired_code)} chars vs input "
-            f"{len(request.code)} — shrank below 50%, looks like a rewrite, "
-            "not a patch"
-        )
-        raise HTTPException(
-            status_code=422,
-            detail="Repair output failed sanity check (code shrank drastically)",
+        # Version history stays truthful: the repaired code is a new iteration.
+        iteration_id = await persist_generation_result(
+            supabase,
+            request.projectId,
+            project.get("canvas_data") or {},
+            repaired_code,
+            "Auto-repair pass (fidelity self-check)",
         )
 
-    # Second sanity guard: the repair prompt names missing elements by their
-    # detector class ("card", "navbar"...) and despite an explicit rule Gemini
-    # sometimes renders that word as the element's visible text (live case:
-    # a '<p>Card</p>' heading + stub injected into a correct signup form). A
-    # class stub the INPUT didn't have means the patch fabricated garbage.
-    if _repair_introduced_class_stubs(repaired_code, request.code):
         print(
-            "[repair] REJECTED: output renders a literal detector-class name "
-            "('Card'/'Navbar'/...) as visible text that the input did not — "
-            "fabricated stub, not a patch"
-        )
-        raise HTTPException(
-            status_code=422,
-            detail="Repair output failed sanity check (introduced detector-class stubs)",
+            f"[repair] ok chars={len(repaired_code)} "
+            f"missing={len(request.missing)} extra={len(request.extra)} "
+            f"took={(time.perf_counter() - _t_start) * 1000:.0f}ms"
         )
-
-    # Version history stays truthful: the repaired code is a new iteration.
-    iteration_id = persist_generation_result(
-        supabase,
-        request.projectId,
-        project.get("canvas_data") or {},
-        repaired_code,
-        "Auto-repair pass (fidelity self-check)",
-    )
-
-    print(
-        f"[repair] ok chars={len(repaired_code)} "
-        f"missing={len(request.missing)} extra={len(request.extra)} "
-        f"took={(time.perf_counter() - _t_start) * 1000:.0f}ms"
-    )
-    return RepairResponse(success=True, code=repaired_code, iteration_id=iteration_id)
+        return RepairResponse(success=True, code=repaired_code, iteration_id=iteration_id)
 
 
 @app.post("/api/annotate", response_model=AnnotateResponse)
-async def annotate(request: AnnotateRequest, http_request: Request):
+async def annotate(request: AnnotateRequest, http_request: Request, response: Response):
     """Annotate-on-render refinement: one targeted Gemini call driven by the
     user's markup on the live preview. The markup resolves to data-cc-id
     elements (or a raw region), and the prompt instructs Gemini to apply the
@@ -2218,86 +3310,81 @@ async def annotate(request: AnnotateRequest, http_request: Request):
         )
 
     # Same per-user AI budget as /api/predict — this is a full Gemini call.
-    if ai_rate_limiter is not None:
-        allowed, retry_after, _ = ai_rate_limiter.check(
-            _rate_limit_key(request, http_request)
+    async with _ai_budget(request, http_request, "annotate", response):
+        supabase = create_supabase_client()
+        project = await asyncio.to_thread(
+            load_project_or_403, supabase, request.projectId, request.userId
         )
-        if not allowed:
-            retry_secs = max(1, math.ceil(retry_after))
-            raise HTTPException(
-                status_code=429,
-                detail=(
-                    "You're sending requests too quickly. "
-                    f"Please wait {retry_secs}s and try again."
+
+        prompt = build_annotation_prompt(
+            request.code,
+            request.framework,
+            request.note,
+            request.targets,
+            request.region,
+            float(request.width),
+            float(request.height),
+        )
+
+        _t_start = time.perf_counter()
+        token = CancellationToken(GEMINI_TIMEOUT_SECONDS, name="gemini")
+        try:
+            refined_code = await asyncio.wait_for(
+                _offload(
+                    gemini_executor,
+                    generate_with_gemini_async,
+                    [],
+                    request.framework,
+                    "tailwind",
+                    None,
+                    prompt_override=prompt,
+                    force_model=request.forceModel,
+                    cancel_token=token,
                 ),
-                headers={"Retry-After": str(retry_secs)},
+                timeout=GEMINI_TIMEOUT_SECONDS,
             )
+        except HTTPException:
+            raise
+        except (asyncio.TimeoutError, CallCancelled):
+            raise HTTPException(status_code=504, detail="Annotation refinement timed out")
+        except GeminiRateLimited as error:
+            raise HTTPException(
+                status_code=429, detail=str(error), headers={"Retry-After": "60"}
+            )
+        except GeminiQuotaExhausted as error:
+            raise HTTPException(status_code=503, detail=str(error))
+        except Exception as error:
+            print(f"[annotate] Gemini error: {error}")
+            raise HTTPException(
+                status_code=500, detail=f"Annotation refinement failed: {error}"
+            )
+        finally:
+            token.cancel("caller finished")
 
-    supabase = create_supabase_client()
-    project = load_project_or_403(supabase, request.projectId, request.userId)
-
-    prompt = build_annotation_prompt(
-        request.code,
-        request.framework,
-        request.note,
-        request.targets,
-        request.region,
-        float(request.width),
-        float(request.height),
-    )
+        if not refined_code or not refined_code.strip():
+            raise HTTPException(
+                status_code=502, detail="Annotation refinement returned empty code"
+            )
 
-    _t_start = time.perf_counter()
-    try:
-        refined_code = await asyncio.wait_for(
-            asyncio.to_thread(
-                generate_with_gemini,
-                [],
-                request.framework,
-                "tailwind",
-                None,
-                prompt_override=prompt,
-                force_model=request.forceModel,
-            ),
-            timeout=GEMINI_TIMEOUT_SECONDS,
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="Annotation refinement timed out")
-    except GeminiRateLimited as error:
-        raise HTTPException(
-            status_code=429, detail=str(error), headers={"Retry-After": "60"}
-        )
-    except GeminiQuotaExhausted as error:
-        raise HTTPException(status_code=503, detail=str(error))
-    except Exception as error:
-        print(f"[annotate] Gemini error: {error}")
-        raise HTTPException(
-            status_code=500, detail=f"Annotation refinement failed: {error}"
+        # Version history stays truthful: the refined code is a new iteration.
+        note_summary = request.note.strip().replace("\n", " ")
+        if len(note_summary) > 120:
+            note_summary = note_summary[:117] + "..."
+        iteration_id = await persist_generation_result(
+            supabase,
+            request.projectId,
+            project.get("canvas_data") or {},
+            refined_code,
+            f"Annotation refinement: {note_summary}",
         )
 
-    if not refined_code or not refined_code.strip():
-        raise HTTPException(
-            status_code=502, detail="Annotation refinement returned empty code"
+        print(
+            f"[annotate] ok chars={len(refined_code)} targets={len(request.targets)} "
+            f"took={(time.perf_counter() - _t_start) * 1000:.0f}ms"
+        )
+        return AnnotateResponse(
+            success=True, code=refined_code, iteration_id=iteration_id
         )
-
-    # Version history stays truthful: the refined code is a new iteration.
-    note_summary = request.note.strip().replace("\n", " ")
-    if len(note_summary) > 120:
-        note_summary = note_summary[:117] + "..."
-    iteration_id = persist_generation_result(
-        supabase,
-        request.projectId,
-        project.get("canvas_data") or {},
-        refined_code,
-        f"Annotation refinement: {note_summary}",
-    )
-
-    print(
-        f"[annotate] ok chars={len(refined_code)} targets={len(request.targets)} "
-        f"took={(time.perf_counter() - _t_start) * 1000:.0f}ms"
-    )
-    return AnnotateResponse(
-        success=True, code=refined_code, iteration_id=iteration_id
-    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""Benchmark: upload image pipeline, base64 round trip vs one ImageHandle.
+
+Usage (from repo root or backend/):
+    python backend/scripts/bench_image_pipeline.py
+    python backend/scripts/bench_image_pipeline.py --runs 5 --size 4000x3000
+
+Feeds a synthetic phone photo (JPEG, default 12 MP: off-white paper with
+sensor noise and a pen wireframe) through the upload path, from the request's
+base64 string to the image Gemini is handed, in two scenarios:
+
+    predict   detection, then the image for Gemini (/api/predict)
+    review    detection, then the PNG preview (/api/detect)
+
+and three implementations:
+
+    legacy    what the pipeline did before ImageHandle: PNG + base64 stash in
+              metadata["processed_image_b64"], base64 decode and PIL re-open
+              for Gemini
+    handle    _prepare_roboflow_image with UPLOAD_PREPROCESS=full: the
+              decoded crop travels in an ImageHandle, encoded only when a
+              consumer asks
+    fast      the default fast preprocessing on top: JPEG draft-mode decode,
+              crop found on a small mask, only the crop binarized at
+              UPLOAD_PREPROCESS_MAX_SIDE (default 1280)
+
+Roboflow and Gemini are not called, and the SDK's own encode of the PIL image
+it is given is the same in both, so it is left out. Each (implementation,
+scenario) runs in a fresh process that is handed the base64 input. Peak
+memory is the highest resident set above the starting point during one run,
+sampled from /proc/self/statm (Linux).
+
+Output is mean wall and CPU milliseconds per run and peak extra RSS in MB.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import numpy as np  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from app.models.inference import _decode_sketch_image, _prepare_roboflow_image  # noqa: E402
+from app.models.roboflow_clients import encode_image  # noqa: E402
+from app.utils.preprocessing import preprocess_uploaded_photo  # noqa: E402
+
+
+def make_photo(width: int, height: int, seed: int = 0) -> str:
+    """A base64 JPEG data URL that looks like a phone photo of a sketch."""
+    rng = np.random.default_rng(seed)
+    paper = np.full((height, width, 3), 228, dtype=np.int16)
+    shade = np.linspace(-18, 12, width, dtype=np.int16)[None, :, None]
+    paper = paper + shade + rng.integers(-9, 10, size=(height, width, 3), dtype=np.int16)
+    image = Image.fromarray(np.clip(paper, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    line = max(3, width // 800)
+    mx, my = width // 10, height // 10
+    draw.rectangle((mx, my, width - mx, my + height // 10), outline=(30, 30, 40), width=line)
+    for col in range(3):
+        x0 = mx + col * (width - 2 * mx) // 3 + 20
+        draw.rectangle((x0, height // 3, x0 + (width - 2 * mx) // 3 - 40, height * 2 // 3), outline=(30, 30, 40), width=line)
+    draw.rectangle((mx, height - my - height // 12, width - mx, height - my), outline=(30, 30, 40), width=line)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def legacy(sketch: str, scenario: str) -> None:
+    """The pre-ImageHandle upload path, step for step."""
+    raw_image = Image.open(io.BytesIO(_decode_sketch_image(sketch)))
+    pil_image = raw_image.convert("RGB")
+    processed, clean = preprocess_uploaded_photo(
+        np.array(pil_image), binarize=True, return_clean=True
+    )
+    pil_image = Image.fromarray(processed)
+    gemini_pil_image = Image.fromarray(clean)
+    encode_image(pil_image)
+    buf = io.BytesIO()
+    gemini_pil_image.save(buf, format="PNG")
+    stash = base64.b64encode(buf.getvalue()).decode("ascii")
+    if scenario == "predict":
+        part = Image.open(io.BytesIO(base64.b64decode(stash)))
+        part.load()
+    else:
+        f"data:image/png;base64,{stash}"
+
+
+def handle(sketch: str, scenario: str) -> None:
+    gemini_image = _prepare_roboflow_image(sketch, "upload-photo", False).gemini_image
+    if scenario == "predict":
+        gemini_image.pil()
+    else:
+        f"data:image/png;base64,{gemini_image.b64('PNG')}"
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as statm:  # Linux
+        return int(statm.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def _peak_extra_mb(fn, *args) -> float:
+    """Highest resident memory above the starting point while ``fn`` runs,
+    sampled every millisecond from a side thread."""
+    baseline = _rss_mb()
+    peak = baseline
+    done = threading.Event()
+
+    def sample() -> None:
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, _rss_mb())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        fn(*args)
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak, _rss_mb()) - baseline
+
+
+def _worker(args) -> tuple:
+    impl, scenario, sketch, runs = args
+    os.environ["UPLOAD_PREPROCESS"] = "fast" if impl == "fast" else "full"
+    fn = legacy if impl == "legacy" else handle
+    peak = _peak_extra_mb(fn, sketch, scenario)  # also warms up
+    wall = cpu = 0.0
+    for _ in range(runs):
+        w0, c0 = time.perf_counter(), time.process_time()
+        fn(sketch, scenario)
+        wall += time.perf_counter() - w0
+        cpu += time.process_time() - c0
+    return wall / runs * 1000, cpu / runs * 1000, peak
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=3, help="runs per measurement")
+    parser.add_argument("--size", default="4000x3000", help="photo WIDTHxHEIGHT")
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.lower().split("x"))
+
+    print(f"{size[0]}x{size[1]} photo ({size[0] * size[1] / 1e6:.0f} MP), {args.runs} run(s)")
+    print(f"{'scenario':<9} {'impl':<7} {'wall ms':>9} {'cpu ms':>9} {'peak MB':>9}")
+    sketch = make_photo(*size)
+    ctx = multiprocessing.get_context("spawn")
+    for scenario in ("predict", "review"):
+        for impl in ("legacy", "handle", "fast"):
+            with ctx.Pool(1) as pool:
+                wall, cpu, peak = pool.apply(_worker, ((impl, scenario, sketch, args.runs),))
+            print(f"{scenario:<9} {impl:<7} {wall:>9.0f} {cpu:>9.0f} {peak:>9.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
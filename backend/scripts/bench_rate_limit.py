@@ -0,0 +1,207 @@
+"""Microbenchmark: rate limiter check() throughput under contention.
+
+Usage (from repo root or backend/):
+    python backend/scripts/bench_rate_limit.py
+    python backend/scripts/bench_rate_limit.py --checks 5000 --threads 8 --processes 4
+
+Runs every limiter backend through the same two scenarios:
+
+    threads    N threads in one process sharing one limiter instance
+               (one uvicorn worker under a burst)
+    processes  N processes, each with its own limiter instance; only the
+               sqlite backend actually shares state between them (N workers
+               on one host)
+
+Each scenario is run with a spread of keys (one user per worker) and with a
+single hot key (every worker checking the same user — the worst case for the
+shared store's write lock). The limit is set high enough that every check is
+admitted, so the numbers measure the bookkeeping, not the rejections.
+
+Output is aggregate checks/second and mean microseconds per check, per
+backend. The process-scenario numbers for memory backends are for reference
+only: those limiters do not enforce a shared budget.
+
+A last table measures what the API cares about with the sqlite backend:
+event-loop stall. One asyncio loop charges the hot key the way main.py does
+while the other processes hammer it; a 1 ms ticker records how late the loop
+wakes up. "inline" calls check() on the loop, "thread" awaits it through
+asyncio.to_thread (what _charge_ai_budget does).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.utils.rate_limit import GCRARateLimiter, SlidingWindowRateLimiter  # noqa: E402
+
+_HUGE_LIMIT = 10**9
+_WINDOW = 3600.0
+
+
+def _make(backend: str, path: str):
+    if backend == "sliding":
+        return SlidingWindowRateLimiter(_HUGE_LIMIT, _WINDOW)
+    if backend == "gcra":
+        return GCRARateLimiter(_HUGE_LIMIT, _WINDOW)
+    return GCRARateLimiter(_HUGE_LIMIT, _WINDOW, path=path)
+
+
+def _hammer(limiter, key: str, checks: int) -> None:
+    for _ in range(checks):
+        limiter.check(key)
+
+
+def _process_worker(args) -> float:
+    backend, path, key, checks, start_at = args
+    limiter = _make(backend, path)
+    limiter.check("warmup")
+    while time.time() < start_at:
+        pass
+    _hammer(limiter, key, checks)
+    return time.time()
+
+
+def run_threads(backend: str, path: str, workers: int, checks: int, hot: bool) -> float:
+    limiter = _make(backend, path)
+    limiter.check("warmup")
+    barrier = threading.Barrier(workers + 1)
+
+    def body(i: int) -> None:
+        barrier.wait()
+        _hammer(limiter, "hot" if hot else f"user-{i}", checks)
+
+    threads = [threading.Thread(target=body, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def run_processes(backend: str, path: str, workers: int, checks: int, hot: bool) -> float:
+    # Start in lockstep: every child builds its limiter, then spins until a
+    # shared wall-clock instant so process start-up is not measured. Elapsed
+    # is from that instant to the last child's finish, as each child saw it.
+    start_at = time.time() + 1.0
+    jobs = [
+        (backend, path, "hot" if hot else f"user-{i}", checks, start_at)
+        for i in range(workers)
+    ]
+    with multiprocessing.Pool(workers) as pool:
+        finished = pool.map(_process_worker, jobs)
+    return max(finished) - start_at
+
+
+def _hammer_until(args) -> None:
+    path, key, stop_at = args
+    limiter = _make("sqlite", path)
+    while time.time() < stop_at:
+        limiter.check(key)
+
+
+def run_loop_stall(path: str, workers: int, checks: int, offload: bool) -> tuple:
+    """(max, mean) event-loop lag in ms while ``checks`` charges run on one
+    loop against ``workers - 1`` processes contending for the same key."""
+    limiter = _make("sqlite", path)
+    limiter.check("warmup")
+
+    async def body() -> tuple:
+        lags = []
+        done = False
+
+        async def ticker() -> None:
+            while not done:
+                due = time.perf_counter() + 0.001
+                await asyncio.sleep(0.001)
+                lags.append(max(0.0, time.perf_counter() - due))
+
+        tick = asyncio.ensure_future(ticker())
+        for _ in range(checks):
+            if offload:
+                await asyncio.to_thread(limiter.check, "hot")
+            else:
+                limiter.check("hot")
+            await asyncio.sleep(0)
+        done = True
+        await tick
+        return max(lags) * 1000, sum(lags) / len(lags) * 1000
+
+    stop_at = time.time() + 3600.0
+    with multiprocessing.Pool(max(1, workers - 1)) as pool:
+        pending = pool.map_async(
+            _hammer_until, [(path, "hot", stop_at)] * max(1, workers - 1)
+        )
+        time.sleep(0.5)  # let the contenders start
+        result = asyncio.run(body())
+        pool.terminate()
+        del pending
+    return result
+
+
+def _fresh_path(directory: str, label: str) -> str:
+    path = os.path.join(directory, f"{label}.sqlite3")
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--checks", type=int, default=2000, help="check() calls per worker")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument(
+        "--backends", default="sliding,gcra,sqlite", help="comma-separated subset to run"
+    )
+    args = parser.parse_args()
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+
+    print(
+        f"{'backend':<8} {'scenario':<12} {'keys':<6} {'workers':>7} "
+        f"{'checks/s':>12} {'us/check':>10}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in backends:
+            for scenario, workers, runner in (
+                ("threads", args.threads, run_threads),
+                ("processes", args.processes, run_processes),
+            ):
+                for hot in (False, True):
+                    path = _fresh_path(tmp, f"{backend}-{scenario}-{hot}")
+                    elapsed = runner(backend, path, workers, args.checks, hot)
+                    total = workers * args.checks
+                    print(
+                        f"{backend:<8} {scenario:<12} {'hot' if hot else 'spread':<6} "
+                        f"{workers:>7} {total / elapsed:>12,.0f} "
+                        f"{elapsed / total * 1e6:>10.1f}"
+                    )
+        if "sqlite" in backends:
+            print(f"\n{'loop':<8} {'workers':>7} {'max lag ms':>11} {'mean lag ms':>12}")
+            for offload in (False, True):
+                path = _fresh_path(tmp, f"loop-{offload}")
+                worst, mean = run_loop_stall(path, args.processes, args.checks // 4, offload)
+                print(
+                    f"{'thread' if offload else 'inline':<8} {args.processes:>7} "
+                    f"{worst:>11.1f} {mean:>12.2f}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
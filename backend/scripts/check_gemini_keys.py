@@ -5,7 +5,7 @@ Usage (from repo root or backend/):
     python backend/scripts/check_gemini_keys.py --json
     python backend/scripts/check_gemini_keys.py --models gemini-3.5-flash,gemini-2.5-flash
 
-For each GEMINI_API_KEY* env var (same regex + ordering as inference.py's pool
+For each GEMINI_API_KEY* env var (same regex + ordering as gemini_pool.py's
 loader) the script fires one tiny generateContent call per ladder model and
 classifies the outcome. Keys are ALWAYS masked in output (first 6 + last 4
 chars) — never print full key material.
@@ -49,7 +49,7 @@ API_URL = (
     "{model}:generateContent?key={key}"
 )
 
-# Same regex + ordering as the pool loader in inference.py.
+# Same regex + ordering as gemini_keys_from_env in app/models/gemini_pool.py.
 _KEY_RE = re.compile(r"^GEMINI_API_KEY(_(\d+))?$")
 
 
@@ -18,10 +18,13 @@ Usage (from backend/):
   python scripts/eval_pipeline.py --num 15 --stage detect  # detection only (cheap)
   python scripts/eval_pipeline.py --images sketch_00001    # specific image(s)
   python scripts/eval_pipeline.py --tag after-fixes        # label the output dir
+  python scripts/eval_pipeline.py --stage detect --max-sides 0,1280,960,640
+                                                           # ROBOFLOW_MAX_SIDE sweep
 
 Artifacts land in backend/debug/eval/<tag>/:
   report.md                    — metrics table + per-image summary
   <image>/detections.json      — raw detected elements
+  <image>/detections_max<N>.json — the same, per --max-sides value (0 = off)
   <image>/prompt.txt           — exact Gemini prompt (generation stage)
   <image>/generated_code.txt   — Gemini output (generation stage)
 
@@ -29,6 +32,10 @@ Notes:
   - Detection stage uses sketch_source=None (no crop preprocessing) so box
     coordinates stay in the original image pixel space the ground-truth labels
     use. Generation stage uses "upload-clean" to exercise the real upload path.
+  - --max-sides runs the detection stage once per ROBOFLOW_MAX_SIDE value and
+    adds an accuracy/latency table (payload size, Roboflow wall time,
+    precision/recall) to the report. Boxes come back in the original pixels
+    at every value, so they are scored against the same labels.
   - Set CACHE_ENABLED=false in the environment; this script also forces it off
     for its own process so repeated runs never serve stale generations.
 """
@@ -60,6 +67,7 @@ load_dotenv(REPO_DIR / ".env.local", override=False)
 load_dotenv(REPO_DIR / ".env", override=False)
 
 from app.models.inference import (  # noqa: E402
+    _prepare_roboflow_image,
     detect_with_roboflow,
     generate_with_gemini,
     _build_gemini_prompt,
@@ -109,6 +117,8 @@ class ImageResult:
     per_class: Dict[str, ClassStats] = field(default_factory=dict)
     generation_ok: Optional[bool] = None
     error: Optional[str] = None
+    detect_ms: Optional[float] = None
+    payload_kb: Optional[float] = None
 
 
 def iou(a: Box, b: Box) -> float:
@@ -197,25 +207,34 @@ def elements_to_boxes(elements) -> List[Box]:
     return out
 
 
-def run_detection_stage(image_path: Path, out_dir: Path, result: ImageResult) -> None:
+def run_detection_stage(
+    image_path: Path, out_dir: Path, result: ImageResult, suffix: str = ""
+) -> None:
     img_w, img_h = image_size(image_path)
     gt = load_ground_truth(LABELS_DIR / f"{image_path.stem}.txt", img_w, img_h)
     result.gt_count = len(gt)
+    detections_path = out_dir / f"detections{suffix}.json"
 
     # sketch_source=None → no crop preprocessing → detection coords stay in the
-    # ground-truth pixel space.
-    output = detect_with_roboflow(image_to_b64(image_path), (img_w, img_h))
+    # ground-truth pixel space (ROBOFLOW_MAX_SIDE maps them back into it too).
+    sketch = image_to_b64(image_path)
+    prepared = _prepare_roboflow_image(sketch, None, False)
+    if prepared is not None:
+        result.payload_kb = len(prepared.payload) / 1024
+    started = time.perf_counter()
+    output = detect_with_roboflow(sketch, (img_w, img_h))
+    result.detect_ms = (time.perf_counter() - started) * 1000
     if output is None or not output.elements:
         result.det_count = 0
         result.per_class = score_detections(gt, [])
-        (out_dir / "detections.json").write_text("[]")
+        detections_path.write_text("[]")
         return
 
     det = elements_to_boxes(output.elements)
     result.det_count = len(det)
     result.per_class = score_detections(gt, det)
 
-    (out_dir / "detections.json").write_text(
+    detections_path.write_text(
         json.dumps(
             [
                 {
@@ -247,10 +266,7 @@ def run_generation_stage(image_path: Path, out_dir: Path, result: ImageResult) -
         return
 
     meta = output.metadata or {}
-    image_bytes = None
-    processed_b64 = meta.pop("processed_image_b64", None)
-    if processed_b64:
-        image_bytes = base64.b64decode(processed_b64)
+    image = output.processed_image
 
     image_w = float(meta.get("image_width") or img_w)
     image_h = float(meta.get("image_height") or img_h)
@@ -268,7 +284,7 @@ def run_generation_stage(image_path: Path, out_dir: Path, result: ImageResult) -
         "tailwind",
         None,
         extra_text=extra_text or None,
-        has_image=image_bytes is not None,
+        has_image=image is not None,
     )
     (out_dir / "prompt.txt").write_text(prompt, encoding="utf-8")
 
@@ -278,13 +294,13 @@ def run_generation_stage(image_path: Path, out_dir: Path, result: ImageResult) -
         "tailwind",
         None,
         extra_text=extra_text or None,
-        image_bytes=image_bytes,
+        image=image,
     )
     (out_dir / "generated_code.txt").write_text(code, encoding="utf-8")
     result.generation_ok = True
 
 
-def write_report(results: List[ImageResult], out_root: Path, stage: str) -> None:
+def aggregate(results: List[ImageResult]) -> Dict[str, ClassStats]:
     totals: Dict[str, ClassStats] = {}
     for r in results:
         for cls, s in r.per_class.items():
@@ -292,6 +308,44 @@ def write_report(results: List[ImageResult], out_root: Path, stage: str) -> None
             agg.tp += s.tp
             agg.fp += s.fp
             agg.fn += s.fn
+    return totals
+
+
+def resize_comparison_lines(sweep: List[Tuple[int, List[ImageResult]]]) -> List[str]:
+    """Markdown table: one row per ROBOFLOW_MAX_SIDE value of the sweep."""
+    lines = [
+        "## Roboflow upload size (ROBOFLOW_MAX_SIDE)",
+        "",
+        "| max side | payload KB (mean) | detect ms (mean) | detect ms (p50) "
+        "| precision | recall |",
+        "|---|---|---|---|---|---|",
+    ]
+    for max_side, results in sweep:
+        all_stats = ClassStats()
+        for s in aggregate(results).values():
+            all_stats.tp += s.tp
+            all_stats.fp += s.fp
+            all_stats.fn += s.fn
+        kb = [r.payload_kb for r in results if r.payload_kb is not None]
+        ms = sorted(r.detect_ms for r in results if r.detect_ms is not None)
+        mean_kb = f"{sum(kb) / len(kb):.0f}" if kb else "-"
+        mean_ms = f"{sum(ms) / len(ms):.0f}" if ms else "-"
+        p50_ms = f"{ms[len(ms) // 2]:.0f}" if ms else "-"
+        lines.append(
+            f"| {max_side or 'off'} | {mean_kb} | {mean_ms} | {p50_ms} "
+            f"| {all_stats.precision:.2%} | {all_stats.recall:.2%} |"
+        )
+    lines.append("")
+    return lines
+
+
+def write_report(
+    results: List[ImageResult],
+    out_root: Path,
+    stage: str,
+    extra_sections: Optional[List[str]] = None,
+) -> None:
+    totals = aggregate(results)
 
     lines = [
         "# Pipeline eval report",
@@ -326,6 +380,8 @@ def write_report(results: List[ImageResult], out_root: Path, stage: str) -> None
         )
         lines.append("")
 
+    lines += extra_sections or []
+
     lines += ["## Per image", "", "| image | GT boxes | detected | recall | generation | note |", "|---|---|---|---|---|---|"]
     for r in results:
         tp = sum(s.tp for s in r.per_class.values())
@@ -353,7 +409,14 @@ def main() -> None:
         "--stage", choices=["detect", "generate", "both"], default="both"
     )
     parser.add_argument("--tag", default=None, help="output dir name under debug/eval/")
+    parser.add_argument(
+        "--max-sides",
+        default=None,
+        help="comma-separated ROBOFLOW_MAX_SIDE values to compare on the detection "
+        "stage, 0 = off (e.g. 0,1280,960,640)",
+    )
     args = parser.parse_args()
+    max_sides = [int(v) for v in args.max_sides.split(",")] if args.max_sides else []
 
     if args.images:
         stems = args.images
@@ -367,6 +430,36 @@ def main() -> None:
     out_root.mkdir(parents=True, exist_ok=True)
     print(f"Evaluating {len(stems)} image(s) -> {out_root}")
 
+    sweep: List[Tuple[int, List[ImageResult]]] = []
+    configured_max_side = os.environ.get("ROBOFLOW_MAX_SIDE")
+    for max_side in max_sides:
+        os.environ["ROBOFLOW_MAX_SIDE"] = str(max_side)
+        print(f"ROBOFLOW_MAX_SIDE={max_side or 'off'}")
+        side_results: List[ImageResult] = []
+        for stem in stems:
+            image_path = IMAGES_DIR / f"{stem}.jpg"
+            if not image_path.exists():
+                continue
+            out_dir = out_root / stem
+            out_dir.mkdir(exist_ok=True)
+            result = ImageResult(name=stem)
+            try:
+                run_detection_stage(image_path, out_dir, result, suffix=f"_max{max_side}")
+            except Exception as exc:
+                result.error = str(exc)
+                print(f"    {stem} ERROR: {exc}")
+            side_results.append(result)
+        sweep.append((max_side, side_results))
+    if configured_max_side is None:
+        os.environ.pop("ROBOFLOW_MAX_SIDE", None)
+    else:
+        os.environ["ROBOFLOW_MAX_SIDE"] = configured_max_side
+    if sweep and args.stage == "detect":
+        # The sweep's off run (or its first value) is the detection stage.
+        results = next((r for side, r in sweep if side == 0), sweep[0][1])
+        write_report(results, out_root, args.stage, resize_comparison_lines(sweep))
+        return
+
     results: List[ImageResult] = []
     for i, stem in enumerate(stems, 1):
         image_path = IMAGES_DIR / f"{stem}.jpg"
@@ -389,7 +482,9 @@ def main() -> None:
 
         results.append(result)
 
-    write_report(results, out_root, args.stage)
+    write_report(
+        results, out_root, args.stage, resize_comparison_lines(sweep) if sweep else None
+    )
 
 
 if __name__ == "__main__":
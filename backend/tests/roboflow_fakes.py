@@ -0,0 +1,51 @@
+"""A stand-in Roboflow model for tests that run real images through
+detect_with_roboflow_async (tiling, incremental region detection)."""
+
+import base64
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.models import inference
+from app.models.detector_ladder import DetectorLadder
+
+
+class ContourDetector:
+    """Stands in for the model: reports every drawn outline still at least
+    16 px on its short side once squeezed into the 640 px input, wide thin
+    ones as navbar, the rest as card. ``sizes`` records each image sent."""
+
+    model_id = "proj/1"
+
+    def __init__(self):
+        self.sizes = []
+
+    async def infer(self, image_b64, *, confidence, timeout=None):
+        image = Image.open(io.BytesIO(base64.b64decode(image_b64))).convert("L")
+        self.sizes.append(image.size)
+        ink = (np.asarray(image) < 128).astype(np.uint8)
+        contours, _ = cv2.findContours(ink, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        predictions = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if min(w, h) * 640 / max(image.size) < 16:
+                continue
+            predictions.append({
+                "class": "navbar" if w > 4 * h else "card",
+                "confidence": 0.9,
+                "x": x + w / 2, "y": y + h / 2, "width": w, "height": h,
+            })
+        return {"predictions": predictions, "image": {"width": image.width, "height": image.height}}
+
+
+def use_contour_detector(monkeypatch):
+    """Route every Roboflow call to a fresh ContourDetector on a fresh ladder
+    with a single model, and return it."""
+    client = ContourDetector()
+    monkeypatch.setattr(inference, "_roboflow_clients", type("C", (), {"client": lambda *a: client})())
+    monkeypatch.setattr(inference, "roboflow_ladder", DetectorLadder())
+    monkeypatch.setenv("ROBOFLOW_MODELS", "proj/1")
+    monkeypatch.delenv("ROBOFLOW_MAX_SIDE", raising=False)
+    return client
@@ -0,0 +1,158 @@
+"""Tests for cooperative cancellation of upstream calls.
+
+generate_with_gemini runs against fake per-key Gemini clients so the tests can
+see exactly which key/model attempts were made after a cancel.
+"""
+
+import threading
+import time
+import types
+
+import pytest
+
+from app.models import inference
+from app.models.gemini_pool import GeminiKeyPool
+from app.utils.cancellation import CallCancelled, CancellationToken, abandoned_counts
+
+
+class TestToken:
+    def test_explicit_cancel(self):
+        token = CancellationToken(name="t")
+        assert not token.cancelled
+        assert token.remaining() is None
+        token.cancel("client went away")
+        assert token.cancelled
+        assert token.reason == "client went away"
+
+    def test_deadline_cancels_implicitly(self):
+        token = CancellationToken(0.01)
+        assert not token.cancelled
+        time.sleep(0.02)
+        assert token.cancelled
+        assert token.remaining() == 0.0
+        assert token.reason == "deadline exceeded"
+
+    def test_wait_wakes_early_on_cancel(self):
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel).start()
+        started = time.perf_counter()
+        assert token.wait(5.0) is True
+        assert time.perf_counter() - started < 1.0
+
+    def test_wait_is_capped_by_deadline(self):
+        token = CancellationToken(0.05)
+        started = time.perf_counter()
+        assert token.wait(5.0) is True
+        assert time.perf_counter() - started < 1.0
+
+    def test_raise_counts_abandoned_call(self):
+        token = CancellationToken(name="test-upstream")
+        token.raise_if_cancelled()  # not cancelled: no-op
+        before = abandoned_counts().get("test-upstream", 0)
+        token.cancel()
+        with pytest.raises(CallCancelled):
+            token.raise_if_cancelled("before attempt 2")
+        assert abandoned_counts()["test-upstream"] == before + 1
+
+
+@pytest.fixture
+def fake_genai(monkeypatch):
+    """Fake per-key Gemini clients: records (key, model, kwargs) per call and
+    runs ``behaviour`` to produce the response."""
+    calls = []
+    state = {"behaviour": lambda model, call: types.SimpleNamespace(text="<div/>")}
+
+    class FakeModel:
+        def __init__(self, api_key, model_name):
+            self.api_key = api_key
+            self.model_name = model_name
+
+        async def generate_content_async(self, content, **kwargs):
+            call = {"key": self.api_key, "model": self.model_name, **kwargs}
+            calls.append(call)
+            return state["behaviour"](self.model_name, call)
+
+    class FakeClients:
+        def model(self, api_key, model_name, generation_config=None):
+            return FakeModel(api_key, model_name)
+
+        async def close_loop_clients(self):
+            pass
+
+    monkeypatch.setattr(inference, "_gemini_clients", FakeClients())
+    monkeypatch.setattr(
+        inference,
+        "gemini_key_pool",
+        GeminiKeyPool(lambda: [("GEMINI_API_KEY", "k1"), ("GEMINI_API_KEY_2", "k2")]),
+    )
+    monkeypatch.setattr(inference, "_GEMINI_MODELS", ("model-a", "model-b"))
+    return calls, state
+
+
+def _generate(**kwargs):
+    return inference.generate_with_gemini([], "react", "tailwind", None, **kwargs)
+
+
+class TestGeminiCancellation:
+    def test_deadline_becomes_request_timeout(self, fake_genai):
+        calls, _ = fake_genai
+        assert _generate(cancel_token=CancellationToken(30.0)) == "<div/>"
+        assert 1.0 <= calls[0]["request_options"]["timeout"] <= 30.0
+
+    def test_no_token_sets_no_timeout(self, fake_genai):
+        calls, _ = fake_genai
+        _generate()
+        assert calls[0]["request_options"] is None
+
+    def test_already_cancelled_makes_no_call(self, fake_genai):
+        calls, _ = fake_genai
+        token = CancellationToken()
+        token.cancel()
+        with pytest.raises(CallCancelled):
+            _generate(cancel_token=token)
+        assert calls == []
+
+    def test_cancel_stops_model_and_key_rotation(self, fake_genai):
+        """Without a token a failed attempt rotates through every key/model;
+        once the caller has given up the next attempt must not start."""
+        calls, state = fake_genai
+        token = CancellationToken()
+
+        def fail_and_cancel(model, call):
+            token.cancel("caller timed out")
+            raise RuntimeError("upstream 500")
+
+        state["behaviour"] = fail_and_cancel
+        with pytest.raises(CallCancelled):
+            _generate(cancel_token=token)
+        assert [c["model"] for c in calls] == ["model-a"]
+
+    def test_late_response_is_dropped(self, fake_genai):
+        calls, state = fake_genai
+        token = CancellationToken()
+
+        def respond_after_cancel(model, call):
+            token.cancel("caller timed out")
+            return types.SimpleNamespace(text="<div/>")
+
+        state["behaviour"] = respond_after_cancel
+        with pytest.raises(CallCancelled):
+            _generate(cancel_token=token)
+        assert inference.gemini_key_pool.success_count_today(0, "model-a") == 0
+
+    def test_stream_stops_between_chunks(self, fake_genai):
+        calls, state = fake_genai
+        token = CancellationToken()
+        received = []
+
+        async def chunks(model, call):
+            assert call["stream"] is True
+            yield types.SimpleNamespace(text="<div>")
+            token.cancel("client disconnected")
+            yield types.SimpleNamespace(text="never forwarded")
+
+        state["behaviour"] = chunks
+        with pytest.raises(CallCancelled):
+            _generate(cancel_token=token, stream_callback=received.append)
+        assert received == ["<div>"]
+        assert len(calls) == 1
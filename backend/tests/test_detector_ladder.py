@@ -0,0 +1,253 @@
+"""Tests for the Roboflow detector ladder: breaker, warmth, latency budgets,
+and detect_with_roboflow_async walking the rungs.
+
+Time is a FakeClock; Roboflow is a fake per-model client that answers (or
+fails) as each test scripts it.
+"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from app.models import inference
+from app.models.detector_ladder import (
+    DetectorLadder,
+    DetectorRung,
+    detector_ladder_from_env,
+    parse_detector_ladder,
+)
+from app.models.roboflow_clients import RoboflowHTTPError
+
+SMALL = DetectorRung("proj/4", 8.0)
+FAST = DetectorRung("proj/2", 5.0)
+LADDER = [SMALL, FAST]
+
+
+class FakeClock:
+    def __init__(self, now=1_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _plan(ladder):
+    return [(attempt.rung.model_id, attempt.fallback) for attempt in ladder.plan(LADDER)]
+
+
+def _warm(ladder, *rungs, seconds=1.0):
+    for rung in rungs:
+        ladder.record_success(rung.model_id, seconds)
+
+
+class TestConfig:
+    def test_parse_budgets_and_defaults(self):
+        rungs = parse_detector_ladder(" proj/4@8 , proj/2, proj/4@1, bad@x ", 10.0)
+        assert rungs == [
+            DetectorRung("proj/4", 8.0),
+            DetectorRung("proj/2", 10.0),
+            DetectorRung("bad", 10.0),
+        ]
+
+    def test_parse_per_rung_thresholds(self):
+        rungs = parse_detector_ladder("proj/4@8:navbar=0.3, proj/2:Card=0.03:footer=x", 10.0)
+        assert rungs == [
+            DetectorRung("proj/4", 8.0, (("navbar", 0.3),)),
+            DetectorRung("proj/2", 10.0, (("card", 0.03),)),
+        ]
+
+    def test_unset_ladder_is_the_single_model_id(self, monkeypatch):
+        monkeypatch.delenv("ROBOFLOW_MODELS", raising=False)
+        monkeypatch.setenv("ROBOFLOW_MODEL_ID", "proj/7")
+        monkeypatch.setenv("ROBOFLOW_LATENCY_BUDGET_S", "12")
+        assert detector_ladder_from_env("proj/1") == [DetectorRung("proj/7", 12.0)]
+
+
+class TestPlan:
+    def test_cold_start_tries_every_rung_in_order(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        assert _plan(ladder) == [("proj/4", False), ("proj/2", False)]
+        assert ladder.take_warmups() == []
+
+    def test_cold_rung_is_skipped_for_a_warm_one_and_warmed(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        _warm(ladder, FAST)
+        assert _plan(ladder) == [("proj/2", False)]
+        assert ladder.take_warmups() == ["proj/4"]
+        assert _plan(ladder) == [("proj/2", False)]
+        assert ladder.take_warmups() == []  # already warming
+        ladder.record_success("proj/4")  # the warm-up landed
+        assert _plan(ladder) == [("proj/4", True), ("proj/2", False)]
+
+    def test_idle_model_goes_cold_again(self):
+        clock = FakeClock()
+        ladder = DetectorLadder(clock=clock)
+        _warm(ladder, SMALL)
+        clock.now += 600
+        _warm(ladder, FAST)
+        clock.now += 400  # SMALL idle for 1000s, FAST for 400s
+        assert _plan(ladder) == [("proj/2", False)]
+
+    def test_rung_over_budget_is_skipped_then_probed(self):
+        clock = FakeClock()
+        ladder = DetectorLadder(clock=clock)
+        _warm(ladder, FAST)
+        for _ in range(3):
+            ladder.record_success("proj/4", 20.0)  # way over its 8s budget
+        assert _plan(ladder) == [("proj/2", False)]
+        clock.now += 301
+        ladder.record_success("proj/2", 1.0)  # keep FAST warm
+        assert _plan(ladder)[0] == ("proj/4", True)
+
+    def test_slow_rung_is_still_used_without_a_healthy_fallback(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        for _ in range(3):
+            ladder.record_success("proj/4", 20.0)
+        assert _plan(ladder) == [("proj/4", False), ("proj/2", False)]
+
+
+class TestBreaker:
+    def test_auth_error_opens_at_once(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        _warm(ladder, SMALL, FAST)
+        ladder.record_failure("proj/4", "credit")
+        assert ladder.is_open("proj/4")
+        assert _plan(ladder) == [("proj/2", False)]
+
+    def test_repeated_timeouts_open(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        for _ in range(2):
+            ladder.record_failure("proj/4", "timeout", 8.0)
+        assert not ladder.is_open("proj/4")
+        ladder.record_failure("proj/4", "timeout", 8.0)
+        assert ladder.is_open("proj/4")
+
+    def test_success_resets_the_failure_run(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        for _ in range(2):
+            ladder.record_failure("proj/4", "error")
+        ladder.record_success("proj/4", 1.0)
+        ladder.record_failure("proj/4", "error")
+        assert not ladder.is_open("proj/4")
+
+    def test_half_open_lets_one_probe_through(self):
+        clock = FakeClock()
+        ladder = DetectorLadder(clock=clock)
+        ladder.record_failure("proj/4", "auth")
+        clock.now += 601
+        assert _plan(ladder)[0][0] == "proj/4"  # the probe
+        assert [m for m, _ in _plan(ladder)] == ["proj/2"]  # probe outstanding
+        ladder.record_success("proj/4", 1.0)
+        assert not ladder.is_open("proj/4")
+
+    def test_failed_probe_reopens_for_longer(self):
+        clock = FakeClock()
+        ladder = DetectorLadder(clock=clock)
+        ladder.record_failure("proj/4", "auth")
+        clock.now += 601
+        ladder.plan(LADDER)
+        ladder.record_failure("proj/4", "auth")
+        clock.now += 601
+        assert ladder.is_open("proj/4")  # 1200s this time
+        clock.now += 600
+        assert not ladder.is_open("proj/4")
+
+    def test_snapshot(self):
+        ladder = DetectorLadder(clock=FakeClock())
+        ladder.record_failure("proj/4", "credit")
+        small, fast = ladder.snapshot(LADDER)
+        assert (small["breaker"], small["open_reason"], small["reopens_in_s"]) == (
+            "open",
+            "credit",
+            600,
+        )
+        assert small["failures"] == {"credit": 1}
+        assert (fast["breaker"], fast["cold"]) == ("closed", True)
+
+
+def _sketch():
+    buf = io.BytesIO()
+    Image.new("RGB", (100, 60), (255, 255, 255)).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+PREDICTION = {"class": "navbar", "confidence": 0.9, "x": 50, "y": 5, "width": 100, "height": 10}
+
+
+@pytest.fixture
+def fake_roboflow(monkeypatch):
+    """Per-model fake clients; ``script[model]`` is a list of outcomes
+    (an exception to raise or a result dict), consumed one per call."""
+    calls = []
+    script = {}
+
+    class FakeClient:
+        def __init__(self, model_id):
+            self.model_id = model_id
+
+        async def infer(self, image_b64, *, confidence, timeout=None):
+            calls.append((self.model_id, timeout))
+            outcome = script[self.model_id].pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+    class FakeClients:
+        def client(self, api_url, api_key, model_id):
+            return FakeClient(model_id)
+
+    ladder = DetectorLadder(clock=FakeClock())
+    monkeypatch.setattr(inference, "_roboflow_clients", FakeClients())
+    monkeypatch.setattr(inference, "roboflow_ladder", ladder)
+    monkeypatch.setenv("ROBOFLOW_MODELS", "proj/4@8,proj/2@5")
+    monkeypatch.setenv("ROBOFLOW_MAX_RETRIES", "1")
+    return calls, script, ladder
+
+
+def _detect():
+    return asyncio.run(
+        inference.detect_with_roboflow_async(_sketch(), (100, 60), api_key="k")
+    )
+
+
+class TestDetectWithLadder:
+    def test_falls_through_to_the_next_rung(self, fake_roboflow):
+        calls, script, ladder = fake_roboflow
+        _warm(ladder, SMALL, FAST)
+        script["proj/4"] = [asyncio.TimeoutError()]
+        script["proj/2"] = [{"predictions": [PREDICTION], "image": {"width": 100, "height": 60}}]
+        output = _detect()
+        assert output.model_version == "proj/2"
+        assert calls == [("proj/4", 8.0), ("proj/2", None)]
+
+    def test_open_breaker_skips_the_call(self, fake_roboflow):
+        calls, script, ladder = fake_roboflow
+        script["proj/4"] = [RoboflowHTTPError(403, "out of credits")]
+        script["proj/2"] = [RoboflowHTTPError(401, "unauthorized")]
+        assert _detect() is None
+        assert ladder.is_open("proj/4") and ladder.is_open("proj/2")
+        calls.clear()
+        assert _detect() is None  # straight to the contour fallback
+        assert calls == []
+
+    def test_each_rung_is_filtered_with_its_own_thresholds(self, fake_roboflow, monkeypatch):
+        calls, script, ladder = fake_roboflow
+        monkeypatch.setenv("ROBOFLOW_MODELS", "proj/4@8,proj/2@5:card=0.03")
+        monkeypatch.delenv("ROBOFLOW_CONFIDENCE_THRESHOLD_CARD", raising=False)
+        _warm(ladder, SMALL, FAST)
+        weak_card = {**PREDICTION, "class": "card", "confidence": 0.1, "width": 40, "height": 30}
+        result = {"predictions": [PREDICTION, weak_card], "image": {"width": 100, "height": 60}}
+        script["proj/4"] = [dict(result)]
+        assert [el.type for el in _detect().elements] == ["navbar"]
+
+        script["proj/4"] = [asyncio.TimeoutError()]
+        script["proj/2"] = [dict(result)]
+        assert sorted(el.type for el in _detect().elements) == ["card", "navbar"]
+
+        settings = inference.roboflow_detection_settings()["class_thresholds"]
+        assert (settings["proj/4"]["card"], settings["proj/2"]["card"]) == (0.20, 0.03)
+        # v2 keeps its card floor even when the ladder does not spell it out.
+        assert inference._resolve_class_threshold("card", 0.4, "object-detection-4affw/2") == 0.03
@@ -0,0 +1,150 @@
+"""Tests for the bounded per-upstream executors.
+
+Blocking work is simulated with threading.Event gates, so the tests control
+exactly when a worker is busy; each test drives its own loop with asyncio.run.
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from app.utils.executors import BoundedConcurrency, BoundedExecutor, ExecutorSaturated
+
+
+@pytest.mark.parametrize("workers, queue", [(0, 1), (1, -1)])
+def test_invalid_config_raises(workers, queue):
+    with pytest.raises(ValueError):
+        BoundedExecutor("t", workers, queue)
+
+
+def test_runs_blocking_function_off_the_loop():
+    pool = BoundedExecutor("t", 1, 0)
+
+    async def scenario():
+        return await pool.run(lambda a, b=0: (threading.current_thread().name, a + b), 1, b=2)
+
+    name, total = asyncio.run(scenario())
+    assert name.startswith("t")
+    assert total == 3
+    assert pool.metrics()["completed"] == 1
+
+
+def test_full_pool_and_queue_sheds_immediately():
+    pool = BoundedExecutor("t", 1, 1)
+    gate = threading.Event()
+
+    async def scenario():
+        running = asyncio.ensure_future(pool.run(gate.wait))
+        queued = asyncio.ensure_future(pool.run(gate.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ExecutorSaturated) as excinfo:
+            await pool.run(gate.wait)
+        metrics = pool.metrics()
+        gate.set()
+        await asyncio.gather(running, queued)
+        return excinfo.value, metrics
+
+    error, metrics = asyncio.run(scenario())
+    assert error.name == "t"
+    assert error.retry_after >= 1
+    assert (metrics["running"], metrics["queued"], metrics["rejected"]) == (1, 1, 1)
+    assert pool.metrics()["completed"] == 2
+
+
+def test_timed_out_caller_keeps_slot_until_thread_finishes():
+    """wait_for abandons the await, but the thread is still busy — admission
+    must keep counting it."""
+    pool = BoundedExecutor("t", 1, 0)
+    gate = threading.Event()
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pool.run(gate.wait), timeout=0.05)
+        with pytest.raises(ExecutorSaturated):
+            await pool.run(gate.wait)
+        gate.set()
+        for _ in range(100):
+            if pool.metrics()["running"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        return await pool.run(lambda: "free again")
+
+    assert asyncio.run(scenario()) == "free again"
+
+
+def test_queue_wait_is_measured():
+    pool = BoundedExecutor("t", 1, 1)
+    gate = threading.Event()
+
+    async def scenario():
+        first = asyncio.ensure_future(pool.run(gate.wait))
+        second = asyncio.ensure_future(pool.run(lambda: None))
+        await asyncio.sleep(0.05)
+        gate.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert pool.metrics()["queue_wait_ms"]["max"] >= 40
+
+
+def test_exceptions_propagate_and_release_the_slot():
+    pool = BoundedExecutor("t", 1, 0)
+
+    def boom():
+        raise RuntimeError("roboflow down")
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await pool.run(boom)
+        return await pool.run(lambda: "ok")
+
+    assert asyncio.run(scenario()) == "ok"
+
+
+def test_concurrency_gate_limits_and_sheds():
+    gate = BoundedConcurrency("g", 1, 1)
+
+    async def scenario():
+        release = asyncio.Event()
+        running = asyncio.ensure_future(gate.run(release.wait))
+        queued = asyncio.ensure_future(gate.run(asyncio.sleep, 0, "queued ran"))
+        await asyncio.sleep(0.01)
+        assert (gate.metrics()["running"], gate.metrics()["queued"]) == (1, 1)
+        with pytest.raises(ExecutorSaturated):
+            await gate.run(asyncio.sleep, 0)
+        release.set()
+        return await asyncio.gather(running, queued)
+
+    assert asyncio.run(scenario())[1] == "queued ran"
+    metrics = gate.metrics()
+    assert (metrics["completed"], metrics["rejected"], metrics["running"]) == (2, 1, 0)
+
+
+def test_concurrency_gate_timeout_frees_slot_at_once():
+    """Unlike a thread, a cancelled coroutine stops — its slot is free again."""
+    gate = BoundedConcurrency("g", 1, 0)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(gate.run(asyncio.sleep, 10), timeout=0.05)
+        return await gate.run(asyncio.sleep, 0, "free again")
+
+    assert asyncio.run(scenario()) == "free again"
+
+
+def test_concurrency_gate_cancelled_waiter_leaves_queue():
+    gate = BoundedConcurrency("g", 1, 1)
+
+    async def scenario():
+        release = asyncio.Event()
+        running = asyncio.ensure_future(gate.run(release.wait))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(gate.run(asyncio.sleep, 0), timeout=0.05)
+        release.set()
+        await running
+        return await gate.run(asyncio.sleep, 0, "ok")
+
+    assert asyncio.run(scenario()) == "ok"
+    assert gate.metrics()["queued"] == 0
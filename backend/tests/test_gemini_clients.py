@@ -0,0 +1,96 @@
+"""Tests for the per-key Gemini client registry.
+
+Client construction is stubbed (no network, no gRPC); what is checked is that
+each key keeps its own long-lived client and that models are pinned to it.
+"""
+
+import asyncio
+import concurrent.futures
+
+from app.models.gemini_clients import GeminiClients
+
+
+class _FakeTransport:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class _FakeClient:
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.transport = _FakeTransport()
+
+
+class _StubbedClients(GeminiClients):
+    def __init__(self):
+        super().__init__()
+        self.built = []
+
+    def _make_client(self, api_key):
+        client = _FakeClient(api_key)
+        self.built.append(client)
+        return client
+
+
+def test_one_client_per_key_is_reused():
+    clients = _StubbedClients()
+
+    async def scenario():
+        return [clients.client(k) for k in ("k1", "k2", "k1", "k2")]
+
+    a1, b1, a2, b2 = asyncio.run(scenario())
+    assert a1 is a2 and b1 is b2
+    assert a1 is not b1
+    assert [c.api_key for c in clients.built] == ["k1", "k2"]
+
+
+def test_model_is_pinned_to_its_keys_client():
+    clients = _StubbedClients()
+
+    async def scenario():
+        return clients.model("k1", "gemini-x"), clients.model("k2", "gemini-x")
+
+    m1, m2 = asyncio.run(scenario())
+    assert m1._async_client.api_key == "k1"
+    assert m2._async_client.api_key == "k2"
+
+
+def test_concurrent_requests_on_different_keys_never_cross():
+    """The old genai.configure() race: threads interleaving configure + call."""
+    clients = _StubbedClients()
+
+    def worker(key):
+        async def scenario():
+            seen = []
+            for _ in range(50):
+                seen.append(clients.model(key, "gemini-x")._async_client.api_key)
+                await asyncio.sleep(0)
+            return seen
+
+        return key, asyncio.run(scenario())
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(worker, ["k1", "k2", "k3", "k4"]))
+    for key, seen in results:
+        assert set(seen) == {key}
+
+
+def test_new_loop_gets_a_new_client_and_closing_releases_it():
+    clients = _StubbedClients()
+
+    async def first():
+        client = clients.client("k1")
+        await clients.close_loop_clients()
+        return client
+
+    old = asyncio.run(first())
+    assert old.transport.closed
+    assert len(clients) == 0
+
+    async def second():
+        return clients.client("k1")
+
+    assert asyncio.run(second()) is not old
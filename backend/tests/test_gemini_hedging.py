@@ -0,0 +1,195 @@
+"""Tests for hedged Gemini requests (GEMINI_HEDGE).
+
+Fake per-key clients sleep for a per-key delay, so each test decides which
+slot is the slow one. The pool is seeded with latency samples to give the
+model a known p90; the minimum hedge delay is zeroed so nothing waits long.
+"""
+
+import asyncio
+import types
+
+import pytest
+
+from app.models import inference
+from app.models.gemini_pool import GeminiKeyPool
+
+
+async def _chunks(text):
+    yield types.SimpleNamespace(text=text)
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    calls = []
+    cancelled = []
+    delays = {"k1": 0.0, "k2": 0.0, "k3": 0.0}
+    failing = set()
+
+    class FakeModel:
+        def __init__(self, api_key, model_name):
+            self.api_key = api_key
+            self.model_name = model_name
+
+        async def generate_content_async(self, content, **kwargs):
+            calls.append((self.api_key, self.model_name))
+            try:
+                await asyncio.sleep(delays[self.api_key])
+            except asyncio.CancelledError:
+                cancelled.append(self.api_key)
+                raise
+            if self.api_key in failing:
+                raise RuntimeError("upstream 500")
+            text = f"<div>{self.api_key}</div>"
+            if kwargs.get("stream"):
+                return _chunks(text)
+            return types.SimpleNamespace(text=text)
+
+    class FakeClients:
+        def model(self, api_key, model_name, generation_config=None):
+            return FakeModel(api_key, model_name)
+
+        async def close_loop_clients(self):
+            pass
+
+    pool = GeminiKeyPool(
+        lambda: [("GEMINI_API_KEY", "k1"), ("GEMINI_API_KEY_2", "k2"), ("GEMINI_API_KEY_3", "k3")],
+        budgets=lambda: {},
+        routing=lambda: "lru",
+    )
+    for _ in range(inference._HEDGE_MIN_SAMPLES):
+        pool.record_latency(2, "model-a", 0.05)  # p90 ≈ 50ms
+    monkeypatch.setattr(inference, "_gemini_clients", FakeClients())
+    monkeypatch.setattr(inference, "gemini_key_pool", pool)
+    monkeypatch.setattr(inference, "_GEMINI_MODELS", ("model-a",))
+    monkeypatch.setattr(inference, "_HEDGE_MIN_DELAY_S", 0.0)
+    monkeypatch.setattr(inference, "_hedge_stats", inference._HedgeStats())
+    monkeypatch.setenv("GEMINI_HEDGE", "true")
+    return types.SimpleNamespace(
+        calls=calls, cancelled=cancelled, delays=delays, failing=failing, pool=pool
+    )
+
+
+def _generate(**kwargs):
+    return inference.generate_with_gemini([], "react", "tailwind", None, **kwargs)
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins(fake_gemini):
+    fake_gemini.delays["k1"] = 5.0
+    assert _generate() == "<div>k2</div>"
+    assert fake_gemini.calls == [("k1", "model-a"), ("k2", "model-a")]
+    assert fake_gemini.cancelled == ["k1"]
+    stats = inference._hedge_stats.snapshot()
+    assert (stats["calls"], stats["hedged"], stats["hedge_wins"]) == (1, 1, 1)
+    assert stats["extra_requests"] == 1
+
+
+def test_primary_that_finishes_within_p90_is_not_hedged(fake_gemini):
+    assert _generate() == "<div>k1</div>"
+    assert fake_gemini.calls == [("k1", "model-a")]
+    assert inference._hedge_stats.snapshot()["hedged"] == 0
+
+
+def test_primary_can_still_win_after_the_hedge_starts(fake_gemini):
+    fake_gemini.delays["k1"] = 0.2
+    fake_gemini.delays["k2"] = 5.0
+    assert _generate() == "<div>k1</div>"
+    assert fake_gemini.cancelled == ["k2"]
+    stats = inference._hedge_stats.snapshot()
+    assert (stats["hedged"], stats["hedge_wins"], stats["win_rate"]) == (1, 0, 0.0)
+
+
+def test_both_failing_moves_on_to_the_next_slot(fake_gemini):
+    fake_gemini.delays["k1"] = 0.2
+    fake_gemini.failing.update({"k1", "k2"})
+    assert _generate() == "<div>k3</div>"
+    assert [key for key, _ in fake_gemini.calls] == ["k1", "k2", "k3"]
+
+
+def test_no_hedge_without_enough_samples(fake_gemini, monkeypatch):
+    unmeasured = GeminiKeyPool(
+        lambda: [("GEMINI_API_KEY", "k1"), ("GEMINI_API_KEY_2", "k2")],
+        budgets=lambda: {},
+        routing=lambda: "lru",
+    )
+    monkeypatch.setattr(inference, "gemini_key_pool", unmeasured)
+    fake_gemini.delays["k1"] = 0.2
+    assert _generate() == "<div>k1</div>"
+    assert fake_gemini.calls == [("k1", "model-a")]
+
+
+def test_hedging_is_off_by_default(fake_gemini, monkeypatch):
+    monkeypatch.delenv("GEMINI_HEDGE")
+    fake_gemini.delays["k1"] = 0.2
+    assert _generate() == "<div>k1</div>"
+    assert fake_gemini.calls == [("k1", "model-a")]
+    assert inference._hedge_stats.snapshot()["calls"] == 0
+
+
+def test_streamed_calls_are_not_hedged(fake_gemini):
+    fake_gemini.delays["k1"] = 0.2
+    received = []
+    assert _generate(stream_callback=received.append) == "<div>k1</div>"
+    assert fake_gemini.calls == [("k1", "model-a")]
+
+
+def test_hedging_is_reported_in_llm_status(fake_gemini):
+    fake_gemini.delays["k1"] = 5.0
+    _generate()
+    hedging = inference.get_llm_pool_status()["hedging"]
+    assert hedging["enabled"] is True
+    assert hedging["hedge_rate"] == 1.0
+    assert hedging["delay_s"]["model-a"] == pytest.approx(0.05, abs=0.01)
+
+
+def test_attached_image_is_encoded_once_for_every_attempt(fake_gemini, monkeypatch):
+    import threading
+
+    from PIL import Image
+
+    from app.utils.image_handle import ImageHandle
+
+    sent = []
+    encoded_on = []
+    handle = ImageHandle.from_pil(Image.new("RGB", (64, 48), "white"))
+    original_encode = handle.encode
+
+    def encode(format="PNG"):
+        encoded_on.append(threading.current_thread() is threading.main_thread())
+        return original_encode(format)
+
+    monkeypatch.setattr(handle, "encode", encode)
+    model_cls = type(inference._gemini_clients.model("k1", "model-a"))
+    generate = model_cls.generate_content_async
+
+    async def recording(self, content, **kwargs):
+        sent.append(content[1])
+        return await generate(self, content, **kwargs)
+
+    monkeypatch.setattr(model_cls, "generate_content_async", recording)
+    fake_gemini.delays["k1"] = 5.0
+    assert _generate(image=handle) == "<div>k2</div>"
+
+    assert encoded_on == [False]  # once, on a worker thread
+    assert len(sent) == 2 and sent[0] is sent[1]
+    assert sent[0]["mime_type"] == "image/png"
+    assert sent[0]["data"].startswith(b"\x89PNG")
+
+
+def test_shared_pool_writes_run_off_the_event_loop(fake_gemini, monkeypatch, tmp_path):
+    import threading
+
+    from app.models.gemini_pool import SQLitePoolStore
+
+    fake_gemini.pool.use_store(SQLitePoolStore(str(tmp_path / "pool.sqlite3")))
+    threads = []
+    for name in ("acquire", "record_success"):
+        method = getattr(fake_gemini.pool, name)
+
+        def spy(*args, _method=method, _name=name, **kwargs):
+            threads.append((_name, threading.current_thread() is threading.main_thread()))
+            return _method(*args, **kwargs)
+
+        monkeypatch.setattr(fake_gemini.pool, name, spy)
+    monkeypatch.delenv("GEMINI_HEDGE")
+    assert _generate() == "<div>k1</div>"
+    assert threads == [("acquire", False), ("record_success", False)]
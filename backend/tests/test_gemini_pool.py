@@ -0,0 +1,348 @@
+"""Tests for the GeminiKeyPool (key, model) slot scheduler.
+
+A FakeClock drives cooldown expiry so no test sleeps. Shared-state tests run
+two pools on one SQLitePoolStore file, standing in for two workers.
+"""
+
+import os
+import sqlite3
+import threading
+
+from app.models.gemini_pool import (
+    GeminiKeyPool,
+    SQLitePoolStore,
+    gemini_keys_from_env,
+    parse_model_budgets,
+    quota_day,
+)
+
+LADDER = ("pro", "flash")
+
+
+class FakeClock:
+    def __init__(self, now=1_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _pool(n=3, clock=None, budgets=None, store=None):
+    keys = [(f"GEMINI_API_KEY_{i + 1}", f"k{i + 1}") for i in range(n)]
+    return GeminiKeyPool(
+        lambda: keys, budgets=lambda: budgets or {}, clock=clock or FakeClock(), store=store
+    )
+
+
+def _picks(pool, clock, count, models=LADDER):
+    picks = []
+    for _ in range(count):
+        slot = pool.acquire(models)
+        picks.append(slot[:2] if slot else None)
+        clock.now += 1
+    return picks
+
+
+def test_keys_from_env_base_key_first(monkeypatch):
+    for name in [n for n in os.environ if n.startswith("GEMINI_API_KEY")]:
+        monkeypatch.delenv(name)
+    monkeypatch.setenv("GEMINI_API_KEY_10", "ten")
+    monkeypatch.setenv("GEMINI_API_KEY_2", "two")
+    monkeypatch.setenv("GEMINI_API_KEY", "base")
+    monkeypatch.setenv("GEMINI_API_KEY_3", "  ")
+    assert gemini_keys_from_env() == [
+        ("GEMINI_API_KEY", "base"),
+        ("GEMINI_API_KEY_2", "two"),
+        ("GEMINI_API_KEY_10", "ten"),
+    ]
+
+
+def test_round_robins_keys_within_the_primary_tier():
+    clock = FakeClock()
+    pool = _pool(3, clock)
+    assert _picks(pool, clock, 6) == [(0, "pro"), (1, "pro"), (2, "pro")] * 2
+
+
+def test_cooling_slot_is_skipped_then_recovers():
+    clock = FakeClock()
+    pool = _pool(2, clock)
+    pool.cool(0, "pro", 60)
+    assert [pool.acquire(LADDER)[:2] for _ in range(2)] == [(1, "pro"), (1, "pro")]
+    clock.now += 61
+    assert pool.acquire(LADDER)[:2] == (0, "pro")  # least recently used again
+
+
+def test_falls_back_a_tier_only_when_every_key_is_cooling():
+    clock = FakeClock()
+    pool = _pool(2, clock)
+    pool.cool(0, "pro", 86_400)
+    pool.cool(1, "pro", 60)
+    assert pool.acquire(LADDER)[:2] == (0, "flash")
+    assert pool.acquire(LADDER)[:2] == (1, "flash")
+    assert pool.all_cooling(("pro",))
+    assert pool.resume_ts(("pro",)) == clock.now + 60
+
+
+def test_exclude_walks_every_slot_once_then_stops():
+    pool = _pool(2)
+    tried = set()
+    while (slot := pool.acquire(LADDER, exclude=tried)) is not None:
+        tried.add(slot[:2])
+    assert tried == {(0, "pro"), (1, "pro"), (0, "flash"), (1, "flash")}
+    assert pool.usable(LADDER, exclude=tried) == 0
+
+
+def test_forced_single_model_scope():
+    pool = _pool(2)
+    assert pool.acquire(("flash",))[:2] == (0, "flash")
+    assert pool.acquire(("unknown-model",))[:2] == (0, "unknown-model")
+
+
+def test_reload_keeps_state_for_unchanged_keys():
+    clock = FakeClock()
+    keys = [("GEMINI_API_KEY", "a"), ("GEMINI_API_KEY_2", "b")]
+    pool = GeminiKeyPool(lambda: list(keys), clock=clock)
+    pool.cool(1, "pro", 60)
+    pool.record_success(1, "pro")
+    keys[:] = [("GEMINI_API_KEY", "b"), ("GEMINI_API_KEY_2", "c")]
+    pool.reload()
+    assert pool.key(0) == "b"
+    assert pool.is_cooled(0, "pro")
+    assert not pool.is_cooled(1, "pro")
+    snapshot = pool.snapshot(("pro",))
+    assert snapshot[0]["last_success_ts"] == clock.now
+    assert snapshot[1]["last_success_ts"] is None
+    assert "b" not in repr(snapshot).replace("GEMINI", "")
+
+
+def test_concurrent_acquires_spread_evenly():
+    pool = GeminiKeyPool(lambda: [(f"K{i}", f"k{i}") for i in range(4)])
+    counts = [0] * 4
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(100):
+            key_index = pool.acquire(LADDER)[0]
+            with lock:
+                counts[key_index] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(counts) == 400
+    assert max(counts) - min(counts) <= 4
+
+
+def test_parse_model_budgets():
+    assert parse_model_budgets("a=10/250, b=/1000 ,c=5/, d=0/0, bad=x/1,,") == {
+        "a": (10, 250),
+        "b": (None, 1000),
+        "c": (5, None),
+    }
+
+
+def test_quota_day_ends_at_pacific_midnight():
+    # 2026-06-01 20:00 UTC is 13:00 PDT; the quota day ends 07:00 UTC next day.
+    day, ends = quota_day(1_780_344_000)
+    assert day == "2026-06-01"
+    assert ends == 1_780_383_600
+
+
+def test_daily_budget_rotates_slot_out_after_its_last_request():
+    clock = FakeClock(1_780_344_000)
+    pool = _pool(2, clock, budgets={"pro": (None, 2)})
+    picks = _picks(pool, clock, 5)
+    # Each key serves exactly its 2 "pro" requests, then the tier falls back.
+    assert picks[:4].count((0, "pro")) == 2
+    assert picks[:4].count((1, "pro")) == 2
+    assert picks[4] == (0, "flash")
+    assert pool.cooldown_remaining(0, "pro") > 3600
+    clock.now = quota_day(clock.now)[1] + 1  # next quota day
+    assert pool.acquire(LADDER)[1] == "pro"
+
+
+def test_rpm_budget_paces_a_single_key():
+    clock = FakeClock()
+    pool = _pool(1, clock, budgets={"pro": (3, None)})
+    assert [s[1] for s in (pool.acquire(LADDER) for _ in range(3))] == ["pro"] * 3
+    assert pool.acquire(LADDER)[1] == "flash"
+    assert pool.all_cooling(("pro",))
+    clock.now += 60
+    assert pool.acquire(LADDER)[1] == "pro"
+
+
+def test_budget_status_is_reported():
+    clock = FakeClock()
+    pool = _pool(1, clock, budgets={"pro": (10, 100)})
+    pool.acquire(LADDER)
+    status = pool.snapshot(LADDER)[0]["models"]
+    assert status["pro"]["budget"] == {
+        "rpm": 10,
+        "rpd": 100,
+        "requests_last_minute": 1,
+        "requests_today": 1,
+    }
+    assert "budget" not in status["flash"]
+
+
+# ── Shared store ─────────────────────────────────────────────────────────────
+
+
+def _workers(tmp_path, clock, n=2, budgets=None):
+    path = str(tmp_path / "pool.sqlite3")
+    return [_pool(n, clock, budgets, store=SQLitePoolStore(path)) for _ in range(2)]
+
+
+def test_cooldown_in_one_worker_is_skipped_by_the_other(tmp_path):
+    clock = FakeClock()
+    a, b = _workers(tmp_path, clock)
+    assert b.acquire(LADDER)[:2] == (0, "pro")  # b builds its heaps first
+    a.cool(1, "pro", 60)
+    clock.now += 1
+    assert b.acquire(LADDER)[:2] == (0, "pro")
+    assert b.cooldown_remaining(1, "pro") == 59
+    clock.now += 60
+    assert b.acquire(LADDER)[:2] == (1, "pro")
+
+
+def test_budget_is_spent_pool_wide(tmp_path):
+    clock = FakeClock()
+    a, b = _workers(tmp_path, clock, n=1, budgets={"pro": (None, 3)})
+    picks = [pool.acquire(LADDER)[1] for pool in (a, b, a, b, a)]
+    assert picks == ["pro", "pro", "pro", "flash", "flash"]
+    assert a.snapshot(("pro",))[0]["models"]["pro"]["budget"]["requests_today"] == 3
+
+
+def test_lease_rechecks_a_stale_local_view(tmp_path):
+    """b's heap still says key 1 is ready; the lease transaction sees a's
+    cooldown and moves on instead of handing the slot out."""
+    clock = FakeClock()
+    a, b = _workers(tmp_path, clock)
+    b.acquire(LADDER)
+    b._synced_at = clock.now + 3600  # pretend b just synced and missed a's write
+    a.cool(1, "pro", 60)
+    assert b.acquire(LADDER)[:2] == (0, "pro")
+    assert b.is_cooled(1, "pro")
+
+
+def test_status_is_pool_wide_and_survives_a_restart(tmp_path):
+    clock = FakeClock()
+    a, b = _workers(tmp_path, clock)
+    a.record_success(0, "pro")
+    b.record_success(0, "pro")
+    b.cool(1, "flash", 600)
+    restarted = _pool(2, clock, store=SQLitePoolStore(str(tmp_path / "pool.sqlite3")))
+    for pool in (a, b, restarted):
+        keys = pool.snapshot(LADDER)
+        assert keys[0]["models"]["pro"]["success_count_today"] == 2
+        assert keys[0]["last_success_ts"] == clock.now
+        assert keys[1]["models"]["flash"]["cooldown_remaining_s"] == 600
+
+
+def test_store_holds_no_key_material(tmp_path):
+    clock = FakeClock()
+    a, _ = _workers(tmp_path, clock)
+    a.acquire(LADDER)
+    a.record_success(0, "pro")
+    conn = sqlite3.connect(str(tmp_path / "pool.sqlite3"))
+    dump = "\n".join(conn.iterdump())
+    assert "k1" not in dump and "k2" not in dump
+
+
+def test_store_errors_fall_back_to_local_state(tmp_path):
+    clock = FakeClock()
+    pool, _ = _workers(tmp_path, clock)
+
+    def broken(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    pool._store.transact = broken
+    pool._store.changed_since = broken
+    pool.cool(0, "pro", 60)
+    assert pool.acquire(LADDER)[:2] == (1, "pro")
+    assert pool.is_cooled(0, "pro")
+
+
+# ── Latency ──────────────────────────────────────────────────────────────────
+
+
+def _latency_pool(clock, routing="latency"):
+    keys = [(f"GEMINI_API_KEY_{i + 1}", f"k{i + 1}") for i in range(3)]
+    pool = GeminiKeyPool(lambda: keys, budgets=lambda: {}, routing=lambda: routing, clock=clock)
+    for _ in range(3):
+        pool.record_latency(0, "pro", 40.0)  # key 1 has gone slow
+        pool.record_latency(1, "pro", 4.0)
+        pool.record_latency(2, "pro", 5.0)
+    return pool
+
+
+def test_latency_routing_skips_a_much_slower_key():
+    clock = FakeClock()
+    pool = _latency_pool(clock)
+    picks = [key for key, _ in _picks(pool, clock, 7, models=("pro",))]
+    assert picks[0] == 0  # never leased by this pool yet: served as a probe
+    assert picks[1:] == [1, 2] * 3  # then the two fast keys round-robin
+
+
+def test_latency_routing_never_changes_tier():
+    clock = FakeClock()
+    pool = _latency_pool(clock)
+    pool.record_latency(0, "flash", 0.5)
+    for _ in range(2):
+        pool.record_latency(0, "flash", 0.5)
+    assert all(model == "pro" for _, model in _picks(pool, clock, 4))
+
+
+def test_latency_routing_probes_a_passed_over_key():
+    clock = FakeClock()
+    pool = _latency_pool(clock)
+    pool.acquire(("pro",))
+    clock.now += 301
+    assert 0 in [key for key, _ in _picks(pool, clock, 3, models=("pro",))]
+
+
+def test_lru_routing_ignores_latency():
+    clock = FakeClock()
+    pool = _latency_pool(clock, routing="lru")
+    assert [key for key, _ in _picks(pool, clock, 3, models=("pro",))] == [0, 1, 2]
+
+
+def test_latency_is_reported_per_slot():
+    clock = FakeClock()
+    pool = _latency_pool(clock)
+    status = pool.snapshot(LADDER)[0]["models"]
+    assert status["pro"]["latency"]["samples"] == 3
+    assert status["pro"]["latency"]["ewma_ms"] == 40000.0
+    assert status["flash"]["latency"]["samples"] == 0
+
+
+def test_pool_lock_is_not_held_across_store_io(tmp_path):
+    import threading
+
+    clock = FakeClock()
+    pool, _ = _workers(tmp_path, clock)
+    pool.acquire(LADDER)
+    entered, release = threading.Event(), threading.Event()
+    transact = pool._store.transact
+
+    def slow_transact(*args):
+        entered.set()
+        release.wait(5)  # another worker holding the write lock
+        transact(*args)
+
+    pool._store.transact = slow_transact
+    writer = threading.Thread(target=pool.cool, args=(0, "pro", 60))
+    writer.start()
+    assert entered.wait(5)
+    try:
+        # Lock-only reads must not queue behind the blocked write.
+        done = threading.Event()
+        reader = threading.Thread(target=lambda: (pool.all_cooling(LADDER), done.set()))
+        reader.start()
+        assert done.wait(1.0)
+    finally:
+        release.set()
+        writer.join()
+    assert pool.is_cooled(0, "pro")
@@ -0,0 +1,128 @@
+"""Tests for ImageHandle and the upload path that carries it from detection to
+Gemini and the /api/detect preview."""
+
+import base64
+import copy
+import io
+import json
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.models import inference
+from app.models.inference import ExternalModelOutput
+from app.utils.image_handle import ImageHandle
+
+
+def _png_bytes(width=40, height=30):
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (255, 255, 255)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _pixels():
+    pixels = np.full((30, 40, 3), 255, dtype=np.uint8)
+    pixels[10:20, 5:35] = 0
+    return pixels
+
+
+def test_encodings_are_made_once(monkeypatch):
+    handle = ImageHandle.from_array(_pixels())
+    saves = []
+    real_save = Image.Image.save
+
+    def counting_save(self, *args, **kwargs):
+        saves.append(kwargs.get("format"))
+        return real_save(self, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "save", counting_save)
+    first = handle.b64("png")
+    assert handle.b64("PNG") == first
+    assert handle.encode("PNG") == base64.b64decode(first)
+    assert saves == ["PNG"]
+    assert Image.open(io.BytesIO(handle.encode("PNG"))).size == (40, 30)
+
+
+def test_pil_is_built_once_and_matches_the_array():
+    handle = ImageHandle.from_array(_pixels())
+    assert handle.size == (40, 30)
+    assert handle.pil() is handle.pil()
+    assert np.array_equal(handle.array(), _pixels())
+    assert not handle.array().flags.writeable
+
+
+def test_crop_view_is_made_compact():
+    frame = np.zeros((300, 400, 3), dtype=np.uint8)
+    handle = ImageHandle.from_array(frame[10:20, 10:30])
+    assert not np.shares_memory(handle.array(), frame)
+    assert handle.size == (20, 10)
+
+
+def test_callers_array_stays_writeable():
+    pixels = _pixels()
+    handle = ImageHandle.from_array(pixels)
+    assert not handle.array().flags.writeable
+    assert pixels.flags.writeable
+    pixels[0, 0] = 7  # the caller's own array, still theirs to write
+
+
+def test_encoded_bytes_are_reused_for_their_own_format():
+    data = _png_bytes()
+    handle = ImageHandle.from_bytes(data)
+    assert handle.encode("PNG") is data
+    assert handle.pil().size == (40, 30)
+
+
+def test_nbytes_counts_pixels_and_encodings_once():
+    handle = ImageHandle.from_array(_pixels())
+    assert handle.nbytes == 30 * 40 * 3
+    png = handle.encode("PNG")
+    handle.b64("PNG")  # not kept
+    assert handle.nbytes == 30 * 40 * 3 + len(png)  # pil() replaced the array
+
+    data = _png_bytes()
+    from_bytes = ImageHandle.from_bytes(data)
+    from_bytes.encode("PNG")  # the source bytes themselves, not a second copy
+    assert from_bytes.nbytes == len(data)
+
+
+def test_copies_share_and_serialization_is_refused():
+    handle = ImageHandle.from_array(_pixels())
+    assert copy.deepcopy(handle) is handle
+    with pytest.raises(TypeError):
+        pickle.dumps(handle)
+
+
+def test_output_carries_the_handle_but_never_serializes_it():
+    output = ExternalModelOutput(source="roboflow", metadata={"image_width": 40})
+    output.processed_image = ImageHandle.from_array(_pixels())
+    assert output.model_copy(deep=True).processed_image is output.processed_image
+    dumped = output.model_dump()
+    assert "processed_image" not in json.dumps(dumped)
+    assert dumped["metadata"] == {"image_width": 40}
+
+
+def _upload(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+@pytest.mark.parametrize("source", ["upload-photo", "upload-clean"])
+def test_upload_preparation_hands_over_the_decoded_crop(source):
+    photo = Image.new("RGB", (400, 300), (240, 240, 240))
+    photo.paste((20, 20, 20), (100, 100, 300, 200))
+    prepared = inference._prepare_roboflow_image(_upload(photo), source, False)
+    payload, gemini_image = prepared.payload, prepared.gemini_image
+    assert Image.open(io.BytesIO(base64.b64decode(payload))).format == "JPEG"
+    assert isinstance(gemini_image, ImageHandle)
+    width, height = gemini_image.size
+    assert width < 400 and height < 300  # cropped to the drawing
+    assert gemini_image.pil().mode == "RGB"
+
+
+def test_canvas_preparation_has_no_gemini_image():
+    prepared = inference._prepare_roboflow_image(_upload(Image.new("RGBA", (50, 40))), None, False)
+    assert prepared.gemini_image is None and prepared.transform is None
@@ -0,0 +1,142 @@
+"""Tests for the Roboflow keep-warm scheduler and the unload-gap learning it
+relies on in DetectorLadder.
+
+One FakeClock drives both the ladder and the scheduler; pings are a fake
+that reports a scripted latency to the ladder the way warm_roboflow_model
+does.
+"""
+
+import asyncio
+from datetime import datetime, timezone
+
+from app.models.detector_ladder import DetectorLadder, DetectorRung
+from app.models.keep_warm import KeepWarm, parse_active_hours
+
+RUNGS = [DetectorRung("proj/4", 8.0)]
+NOON = datetime(2026, 10, 1, 12, tzinfo=timezone.utc).timestamp()
+
+
+class FakeClock:
+    def __init__(self, now=NOON):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _setup(latency=1.0, **kwargs):
+    clock = FakeClock()
+    ladder = DetectorLadder(clock=clock)
+    pinged = []
+    script = {"latency": latency}
+
+    async def ping(model_id):
+        pinged.append(model_id)
+        seconds = script["latency"]
+        return seconds, ladder.record_success(model_id, seconds, track_latency=False)
+
+    warm = KeepWarm(ladder, lambda: RUNGS, ping, clock=clock, **kwargs)
+    return clock, ladder, warm, pinged, script
+
+
+def _tick(warm):
+    return asyncio.run(warm.tick())
+
+
+def test_parse_active_hours():
+    assert parse_active_hours("8-20, 22-2,x-3,5-5,") == [(8, 20), (22, 2)]
+    assert parse_active_hours("") == []
+
+
+def test_never_warmed_model_is_pinged_at_once():
+    _, _, warm, pinged, _ = _setup()
+    _tick(warm)
+    assert pinged == ["proj/4"]
+
+
+def test_ping_lands_just_before_the_unload_gap():
+    clock, ladder, warm, pinged, _ = _setup()
+    ladder.record_success("proj/4", 1.0)
+    clock.now += 700  # 0.8 × 900s default estimate = 720s
+    assert warm.due() == ([], 20.0)
+    clock.now += 20
+    _tick(warm)
+    assert pinged == ["proj/4"]
+
+
+def test_real_traffic_resets_the_idle_clock():
+    clock, ladder, warm, pinged, _ = _setup()
+    ladder.record_success("proj/4", 1.0)
+    clock.now += 700
+    ladder.record_success("proj/4", 1.0)  # a user detection
+    clock.now += 100
+    _tick(warm)
+    assert pinged == []
+
+
+def test_cold_ping_pulls_the_estimate_in():
+    clock, ladder, warm, _, script = _setup(latency=40.0)
+    ladder.record_success("proj/4", 1.0)
+    clock.now += 720
+    _tick(warm)
+    assert ladder.idle("proj/4")[1] == 720.0
+    assert warm.metrics()["models"]["proj/4"]["cold"]["samples"] == 1
+
+
+def test_warm_pings_stretch_the_estimate():
+    clock, ladder, warm, _, _ = _setup(latency=1.0)
+    ladder.record_success("proj/4", 1.0)
+    for _ in range(8):
+        clock.now += 720
+        _tick(warm)
+    assert round(ladder.idle("proj/4")[1]) == 990
+    metrics = warm.metrics()["models"]["proj/4"]
+    assert (metrics["pings"], metrics["warm"]["samples"]) == (8, 8)
+
+
+def test_quick_slow_answer_does_not_count_as_cold():
+    clock, ladder, _, _, _ = _setup()
+    ladder.record_success("proj/4", 1.0)
+    clock.now += 5
+    assert ladder.record_success("proj/4", 30.0) is None
+    assert ladder.idle("proj/4")[1] == 900.0
+
+
+def test_outside_active_hours_nothing_is_pinged():
+    clock, _, warm, pinged, _ = _setup(active_hours=[(22, 6)])
+    _tick(warm)  # noon
+    assert pinged == []
+    clock.now += 11 * 3600  # 23:00, inside the wrapped range
+    _tick(warm)
+    assert pinged == ["proj/4"]
+
+
+def test_daily_budget_caps_pings_and_resets():
+    clock, ladder, warm, pinged, _ = _setup(max_pings_per_day=2)
+    for _ in range(3):
+        _tick(warm)
+        clock.now += 800
+    assert len(pinged) == 2
+    assert warm.metrics()["pings_today"] == 2
+    clock.now += 24 * 3600
+    _tick(warm)
+    assert len(pinged) == 3
+
+
+def test_open_breaker_is_not_pinged():
+    _, ladder, warm, pinged, _ = _setup()
+    ladder.record_failure("proj/4", "credit")
+    _tick(warm)
+    assert pinged == []
+
+
+def test_failed_ping_is_counted():
+    clock = FakeClock()
+    ladder = DetectorLadder(clock=clock)
+
+    async def ping(model_id):
+        return None
+
+    warm = KeepWarm(ladder, lambda: RUNGS, ping, clock=clock)
+    _tick(warm)
+    assert warm.metrics()["models"]["proj/4"]["failures"] == 1
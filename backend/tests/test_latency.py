@@ -0,0 +1,54 @@
+"""Tests for the streaming latency statistics (EWMA + P² quantiles)."""
+
+import random
+
+import pytest
+
+from app.utils.latency import LatencyStats, P2Quantile
+
+
+@pytest.mark.parametrize("p", [0.5, 0.95])
+def test_p2_tracks_the_true_quantile(p):
+    rng = random.Random(7)
+    samples = [rng.lognormvariate(0.0, 0.6) for _ in range(5000)]
+    estimator = P2Quantile(p)
+    for x in samples:
+        estimator.add(x)
+    exact = sorted(samples)[int(p * len(samples))]
+    assert estimator.value() == pytest.approx(exact, rel=0.05)
+
+
+def test_p2_is_exact_for_the_first_samples():
+    estimator = P2Quantile(0.5)
+    assert estimator.value() is None
+    for x in (3.0, 1.0, 2.0):
+        estimator.add(x)
+    assert estimator.value() == 2.0
+
+
+@pytest.mark.parametrize("p", [0.0, 1.0])
+def test_p2_rejects_degenerate_quantiles(p):
+    with pytest.raises(ValueError):
+        P2Quantile(p)
+
+
+def test_ewma_follows_a_slot_that_turns_slow():
+    stats = LatencyStats(alpha=0.5)
+    for _ in range(20):
+        stats.add(2.0)
+    for _ in range(3):
+        stats.add(60.0)
+    assert stats.ewma > 50.0
+    assert stats.quantile(0.5) < 5.0  # the median barely moves
+
+
+def test_summary_is_in_milliseconds():
+    stats = LatencyStats()
+    assert stats.summary() == {"samples": 0, "ewma_ms": None, "p50_ms": None, "p95_ms": None}
+    stats.add(1.5)
+    assert stats.summary() == {
+        "samples": 1,
+        "ewma_ms": 1500.0,
+        "p50_ms": 1500.0,
+        "p95_ms": 1500.0,
+    }
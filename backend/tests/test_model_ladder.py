@@ -4,14 +4,13 @@ Covers: GEMINI_MODELS parsing, the forceModel component of the generation
 cache key, and the /api/llm-status pool snapshot shape (no key material).
 """
 
-import time
+import pytest
 
 from main import _generation_cache_key
 from app.models import inference
+from app.models.gemini_pool import GeminiKeyPool, quota_day
 from app.models.inference import (
     _parse_gemini_models,
-    _record_model_success,
-    _success_count_today,
     get_llm_pool_status,
 )
 
@@ -79,35 +78,44 @@ class TestForceModelCacheKey:
 
 class TestSuccessCounter:
     def setup_method(self):
-        inference._key_model_success_counts.clear()
+        self.now = 1_780_344_000.0
+        self.pool = GeminiKeyPool(
+            lambda: [("GEMINI_API_KEY", "a"), ("GEMINI_API_KEY_2", "b")],
+            clock=lambda: self.now,
+        )
 
     def test_counts_increment(self):
-        _record_model_success(0, "gemini-3.5-flash")
-        _record_model_success(0, "gemini-3.5-flash")
-        assert _success_count_today(0, "gemini-3.5-flash") == 2
+        self.pool.record_success(0, "gemini-3.5-flash")
+        self.pool.record_success(0, "gemini-3.5-flash")
+        assert self.pool.success_count_today(0, "gemini-3.5-flash") == 2
 
     def test_counts_are_per_key_and_model(self):
-        _record_model_success(0, "gemini-3.5-flash")
-        _record_model_success(1, "gemini-3.5-flash")
-        _record_model_success(0, "gemini-3-flash-preview")
-        assert _success_count_today(0, "gemini-3.5-flash") == 1
-        assert _success_count_today(1, "gemini-3.5-flash") == 1
-        assert _success_count_today(0, "gemini-3-flash-preview") == 1
+        self.pool.record_success(0, "gemini-3.5-flash")
+        self.pool.record_success(1, "gemini-3.5-flash")
+        self.pool.record_success(0, "gemini-3-flash-preview")
+        assert self.pool.success_count_today(0, "gemini-3.5-flash") == 1
+        assert self.pool.success_count_today(1, "gemini-3.5-flash") == 1
+        assert self.pool.success_count_today(0, "gemini-3-flash-preview") == 1
 
     def test_stale_days_dropped(self):
-        inference._key_model_success_counts[("2000-01-01", 0, "gemini-3.5-flash")] = 7
-        _record_model_success(0, "gemini-3.5-flash")
-        assert ("2000-01-01", 0, "gemini-3.5-flash") not in (
-            inference._key_model_success_counts
-        )
+        self.pool.record_success(0, "gemini-3.5-flash")
+        self.now = quota_day(self.now)[1] + 1
+        assert self.pool.success_count_today(0, "gemini-3.5-flash") == 0
+        self.pool.record_success(0, "gemini-3.5-flash")
+        assert self.pool.success_count_today(0, "gemini-3.5-flash") == 1
 
 
 class TestPoolStatus:
+    @pytest.fixture(autouse=True)
+    def fresh_pool(self, monkeypatch):
+        monkeypatch.setattr(inference, "gemini_key_pool", GeminiKeyPool())
+
     def test_shape_and_no_key_material(self, monkeypatch):
         monkeypatch.setenv("GEMINI_API_KEY", "secret-key-value-1")
         monkeypatch.setenv("GEMINI_API_KEY_2", "secret-key-value-2")
         status = get_llm_pool_status()
         assert status["ladder"] == list(inference._GEMINI_MODELS)
+        assert status["routing"] in ("lru", "latency")
         assert len(status["keys"]) >= 2
         flat = repr(status)
         assert "secret-key-value-1" not in flat
@@ -119,25 +127,26 @@ class TestPoolStatus:
             entry = first["models"][model_name]
             assert "cooldown_remaining_s" in entry
             assert "success_count_today" in entry
+            assert set(entry["latency"]) == {"samples", "ewma_ms", "p50_ms", "p95_ms"}
 
     def test_cooldown_reflected(self, monkeypatch):
         monkeypatch.setenv("GEMINI_API_KEY", "secret-key-value-1")
         model_name = inference._GEMINI_MODELS[0]
-        inference._apply_model_cooldown(0, model_name, 120)
-        try:
-            status = get_llm_pool_status()
-            remaining = status["keys"][0]["models"][model_name][
-                "cooldown_remaining_s"
-            ]
-            assert 0 < remaining <= 120
-        finally:
-            inference._model_cooldowns.pop((0, model_name), None)
+        inference.gemini_key_pool.cool(0, model_name, 120)
+        status = get_llm_pool_status()
+        remaining = status["keys"][0]["models"][model_name]["cooldown_remaining_s"]
+        assert 0 < remaining <= 120
 
     def test_last_success_ts_surface(self, monkeypatch):
         monkeypatch.setenv("GEMINI_API_KEY", "secret-key-value-1")
-        inference._key_last_used[0] = time.time()
-        try:
-            status = get_llm_pool_status()
-            assert status["keys"][0]["last_success_ts"] is not None
-        finally:
-            inference._key_last_used.pop(0, None)
+        inference.gemini_key_pool.record_success(0, inference._GEMINI_MODELS[0])
+        status = get_llm_pool_status()
+        assert status["keys"][0]["last_success_ts"] is not None
+
+    def test_reload_picks_up_new_keys(self, monkeypatch):
+        monkeypatch.setenv("GEMINI_API_KEY", "secret-key-value-1")
+        before = len(get_llm_pool_status()["keys"])
+        monkeypatch.setenv("GEMINI_API_KEY_99", "secret-key-value-99")
+        assert len(get_llm_pool_status()["keys"]) == before  # built once
+        inference.gemini_key_pool.reload()
+        assert len(get_llm_pool_status()["keys"]) == before + 1
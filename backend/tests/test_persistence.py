@@ -0,0 +1,237 @@
+"""Tests for the write-behind persistence queue.
+
+A fake supabase client records every insert/update so the tests can assert on
+batching, coalescing, retries and the pre-generated iteration id without a
+network. The writer thread is real; each test stops the queue (which drains
+it) before asserting, so there is no sleeping or polling.
+"""
+
+import uuid
+
+import pytest
+
+from app.utils.persistence import PersistenceQueue
+
+
+class _Query:
+    def __init__(self, client, table, kind, payload):
+        self._client = client
+        self._table = table
+        self._kind = kind
+        self._payload = payload
+        self._match = None
+
+    def eq(self, column, value):
+        self._match = (column, value)
+        return self
+
+    def execute(self):
+        self._client.attempts += 1
+        if self._client.fail_next > 0:
+            self._client.fail_next -= 1
+            raise RuntimeError("supabase unavailable")
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        if self._client.poison and self._kind != "update":
+            if any(r.get("poison") for r in rows):
+                raise RuntimeError("bad row")
+        ids = {r["id"] for r in rows if self._kind != "update" and r.get("id")}
+        if self._kind == "insert" and ids & self._client.ids:
+            raise RuntimeError("duplicate key value violates unique constraint (23505)")
+        self._client.ids |= ids
+        self._client.calls.append((self._kind, self._table, self._payload, self._match))
+        if self._client.lose_reply > 0:
+            self._client.lose_reply -= 1
+            raise RuntimeError("connection reset")  # written, reply lost
+        return self
+
+
+class _Table:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def insert(self, payload):
+        return _Query(self._client, self._name, "insert", payload)
+
+    def upsert(self, payload, on_conflict="", ignore_duplicates=False):
+        assert on_conflict == "id" and ignore_duplicates
+        rows = payload if isinstance(payload, list) else [payload]
+        fresh = [r for r in rows if r["id"] not in self._client.ids]
+        return _Query(self._client, self._name, "upsert", fresh)
+
+    def update(self, payload):
+        return _Query(self._client, self._name, "update", payload)
+
+
+class FakeSupabase:
+    def __init__(self, fail_next=0, poison=False, lose_reply=0):
+        self.calls = []
+        self.attempts = 0
+        self.fail_next = fail_next
+        self.poison = poison
+        self.lose_reply = lose_reply
+        self.ids = set()
+
+    def table(self, name):
+        return _Table(self, name)
+
+
+class _BusyWriter:
+    """Stand-in thread: makes the queue accept submissions while nothing is
+    draining it, so tests can pile jobs up deterministically."""
+
+    def is_alive(self):
+        return True
+
+
+def _queue(client, **kwargs):
+    kwargs.setdefault("retry_base_seconds", 0.0)
+    return PersistenceQueue(lambda: client, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"max_depth": 0}, {"batch_size": 0}, {"max_retries": 0}],
+)
+def test_invalid_config_raises(kwargs):
+    with pytest.raises(ValueError):
+        PersistenceQueue(lambda: None, **kwargs)
+
+
+def test_not_running_refuses_submissions():
+    q = _queue(FakeSupabase())
+    assert q.submit_iteration("p1", {}, "code", None) is None
+    assert q.submit_insert("detection_corrections", [{"a": 1}]) is False
+
+
+def test_submit_iteration_returns_pregenerated_uuid_and_writes_it():
+    client = FakeSupabase()
+    q = _queue(client)
+    q.start()
+    iteration_id = q.submit_iteration("p1", {"width": 10}, "<div/>", "prompt")
+    q.stop()
+
+    assert uuid.UUID(iteration_id)
+    inserts = [c for c in client.calls if c[0] == "upsert"]
+    updates = [c for c in client.calls if c[0] == "update"]
+    assert inserts[0][1] == "iterations"
+    assert inserts[0][2][0]["id"] == iteration_id
+    assert inserts[0][2][0]["generated_code"] == "<div/>"
+    assert updates == [
+        ("update", "projects", {"generated_code": "<div/>", "canvas_data": {"width": 10}}, ("id", "p1"))
+    ]
+
+
+def test_batch_coalesces_inserts_and_project_updates():
+    client = FakeSupabase()
+    q = _queue(client, batch_size=50)
+    # Enqueue before starting the writer so everything lands in one batch.
+    q._thread = _BusyWriter()
+    ids = [q.submit_iteration("p1", {}, f"code-{i}", None) for i in range(3)]
+    q._thread = None
+    q.start()
+    q.stop()
+
+    inserts = [c for c in client.calls if c[0] == "upsert"]
+    updates = [c for c in client.calls if c[0] == "update"]
+    assert len(inserts) == 1
+    assert [row["id"] for row in inserts[0][2]] == ids
+    # Three updates to the same project collapse into the last one.
+    assert len(updates) == 1
+    assert updates[0][2]["generated_code"] == "code-2"
+    assert q.metrics()["written"] == 6
+
+
+def test_transient_failure_is_retried():
+    client = FakeSupabase(fail_next=1)
+    q = _queue(client, max_retries=3)
+    q.start()
+    assert q.submit_insert("detection_corrections", [{"action": "add"}])
+    q.stop()
+
+    assert client.calls == [("insert", "detection_corrections", [{"action": "add"}], None)]
+    metrics = q.metrics()
+    assert metrics["retries"] == 1
+    assert metrics["failed"] == 0
+
+
+def test_persistent_failure_counts_as_failed():
+    client = FakeSupabase(fail_next=10)
+    q = _queue(client, max_retries=2)
+    q.start()
+    q.submit_insert("detection_corrections", [{"action": "add"}])
+    q.stop()
+
+    assert client.calls == []
+    assert q.metrics()["failed"] == 1
+
+
+def test_poison_row_does_not_drop_its_batch_neighbours():
+    client = FakeSupabase(poison=True)
+    q = _queue(client, max_retries=1)
+    q.start()
+    q.submit_insert("detection_corrections", [{"ok": 1}, {"poison": True}, {"ok": 2}])
+    q.stop()
+
+    written = [c[2] for c in client.calls]
+    assert written == [{"ok": 1}, {"ok": 2}]
+    metrics = q.metrics()
+    assert metrics["written"] == 2
+    assert metrics["failed"] == 1
+
+
+def test_retry_after_a_lost_reply_is_not_a_failure():
+    client = FakeSupabase(lose_reply=1)
+    q = _queue(client, max_retries=3)
+    q.start()
+    iteration_id = q.submit_iteration("p1", {}, "code", None)
+    q.stop()
+
+    written = [c for c in client.calls if c[0] == "upsert"]
+    assert [row["id"] for row in written[0][2]] == [iteration_id]
+    assert all(c[2] == [] for c in written[1:])  # the re-send skipped the row
+    metrics = q.metrics()
+    assert metrics["failed"] == 0
+    assert metrics["written"] == 2
+
+
+def test_stop_does_not_hang_on_a_full_queue_behind_a_stuck_writer():
+    import threading
+    import time
+
+    release = threading.Event()
+
+    class _Stuck(FakeSupabase):
+        def table(self, name):
+            release.wait(5)
+            return super().table(name)
+
+    q = _queue(_Stuck(), max_depth=2, batch_size=1)
+    q.start()
+    q.submit_insert("detection_corrections", [{"a": 1}])
+    while q.metrics()["depth"]:  # writer has taken the first job and is stuck
+        time.sleep(0.001)
+    assert q.submit_insert("detection_corrections", [{"a": 2}])
+    assert q.submit_insert("detection_corrections", [{"a": 3}])
+    start = time.monotonic()
+    q.stop(timeout=0.2)
+    assert time.monotonic() - start < 1.0
+    release.set()
+
+
+def test_full_queue_rejects_without_blocking():
+    q = _queue(FakeSupabase(), max_depth=3)
+    q._thread = _BusyWriter()
+    assert q.submit_iteration("p1", {}, "a", None) is not None
+    # Only one slot left: the insert+update pair must be refused as a unit.
+    assert q.submit_iteration("p1", {}, "b", None) is None
+    assert q.metrics()["depth"] == 2
+    assert q.metrics()["rejected"] == 1
+
+
+def test_metrics_shape():
+    q = _queue(FakeSupabase())
+    metrics = q.metrics()
+    for key in ("running", "depth", "max_depth", "enqueued", "written", "failed"):
+        assert key in metrics
+    assert set(metrics["write_latency_ms"]) == {"last", "avg", "max"}
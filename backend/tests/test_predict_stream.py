@@ -0,0 +1,65 @@
+"""Tests for the /api/predict/stream building blocks.
+
+The endpoint itself needs Supabase/Roboflow/Gemini; what is checked here is
+the SSE frame format and the Gemini chunk forwarding it relies on.
+"""
+
+import asyncio
+import json
+
+from app.models.inference import _stream_gemini_text
+from main import _sse_event
+
+
+def _parse(frame):
+    assert frame.endswith("\n\n")
+    event_line, data_line = frame.rstrip("\n").split("\n")
+    assert event_line.startswith("event: ")
+    assert data_line.startswith("data: ")
+    return event_line[len("event: "):], json.loads(data_line[len("data: "):])
+
+
+def test_sse_event_round_trips_payload():
+    event, data = _parse(_sse_event("code", {"delta": "<div>\n\n</div>"}))
+    assert event == "code"
+    assert data == {"delta": "<div>\n\n</div>"}
+
+
+def test_sse_event_keeps_blank_lines_out_of_the_frame():
+    frame = _sse_event("done", {"code": "a\n\nb"})
+    assert frame.count("\n\n") == 1
+
+
+class _Chunk:
+    def __init__(self, text=None, blocked=False):
+        self._text = text
+        self._blocked = blocked
+
+    @property
+    def text(self):
+        if self._blocked:
+            raise ValueError("chunk blocked by safety filter")
+        return self._text
+
+
+class _StreamingModel:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.kwargs = None
+
+    async def generate_content_async(self, content, **kwargs):
+        self.kwargs = kwargs
+        return self
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+def test_stream_forwards_chunks_and_joins_them():
+    model = _StreamingModel([_Chunk("<div>"), _Chunk(""), _Chunk(blocked=True), _Chunk("</div>")])
+    seen = []
+    text = asyncio.run(_stream_gemini_text(model, "prompt", seen.append))
+    assert model.kwargs == {"stream": True}
+    assert seen == ["<div>", "</div>"]
+    assert text == "<div></div>"
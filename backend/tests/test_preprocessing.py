@@ -0,0 +1,129 @@
+"""Tests for canvas rasterization, the lazy contour-fallback input and the
+fast, resolution-capped upload preprocessing."""
+
+import numpy as np
+import pytest
+
+from app.models.inference import ExternalModelElement, ExternalModelOutput, SketchDetector
+from app.utils.preprocessing import preprocess_canvas_data, preprocess_uploaded_photo_fast
+
+
+def _box_line(x, y, w, h):
+    return {"points": [x, y, x + w, y, x + w, y + h, x, y + h, x, y], "width": 2}
+
+
+def test_strokes_are_drawn_at_target_size():
+    canvas = {"width": 1000, "height": 500, "lines": [_box_line(100, 100, 500, 200)]}
+    image = preprocess_canvas_data(canvas, target_size=(200, 100))
+    assert image.shape == (100, 200, 3) and image.dtype == np.float32
+    ink = np.argwhere(image[..., 0] < 0.5)
+    assert (ink.min(axis=0) == [20, 20]).all()
+    assert (ink.max(axis=0) == [60, 120]).all()
+
+
+def test_mini_canvas_strokes_format():
+    canvas = {"width": 256, "height": 256, "strokes": [[{"x": 10, "y": 10}, {"x": 200, "y": 10}]]}
+    image = preprocess_canvas_data(canvas)
+    assert image[10, 10:200, 0].max() < 0.5
+    assert image[100, :, 0].min() == 1.0
+
+
+def test_contour_fallback_finds_the_drawn_box():
+    canvas = {"width": 1000, "height": 600, "lines": [_box_line(100, 100, 600, 300)]}
+    elements = SketchDetector().detect(lambda: preprocess_canvas_data(canvas))
+    assert len(elements) == 1
+    assert elements[0]["bounds"]["width"] > 140
+
+
+def test_lazy_input_is_not_built_when_the_model_answered():
+    built = []
+
+    def processed():
+        built.append(True)
+        return preprocess_canvas_data({"lines": []})
+
+    output = ExternalModelOutput(
+        source="roboflow",
+        elements=[
+            ExternalModelElement(type="card", bounds={"x": 0, "y": 0, "width": 10, "height": 10})
+        ],
+    )
+    assert SketchDetector().detect(processed, external_output=output)
+    assert built == []
+
+
+def _photo(width, height, box):
+    """Off-white 'paper' with one dark pen rectangle at ``box`` (x0, y0, x1, y1)."""
+    import cv2
+
+    photo = np.full((height, width, 3), 225, dtype=np.uint8)
+    cv2.rectangle(photo, box[:2], box[2:], (25, 25, 25), max(3, width // 600))
+    return photo
+
+
+def _ink_bbox(image):
+    ys, xs = np.where(image[..., 0] < 128)
+    return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+@pytest.mark.parametrize("binarize", [True, False])
+def test_fast_upload_path_caps_the_crop_and_maps_back(binarize):
+    box = (900, 600, 2700, 1800)
+    processed, clean, t = preprocess_uploaded_photo_fast(
+        _photo(3600, 2400, box), binarize=binarize, max_side=640
+    )
+    assert max(processed.shape[:2]) == 640
+    assert processed.shape == clean.shape
+    x0, y0, x1, y1 = _ink_bbox(processed)
+    mapped = ((box[0] - t["offsetX"]) * t["scaleX"], (box[1] - t["offsetY"]) * t["scaleY"])
+    assert abs(mapped[0] - x0) <= 2 and abs(mapped[1] - y0) <= 2
+
+
+def test_fast_upload_path_leaves_small_images_at_full_size():
+    processed, _, t = preprocess_uploaded_photo_fast(
+        _photo(400, 300, (100, 80, 300, 220)), binarize=True, max_side=1280
+    )
+    assert (t["scaleX"], t["scaleY"]) == (1.0, 1.0)
+    assert max(processed.shape[:2]) < 400  # cropped, not scaled
+
+
+def test_jpeg_upload_is_draft_decoded_and_the_transform_covers_it(monkeypatch):
+    import base64
+    import io
+
+    from PIL import Image
+
+    from app.models import inference
+
+    monkeypatch.setenv("UPLOAD_PREPROCESS_MAX_SIDE", "640")
+    box = (400, 300, 3600, 2700)
+    buf = io.BytesIO()
+    Image.fromarray(_photo(4000, 3000, box)).save(buf, format="JPEG", quality=95)
+    sketch = base64.b64encode(buf.getvalue()).decode()
+
+    prepared = inference._prepare_roboflow_image(sketch, "upload-photo", False)
+    t = prepared.transform
+    assert 0.1 < t["scaleX"] < 0.25  # draft 1/4 decode, then the 640 cap
+    payload = np.asarray(Image.open(io.BytesIO(base64.b64decode(prepared.payload))))
+    assert max(payload.shape[:2]) == 640
+    x0, y0, _, _ = _ink_bbox(payload)
+    assert abs((box[0] - t["offsetX"]) * t["scaleX"] - x0) <= 3
+    assert abs((box[1] - t["offsetY"]) * t["scaleY"] - y0) <= 3
+
+
+def test_full_mode_keeps_native_resolution(monkeypatch):
+    import base64
+    import io
+
+    from PIL import Image
+
+    from app.models import inference
+
+    monkeypatch.setenv("UPLOAD_PREPROCESS", "full")
+    buf = io.BytesIO()
+    Image.fromarray(_photo(1600, 1200, (400, 300, 1200, 900))).save(buf, format="PNG")
+    prepared = inference._prepare_roboflow_image(
+        base64.b64encode(buf.getvalue()).decode(), "upload-clean", False
+    )
+    assert prepared.transform is None
+    assert max(prepared.gemini_image.size) > 640
@@ -11,13 +11,14 @@ import threading
 import pytest
 
 from app.utils import rate_limit
-from app.utils.rate_limit import SlidingWindowRateLimiter
+from app.utils.rate_limit import GCRARateLimiter, SlidingWindowRateLimiter
 
 
 class FakeClock:
     """Controllable stand-in for the `time` module the limiter imports.
 
-    The limiter only ever calls `time.monotonic()`, so that is all we model.
+    The sliding window calls `time.monotonic()`; GCRA uses `time.time()` so
+    its state means the same thing in every process. Both read one counter.
     Tests advance time explicitly instead of sleeping.
     """
 
@@ -27,6 +28,9 @@ class FakeClock:
     def monotonic(self) -> float:
         return self._now
 
+    def time(self) -> float:
+        return self._now
+
     def advance(self, seconds: float) -> None:
         self._now += seconds
 
@@ -197,3 +201,233 @@ def test_concurrent_callers_never_exceed_limit():
         t.join()
 
     assert allowed_count == limit
+
+
+# --- GCRA: same contract, one TAT per key, optionally shared ---------------
+
+@pytest.fixture(params=["memory", "sqlite"])
+def gcra_factory(request, tmp_path):
+    path = str(tmp_path / "rl.sqlite3") if request.param == "sqlite" else None
+
+    def make(max_requests, window_seconds):
+        return GCRARateLimiter(max_requests, window_seconds, path=path)
+
+    return make
+
+
+def test_gcra_invalid_config_raises():
+    with pytest.raises(ValueError):
+        GCRARateLimiter(0, 1.0)
+    with pytest.raises(ValueError):
+        GCRARateLimiter(1, 0.0)
+
+
+def test_gcra_allows_burst_then_blocks(clock, gcra_factory):
+    rl = gcra_factory(3, 30.0)
+    assert [rl.check("k") for _ in range(3)] == [(True, 0.0, 2), (True, 0.0, 1), (True, 0.0, 0)]
+    allowed, retry_after, remaining = rl.check("k")
+    assert allowed is False
+    assert remaining == 0
+    # One emission interval (30s / 3) until the next slot.
+    assert retry_after == pytest.approx(10.0)
+
+
+def test_gcra_refills_one_slot_per_interval(clock, gcra_factory):
+    rl = gcra_factory(3, 30.0)
+    for _ in range(3):
+        rl.check("k")
+    clock.advance(10.0)
+    assert rl.check("k")[0] is True
+    assert rl.check("k")[0] is False
+    clock.advance(30.0)
+    assert rl.check("k") == (True, 0.0, 2)
+
+
+def test_gcra_blocked_attempts_are_not_recorded(clock, gcra_factory):
+    rl = gcra_factory(1, 10.0)
+    assert rl.check("k")[0] is True
+    for _ in range(5):
+        clock.advance(1.0)
+        assert rl.check("k")[0] is False
+    clock.advance(5.0)
+    assert rl.check("k")[0] is True
+
+
+def test_gcra_keys_are_independent(clock, gcra_factory):
+    rl = gcra_factory(1, 10.0)
+    assert rl.check("a")[0] is True
+    assert rl.check("b")[0] is True
+    assert rl.check("a")[0] is False
+
+
+def test_gcra_sqlite_state_is_shared_between_instances(clock, tmp_path):
+    """Two limiters on one file stand in for two uvicorn workers."""
+    path = str(tmp_path / "rl.sqlite3")
+    worker_a = GCRARateLimiter(2, 60.0, path=path)
+    worker_b = GCRARateLimiter(2, 60.0, path=path)
+    assert worker_a.check("user")[0] is True
+    assert worker_b.check("user")[0] is True
+    assert worker_a.check("user")[0] is False
+    assert worker_b.check("user")[0] is False
+
+
+def test_gcra_sweep_drops_replenished_keys(clock):
+    rl = GCRARateLimiter(1, 10.0)
+    rl.check("old-user")
+    clock.advance(11.0)
+    rl.check("new-user")
+    assert "old-user" not in rl._tats
+    assert "new-user" in rl._tats
+
+
+def test_gcra_shared_concurrent_callers_never_exceed_limit(tmp_path):
+    limit = 20
+    path = str(tmp_path / "rl.sqlite3")
+    rl = GCRARateLimiter(max_requests=limit, window_seconds=3600.0, path=path)
+
+    allowed_count = 0
+    count_lock = threading.Lock()
+    start = threading.Event()
+
+    def worker():
+        start.wait()
+        nonlocal allowed_count
+        if rl.check("shared")[0]:
+            with count_lock:
+                allowed_count += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(60)]
+    for t in threads:
+        t.start()
+    start.set()
+    for t in threads:
+        t.join()
+
+    assert allowed_count == limit
+
+
+# --- cost-weighted budgets: check(cost) / refund / remaining ----------------
+
+@pytest.fixture(params=["sliding", "gcra", "gcra-sqlite"])
+def any_limiter(request, tmp_path):
+    def make(max_requests, window_seconds):
+        if request.param == "sliding":
+            return SlidingWindowRateLimiter(max_requests, window_seconds)
+        path = str(tmp_path / "rl.sqlite3") if request.param == "gcra-sqlite" else None
+        return GCRARateLimiter(max_requests, window_seconds, path=path)
+
+    return make
+
+
+def test_weighted_check_spends_cost_units(clock, any_limiter):
+    rl = any_limiter(10, 60.0)
+    assert rl.check("k", 4) == (True, 0.0, 6)
+    assert rl.check("k", 4) == (True, 0.0, 2)
+    allowed, retry_after, remaining = rl.check("k", 4)
+    assert (allowed, remaining) == (False, 0)
+    assert retry_after > 0
+    # A cheaper call still fits in what is left.
+    assert rl.check("k", 1)[0] is True
+
+
+def test_zero_cost_is_free_even_when_exhausted(clock, any_limiter):
+    rl = any_limiter(3, 60.0)
+    rl.check("k", 3)
+    assert rl.check("k", 0)[0] is True
+    assert rl.remaining("k") == 0
+
+
+def test_refund_returns_units(clock, any_limiter):
+    rl = any_limiter(6, 60.0)
+    rl.check("k", 3)
+    rl.check("k", 3)
+    assert rl.remaining("k") == 0
+    rl.refund("k", 3)
+    assert rl.remaining("k") == 3
+    assert rl.check("k", 3)[0] is True
+
+
+def test_remaining_does_not_record(clock, any_limiter):
+    rl = any_limiter(5, 60.0)
+    assert rl.remaining("fresh") == 5
+    assert rl.remaining("fresh") == 5
+    assert rl.check("fresh", 2)[2] == 3
+
+
+def test_cost_above_budget_is_clamped(clock, any_limiter):
+    rl = any_limiter(3, 60.0)
+    assert rl.check("k", 10)[0] is True
+    assert rl.check("k", 1)[0] is False
+
+
+def test_rate_limit_costs_env_overrides_defaults():
+    from main import _DEFAULT_RATE_LIMIT_COSTS, _parse_rate_limit_costs
+
+    costs = _parse_rate_limit_costs("fidelity=6, chat=0.5,bogus=2,generate=x")
+    assert costs["fidelity"] == 6.0
+    assert costs["chat"] == 0.5
+    assert "bogus" not in costs
+    assert costs["generate"] == _DEFAULT_RATE_LIMIT_COSTS["generate"]
+
+
+def test_gcra_shared_store_fails_open_quickly_when_locked(tmp_path):
+    import sqlite3
+    import time
+
+    path = str(tmp_path / "rl.sqlite3")
+    rl = GCRARateLimiter(1, 60.0, path=path, busy_timeout=0.05)
+    assert rl.check("user")[0] is True
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")  # another worker holding the write lock
+    try:
+        start = time.monotonic()
+        assert rl.check("user") == (True, 0.0, 0)
+        rl.refund("user", 1.0)
+        assert time.monotonic() - start < 1.0
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert rl.check("user")[0] is False  # the failed-open check was not recorded
+
+
+# --- main._ai_budget: charge up front, settle whatever happens --------------
+
+@pytest.mark.parametrize(
+    "outcome, left",
+    [
+        ("ok", 6.0),  # generate (4) kept
+        ("cache_hit", 9.0),  # billed as a cache hit (1)
+        ("shed", 10.0),  # 503: all back
+        ("error", 10.0),  # unexpected failure: all back
+        ("bad_request", 6.0),  # 4xx: kept
+    ],
+)
+def test_ai_budget_refunds_shed_and_failed_requests(monkeypatch, outcome, left):
+    import asyncio
+    from types import SimpleNamespace
+
+    from fastapi import HTTPException
+
+    import main
+
+    limiter = GCRARateLimiter(10, 3600.0)
+    monkeypatch.setattr(main, "ai_rate_limiter", limiter)
+    monkeypatch.setattr(main, "RATE_LIMIT_COSTS", {"generate": 4.0, "cache_hit": 1.0})
+    request = SimpleNamespace(userId="u1")
+
+    async def call():
+        async with main._ai_budget(request, None, "generate") as budget:
+            if outcome == "cache_hit":
+                budget.billed_as = "cache_hit"
+            elif outcome == "shed":
+                raise HTTPException(status_code=503, detail="busy")
+            elif outcome == "error":
+                raise RuntimeError("upstream")
+            elif outcome == "bad_request":
+                raise HTTPException(status_code=400, detail="bad")
+
+    try:
+        asyncio.run(call())
+    except (HTTPException, RuntimeError):
+        pass
+    assert limiter.remaining("user:u1") == left
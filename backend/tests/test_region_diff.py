@@ -0,0 +1,183 @@
+"""Tests for incremental region re-detection: the pixel diff, the crop plan,
+the merge and the /api/predict detection step that uses them."""
+
+import asyncio
+import base64
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+from app.models.inference import ExternalModelElement
+from app.utils.cancellation import CancellationToken
+from app.utils.region_diff import (
+    SketchHistory,
+    SketchSnapshot,
+    changed_region,
+    merge_region_detections,
+    plan_crop,
+)
+from roboflow_fakes import use_contour_detector
+
+
+def _el(cls, x, y, w, h):
+    return ExternalModelElement(
+        type=cls, confidence=0.9, bounds={"x": x, "y": y, "width": w, "height": h}
+    )
+
+
+def _boxes(elements):
+    return sorted(
+        (el.type, *(round(el.bounds[k]) for k in ("x", "y", "width", "height")))
+        for el in elements
+    )
+
+
+def test_identical_thumbnails_have_no_changed_region():
+    thumb = np.full((60, 80), 255, dtype=np.uint8)
+    assert changed_region(thumb, thumb.copy()) is None
+    edited = thumb.copy()
+    cv2.rectangle(edited, (10, 20), (30, 40), 0, 1)
+    assert changed_region(thumb, edited) == (10, 20, 21, 21)
+
+
+def test_crop_pads_the_change_and_leaves_its_section_alone():
+    section = _el("section", 0, 100, 1000, 800)
+    crop, changed = plan_crop((50, 50, 10, 10), (100, 100), (1000, 1000), [section])
+    x, y, w, h = crop
+    assert x < changed[0] and x + w > changed[0] + changed[2]
+    assert w * h < 0.1 * 1000 * 1000
+
+
+def test_box_cut_by_the_change_is_pulled_into_the_crop():
+    card = _el("card", 400, 400, 200, 100)
+    _, changed = plan_crop((55, 45, 10, 10), (100, 100), (1000, 1000), [card])
+    assert changed[0] <= 400 and changed[0] + changed[2] >= 600
+
+
+def test_large_change_asks_for_a_full_detection():
+    assert plan_crop((0, 0, 80, 80), (100, 100), (1000, 1000), []) is None
+
+
+def test_merge_replaces_boxes_inside_the_crop_and_keeps_partial_views_out():
+    previous = [_el("navbar", 0, 0, 1000, 80), _el("card", 420, 420, 60, 60), _el("section", 0, 100, 1000, 800)]
+    crop = (300, 300, 400, 400)
+    fresh = [_el("card", 120, 120, 60, 60), _el("card", 250, 120, 60, 60), _el("section", 0, 0, 400, 400)]
+    merged = merge_region_detections(previous, fresh, crop, (1000, 1000))
+    assert _boxes(merged) == [
+        ("card", 420, 420, 60, 60),
+        ("card", 550, 420, 60, 60),
+        ("navbar", 0, 0, 1000, 80),
+        ("section", 0, 100, 1000, 800),
+    ]
+
+
+def test_history_hands_out_copies():
+    history = SketchHistory(max_size=1)
+    history.put("a", SketchSnapshot(np.zeros((2, 2)), (2, 2), [_el("card", 0, 0, 1, 1)], "s"))
+    history.get("a").elements[0].bounds["x"] = 99
+    assert history.get("a").elements[0].bounds["x"] == 0
+    history.put("b", SketchSnapshot(np.zeros((2, 2)), (2, 2), [], "s"))
+    assert history.get("a") is None and history.size == 1
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    client = use_contour_detector(monkeypatch)
+    monkeypatch.setattr(main, "detection_cache", None)
+    monkeypatch.setattr(main, "sketch_history", SketchHistory())
+    monkeypatch.setenv("ROBOFLOW_API_KEY", "k")
+    monkeypatch.setenv("ROBOFLOW_TILING", "off")
+    return client
+
+
+def _export(cards):
+    page = np.full((900, 1200, 4), 0, dtype=np.uint8)  # transparent, like Konva
+    cv2.rectangle(page, (40, 40), (1160, 120), (0, 0, 0, 255), 3)
+    for x, y in cards:
+        cv2.rectangle(page, (x, y), (x + 150, y + 100), (0, 0, 0, 255), 3)
+    buf = io.BytesIO()
+    Image.fromarray(page, "RGBA").save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+def _generate(cards, previous=None, screen=None):
+    request = main.GenerateCodeRequest(
+        projectId="p",
+        userId="u",
+        sketchImage=_export(cards),
+        previousElements=previous,
+        currentScreen=screen,
+    )
+    return asyncio.run(
+        main._detect_for_generation(request, (1200, 900), CancellationToken(60.0))
+    )
+
+
+def test_an_added_card_is_detected_in_a_crop(detector):
+    first, how = _generate([(100, 300), (400, 300)])
+    assert how == "cache miss" and detector.sizes == [(1200, 900)]
+    previous = [
+        main.DetectedElement(type=el.type, confidence=el.confidence, bounds=el.bounds)
+        for el in first.elements
+    ]
+
+    second, how = _generate([(100, 300), (400, 300), (700, 600)], previous)
+    assert how.startswith("incremental region")
+    crop_w, crop_h = detector.sizes[-1]
+    assert crop_w * crop_h < 0.2 * 1200 * 900
+    added = ("card", 698, 598, 155, 105)  # the 3 px outline drawn at 700, 600
+    assert _boxes(second.elements) == sorted(_boxes(first.elements) + [added])
+    assert (second.metadata["image_width"], second.metadata["image_height"]) == (1200, 900)
+
+    calls = len(detector.sizes)
+    third, how = _generate([(100, 300), (400, 300), (700, 600)], previous)
+    assert how == "incremental unchanged" and len(detector.sizes) == calls
+    assert _boxes(third.elements) == _boxes(second.elements)
+
+
+def test_without_previous_elements_the_whole_sketch_is_detected(detector):
+    _generate([(100, 300)])
+    _, how = _generate([(100, 300), (700, 600)])
+    assert how == "cache miss"
+    assert detector.sizes == [(1200, 900), (1200, 900)]
+
+
+def _previous(output):
+    return [
+        main.DetectedElement(type=el.type, confidence=el.confidence, bounds=el.bounds)
+        for el in output.elements
+    ]
+
+
+def test_snapshots_come_from_the_detection_not_a_second_decode(detector, monkeypatch):
+    from app.utils.response_cache import DetectionCache
+
+    planned = []
+    plan = main._plan_region_detection
+    monkeypatch.setattr(main, "_plan_region_detection", lambda *a: planned.append(1) or plan(*a))
+    monkeypatch.setattr(main, "detection_cache", DetectionCache())
+
+    first, how = _generate([(100, 300)], screen="home")
+    assert how == "cache miss"
+    _, how = _generate([(100, 300)], screen="about")
+    assert how == "cache hit"
+    assert planned == []
+    assert main.sketch_history.size == 2  # the hit's snapshot came from the cache
+
+    _, how = _generate([(100, 300), (700, 600)], _previous(first), screen="about")
+    assert how.startswith("incremental region") and planned == [1]
+
+
+def test_a_plan_that_fails_in_any_way_detects_the_whole_sketch(detector, monkeypatch):
+    first, _ = _generate([(100, 300)])
+
+    def shed(*args):
+        raise main.HTTPException(status_code=503, detail="busy")
+
+    monkeypatch.setattr(main, "_plan_region_detection", shed)
+    second, how = _generate([(100, 300), (700, 600)], _previous(first))
+    assert how == "cache miss" and len(second.elements) == 3
@@ -1,7 +1,8 @@
 """Tests for the generation response cache (B12).
 
 Covers GenerationCache contract (get/put, TTL expiry, LRU eviction, thread
-safety) and _generation_cache_key stability. Time-dependent tests inject a
+safety), the SQLite backend behind the same contract, and
+_generation_cache_key stability. Time-dependent tests inject a
 fake clock via monkeypatch (same pattern as test_rate_limit.py) so tests are
 fast and never flaky.
 """
@@ -21,6 +22,9 @@ class FakeClock:
     def monotonic(self) -> float:
         return self._now
 
+    def time(self) -> float:
+        return self._now
+
     def advance(self, seconds: float) -> None:
         self._now += seconds
 
@@ -227,3 +231,244 @@ def test_key_upload_ignores_annotations():
     k_with_ann = fn("img", "react", "upload-photo", [ann])
     k_without = fn("img", "react", "upload-photo", None)
     assert k_with_ann == k_without
+
+
+# ---------------------------------------------------------------------------
+# DetectionCache (second tier: Roboflow output)
+# ---------------------------------------------------------------------------
+
+def _detection(n_elements: int = 1, with_png: bool = True):
+    from app.models.inference import ExternalModelElement, ExternalModelOutput
+
+    metadata = {"image_width": 800, "image_height": 600}
+    if with_png:
+        metadata["processed_image_b64"] = "iVBORw0KGgo="
+    return ExternalModelOutput(
+        source="roboflow",
+        elements=[
+            ExternalModelElement(
+                type="card", confidence=0.9, bounds={"x": i, "y": 0, "width": 10, "height": 10}
+            )
+            for i in range(n_elements)
+        ],
+        metadata=metadata,
+    )
+
+
+def test_detection_cache_counts_hits_and_misses(clock):
+    from app.utils.response_cache import DetectionCache
+
+    cache = DetectionCache(max_size=4, ttl_seconds=60)
+    assert cache.get("k") is None
+    cache.put("k", _detection())
+    assert cache.get("k") is not None
+    assert cache.stats() == {"size": 1, "bytes": 0, "hits": 1, "misses": 1}
+
+
+def test_detection_cache_returns_isolated_copies(clock):
+    """Downstream pops processed_image_b64 and mutates elements in place —
+    neither may leak back into the cached entry."""
+    from app.utils.response_cache import DetectionCache
+
+    cache = DetectionCache(max_size=4, ttl_seconds=60)
+    original = _detection()
+    cache.put("k", original)
+    original.elements.clear()
+
+    first = cache.get("k")
+    first.metadata.pop("processed_image_b64")
+    first.elements[0].bounds["x"] = 999
+
+    second = cache.get("k")
+    assert second.metadata["processed_image_b64"] == "iVBORw0KGgo="
+    assert second.elements[0].bounds["x"] == 0
+
+
+def test_detection_cache_ttl_and_lru(clock):
+    from app.utils.response_cache import DetectionCache
+
+    cache = DetectionCache(max_size=2, ttl_seconds=60)
+    cache.put("a", _detection())
+    cache.put("b", _detection())
+    cache.get("a")
+    cache.put("c", _detection())  # evicts b, the least recently used
+    assert cache.get("b") is None
+    clock.advance(61)
+    assert cache.get("a") is None
+    assert cache.size == 1  # c expired too but is only dropped when read
+
+
+def test_detection_cache_is_bounded_by_image_bytes(clock):
+    import numpy as np
+
+    from app.utils.image_handle import ImageHandle
+    from app.utils.response_cache import DetectionCache
+
+    noise = np.random.default_rng(0).integers(0, 256, (100, 100, 3), dtype=np.uint8)
+
+    def upload(pixels=noise):
+        output = _detection(with_png=False)
+        output.processed_image = ImageHandle.from_array(pixels.copy())
+        return output
+
+    cache = DetectionCache(max_size=8, ttl_seconds=60, max_bytes=100_000)
+    grown = upload()
+    cache.put("a", grown)
+    cache.put("b", upload())
+    cache.put("c", upload())
+    assert cache.nbytes == 90_000
+    cache.get("a")
+    cache.put("d", upload())  # 120 KB would not fit: b, the LRU entry, goes
+    assert cache.get("b") is None
+    assert cache.size == 3
+
+    grown.processed_image.encode("PNG")  # a's handle grew after it was stored
+    cache.put("e", upload())  # c alone would have made room at the stored size
+    assert cache.get("c") is None and cache.get("a") is None
+    assert cache.nbytes == 60_000
+
+    cache.put("huge", upload(np.zeros((200, 200, 3), np.uint8)))  # over the whole budget
+    assert cache.get("huge") is None and cache.size == 2
+
+
+def test_detection_key_ignores_data_url_prefix_but_not_source():
+    from main import _detection_cache_key
+
+    raw = "iVBORw0KGgo="
+    assert _detection_cache_key(raw, None, (1000, 600)) == _detection_cache_key(
+        "data:image/png;base64," + raw, "canvas", (1000, 600)
+    )
+    assert _detection_cache_key(raw, None, (1000, 600)) != _detection_cache_key(
+        raw, "upload-photo", (1000, 600)
+    )
+    assert _detection_cache_key(raw, None, (1000, 600)) != _detection_cache_key(
+        raw, None, (1200, 600)
+    )
+
+
+def test_detection_key_tracks_threshold_env(monkeypatch):
+    from main import _detection_cache_key
+
+    before = _detection_cache_key("img", None, (1000, 600))
+    monkeypatch.setenv("ROBOFLOW_CONFIDENCE_THRESHOLD_CARD", "0.05")
+    assert _detection_cache_key("img", None, (1000, 600)) != before
+
+
+# ---------------------------------------------------------------------------
+# SQLiteGenerationCache (shared, persistent backend)
+# ---------------------------------------------------------------------------
+
+def _sqlite(tmp_path, **kwargs):
+    from app.utils.response_cache import SQLiteGenerationCache
+
+    kwargs.setdefault("max_size", 10)
+    kwargs.setdefault("ttl_seconds", 60)
+    return SQLiteGenerationCache(str(tmp_path / "cache.sqlite3"), **kwargs)
+
+
+def test_sqlite_round_trip(clock, tmp_path):
+    cache = _sqlite(tmp_path)
+    assert cache.get("k") is None
+    cache.put(
+        "k",
+        CachedResult(generated_code="<div>hi</div>", elements_json=[{"type": "card"}], source="gemini"),
+    )
+    got = cache.get("k")
+    assert got.generated_code == "<div>hi</div>"
+    assert got.elements_json == [{"type": "card"}]
+    assert got.source == "gemini"
+    assert cache.size == 1
+
+
+def test_sqlite_is_shared_and_survives_reopen(clock, tmp_path):
+    """A second instance on the same file stands in for another worker, or
+    the same worker after a restart."""
+    first = _sqlite(tmp_path)
+    first.put("k", _result("shared"))
+    second = _sqlite(tmp_path)
+    assert second.get("k").generated_code == "shared"
+
+
+def test_sqlite_stores_code_compressed(clock, tmp_path):
+    cache = _sqlite(tmp_path)
+    code = "<div class='card'>hello</div>\n" * 500
+    cache.put("k", _result(code))
+    assert cache.size_bytes < len(code) // 10
+    assert cache.get("k").generated_code == code
+
+
+def test_sqlite_ttl_expiry(clock, tmp_path):
+    cache = _sqlite(tmp_path, ttl_seconds=60)
+    cache.put("k", _result())
+    clock.advance(61)
+    assert cache.get("k") is None
+    assert cache.size == 0
+
+
+def test_sqlite_lru_by_entry_count(clock, tmp_path):
+    cache = _sqlite(tmp_path, max_size=2)
+    cache.put("a", _result("a"))
+    clock.advance(1)
+    cache.put("b", _result("b"))
+    clock.advance(1)
+    cache.get("a")  # a is now more recent than b
+    clock.advance(1)
+    cache.put("c", _result("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_sqlite_lru_by_bytes(clock, tmp_path):
+    import os as _os
+
+    cache = _sqlite(tmp_path, max_size=100, max_bytes=1500)
+    # Random hex compresses ~2x only, so each entry is ~550 bytes on disk.
+    for i in range(5):
+        cache.put(f"k{i}", _result(_os.urandom(512).hex()))
+        clock.advance(1)
+    assert cache.size_bytes <= 1500
+    assert cache.get("k4") is not None
+    assert cache.get("k0") is None
+
+
+def test_sqlite_hit_does_not_wait_on_another_writer(clock, tmp_path):
+    import sqlite3
+    import time
+
+    cache = _sqlite(tmp_path)
+    cache.put("k", _result("cached"))
+    other = sqlite3.connect(str(tmp_path / "cache.sqlite3"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")  # another worker mid-put
+    try:
+        start = time.monotonic()
+        assert cache.get("k").generated_code == "cached"
+        assert time.monotonic() - start < 1.0
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+
+def test_metrics_counts_the_sqlite_cache_off_the_event_loop(clock, tmp_path, monkeypatch):
+    import asyncio
+    import threading
+
+    import main
+    from app.utils.response_cache import SQLiteGenerationCache
+
+    class Spy(SQLiteGenerationCache):
+        @property
+        def size(self):
+            threads.append(threading.current_thread() is threading.main_thread())
+            return super().size
+
+    threads = []
+    monkeypatch.setattr(main, "generation_cache", Spy(str(tmp_path / "spy.sqlite3")))
+    section = asyncio.run(main.metrics())["generation_cache"]
+    assert section == {"backend": "Spy", "size": 0}
+    assert threads == [False]
+
+
+def test_sqlite_bad_config_raises(tmp_path):
+    with pytest.raises(ValueError):
+        _sqlite(tmp_path, max_bytes=0)
@@ -0,0 +1,273 @@
+"""Tests for the pooled Roboflow clients and the async retry loop.
+
+The hosted protocol is exercised against a local aiohttp server standing in
+for detect.roboflow.com; the retry tests use a fake client so they can count
+attempts and see the payload each one was given.
+"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from aiohttp import web
+from PIL import Image
+
+from app.models import inference
+from app.models.detector_ladder import DetectorLadder
+from app.models.roboflow_clients import (
+    RoboflowClient,
+    RoboflowClients,
+    RoboflowHTTPError,
+    encode_image,
+)
+from app.utils.cancellation import CallCancelled, CancellationToken
+
+
+class _StubbedClients(RoboflowClients):
+    def __init__(self):
+        super().__init__()
+        self.built = []
+
+    def _make_client(self, api_url, api_key, model_id):
+        client = super()._make_client(api_url, api_key, model_id)
+        self.built.append(client)
+        return client
+
+
+def test_one_client_per_endpoint_is_reused():
+    clients = _StubbedClients()
+
+    async def scenario():
+        return [
+            clients.client("https://detect.roboflow.com", key, "proj/1")
+            for key in ("k1", "k2", "k1")
+        ]
+
+    a1, b1, a2 = asyncio.run(scenario())
+    assert a1 is a2 and a1 is not b1
+    assert len(clients.built) == 2
+    assert a1.hosted
+
+
+def test_client_is_rebuilt_on_a_new_loop():
+    clients = _StubbedClients()
+
+    async def scenario():
+        return clients.client("https://detect.roboflow.com", "k1", "proj/1")
+
+    first = asyncio.run(scenario())
+    second = asyncio.run(scenario())
+    assert first is not second
+    assert len(clients) == 1
+
+
+def test_close_loop_clients_closes_sessions():
+    clients = RoboflowClients()
+
+    async def scenario():
+        client = clients.client("https://detect.roboflow.com", "k1", "proj/1")
+        session = client._http()
+        await clients.close_loop_clients()
+        return session
+
+    session = asyncio.run(scenario())
+    assert session.closed
+    assert len(clients) == 0
+
+
+def test_self_hosted_url_is_not_spoken_to_directly():
+    assert not RoboflowClient("http://localhost:9001", "k", "proj/1").hosted
+    assert RoboflowClient("https://detect.roboflow.com/", "k", "proj/1").hosted
+
+
+def test_encode_image_is_the_jpeg_roboflow_receives():
+    payload = encode_image(Image.new("RGB", (32, 16), (255, 255, 255)))
+    decoded = Image.open(io.BytesIO(base64.b64decode(payload)))
+    assert decoded.format == "JPEG"
+    assert decoded.size == (32, 16)
+
+
+def _hosted_client(base_url):
+    client = RoboflowClient(base_url, "secret", "proj/3")
+    client.hosted = True  # speak the hosted protocol to the local stand-in
+    return client
+
+
+def test_hosted_protocol_reuses_one_connection():
+    seen = []
+
+    async def handler(request):
+        seen.append(
+            {
+                "path": request.path,
+                "query": dict(request.query),
+                "body": await request.text(),
+                "peer": request.transport.get_extra_info("peername"),
+            }
+        )
+        if request.query.get("confidence") == "0.9":
+            return web.Response(status=403, text="forbidden: out of credits")
+        return web.json_response({"predictions": []})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/proj/3", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = _hosted_client(f"http://127.0.0.1:{port}")
+        try:
+            results = [
+                await client.infer("AAAA", confidence=0.05, timeout=5.0) for _ in range(3)
+            ]
+            with pytest.raises(RoboflowHTTPError) as excinfo:
+                await client.infer("AAAA", confidence=0.9, timeout=5.0)
+            return results, excinfo.value
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    results, error = asyncio.run(scenario())
+    assert results == [{"predictions": []}] * 3
+    assert error.status == 403
+    assert "secret" not in str(error)
+    assert seen[0]["path"] == "/proj/3"
+    assert seen[0]["query"] == {"api_key": "secret", "confidence": "0.05"}
+    assert seen[0]["body"] == "AAAA"
+    assert len({call["peer"] for call in seen}) == 1  # kept alive, not reconnected
+
+
+class _FlakyClient:
+    model_id = "proj/1"
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.payloads = []
+        self.timeouts = []
+
+    async def infer(self, image_b64, *, confidence, timeout=None):
+        self.payloads.append(image_b64)
+        self.timeouts.append(timeout)
+        if self.failures:
+            raise self.failures.pop(0)
+        return {"predictions": [{"class": "card"}]}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record backoff delays instead of sleeping through them."""
+    recorded = []
+
+    async def fake_sleep(delay):
+        recorded.append(delay)
+
+    monkeypatch.setattr(inference.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(inference, "roboflow_ladder", DetectorLadder())
+    monkeypatch.setenv("ROBOFLOW_MAX_RETRIES", "3")
+    return recorded
+
+
+def _infer(client, **kwargs):
+    return asyncio.run(inference._infer_roboflow(client, "PAYLOAD", confidence=0.05, **kwargs))
+
+
+def test_retries_reuse_the_encoded_payload_with_backoff(sleeps):
+    client = _FlakyClient([RuntimeError("502"), RuntimeError("502")])
+    assert _infer(client) == {"predictions": [{"class": "card"}]}
+    assert client.payloads == ["PAYLOAD"] * 3
+    assert sleeps == [1.0, 2.0]
+
+
+def test_auth_failure_is_not_retried(sleeps):
+    client = _FlakyClient([RoboflowHTTPError(403, "forbidden")])
+    assert _infer(client) is None
+    assert len(client.payloads) == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries(sleeps):
+    client = _FlakyClient([RuntimeError("502")] * 5)
+    assert _infer(client) is None
+    assert len(client.payloads) == 3
+
+
+def test_deadline_bounds_timeout_and_skips_hopeless_retry(sleeps):
+    client = _FlakyClient([RuntimeError("502")])
+    assert _infer(client, cancel_token=CancellationToken(0.5)) is None
+    assert len(client.payloads) == 1
+    assert 0 < client.timeouts[0] <= 0.5
+    assert sleeps == []
+
+
+def test_cancelled_token_makes_no_call(sleeps):
+    client = _FlakyClient([])
+    token = CancellationToken()
+    token.cancel()
+    with pytest.raises(CallCancelled):
+        _infer(client, cancel_token=token)
+    assert client.payloads == []
+
+
+class _PayloadSizedClient:
+    """Answers in the pixel space of the payload it was sent, like Roboflow:
+    one navbar across the top tenth of the image."""
+
+    model_id = "proj/1"
+
+    def __init__(self):
+        self.sizes = []
+
+    async def infer(self, image_b64, *, confidence, timeout=None):
+        width, height = Image.open(io.BytesIO(base64.b64decode(image_b64))).size
+        self.sizes.append((width, height))
+        navbar = {
+            "class": "navbar",
+            "confidence": 0.9,
+            "x": width / 2,
+            "y": height / 20,
+            "width": width * 0.9,
+            "height": height / 10,
+        }
+        return {"predictions": [navbar], "image": {"width": width, "height": height}}
+
+
+def _detect_canvas(monkeypatch, size):
+    client = _PayloadSizedClient()
+    monkeypatch.setattr(inference, "_roboflow_clients", type("C", (), {"client": lambda *a: client})())
+    monkeypatch.setattr(inference, "roboflow_ladder", DetectorLadder())
+    monkeypatch.setenv("ROBOFLOW_MODELS", "proj/1")
+    buf = io.BytesIO()
+    Image.new("RGB", size, (255, 255, 255)).save(buf, format="PNG")
+    sketch = base64.b64encode(buf.getvalue()).decode()
+    output = asyncio.run(inference.detect_with_roboflow_async(sketch, size, api_key="k"))
+    return client, output
+
+
+def test_downscaled_upload_reports_boxes_in_original_pixels(monkeypatch):
+    monkeypatch.setenv("ROBOFLOW_MAX_SIDE", "640")
+    client, output = _detect_canvas(monkeypatch, (2000, 1200))
+    assert client.sizes == [(640, 384)]
+    meta = output.metadata
+    assert (meta["image_width"], meta["image_height"]) == (2000, 1200)
+    assert meta["roboflow_upload_size"] == [640, 384]
+    bounds = output.elements[0].bounds
+    assert bounds["x"] == pytest.approx(100) and bounds["y"] == pytest.approx(0)
+    assert bounds["width"] == pytest.approx(1800) and bounds["height"] == pytest.approx(120)
+
+
+@pytest.mark.parametrize("max_side", ["", "4000"])
+def test_upload_is_untouched_when_off_or_already_small(monkeypatch, max_side):
+    monkeypatch.setenv("ROBOFLOW_MAX_SIDE", max_side)
+    client, output = _detect_canvas(monkeypatch, (2000, 1200))
+    assert client.sizes == [(2000, 1200)]
+    assert "roboflow_upload_size" not in output.metadata
+
+
+def test_max_side_keys_the_detection_cache(monkeypatch):
+    monkeypatch.delenv("ROBOFLOW_MAX_SIDE", raising=False)
+    off = inference.roboflow_detection_settings()
+    monkeypatch.setenv("ROBOFLOW_MAX_SIDE", "640")
+    assert inference.roboflow_detection_settings() != off
@@ -0,0 +1,160 @@
+"""Tests for single-flight coalescing of identical in-flight AI calls.
+
+The coalescer is event-loop local, so each test drives its own loop with
+asyncio.run (no pytest-asyncio dependency). The flight keys for /api/detect
+and /api/fidelity are pure helpers in main.py and are checked directly.
+"""
+
+import asyncio
+
+import pytest
+
+from app.utils.single_flight import SingleFlight
+from main import DetectedElement, _detect_flight_key, _fidelity_flight_key
+
+
+def test_concurrent_duplicates_share_one_call():
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        flight = SingleFlight("t")
+        results = await asyncio.gather(*(flight.do("k", work) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(scenario())
+    assert calls == 1
+    assert [r for r, _ in results] == ["result"] * 5
+    assert [shared for _, shared in results] == [False, True, True, True, True]
+    assert flight.metrics() == {"inflight": 0, "leaders": 1, "followers": 4}
+
+
+def test_different_keys_run_independently():
+    calls = []
+
+    async def scenario():
+        flight = SingleFlight("t")
+
+        def work(tag):
+            async def _run():
+                calls.append(tag)
+                await asyncio.sleep(0)
+                return tag
+            return _run
+
+        return await asyncio.gather(flight.do("a", work("a")), flight.do("b", work("b")))
+
+    results = asyncio.run(scenario())
+    assert sorted(calls) == ["a", "b"]
+    assert [r for r, _ in results] == ["a", "b"]
+
+
+def test_key_is_forgotten_after_completion():
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        return calls
+
+    async def scenario():
+        flight = SingleFlight("t")
+        first, _ = await flight.do("k", work)
+        second, shared = await flight.do("k", work)
+        return first, second, shared, flight.inflight
+
+    first, second, shared, inflight = asyncio.run(scenario())
+    assert (first, second) == (1, 2)
+    assert shared is False
+    assert inflight == 0
+
+
+def test_exception_propagates_to_every_waiter():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("gemini timed out")
+
+    async def scenario():
+        flight = SingleFlight("t")
+        return await asyncio.gather(
+            flight.do("k", work), flight.do("k", work), return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_cancelled_follower_does_not_cancel_shared_call():
+    async def work():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def scenario():
+        flight = SingleFlight("t")
+        leader = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0)
+        follower.cancel()
+        return await leader, follower
+
+    (result, shared), follower = asyncio.run(scenario())
+    assert result == "done"
+    assert shared is False
+    assert follower.cancelled()
+
+
+# ---------------------------------------------------------------------------
+# Flight keys
+# ---------------------------------------------------------------------------
+
+IMG = "data:image/png;base64,AAAA"
+
+
+def _el(cls="card", x=0.0):
+    return DetectedElement(
+        type=cls, confidence=0.9, bounds={"x": x, "y": 0, "width": 10, "height": 10}
+    )
+
+
+class TestDetectFlightKey:
+    def test_stable(self):
+        assert _detect_flight_key(IMG, "upload-photo") == _detect_flight_key(IMG, "upload-photo")
+
+    def test_source_changes_key(self):
+        assert _detect_flight_key(IMG, "upload-photo") != _detect_flight_key(IMG, "upload-clean")
+
+    def test_none_source_is_canvas(self):
+        assert _detect_flight_key(IMG, None) == _detect_flight_key(IMG, "canvas")
+
+    def test_image_changes_key(self):
+        assert _detect_flight_key(IMG, None) != _detect_flight_key(IMG + "B", None)
+
+    def test_canvas_size_changes_key(self):
+        # The shared output carries canvas_width/canvas_height in its metadata.
+        assert _detect_flight_key(IMG, None, (800, 600)) != _detect_flight_key(IMG, None, (1200, 600))
+
+
+class TestFidelityFlightKey:
+    @pytest.mark.parametrize(
+        "other",
+        [
+            ("<div>b</div>", "react", [_el()], 1000, 600),
+            ("<div>a</div>", "react", [_el(x=5.0)], 1000, 600),
+            ("<div>a</div>", "react", [_el()], 1200, 600),
+            ("<div>a</div>", "html", [_el()], 1000, 600),
+        ],
+    )
+    def test_inputs_change_key(self, other):
+        base = _fidelity_flight_key("<div>a</div>", "react", [_el()], 1000, 600)
+        assert base != _fidelity_flight_key(*other)
+
+    def test_stable(self):
+        a = _fidelity_flight_key("<div>a</div>", "react", [_el()], 1000, 600)
+        b = _fidelity_flight_key("<div>a</div>", "react", [_el()], 1000, 600)
+        assert a == b
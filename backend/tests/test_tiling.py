@@ -0,0 +1,235 @@
+"""Tests for tiled detection: the tile grid, the cross-tile merge and the
+tiled path through detect_with_roboflow_async."""
+
+import asyncio
+import base64
+import io
+import time
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.models import inference
+from app.utils.tiling import merge_tile_predictions, small_region_count, tile_grid
+from roboflow_fakes import use_contour_detector
+
+
+def _pred(cls, x0, y0, x1, y1, confidence=0.9):
+    return {
+        "class": cls,
+        "confidence": confidence,
+        "x": (x0 + x1) / 2,
+        "y": (y0 + y1) / 2,
+        "width": x1 - x0,
+        "height": y1 - y0,
+    }
+
+
+def _corners(prediction):
+    x, y, w, h = (prediction[k] for k in ("x", "y", "width", "height"))
+    return x - w / 2, y - h / 2, x + w / 2, y + h / 2
+
+
+def test_grid_covers_the_image_with_even_overlap():
+    tiles = tile_grid(3000, 2000, tile_size=1024)
+    xs = sorted({x for x, _, _, _ in tiles})
+    assert len(tiles) == len(xs) * len({y for _, y, _, _ in tiles})
+    assert xs[0] == 0 and max(x + w for x, _, w, _ in tiles) == 3000
+    assert max(y + h for _, y, _, h in tiles) == 2000
+    width = tiles[0][2]
+    assert width <= 1024
+    assert (xs[0] + width) - xs[1] == pytest.approx(0.25 * width, abs=2)
+
+
+def test_grid_grows_tiles_instead_of_exceeding_the_cap():
+    tiles = tile_grid(8000, 8000, tile_size=1024)
+    assert len(tiles) == 16
+    assert tiles[-1][0] + tiles[-1][2] == 8000
+
+
+def test_small_image_is_one_tile():
+    assert tile_grid(900, 700, tile_size=1024) == [(0, 0, 900, 700)]
+
+
+def test_navbar_cut_by_a_tile_edge_is_stitched():
+    tiles = [
+        ((0, 0, 1000, 1000), [_pred("navbar", 20, 20, 1000, 120)]),
+        ((750, 0, 1000, 1000), [_pred("navbar", 0, 22, 980, 118, 0.8)]),
+    ]
+    merged = merge_tile_predictions([], tiles, (1750, 1000), min_confidence=lambda cls: 0.5)
+    assert len(merged) == 1
+    assert _corners(merged[0]) == pytest.approx((20, 20, 1730, 120))
+    assert merged[0]["confidence"] == 0.9
+
+
+def test_bars_that_do_not_line_up_are_not_stitched():
+    tiles = [
+        ((0, 0, 1000, 1000), [_pred("section", 20, 20, 1000, 120)]),
+        ((750, 0, 1000, 1000), [_pred("section", 0, 300, 980, 900)]),
+    ]
+    merged = merge_tile_predictions([], tiles, (1750, 1000), min_confidence=lambda cls: 0.5)
+    assert len(merged) == 2
+
+
+def test_fragment_of_a_card_seen_whole_elsewhere_is_dropped():
+    tiles = [
+        ((0, 0, 1000, 1000), [_pred("card", 700, 400, 900, 500)]),
+        ((750, 0, 1000, 1000), [_pred("card", 0, 400, 150, 500)]),  # cut at x=750
+    ]
+    full = [_pred("card", 100, 100, 200, 200), _pred("card", 300, 100, 400, 200, 0.1)]
+    merged = merge_tile_predictions(full, tiles, (1750, 1000), min_confidence=lambda cls: 0.5)
+    assert sorted(_corners(p) for p in merged) == [(100, 100, 200, 200), (700, 400, 900, 500)]
+
+
+def test_density_counts_boxes_too_small_for_the_model_input():
+    page = np.full((2000, 2000), 255, dtype=np.uint8)
+    for i in range(12):
+        x = 100 + 150 * i
+        cv2.rectangle(page, (x, 1200), (x + 50, 1250), 0, 4)
+    cv2.rectangle(page, (100, 100), (1900, 900), 0, 6)
+    assert small_region_count(page) == 12
+
+
+def _page():
+    """3000x2000 page: a full-width navbar and 40 small cards."""
+    page = np.full((2000, 3000, 3), 255, dtype=np.uint8)
+    cv2.rectangle(page, (40, 40), (2960, 200), (0, 0, 0), 6)
+    for row in range(4):
+        for col in range(10):
+            x, y = 200 + col * 270, 600 + row * 300
+            cv2.rectangle(page, (x, y), (x + 60, y + 60), (0, 0, 0), 4)
+    buf = io.BytesIO()
+    Image.fromarray(page).save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    return use_contour_detector(monkeypatch)
+
+
+def _detect(sketch, size):
+    return asyncio.run(inference.detect_with_roboflow_async(sketch, size, api_key="k"))
+
+
+def test_tiles_recover_cards_the_full_image_loses(detector, monkeypatch):
+    monkeypatch.setenv("ROBOFLOW_TILING", "off")
+    whole = _detect(_page(), (3000, 2000))
+    assert [el.type for el in whole.elements] == ["navbar"]
+
+    monkeypatch.setenv("ROBOFLOW_TILING", "auto")
+    detector.sizes.clear()
+    tiled = _detect(_page(), (3000, 2000))
+    assert len(detector.sizes) == 13  # 4 x 3 tiles + the full pass
+    assert max(detector.sizes[0]) == 1024
+    types = [el.type for el in tiled.elements]
+    assert types.count("navbar") == 1 and types.count("card") == 40
+    navbar = tiled.elements[types.index("navbar")].bounds
+    assert navbar["x"] == pytest.approx(40, abs=8)
+    assert navbar["width"] == pytest.approx(2920, abs=16)
+    assert (tiled.metadata["image_width"], tiled.metadata["image_height"]) == (3000, 2000)
+    assert tiled.metadata["tiles"] == {"count": 12, "failed": 0}
+
+
+def test_a_tiled_detection_is_one_ladder_outcome(detector, monkeypatch):
+    monkeypatch.setenv("ROBOFLOW_MAX_RETRIES", "1")
+    outcomes = []
+    ladder = inference.roboflow_ladder
+    monkeypatch.setattr(ladder, "record_success", lambda *a, **k: outcomes.append("success"))
+    monkeypatch.setattr(ladder, "record_failure", lambda *a, **k: outcomes.append("failure"))
+    infer = detector.infer
+
+    async def tiles_time_out(image_b64, **kwargs):
+        if detector.sizes:  # the full pass goes first
+            detector.sizes.append(None)
+            raise asyncio.TimeoutError()
+        return await infer(image_b64, **kwargs)
+
+    monkeypatch.setattr(detector, "infer", tiles_time_out)
+    tiled = _detect(_page(), (3000, 2000))
+    assert len(detector.sizes) == 13
+    assert tiled.metadata["tiles"] == {"count": 12, "failed": 12}
+    assert outcomes == ["success"]
+
+
+def _tiled_attempt(detector, budget_s=None):
+    prepared = inference._prepare_roboflow_image(_page(), None, False)
+    assert len(prepared.tiles) == 12
+    started = time.perf_counter()
+    result = asyncio.run(
+        inference._infer_tiled(
+            detector, prepared, 0.4, budget_s=budget_s, confidence=0.05, max_attempts=1
+        )
+    )
+    return result, time.perf_counter() - started
+
+
+def test_failed_full_pass_cancels_the_tiles(detector, monkeypatch):
+    cancelled = []
+
+    async def infer(image_b64, **kwargs):
+        if not cancelled and not detector.sizes:
+            detector.sizes.append("full")
+            raise RuntimeError("upstream 500")
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    monkeypatch.setattr(detector, "infer", infer)
+    result, seconds = _tiled_attempt(detector)
+    assert result is None and seconds < 1
+    assert len(cancelled) == 4  # every tile in flight (ROBOFLOW_TILE_CONCURRENCY)
+
+
+def test_fallback_tiled_attempt_keeps_to_the_rung_budget(detector, monkeypatch):
+    infer = detector.infer
+
+    async def slow_tiles(image_b64, **kwargs):
+        if detector.sizes:
+            await asyncio.sleep(5)
+        return await infer(image_b64, **kwargs)
+
+    monkeypatch.setattr(detector, "infer", slow_tiles)
+    result, seconds = _tiled_attempt(detector, budget_s=0.3)
+    assert result is None and seconds < 1
+
+
+def test_small_sparse_image_is_sent_whole(detector):
+    buf = io.BytesIO()
+    Image.new("RGB", (1600, 1000), (255, 255, 255)).save(buf, format="PNG")
+    _detect(base64.b64encode(buf.getvalue()).decode(), (1600, 1000))
+    assert detector.sizes == [(1600, 1000)]
+
+
+def test_text_on_the_page_is_not_read_as_small_boxes(detector):
+    """Letter counters (o, a, e, B, d) are holes in the ink too."""
+    page = np.full((1200, 2000, 3), 255, dtype=np.uint8)
+    cv2.rectangle(page, (40, 40), (1960, 160), (0, 0, 0), 4)  # navbar
+    cv2.rectangle(page, (40, 220), (1960, 1160), (0, 0, 0), 4)  # section
+    for i, line in enumerate((
+        "Good food, good mood. Book a table today and bring",
+        "a friend: deep-dish pizza, pasta and bread baked",
+        "fresh every morning. Open seven days a week.",
+    )):
+        cv2.putText(page, line, (100, 420 + 160 * i), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (0, 0, 0), 3)
+    assert small_region_count(page[:, :, 0]) == 0
+
+    buf = io.BytesIO()
+    Image.fromarray(page).save(buf, format="PNG")
+    _detect(base64.b64encode(buf.getvalue()).decode(), (2000, 1200))
+    assert len(detector.sizes) == 1
+
+
+def test_dense_page_below_the_size_trigger_is_tiled(monkeypatch):
+    monkeypatch.delenv("ROBOFLOW_TILING", raising=False)
+    page = np.full((1600, 2400), 255, dtype=np.uint8)
+    for i in range(16):
+        cv2.rectangle(page, (100 + 140 * i, 800), (140 + 140 * i, 840), 0, 3)
+    image = Image.fromarray(page)
+    assert len(inference._plan_tiles(image, inference.roboflow_tiling())) > 1
+    monkeypatch.setenv("ROBOFLOW_TILE_DENSITY", "50")
+    assert inference._plan_tiles(image, inference.roboflow_tiling()) == []
@@ -0,0 +1,139 @@
+"""Tests for vector-native detection from canvasData.
+
+The sketch PNG is a blank image of the size the frontend's export would
+produce for the drawing ((content bbox + 2 × 24px padding) × pixelRatio 2),
+so the rebuilt transform can be checked against known pixel coordinates.
+"""
+
+import base64
+import io
+
+from PIL import Image
+
+from app.models.vector_detector import detect_from_canvas, png_size
+
+
+def _rect(x, y, w, h, kind="rectangle", **extra):
+    return {"type": kind, "x": x, "y": y, "width": w, "height": h, "strokeWidth": 2, **extra}
+
+
+def _stroke(points, tool="pen"):
+    return {"tool": tool, "points": [c for p in points for c in p], "width": 2}
+
+
+def _outline(x, y, w, h, steps=6):
+    """A closed freehand rectangle: points along all four edges."""
+    pts = []
+    for i in range(steps):
+        pts.append((x + w * i / steps, y))
+    for i in range(steps):
+        pts.append((x + w, y + h * i / steps))
+    for i in range(steps):
+        pts.append((x + w - w * i / steps, y + h))
+    for i in range(steps):
+        pts.append((x, y + h - h * i / steps))
+    pts.append((x + 1, y + 1))
+    return pts
+
+
+def _png(width, height):
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (255, 255, 255)).save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+# Content bbox with the 1px half-stroke: (99, 99) – (901, 601) → 802 × 502.
+PAGE = [
+    _rect(100, 100, 800, 60),  # navbar
+    _rect(100, 200, 800, 300),  # section
+    _rect(120, 220, 200, 150),
+    _rect(350, 220, 200, 150),
+    _rect(580, 220, 200, 150, kind="button"),
+    _rect(100, 540, 800, 60),  # footer
+]
+PAGE_SIZE = ((802 + 48) * 2, (502 + 48) * 2)
+
+
+def _detect(canvas, size=PAGE_SIZE):
+    return detect_from_canvas(canvas, size)
+
+
+def test_png_size_reads_the_header_only():
+    assert png_size(_png(37, 21)) == (37, 21)
+    assert png_size("not a png") is None
+
+
+def test_page_layout_is_classified():
+    output = _detect({"shapes": PAGE})
+    assert output.source == "vector"
+    assert [e.type for e in output.elements] == [
+        "navbar", "section", "card", "card", "card", "footer",
+    ]
+    assert all(e.confidence >= 0.6 for e in output.elements)
+
+
+def test_boxes_land_in_png_pixel_space():
+    output = _detect({"shapes": PAGE})
+    navbar = output.elements[0]
+    # offset = 99 - 24 = 75, scale 2
+    assert navbar.bounds == {"x": 50.0, "y": 50.0, "width": 1600.0, "height": 120.0}
+    assert output.metadata["export_transform"] == {"offsetX": 75.0, "offsetY": 75.0, "scale": 2.0}
+
+
+def test_component_group_offsets_are_applied():
+    shapes = PAGE[:1] + PAGE[2:]
+    group = {"x": 100, "y": 200, "shapes": [_rect(0, 0, 800, 300)]}
+    output = _detect({"shapes": shapes, "componentGroups": [group]})
+    section = next(e for e in output.elements if e.type == "section")
+    assert (section.bounds["x"], section.bounds["y"]) == (50.0, 250.0)
+
+
+def test_closed_pen_stroke_is_a_card():
+    canvas = {"shapes": PAGE[:2] + PAGE[5:], "lines": [_stroke(_outline(120, 220, 200, 150))]}
+    output = _detect(canvas)
+    cards = [e for e in output.elements if e.type == "card"]
+    assert len(cards) == 1
+    assert cards[0].attributes["vector_origin"] == "stroke"
+
+
+def test_ink_inside_a_box_is_explained():
+    scribble = _stroke([(130, 240), (150, 230), (170, 250), (190, 232), (210, 248)])
+    output = _detect({"shapes": PAGE, "lines": [scribble]})
+    assert output is not None and len(output.elements) == 6
+
+
+def test_eraser_falls_back():
+    assert _detect({"shapes": PAGE, "lines": [_stroke([(130, 240), (140, 250)], tool="eraser")]}) is None
+
+
+def test_box_drawn_in_separate_strokes_falls_back():
+    edges = [
+        _stroke([(120, 400), (300, 401), (400, 400)]),
+        _stroke([(400, 400), (401, 440), (400, 480)]),
+    ]
+    assert _detect({"shapes": PAGE, "lines": edges}) is None
+
+
+def test_rotated_shape_falls_back():
+    shapes = PAGE[:-1] + [_rect(100, 540, 800, 60, rotation=12)]
+    assert _detect({"shapes": shapes}) is None
+
+
+def test_values_that_do_not_parse_fall_back():
+    bad_line = {**_stroke(_outline(120, 400, 200, 80)), "width": "none"}
+    for canvas in (
+        {"shapes": PAGE[:-1] + [_rect(100, 540, 800, 60, rotation="none")]},
+        {"shapes": PAGE[:-1] + [_rect(100, 540, 800, 60, strokeWidth=[2])]},
+        {"shapes": PAGE, "componentGroups": [{"x": "none", "shapes": PAGE[:1]}]},
+        {"shapes": PAGE, "lines": [bad_line]},
+    ):
+        assert _detect(canvas) is None
+
+
+def test_png_that_does_not_match_the_drawing_falls_back():
+    assert _detect({"shapes": PAGE}, size=(1700, 600)) is None
+    assert _detect({"shapes": PAGE}, size=None) is None
+
+
+def test_confidence_gate():
+    assert detect_from_canvas({"shapes": PAGE}, PAGE_SIZE, min_confidence=0.99) is None